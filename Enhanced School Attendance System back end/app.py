@@ -1,18 +1,58 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
+import click
 import psycopg2
 from dotenv import load_dotenv
 import os
 import psycopg2.extras
 from psycopg2.extras import execute_values
+import openpyxl
+import qrcode
+import qrcode.image.svg
+from PIL import Image, ImageDraw, ImageFont
 from datetime import timezone, datetime, timedelta, date
-from functools import wraps # Import wraps for the decorator
+from collections import OrderedDict
+import gzip
+import zlib
+import threading
+import hashlib
+import time
+import math
+import sqlite3
+import tempfile
+import csv
+import io
+import json
+import logging
+import logging.handlers
+import atexit
+import re
+import sys
+import zipfile
+from functools import wraps, lru_cache # Import wraps for the decorator
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from werkzeug.security import generate_password_hash, check_password_hash # Import these
 import jwt # Import PyJWT
 import secrets
+import random
+import select
+import signal
+import socket
+import ipaddress
+import queue
 from flask_cors import CORS
 from jwt.exceptions import InvalidTokenError, ExpiredSignatureError, DecodeError # *** Import specific exception classes ***
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token
+try:
+    import brotli # Optional: enables 'br' responses when installed
+except ImportError:
+    brotli = None
+try:
+    import msgpack # Optional: enables MessagePack-encoded columnar responses
+except ImportError:
+    msgpack = None
 # from sqlalchemy import text
 
 
@@ -21,12 +61,141 @@ app = Flask(__name__)
 CORS(app, resources={r"/admin/*": {"origins": ["http://localhost:5500", "https://your-frontend.onrender.com"]}})
 
 
+# --- Logging ---
+# Everything goes through the 'esas' logger instead of print(). The calling thread only filters a record and puts it
+# on a bounded in-memory queue; a listener thread formats and writes it, so a slow stdout or log collector never
+# blocks a gunicorn worker. When the queue is full, records are dropped and counted rather than waited for. Records
+# logged during a request carry its correlation ID (the caller's X-Request-ID when it looks sane, otherwise a new
+# one; echoed back on the response), method and route. High-volume events pass extra={'sample': LOG_SAMPLE_RATE}
+# and only that fraction is kept. LOG_FORMAT=json (default) writes one JSON object per line; LOG_FORMAT=text is for
+# reading in a terminal.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01)) # Fraction of high-volume events kept
+REQUEST_ID_HEADER = 'X-Request-ID'
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+_STANDARD_LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record: timestamp, level, logger, message, extra fields and traceback."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_LOG_RECORD_FIELDS and value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LogContextFilter(logging.Filter):
+    """Runs on the calling thread: drops unsampled high-volume records and stamps the rest with request context."""
+
+    def filter(self, record):
+        rate = getattr(record, 'sample', None)
+        if rate is not None and random.random() >= rate:
+            return False
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule is not None else request.path
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records without ever blocking and writes them to `target` from a listener thread in each process."""
+
+    def __init__(self, target):
+        super().__init__(queue.Queue(LOG_QUEUE_SIZE))
+        self.target = target
+        self._listener_pid = None
+
+    def prepare(self, record):
+        # Render the message and traceback now, while args are still what was logged; keep them apart for JSON
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._listener_pid != os.getpid():
+            self.start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            count_metric('esas_log_records_dropped_total')
+
+    def start_listener(self):
+        with self.lock:
+            if self._listener_pid == os.getpid():
+                return
+            self.queue = queue.Queue(LOG_QUEUE_SIZE) # A fresh queue after forking: the parent's locks may be held
+            listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop) # Flushes what is still queued (CLI commands, worker shutdown)
+            self._listener_pid = os.getpid()
+
+
+def configure_logging():
+    """Sets up the 'esas' logger; safe to call more than once."""
+    logger = logging.getLogger('esas')
+    if logger.handlers:
+        return logger
+    target = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'text':
+        target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(message)s', defaults={'request_id': '-'}))
+    else:
+        target.setFormatter(JsonLogFormatter())
+    handler = NonBlockingQueueHandler(target)
+    handler.addFilter(LogContextFilter())
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    return logger
+
+
+log = configure_logging()
+
+
+@app.before_request
+def assign_request_id():
+    supplied = request.headers.get(REQUEST_ID_HEADER, '')
+    g.request_id = supplied if REQUEST_ID_PATTERN.fullmatch(supplied) else secrets.token_hex(8)
+
+
+@app.after_request
+def echo_request_id(response):
+    if 'request_id' in g:
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+# --- Logging Ends Here ---
+
+
 SECRET_KEY = os.environ.get('SECRET_KEY', '@CyberBles0987654321')
 app.config['SECRET_KEY'] = SECRET_KEY # Optional: add to Flask config
+# Upper bound on any request body (uploads included); larger requests get 413 before the body is read
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 32 * 1024 * 1024))
+
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    return jsonify({"error": f"Request body too large. The limit is {app.config['MAX_CONTENT_LENGTH']} bytes."}), 413
 
 
 # # Database connection details (using environment variables for security)
-print(f"DB_PORT from env: {os.getenv('DB_PORT')}")
+log.debug("DB_PORT from env: %s", os.getenv('DB_PORT'))
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = int(os.getenv("DB_PORT"))
 DB_NAME = os.getenv("DB_NAME")
@@ -41,7 +210,7 @@ if database_url:
     # We replace 'postgresql://' with 'postgresql+psycopg2://' to tell SQLAlchemy
     # to use the psycopg2 driver. Ensure psycopg2-binary is installed (pip install psycopg2-binary).
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url.replace('postgresql://', 'postgresql+psycopg2://')
-    print("Using DATABASE_URL for SQLAlchemy configuration.") # For debugging
+    log.info("Using DATABASE_URL for SQLAlchemy configuration.")
 
 else:
     # Fallback for local development if DATABASE_URL is NOT set
@@ -56,10 +225,10 @@ else:
     # We also include the driver +psycopg2 here
     if local_db_user and local_db_pass and local_db_host and local_db_port and local_db_name:
          app.config['SQLALCHEMY_DATABASE_URI'] = f"postgresql+psycopg2://{local_db_user}:{local_db_pass}@{local_db_host}:{local_db_port}/{local_db_name}"
-         print("DATABASE_URL not set, using local DB configuration from .env.") # For debugging
+         log.info("DATABASE_URL not set, using local DB configuration from .env.")
     else:
          # If neither DATABASE_URL nor local DB variables are fully set
-         print("WARNING: DATABASE_URL not set and local DB config missing. Database features may not work.")
+         log.warning("DATABASE_URL not set and local DB config missing. Database features may not work.")
          # Set URI to None or a dummy value - SQLAlchemy will raise an error if you try to use db without a valid URI
          app.config['SQLALCHEMY_DATABASE_URI'] = None
 
@@ -83,6 +252,1294 @@ db = SQLAlchemy(app)
 # # db = SQLAlchemy(app) # Initialize SQLAlchemy after config
 
 
+######################################################################################################################################################
+
+# --- Response Compression ---
+# Some deployments run gunicorn with no proxy in front, so the app negotiates gzip/brotli itself.
+# Small bodies go out as-is, streamed bodies are compressed chunk by chunk, and buffered GET responses
+# get a weak ETag so repeat loads of the hot lists can reuse already-compressed bytes (or get a 304).
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)) # Bytes; smaller bodies are not worth the CPU
+GZIP_COMPRESS_LEVEL = int(os.environ.get('GZIP_COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5)) # 4-6 is the usual sweet spot for dynamic responses
+COMPRESSED_CACHE_MAX_BYTES = int(os.environ.get('COMPRESSED_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'text/csv', 'text/plain', 'text/html', 'text/css',
+    'application/javascript', 'image/svg+xml',
+}
+
+_compressed_body_cache = OrderedDict() # (etag, encoding) -> compressed bytes, oldest first
+_compressed_body_cache_bytes = 0
+_compressed_body_cache_lock = threading.Lock()
+
+
+def negotiate_content_encoding():
+    """Returns 'br', 'gzip' or None for the current request, honouring Accept-Encoding q-values."""
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compress_body(body, encoding):
+    """Compresses a complete response body with the negotiated encoding."""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_COMPRESS_LEVEL, mtime=0) # mtime=0 keeps output stable for caching
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compresses a streamed body incrementally.
+    The wrapped iterable is closed when the client goes away so generators holding cursors can clean up.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, 31) # wbits=31 -> gzip container
+        compress, finish = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            output = compress(chunk)
+            if output:
+                yield output
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def get_cached_compressed_body(cache_key):
+    with _compressed_body_cache_lock:
+        compressed = _compressed_body_cache.get(cache_key)
+        if compressed is not None:
+            _compressed_body_cache.move_to_end(cache_key)
+        return compressed
+
+
+def cache_compressed_body(cache_key, compressed):
+    """Stores compressed bytes, evicting least recently used entries past COMPRESSED_CACHE_MAX_BYTES."""
+    global _compressed_body_cache_bytes
+    if len(compressed) > COMPRESSED_CACHE_MAX_BYTES // 4:
+        return # One huge export should not flush every hot list out of the cache
+    with _compressed_body_cache_lock:
+        previous = _compressed_body_cache.pop(cache_key, None)
+        if previous is not None:
+            _compressed_body_cache_bytes -= len(previous)
+        _compressed_body_cache[cache_key] = compressed
+        _compressed_body_cache_bytes += len(compressed)
+        while _compressed_body_cache_bytes > COMPRESSED_CACHE_MAX_BYTES:
+            _, evicted = _compressed_body_cache.popitem(last=False)
+            _compressed_body_cache_bytes -= len(evicted)
+
+
+@app.after_request
+def compress_response(response):
+    """Negotiates gzip/brotli for compressible responses and adds ETag/Vary headers for buffered GETs."""
+    # Lets the admin frontend read transfer vs decoded sizes through the Resource Timing API
+    response.headers.setdefault('Timing-Allow-Origin', '*')
+
+    if request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    if 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    if 'no-transform' in response.headers.get('Cache-Control', ''):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_content_encoding()
+
+    # --- Streamed bodies (generators): compress on the fly, length is unknown up front ---
+    if response.is_streamed:
+        if encoding:
+            response.response = compress_chunks(response.response, encoding)
+            response.direct_passthrough = False
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    # --- Buffered bodies: tag successful GETs so browsers revalidate instead of re-downloading ---
+    if request.method == 'GET' and response.status_code == 200:
+        if response.get_etag()[0] is None:
+            response.add_etag(weak=True) # Weak: the same tag covers the gzip, br and identity variants
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    if not encoding:
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return response
+
+    etag = response.get_etag()[0]
+    cache_key = (etag, encoding) if etag else None
+    compressed = get_cached_compressed_body(cache_key) if cache_key else None
+    if compressed is None:
+        compressed = compress_body(body, encoding)
+        if cache_key:
+            cache_compressed_body(cache_key, compressed)
+
+    if len(compressed) >= len(body):
+        return response # Already-dense payloads are cheaper to send as they are
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+# --- Response Compression Ends Here ---
+
+
+######################################################################################################################################################
+
+# --- Request Metrics ---
+# Per-route latency histograms and status counts, plus the number of SQL statements and the database time each
+# request spent, exposed in Prometheus text format on GET /metrics. Routes open connections through connect_db(),
+# whose connections hand out cursors that time execute()/executemany()/copy_expert() and add to the current request's
+# totals; that includes RealDictCursor and named cursors. There is no connection pool (each request connects), so the
+# time spent waiting for a connection is measured as connect time; waits on the password verification pool are
+# measured in verify_password(). Metrics are plain in-process counters behind one lock. Under gunicorn each worker
+# keeps its own, so when METRICS_DIR is set every worker writes a snapshot there every METRICS_FLUSH_SECONDS and
+# /metrics sums the snapshots of all workers. Snapshot files are named after the pid plus a random per-process ID, so a
+# recycled pid never overwrites a dead worker's file. Files that stop being refreshed for METRICS_STALE_SECONDS belong
+# to dead workers; the next scrape folds them into base.json and deletes them, so totals never go back and the
+# directory does not grow with every worker recycle.
+# Scraping requires METRICS_TOKEN as a bearer token. Without a token configured, /metrics only answers direct
+# (not proxied) requests from the loopback interface, e.g. a Prometheus agent on the same machine.
+METRICS_DIR = os.environ.get('METRICS_DIR') # Shared by the workers of one deployment; unset = this process only
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+METRICS_STALE_SECONDS = float(os.environ.get('METRICS_STALE_SECONDS', max(60, 10 * METRICS_FLUSH_SECONDS)))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SQL_STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250, 1000)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'esas_http_requests_total': ('counter', "HTTP requests by route, method and status.", None),
+    'esas_http_request_duration_seconds': ('histogram', "Time to produce the response, by route.", LATENCY_BUCKETS),
+    'esas_http_request_sql_statements': ('histogram', "SQL statements executed per request, by route.", SQL_STATEMENT_BUCKETS),
+    'esas_http_request_db_seconds': ('histogram', "Time spent in SQL statements per request, by route.", LATENCY_BUCKETS),
+    'esas_db_connect_seconds': ('histogram', "Time spent waiting for a new database connection.", LATENCY_BUCKETS),
+    'esas_password_verify_seconds': ('histogram', "Password checks including the wait for the verification pool.", LATENCY_BUCKETS),
+    'esas_log_records_dropped_total': ('counter', "Log records dropped because the log queue was full.", None),
+}
+
+_metrics = {} # (name, labels) -> count (counters) or [per-bucket counts..., +Inf count, sum] (histograms)
+_metrics_lock = threading.Lock()
+_metrics_flusher_pid = None
+_metrics_instance = None # (pid, random ID) naming this process's snapshot file
+
+
+def count_metric(name, labels=(), amount=1):
+    """Adds to a counter; labels is a tuple of (label, value) pairs."""
+    with _metrics_lock:
+        _metrics[(name, labels)] = _metrics.get((name, labels), 0) + amount
+
+
+def observe_metric(name, value, labels=()):
+    """Records one observation in a histogram."""
+    buckets = METRICS[name][2]
+    index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+    with _metrics_lock:
+        series = _metrics.get((name, labels))
+        if series is None:
+            series = _metrics[(name, labels)] = [0] * (len(buckets) + 2)
+        series[index] += 1
+        series[-1] += value
+
+
+def record_sql_statement(cursor, query, params, duration, succeeded):
+    """Adds one statement to the current request's SQL totals and hands slow ones to the slow query log."""
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + duration
+    if 0 < SLOW_QUERY_THRESHOLD_MS <= duration * 1000:
+        try:
+            capture_slow_query(cursor, query, params, duration, succeeded)
+        except Exception as e:
+            log.warning("Could not capture slow query: %s", e) # Never fail the statement's caller
+
+
+class InstrumentedCursorMixin:
+    """Times statements run through a cursor; mixed into whichever cursor class the caller asked for."""
+
+    def _timed(self, query, params, run):
+        started = time.perf_counter()
+        succeeded = False
+        try:
+            result = run()
+            succeeded = True
+            return result
+        finally:
+            record_sql_statement(self, query, params, time.perf_counter() - started, succeeded)
+
+    def execute(self, query, vars=None):
+        return self._timed(query, vars, lambda: super(InstrumentedCursorMixin, self).execute(query, vars))
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        return self._timed(query, {"rows": len(vars_list)}, lambda: super(InstrumentedCursorMixin, self).executemany(query, vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(sql, None, lambda: super(InstrumentedCursorMixin, self).copy_expert(sql, file, size))
+
+
+@lru_cache(maxsize=None)
+def instrumented_cursor_class(cursor_class):
+    return type(f"Instrumented{cursor_class.__name__}", (InstrumentedCursorMixin, cursor_class), {})
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        cursor_class = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = instrumented_cursor_class(cursor_class)
+        return super().cursor(*args, **kwargs)
+
+    def raw_cursor(self):
+        """A plain cursor whose statements are neither timed nor captured (used for EXPLAIN)."""
+        return super().cursor()
+
+
+def connect_db():
+    """Opens an instrumented connection to the application database."""
+    started = time.perf_counter()
+    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS,
+                            connection_factory=InstrumentedConnection)
+    observe_metric('esas_db_connect_seconds', time.perf_counter() - started)
+    return conn
+
+
+def metrics_snapshot_name():
+    """This process's snapshot file name, <pid>-<random>.json; a new one after forking."""
+    global _metrics_instance
+    if _metrics_instance is None or _metrics_instance[0] != os.getpid():
+        _metrics_instance = (os.getpid(), secrets.token_hex(4), False) # (pid, ID, written yet)
+    return f"{_metrics_instance[0]}-{_metrics_instance[1]}.json"
+
+
+def write_metrics_file(path, content):
+    fd, temp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w') as temp_file:
+        json.dump(content, temp_file)
+    os.replace(temp_path, path)
+
+
+def flush_metrics_snapshot():
+    """Writes this process's metrics to its snapshot file in METRICS_DIR, atomically."""
+    global _metrics_instance
+    path = os.path.join(METRICS_DIR, metrics_snapshot_name())
+    with _metrics_lock:
+        if _metrics_instance[2] and not os.path.exists(path):
+            # This worker stalled long enough to be folded into base.json as dead: those totals are counted there,
+            # so carry on from zero under a new file name instead of counting them twice
+            _metrics.clear()
+            _metrics_instance = None
+            path = os.path.join(METRICS_DIR, metrics_snapshot_name())
+        snapshot = [[name, [list(pair) for pair in labels], value] for (name, labels), value in _metrics.items()]
+        _metrics_instance = _metrics_instance[:2] + (True,)
+    write_metrics_file(path, snapshot)
+
+
+def start_metrics_flusher():
+    """Starts the snapshot thread once per process (so again in each gunicorn worker after forking)."""
+    global _metrics_flusher_pid
+    if not METRICS_DIR or _metrics_flusher_pid == os.getpid():
+        return
+    with _metrics_lock:
+        if _metrics_flusher_pid == os.getpid():
+            return
+        _metrics_flusher_pid = os.getpid()
+
+    def flush_forever():
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                flush_metrics_snapshot()
+            except OSError as e:
+                log.warning("Could not write metrics snapshot to %s: %s", METRICS_DIR, e)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    threading.Thread(target=flush_forever, name='metrics-flusher', daemon=True).start()
+
+
+def metrics_series(merged):
+    return [[name, [list(pair) for pair in labels], value] for (name, labels), value in merged.items()]
+
+
+def merge_metrics_snapshot(merged, snapshot):
+    """Adds a snapshot's series ([name, labels, value] lists) into the `merged` dict."""
+    for name, labels, value in snapshot:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        if isinstance(value, list):
+            total = merged.setdefault(key, [0] * len(value))
+            merged[key] = [a + b for a, b in zip(total, value)]
+        else:
+            merged[key] = merged.get(key, 0) + value
+
+
+def fold_dead_metrics_snapshots(base):
+    """
+    Adds the snapshots of workers that stopped flushing for METRICS_STALE_SECONDS to `base` and deletes them.
+    base.json is written with the folded file names before they are deleted, so a crash in between never counts a
+    file twice. Caller holds the fold lock.
+    """
+    now = time.time()
+    merged = {}
+    merge_metrics_snapshot(merged, base["metrics"])
+    folded = set(base["folded"])
+    dead = []
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith('.json') or filename == 'base.json':
+            continue
+        path = os.path.join(METRICS_DIR, filename)
+        try:
+            if now - os.path.getmtime(path) < METRICS_STALE_SECONDS:
+                continue
+            if filename not in folded:
+                with open(path) as snapshot_file:
+                    merge_metrics_snapshot(merged, json.load(snapshot_file))
+            dead.append(filename)
+        except (OSError, ValueError):
+            continue
+    if not dead:
+        return base
+    base_path = os.path.join(METRICS_DIR, 'base.json')
+    base = {"folded": sorted(folded | set(dead)), "metrics": metrics_series(merged)}
+    write_metrics_file(base_path, base)
+    for filename in dead:
+        try:
+            os.remove(os.path.join(METRICS_DIR, filename))
+        except OSError:
+            pass
+    base = {"folded": [], "metrics": base["metrics"]} # Every folded file is gone now
+    write_metrics_file(base_path, base)
+    return base
+
+
+def collect_metrics():
+    """This process's metrics, or the sum over every worker's snapshot (and base.json) when METRICS_DIR is set."""
+    if not METRICS_DIR:
+        with _metrics_lock:
+            return {key: list(value) if isinstance(value, list) else value for key, value in _metrics.items()}
+    import fcntl # POSIX only, like the gunicorn deployments METRICS_DIR is meant for
+    flush_metrics_snapshot() # Include this worker's latest numbers
+    with open(os.path.join(METRICS_DIR, 'fold.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX) # Scrapes fold and read one at a time, so none sees a half-done fold
+        try:
+            with open(os.path.join(METRICS_DIR, 'base.json')) as base_file:
+                base = json.load(base_file)
+        except (OSError, ValueError):
+            base = {"folded": [], "metrics": []} # No worker has died yet
+        try:
+            base = fold_dead_metrics_snapshots(base)
+        except OSError as e:
+            log.warning("Could not fold dead workers' metrics in %s: %s", METRICS_DIR, e)
+        merged = {}
+        merge_metrics_snapshot(merged, base["metrics"])
+        for filename in os.listdir(METRICS_DIR):
+            if not filename.endswith('.json') or filename == 'base.json' or filename in base["folded"]:
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, filename)) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue # Being replaced right now; its numbers are in the next scrape
+            merge_metrics_snapshot(merged, snapshot)
+    return merged
+
+
+def format_metric_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+
+
+def render_metrics(metrics):
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (series_name, labels), value in sorted(metrics.items()):
+            if series_name != name:
+                continue
+            if metric_type == 'counter':
+                lines.append(f"{name}{format_metric_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], value[:-1]):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_metric_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+@app.before_request
+def start_request_timer():
+    start_metrics_flusher()
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Runs before compression (after_request hooks run in reverse order), so it times producing the response."""
+    if request.path == '/metrics' or 'request_started' not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched' # Templates keep label counts bounded
+    labels = (('method', request.method), ('route', route))
+    count_metric('esas_http_requests_total', labels + (('status', str(response.status_code)),))
+    observe_metric('esas_http_request_duration_seconds', time.perf_counter() - g.request_started, labels)
+    observe_metric('esas_http_request_sql_statements', g.get('sql_statements', 0), labels)
+    observe_metric('esas_http_request_db_seconds', g.get('sql_seconds', 0.0), labels)
+    return response
+
+
+def is_direct_loopback_request():
+    """True for a request from this machine that did not come through a reverse proxy."""
+    if request.headers.get('X-Forwarded-For') or request.headers.get('Forwarded'):
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or '').is_loopback
+    except ValueError:
+        return False
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request, SQL and pool-wait metrics in Prometheus text format. Requires METRICS_TOKEN (or a local scraper)."""
+    if METRICS_TOKEN:
+        if not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+            return jsonify({"error": "Authentication required."}), 401
+    elif not is_direct_loopback_request():
+        return jsonify({"error": "Authentication required. Set METRICS_TOKEN to scrape metrics remotely."}), 401
+    return app.response_class(render_metrics(collect_metrics()), content_type='text/plain; version=0.0.4; charset=utf-8', headers={
+        "Cache-Control": "no-store"
+    })
+# --- Request Metrics Ends Here ---
+
+
+######################################################################################################################################################
+
+# --- Columnar Response Format ---
+# Large tabular endpoints accept ?format=columnar and return {"columns": [...], "row_count": n, "data": {column: [values...]}}
+# instead of a list of row objects, so keys are sent once and no per-row dict is built on the server.
+# Clients that send "Accept: application/msgpack" get the same structure MessagePack-encoded (when msgpack is installed).
+MSGPACK_MIMETYPE = 'application/msgpack'
+COMPRESSIBLE_MIMETYPES.add(MSGPACK_MIMETYPE)
+
+
+def wants_columnar_format():
+    """True when the caller asked for the columnar response shape (?format=columnar)."""
+    return request.args.get('format', '').lower() == 'columnar'
+
+
+def tabular_cursor_factory():
+    """Cursor factory for list routes: plain tuples for columnar output, dictionaries otherwise."""
+    return None if wants_columnar_format() else psycopg2.extras.RealDictCursor
+
+
+def _msgpack_default(value):
+    # Values msgpack cannot encode natively (dates, timestamps, numerics)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def columnar_response(cur):
+    """
+    Builds a columnar response from an executed (tuple) cursor.
+    Columns are transposed straight from the fetched tuples.
+    """
+    columns = [desc[0] for desc in cur.description]
+    rows = cur.fetchall()
+    if rows:
+        data = dict(zip(columns, zip(*rows)))
+    else:
+        data = {column: [] for column in columns}
+    payload = {"columns": columns, "row_count": len(rows), "data": data}
+
+    if msgpack is not None and request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        return app.response_class(msgpack.packb(payload, default=_msgpack_default, use_bin_type=True), mimetype=MSGPACK_MIMETYPE)
+    return jsonify(payload)
+# --- Columnar Response Format Ends Here ---
+
+
+######################################################################################################################################################
+
+# --- Support Tables ---
+# Tables owned by the app's own features (token revocation, background jobs, caches...) rather than the core schema.
+# Each feature registers its CREATE ... IF NOT EXISTS statements here. They are applied once per worker on first use,
+# or up front with `flask --app app init-db`.
+SUPPORT_TABLES_DDL = []
+_support_tables_ready = False
+_support_tables_lock = threading.Lock()
+
+
+def register_support_table(ddl):
+    """Registers an idempotent DDL statement (CREATE TABLE/INDEX IF NOT EXISTS ...) for ensure_support_tables()."""
+    SUPPORT_TABLES_DDL.append(ddl)
+
+
+def ensure_support_tables():
+    """Applies all registered support-table DDL once per process, on its own connection."""
+    global _support_tables_ready
+    if _support_tables_ready:
+        return
+    with _support_tables_lock:
+        if _support_tables_ready:
+            return
+        conn = connect_db()
+        try:
+            with conn.cursor() as cur:
+                for ddl in SUPPORT_TABLES_DDL:
+                    cur.execute(ddl)
+            conn.commit()
+            _support_tables_ready = True
+        finally:
+            conn.close()
+
+
+def soft_deleted_filter(entity_type, column):
+    """
+    SQL condition hiding soft-deleted rows, e.g. soft_deleted_filter('student', 's.student_id').
+    Tombstones live in pendingdeletions (see the Cascade Delete Engine); defined here so module-level SQL can use it.
+    """
+    return f"NOT EXISTS (SELECT 1 FROM pendingdeletions pd WHERE pd.entity_type = '{entity_type}' AND pd.entity_id = {column}::TEXT)"
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Creates the support tables used by the caching, revocation and job features."""
+    ensure_support_tables()
+    click.echo(f"Support tables ready ({len(SUPPORT_TABLES_DDL)} statements applied).")
+# --- Support Tables Ends Here ---
+
+######################################################################################################################################################
+
+# --- Background Job Queue ---
+# Long admin operations (imports, purges, rollovers...) are queued in the jobs table and executed by a separate worker
+# process (`flask --app app worker`, the 'worker' entry in the Procfile), so web requests only pay for one INSERT.
+# Workers claim the highest-priority ready job with FOR UPDATE SKIP LOCKED, so any number of them can share the table
+# without blocking each other. A claimed job holds a lease (locked_until) that a heartbeat thread extends while the
+# handler runs; if a worker dies, the lease runs out and another worker picks the job up again. A handler whose job
+# was taken over anyway (e.g. after a long database outage) learns so from JobContext.check_lease() and stops without
+# committing. Failed jobs are retried with exponential backoff until max_attempts; a job whose lease ran out on
+# its last attempt (the worker was OOM-killed, say) is marked failed with a "worker lost" error instead of being
+# reclaimed forever. Handlers register with @job_handler('type') and receive a JobContext.
+JOB_DEFAULT_PRIORITY = 100 # Lower numbers run first
+JOB_DEFAULT_MAX_ATTEMPTS = int(os.environ.get('JOB_DEFAULT_MAX_ATTEMPTS', 5))
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 300))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get('JOB_RETRY_BASE_SECONDS', 10))
+JOB_RETRY_MAX_SECONDS = float(os.environ.get('JOB_RETRY_MAX_SECONDS', 3600))
+JOB_WORKER_POLL_SECONDS = float(os.environ.get('JOB_WORKER_POLL_SECONDS', 5))
+JOB_PROGRESS_MIN_INTERVAL_SECONDS = float(os.environ.get('JOB_PROGRESS_MIN_INTERVAL_SECONDS', 1))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get('JOB_HEARTBEAT_SECONDS', max(JOB_LEASE_SECONDS / 5, 1)))
+# Development convenience: run a worker thread inside the web process when no separate worker is deployed
+JOB_INLINE_WORKER = os.environ.get('JOB_INLINE_WORKER', 'false').lower() == 'true'
+JOB_NOTIFY_CHANNEL = 'jobs_queued'
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id VARCHAR(32) PRIMARY KEY,
+        job_type VARCHAR(64) NOT NULL,
+        payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+        attachment BYTEA, -- Uploaded file for the job; workers may run on another machine than the web process
+        status VARCHAR(20) NOT NULL DEFAULT 'queued', -- queued, running, completed, failed
+        priority INTEGER NOT NULL DEFAULT 100,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        run_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        dedupe_key VARCHAR(128),
+        locked_by VARCHAR(128),
+        locked_until TIMESTAMP WITH TIME ZONE,
+        progress_current BIGINT,
+        progress_total BIGINT,
+        progress_message TEXT,
+        result JSONB,
+        last_error TEXT,
+        created_by VARCHAR(64),
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        started_at TIMESTAMP WITH TIME ZONE,
+        finished_at TIMESTAMP WITH TIME ZONE
+    );
+""")
+register_support_table("CREATE INDEX IF NOT EXISTS jobs_ready_idx ON jobs (priority, run_after) WHERE status = 'queued';")
+register_support_table("CREATE INDEX IF NOT EXISTS jobs_lease_idx ON jobs (locked_until) WHERE status = 'running';")
+# At most one queued job per dedupe key (e.g. a single pending purge however many soft deletes asked for one)
+register_support_table("CREATE UNIQUE INDEX IF NOT EXISTS jobs_dedupe_idx ON jobs (dedupe_key) WHERE status = 'queued';")
+
+JOB_HANDLERS = {}
+PERIODIC_TASKS = [] # (name, fn, every_seconds), run by `flask worker` next to the job threads
+_inline_worker_lock = threading.Lock()
+_inline_worker_started = False
+
+
+class JobFailed(Exception):
+    """Raised by a handler for failures that retrying cannot fix; the job is failed without further attempts."""
+
+
+class JobLeaseLost(Exception):
+    """Raised by JobContext.check_lease() once another worker has taken the job over; the handler must not commit."""
+
+
+def job_handler(job_type, max_attempts=None, priority=None):
+    """Registers the decorated function as the handler for `job_type`. It is called with a JobContext."""
+    def decorator(f):
+        JOB_HANDLERS[job_type] = {
+            'fn': f,
+            'max_attempts': max_attempts or JOB_DEFAULT_MAX_ATTEMPTS,
+            'priority': JOB_DEFAULT_PRIORITY if priority is None else priority,
+        }
+        return f
+    return decorator
+
+
+def periodic_task(every_seconds):
+    """Registers the decorated no-argument function to run every `every_seconds` in worker processes (0 disables it)."""
+    def decorator(f):
+        if every_seconds > 0:
+            PERIODIC_TASKS.append((f.__name__, f, every_seconds))
+        return f
+    return decorator
+
+
+def enqueue_job(cur, job_type, payload=None, created_by=None, priority=None, max_attempts=None,
+                attachment=None, dedupe_key=None, job_id=None, delay_seconds=0):
+    """
+    Queues a job on the caller's cursor (it becomes visible when the caller commits) and returns its job_id.
+    With a dedupe_key, returns the already queued job's ID instead of queuing a second one.
+    """
+    handler = JOB_HANDLERS[job_type]
+    job_id = job_id or secrets.token_hex(16)
+    cur.execute("""
+        INSERT INTO jobs (job_id, job_type, payload, attachment, priority, max_attempts, run_after, dedupe_key, created_by)
+        VALUES (%s, %s, %s, %s, %s, %s, NOW() + %s * INTERVAL '1 second', %s, %s)
+        ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+        RETURNING job_id;
+    """, (
+        job_id, job_type, psycopg2.extras.Json(payload or {}),
+        psycopg2.Binary(attachment) if attachment is not None else None,
+        handler['priority'] if priority is None else priority,
+        max_attempts or handler['max_attempts'], delay_seconds, dedupe_key,
+        str(created_by) if created_by is not None else None
+    ))
+    row = cur.fetchone()
+    if row is None:
+        cur.execute("SELECT job_id FROM jobs WHERE dedupe_key = %s AND status = 'queued';", (dedupe_key,))
+        row = cur.fetchone()
+        if row is None: # Claimed between the two statements; queue a fresh one
+            return enqueue_job(cur, job_type, payload, created_by, priority, max_attempts, attachment, None, job_id, delay_seconds)
+    cur.execute(f"NOTIFY {JOB_NOTIFY_CHANNEL};") # Delivered on commit; wakes idle workers
+    if JOB_INLINE_WORKER:
+        start_inline_job_worker()
+    return row[0]
+
+
+class JobContext:
+    """What a handler sees of its job: ID, payload, attachment, attempt number, a progress reporter and a lease check."""
+
+    def __init__(self, job_conn, job_id, job_type, payload, attachment, attempt, worker_id):
+        self.job_conn = job_conn # Autocommit connection used only for job bookkeeping (psycopg2 connections are thread safe)
+        self.job_id = job_id
+        self.job_type = job_type
+        self.payload = payload
+        self.attachment = attachment
+        self.attempt = attempt
+        self.worker_id = worker_id
+        self._last_progress_at = 0.0
+        self.lease_lost = threading.Event()
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def progress(self, current, total=None, message=None, force=False):
+        """
+        Records progress. Calls closer than JOB_PROGRESS_MIN_INTERVAL_SECONDS are dropped.
+        Raises JobLeaseLost if another worker has taken the job over.
+        """
+        self.check_lease()
+        now = time.monotonic()
+        if not force and now - self._last_progress_at < JOB_PROGRESS_MIN_INTERVAL_SECONDS:
+            return
+        self._last_progress_at = now
+        with self.job_conn.cursor() as cur:
+            cur.execute("""
+                UPDATE jobs
+                SET progress_current = %s, progress_total = COALESCE(%s, progress_total),
+                    progress_message = COALESCE(%s, progress_message),
+                    locked_until = NOW() + %s * INTERVAL '1 second'
+                WHERE job_id = %s AND locked_by = %s AND status = 'running';
+            """, (current, total, message, JOB_LEASE_SECONDS, self.job_id, self.worker_id))
+            if cur.rowcount == 0:
+                self.lease_lost.set()
+        self.check_lease()
+
+    def extend_lease(self):
+        """Pushes locked_until JOB_LEASE_SECONDS ahead; flags the lease as lost if this worker no longer holds the job."""
+        with self.job_conn.cursor() as cur:
+            cur.execute("""
+                UPDATE jobs SET locked_until = NOW() + %s * INTERVAL '1 second'
+                WHERE job_id = %s AND locked_by = %s AND status = 'running';
+            """, (JOB_LEASE_SECONDS, self.job_id, self.worker_id))
+            if cur.rowcount == 0:
+                self.lease_lost.set()
+
+    def check_lease(self):
+        """Raises JobLeaseLost once the job has been re-claimed by another worker. Call it before committing results."""
+        if self.lease_lost.is_set():
+            raise JobLeaseLost(f"Job {self.job_id} was taken over by another worker.")
+
+    def start_heartbeat(self):
+        """Extends the lease every JOB_HEARTBEAT_SECONDS until stop_heartbeat(), however long the handler runs."""
+        def beat():
+            while not self._heartbeat_stop.wait(JOB_HEARTBEAT_SECONDS):
+                try:
+                    self.extend_lease()
+                except psycopg2.Error as e:
+                    log.warning("Could not extend the lease of job %s: %s", self.job_id, e)
+                if self.lease_lost.is_set():
+                    log.warning("Job %s was taken over by another worker; its handler stops at the next lease check.", self.job_id)
+                    return
+        self._heartbeat_thread = threading.Thread(target=beat, name=f"job-heartbeat-{self.job_id}", daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self._heartbeat_stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+
+
+def job_retry_delay_seconds(attempt):
+    """Exponential backoff with jitter: base * 2^(attempt-1), capped, +/- 20%."""
+    delay = min(JOB_RETRY_BASE_SECONDS * (2 ** max(attempt - 1, 0)), JOB_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def claim_job(job_conn, worker_id, job_types=None):
+    """
+    Claims the next ready job (or one whose worker's lease expired) and returns its row, or None.
+    SKIP LOCKED makes concurrent workers pass over each other's candidate rows instead of waiting on them.
+    Expired jobs that have used up max_attempts are failed in the same statement rather than reclaimed.
+    """
+    with job_conn.cursor() as cur:
+        cur.execute("""
+            WITH lost AS (
+                UPDATE jobs
+                SET status = 'failed', finished_at = NOW(), locked_by = NULL, locked_until = NULL, attachment = NULL,
+                    last_error = 'Worker lost: the lease expired on the last attempt (' || attempts || '/' || max_attempts || ').'
+                WHERE job_id IN (
+                    SELECT job_id FROM jobs
+                    WHERE status = 'running' AND locked_until < NOW() AND attempts >= max_attempts
+                    FOR UPDATE SKIP LOCKED
+                )
+            )
+            UPDATE jobs j
+            SET status = 'running', attempts = j.attempts + 1, locked_by = %(worker_id)s,
+                locked_until = NOW() + %(lease)s * INTERVAL '1 second',
+                started_at = COALESCE(j.started_at, NOW())
+            WHERE j.job_id = (
+                SELECT job_id FROM jobs
+                WHERE ((status = 'queued' AND run_after <= NOW())
+                       OR (status = 'running' AND locked_until < NOW() AND attempts < max_attempts))
+                  AND (%(job_types)s::VARCHAR[] IS NULL OR job_type = ANY(%(job_types)s::VARCHAR[]))
+                ORDER BY priority, run_after, created_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING j.job_id, j.job_type, j.payload, j.attachment, j.attempts, j.max_attempts;
+        """, {'worker_id': worker_id, 'lease': JOB_LEASE_SECONDS, 'job_types': list(job_types) if job_types else None})
+        return cur.fetchone()
+
+
+def finish_job(job_conn, job_id, worker_id, result):
+    with job_conn.cursor() as cur:
+        cur.execute("""
+            UPDATE jobs
+            SET status = 'completed', result = %s, finished_at = NOW(), locked_by = NULL, locked_until = NULL,
+                attachment = NULL, progress_current = COALESCE(progress_total, progress_current)
+            WHERE job_id = %s AND locked_by = %s;
+        """, (psycopg2.extras.Json(result), job_id, worker_id))
+
+
+def fail_job(job_conn, job_id, worker_id, error, retry_in_seconds=None):
+    """Requeues the job after `retry_in_seconds`, or marks it failed for good when that is None."""
+    with job_conn.cursor() as cur:
+        if retry_in_seconds is None:
+            cur.execute("""
+                UPDATE jobs
+                SET status = 'failed', last_error = %s, finished_at = NOW(), locked_by = NULL, locked_until = NULL, attachment = NULL
+                WHERE job_id = %s AND locked_by = %s;
+            """, (error, job_id, worker_id))
+        else:
+            cur.execute("""
+                UPDATE jobs
+                SET status = 'queued', last_error = %s, run_after = NOW() + %s * INTERVAL '1 second',
+                    locked_by = NULL, locked_until = NULL
+                WHERE job_id = %s AND locked_by = %s;
+            """, (error, retry_in_seconds, job_id, worker_id))
+
+
+def run_one_job(job_conn, worker_id, job_types=None):
+    """Claims and runs a single job. Returns False when nothing was ready."""
+    claimed = claim_job(job_conn, worker_id, job_types)
+    if claimed is None:
+        return False
+    job_id, job_type, payload, attachment, attempt, max_attempts = claimed
+    handler = JOB_HANDLERS.get(job_type)
+    if handler is None:
+        fail_job(job_conn, job_id, worker_id, f"No handler registered for job type '{job_type}'.")
+        return True
+
+    context = JobContext(job_conn, job_id, job_type, payload, bytes(attachment) if attachment is not None else None, attempt, worker_id)
+    started = time.monotonic()
+    context.start_heartbeat()
+    try:
+        result = handler['fn'](context)
+    except JobLeaseLost as e:
+        log.warning("Job %s (%s) abandoned: %s", job_id, job_type, e) # The new holder records the outcome
+    except JobFailed as e:
+        log.error("Job %s (%s) failed: %s", job_id, job_type, e)
+        fail_job(job_conn, job_id, worker_id, str(e))
+    except Exception as e:
+        error = f"{type(e).__name__} - {e}"
+        if attempt >= max_attempts:
+            log.error("Job %s (%s) failed on attempt %s/%s, giving up: %s", job_id, job_type, attempt, max_attempts, error)
+            fail_job(job_conn, job_id, worker_id, error)
+        else:
+            delay = job_retry_delay_seconds(attempt)
+            log.warning("Job %s (%s) failed on attempt %s/%s, retrying in %.0fs: %s", job_id, job_type, attempt, max_attempts, delay, error)
+            fail_job(job_conn, job_id, worker_id, error, retry_in_seconds=delay)
+    else:
+        if context.lease_lost.is_set():
+            log.warning("Job %s (%s) finished after another worker had taken it over; its result was not recorded.", job_id, job_type)
+        else:
+            finish_job(job_conn, job_id, worker_id, result if result is not None else {})
+            log.info("Job %s (%s) completed in %.1fs.", job_id, job_type, time.monotonic() - started)
+    finally:
+        context.stop_heartbeat()
+    return True
+
+
+def run_job_worker(worker_id, job_types=None, stop_event=None, exit_when_idle=False):
+    """
+    Worker loop: runs jobs back to back while any are ready, otherwise sleeps until a NOTIFY from enqueue_job
+    or JOB_WORKER_POLL_SECONDS (which also picks up retries whose backoff has elapsed and expired leases).
+    """
+    ensure_support_tables()
+    stop_event = stop_event or threading.Event()
+    job_conn = None
+    while not stop_event.is_set():
+        try:
+            if job_conn is None or job_conn.closed:
+                job_conn = connect_db()
+                job_conn.autocommit = True
+                with job_conn.cursor() as cur:
+                    cur.execute(f"LISTEN {JOB_NOTIFY_CHANNEL};")
+            if run_one_job(job_conn, worker_id, job_types):
+                continue
+            if exit_when_idle:
+                break
+            readable, _, _ = select.select([job_conn], [], [], JOB_WORKER_POLL_SECONDS)
+            if readable:
+                job_conn.poll()
+                job_conn.notifies.clear()
+        except psycopg2.Error as e:
+            log.warning("Job worker %s lost its database connection: %s", worker_id, e)
+            if job_conn is not None:
+                job_conn.close()
+            job_conn = None
+            stop_event.wait(JOB_WORKER_POLL_SECONDS)
+    if job_conn is not None:
+        job_conn.close()
+
+
+def run_periodic_task(name, fn, every_seconds, stop_event):
+    while not stop_event.is_set():
+        try:
+            fn()
+        except Exception as e:
+            log.error("Periodic task %s failed: %s - %s", name, type(e).__name__, e)
+        stop_event.wait(every_seconds)
+
+
+def start_inline_job_worker():
+    """Starts one daemon worker thread in this process (JOB_INLINE_WORKER=true) unless it is already running."""
+    global _inline_worker_started
+    with _inline_worker_lock:
+        if _inline_worker_started:
+            return
+        _inline_worker_started = True
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:inline"
+    threading.Thread(target=run_job_worker, args=(worker_id,), daemon=True).start()
+
+
+@app.cli.command('worker')
+@click.option('--concurrency', default=1, show_default=True, help='Number of worker threads in this process.')
+@click.option('--job-type', 'job_types', multiple=True, help='Only run jobs of these types (repeatable).')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty instead of waiting for more jobs.')
+def worker_command(concurrency, job_types, burst):
+    """Runs background jobs from the jobs table until SIGTERM/SIGINT."""
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        log.info("Job worker received signal %s; finishing current jobs before exiting.", signum)
+        stop_event.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    base_id = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [
+        threading.Thread(target=run_job_worker, args=(f"{base_id}:{n}", job_types or None, stop_event, burst))
+        for n in range(max(concurrency, 1))
+    ]
+    log.info("Job worker %s started with %s thread(s) for %s.", base_id, len(threads), ', '.join(job_types) or 'all job types')
+    for thread in threads:
+        thread.start()
+    if not burst:
+        for name, fn, every_seconds in PERIODIC_TASKS:
+            threading.Thread(target=run_periodic_task, args=(name, fn, every_seconds, stop_event), daemon=True).start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(timeout=1) # Short joins keep the main thread responsive to signals
+    log.info("Job worker %s stopped.", base_id)
+
+
+def serialize_job(job):
+    """JSON-ready view of a jobs row (RealDictCursor) with a progress percentage."""
+    job = dict(job)
+    job['progress_percent'] = (
+        round(100.0 * job['progress_current'] / job['progress_total'], 1)
+        if job.get('progress_total') and job.get('progress_current') is not None else None
+    )
+    for key in ('run_after', 'locked_until', 'created_at', 'started_at', 'finished_at'):
+        if job.get(key):
+            job[key] = job[key].isoformat()
+    return job
+# --- Background Job Queue Ends Here ---
+
+######################################################################################################################################################
+
+# --- Attendance Statistics ---
+# Reports used to aggregate attendancerecords x sessions x enrollments on every request. Instead, statement-level
+# triggers on attendancerecords, attendancesessions and studentsenrolledcourses append the touched session (or
+# course/year, for enrollments) to the attendancechanges log; appending never contends on a shared row, so scan
+# storms are unaffected. refresh_attendance_stats() drains the log and recomputes attendancesessionstats (one row
+# per session: expected, present, late, excused, absent) for just the touched sessions, plus any session whose start
+# time has passed since the last refresh. Features that keep further aggregates register a step with
+# @attendance_stats_refresh_step; steps see the temp tables changed_sessions and affected_scopes. Readers call the
+# refresh lazily before reading (a no-op when nothing changed) and workers run it periodically. Each refresh that
+# changes anything bumps the stats version that cached reports are keyed on.
+ATTENDANCE_STATS_REFRESH_SECONDS = int(os.environ.get('ATTENDANCE_STATS_REFRESH_SECONDS', 60))
+ATTENDED_STATUSES = ('Present', 'Late') # Count towards attendance rates
+EXCUSED_STATUSES = ('Excused',) # Removed from the denominator
+# Set on a connection to keep its attendance deletes out of the change log (archiving keeps frozen statistics)
+SKIP_ATTENDANCE_CHANGE_LOG_SQL = "SELECT set_config('esas.skip_change_log', 'on', false);"
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS attendancechanges (
+        change_id BIGSERIAL PRIMARY KEY,
+        session_id VARCHAR(64), -- Set for record and session changes
+        course_id VARCHAR(64), -- Set (with academic_year_id) for enrollment changes
+        academic_year_id VARCHAR(64),
+        changed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+    );
+""")
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS attendancesessionstats (
+        session_id VARCHAR(64) PRIMARY KEY,
+        assignment_id VARCHAR(64) NOT NULL,
+        course_id VARCHAR(64),
+        department_id VARCHAR(64),
+        faculty_id VARCHAR(64),
+        academic_year_id VARCHAR(64),
+        session_datetime TIMESTAMP WITH TIME ZONE,
+        expected INTEGER NOT NULL DEFAULT 0, -- Students enrolled in the course for the year
+        present INTEGER NOT NULL DEFAULT 0,
+        late INTEGER NOT NULL DEFAULT 0,
+        excused INTEGER NOT NULL DEFAULT 0,
+        absent INTEGER NOT NULL DEFAULT 0,
+        refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+    );
+""")
+for _column in ('assignment_id', 'course_id', 'department_id', 'faculty_id'):
+    register_support_table(f"CREATE INDEX IF NOT EXISTS attendancesessionstats_{_column}_idx ON attendancesessionstats ({_column}, session_datetime);")
+register_support_table("CREATE INDEX IF NOT EXISTS attendancesessions_datetime_idx ON attendancesessions (session_datetime);")
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS attendancestatsstate (
+        singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+        version BIGINT NOT NULL DEFAULT 0,
+        refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT '-infinity' -- First refresh covers every past session
+    );
+    INSERT INTO attendancestatsstate (singleton) VALUES (TRUE) ON CONFLICT DO NOTHING;
+""")
+register_support_table("""
+    CREATE OR REPLACE FUNCTION log_attendance_changes() RETURNS trigger AS $$
+    BEGIN
+        IF current_setting('esas.skip_change_log', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        IF TG_TABLE_NAME = 'studentsenrolledcourses' THEN
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO attendancechanges (course_id, academic_year_id) SELECT DISTINCT course_id::TEXT, academic_year_id::TEXT FROM new_rows;
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                INSERT INTO attendancechanges (course_id, academic_year_id) SELECT DISTINCT course_id::TEXT, academic_year_id::TEXT FROM old_rows;
+            END IF;
+        ELSE
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO attendancechanges (session_id) SELECT DISTINCT session_id::TEXT FROM new_rows;
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                INSERT INTO attendancechanges (session_id) SELECT DISTINCT session_id::TEXT FROM old_rows;
+            END IF;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+register_support_table("""
+    DO $$
+    DECLARE
+        logged TEXT;
+    BEGIN
+        FOREACH logged IN ARRAY ARRAY['attendancerecords', 'attendancesessions', 'studentsenrolledcourses'] LOOP
+            IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = logged || '_log_insert') THEN
+                EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION log_attendance_changes()', logged || '_log_insert', logged);
+                EXECUTE format('CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION log_attendance_changes()', logged || '_log_update', logged);
+                EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION log_attendance_changes()', logged || '_log_delete', logged);
+            END IF;
+        END LOOP;
+    END $$;
+""")
+
+ATTENDANCE_STATS_REFRESH_STEPS = []
+
+
+def attendance_stats_refresh_step(f):
+    """Registers f(cur) to run inside every attendance stats refresh that changed something."""
+    ATTENDANCE_STATS_REFRESH_STEPS.append(f)
+    return f
+
+
+def refresh_attendance_stats(conn=None):
+    """
+    Folds pending attendance changes into the statistics tables and returns the current stats version.
+    When another process holds the refresh, returns the version as it stands (slightly older data) without waiting.
+    Commits on `conn` (or uses its own connection when None).
+    """
+    ensure_support_tables()
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            # Cheap check first: most calls find nothing to do
+            cur.execute("""
+                SELECT st.version,
+                       EXISTS (SELECT 1 FROM attendancechanges)
+                       OR EXISTS (SELECT 1 FROM attendancesessions WHERE session_datetime > st.refreshed_at AND session_datetime <= NOW())
+                FROM attendancestatsstate st;
+            """)
+            version, pending = cur.fetchone()
+            if not pending:
+                conn.commit()
+                return version
+
+            cur.execute("SELECT version FROM attendancestatsstate FOR UPDATE SKIP LOCKED;")
+            state = cur.fetchone()
+            if state is None:
+                conn.commit()
+                return version # Another refresh is running
+            version = state[0]
+
+            # Only committed log rows are visible (and consumed); later ones wait for the next refresh
+            cur.execute("""
+                CREATE TEMP TABLE consumed_changes ON COMMIT DROP AS
+                SELECT session_id, course_id, academic_year_id FROM attendancechanges WITH NO DATA;
+                WITH consumed AS (
+                    DELETE FROM attendancechanges RETURNING session_id, course_id, academic_year_id
+                )
+                INSERT INTO consumed_changes SELECT DISTINCT * FROM consumed;
+                CREATE TEMP TABLE changed_sessions (session_id VARCHAR(64) PRIMARY KEY) ON COMMIT DROP;
+                INSERT INTO changed_sessions
+                SELECT session_id FROM consumed_changes WHERE session_id IS NOT NULL
+                UNION
+                SELECT ats.session_id
+                FROM consumed_changes c
+                JOIN coursesassignedtolecturers ca ON ca.course_id = c.course_id AND ca.academic_year_id = c.academic_year_id
+                JOIN attendancesessions ats ON ats.assignment_id = ca.assignment_id
+                WHERE c.session_id IS NULL
+                UNION
+                SELECT session_id FROM attendancesessions
+                WHERE session_datetime > (SELECT refreshed_at FROM attendancestatsstate) AND session_datetime <= NOW();
+                -- Scopes touched: enrollment changes, plus stats rows about to be replaced (their scopes before the change)
+                CREATE TEMP TABLE affected_scopes ON COMMIT DROP AS
+                SELECT NULL::VARCHAR(64) AS assignment_id, c.course_id, co.department_id::VARCHAR(64) AS department_id,
+                       d.faculty_id::VARCHAR(64) AS faculty_id, c.academic_year_id
+                FROM consumed_changes c
+                LEFT JOIN courses co ON co.course_id = c.course_id
+                LEFT JOIN departments d ON d.department_id = co.department_id
+                WHERE c.session_id IS NULL
+                UNION ALL
+                SELECT assignment_id, course_id, department_id, faculty_id, academic_year_id
+                FROM attendancesessionstats
+                WHERE session_id IN (SELECT session_id FROM changed_sessions);
+                SELECT (SELECT COUNT(*) FROM changed_sessions) + (SELECT COUNT(*) FROM consumed_changes WHERE session_id IS NULL);
+            """)
+
+            if cur.fetchone()[0]:
+                cur.execute("DELETE FROM attendancesessionstats WHERE session_id IN (SELECT session_id FROM changed_sessions);")
+                cur.execute("""
+                    WITH fresh AS (
+                        INSERT INTO attendancesessionstats (session_id, assignment_id, course_id, department_id, faculty_id, academic_year_id,
+                                                            session_datetime, expected, present, late, excused, absent, refreshed_at)
+                        SELECT ats.session_id, ca.assignment_id, ca.course_id, c.department_id, d.faculty_id, ca.academic_year_id,
+                               ats.session_datetime,
+                               (SELECT COUNT(*) FROM studentsenrolledcourses sec WHERE sec.course_id = ca.course_id AND sec.academic_year_id = ca.academic_year_id),
+                               COUNT(ar.session_id) FILTER (WHERE ar.status = 'Present'),
+                               COUNT(ar.session_id) FILTER (WHERE ar.status = 'Late'),
+                               COUNT(ar.session_id) FILTER (WHERE ar.status = ANY(%(excused)s)),
+                               COUNT(ar.session_id) FILTER (WHERE ar.status = 'Absent'),
+                               NOW()
+                        FROM changed_sessions cs
+                        JOIN attendancesessions ats ON ats.session_id = cs.session_id
+                        JOIN coursesassignedtolecturers ca ON ca.assignment_id = ats.assignment_id
+                        LEFT JOIN courses c ON c.course_id = ca.course_id
+                        LEFT JOIN departments d ON d.department_id = c.department_id
+                        LEFT JOIN attendancerecords ar ON ar.session_id = ats.session_id
+                        GROUP BY ats.session_id, ca.assignment_id, ca.course_id, c.department_id, d.faculty_id, ca.academic_year_id, ats.session_datetime
+                        RETURNING assignment_id, course_id, department_id, faculty_id, academic_year_id
+                    )
+                    INSERT INTO affected_scopes SELECT * FROM fresh;
+                """, {'excused': list(EXCUSED_STATUSES)})
+                for step in ATTENDANCE_STATS_REFRESH_STEPS:
+                    step(cur)
+                version += 1
+
+            cur.execute("UPDATE attendancestatsstate SET version = %s, refreshed_at = NOW();", (version,)) # NOW() is fixed per transaction
+        conn.commit()
+        return version
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if own_conn:
+            conn.close()
+
+
+@periodic_task(ATTENDANCE_STATS_REFRESH_SECONDS)
+def refresh_attendance_stats_periodically():
+    refresh_attendance_stats()
+
+
+@app.cli.command('refresh-attendance-stats')
+def refresh_attendance_stats_command():
+    """Folds pending attendance changes into the statistics tables (the first run builds them from scratch)."""
+    click.echo(f"Attendance statistics at version {refresh_attendance_stats()}.")
+# --- Attendance Statistics Ends Here ---
+
+# --- Report Cache ---
+# Registers, analytics and eligibility lists are requested again and again with the same parameters around exam time.
+# Their results are cached per (report type, parameters) together with the data versions of the scopes they read:
+# reportscopeversions holds a version per assignment, course, department and faculty, and a stats refresh step bumps
+# only the scopes in affected_scopes, so a scan in one course leaves every other course's and department's cached
+# reports valid. Reports over no particular scope are keyed on the global stats version instead. Entries hold the
+# finished response body, are evicted least recently used past REPORT_CACHE_MAX_BYTES, and expire after
+# REPORT_CACHE_MAX_AGE_SECONDS, which bounds staleness from data the versions do not track (e.g. a renamed student).
+REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+REPORT_CACHE_MAX_AGE_SECONDS = int(os.environ.get('REPORT_CACHE_MAX_AGE_SECONDS', 900))
+REPORT_SCOPE_TYPES = ('assignment', 'course', 'department', 'faculty') # Columns of affected_scopes, minus the year
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS reportscopeversions (
+        scope_type VARCHAR(16) NOT NULL,
+        scope_id VARCHAR(64) NOT NULL,
+        version BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (scope_type, scope_id)
+    );
+""")
+
+_report_cache = OrderedDict() # (report type, params) -> (versions, expires at, body), oldest first
+_report_cache_bytes = 0
+_report_cache_lock = threading.Lock()
+
+
+@attendance_stats_refresh_step
+def bump_report_scope_versions(cur):
+    scope_values = ", ".join(f"('{scope_type}', a.{scope_type}_id)" for scope_type in REPORT_SCOPE_TYPES)
+    cur.execute(f"""
+        INSERT INTO reportscopeversions (scope_type, scope_id, version)
+        SELECT DISTINCT s.scope_type, s.scope_id, 1
+        FROM affected_scopes a
+        CROSS JOIN LATERAL (VALUES {scope_values}) AS s (scope_type, scope_id)
+        WHERE s.scope_id IS NOT NULL
+        ON CONFLICT (scope_type, scope_id) DO UPDATE SET version = reportscopeversions.version + 1;
+    """)
+
+
+def report_data_versions(conn, scopes=None):
+    """
+    Refreshes the attendance statistics and returns the versions a report over `scopes` ([(scope_type, scope_id)])
+    is keyed on, in the order given (0 for a scope that never changed). With no scopes, the global stats version.
+    """
+    version = refresh_attendance_stats(conn)
+    tombstones = ('tombstones', soft_delete_version()) # Soft deletes hide rows without touching the statistics
+    if not scopes:
+        return (('stats', version), tombstones)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT scope_type, scope_id, version FROM reportscopeversions
+            WHERE (scope_type, scope_id) IN (SELECT * FROM unnest(%s::VARCHAR[], %s::VARCHAR[]));
+        """, ([scope_type for scope_type, _ in scopes], [str(scope_id) for _, scope_id in scopes]))
+        found = {(scope_type, scope_id): scope_version for scope_type, scope_id, scope_version in cur.fetchall()}
+    return tuple((scope_type, str(scope_id), found.get((scope_type, str(scope_id)), 0)) for scope_type, scope_id in scopes) + (tombstones,)
+
+
+def get_cached_report(report_type, params, versions):
+    """The cached body of a report, or None if absent, expired or computed at other data versions."""
+    global _report_cache_bytes
+    key = (report_type, params)
+    with _report_cache_lock:
+        cached = _report_cache.get(key)
+        if cached is None:
+            return None
+        cached_versions, expires_at, body = cached
+        if cached_versions != versions or expires_at < time.monotonic():
+            del _report_cache[key]
+            _report_cache_bytes -= len(body)
+            return None
+        _report_cache.move_to_end(key)
+        return body
+
+
+def cache_report(report_type, params, versions, body):
+    """Stores a report body, evicting least recently used reports past REPORT_CACHE_MAX_BYTES."""
+    global _report_cache_bytes
+    if len(body) > REPORT_CACHE_MAX_BYTES // 4:
+        return # One huge register should not flush every other report
+    key = (report_type, params)
+    with _report_cache_lock:
+        previous = _report_cache.pop(key, None)
+        if previous is not None:
+            _report_cache_bytes -= len(previous[2])
+        _report_cache[key] = (versions, time.monotonic() + REPORT_CACHE_MAX_AGE_SECONDS, body)
+        _report_cache_bytes += len(body)
+        while _report_cache_bytes > REPORT_CACHE_MAX_BYTES:
+            _, (_, _, evicted) = _report_cache.popitem(last=False)
+            _report_cache_bytes -= len(evicted)
+
+
+def cached_json_report(report_type, params, versions, build):
+    """A JSON response for the report, from the cache or from build() (which returns the payload)."""
+    body = get_cached_report(report_type, params, versions)
+    if body is None:
+        body = jsonify(build()).get_data()
+        cache_report(report_type, params, versions, body)
+    return app.response_class(body, mimetype='application/json')
+# --- Report Cache Ends Here ---
+
+
 ######################################################################################################################################################
 
 # --- Students and Lecturers Registration, Approval, and Rejection route ---
@@ -105,7 +1562,7 @@ def register_student():
 
         conn = None
         try:
-            conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+            conn = connect_db()
             cur = conn.cursor()
             sql = "INSERT INTO AdmissionApplications (first_name, last_name, email, contact_number, date_of_birth, gender, level, intended_department_name, intended_program, proposed_password, proposed_username) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
             values = (first_name, last_name, email, contact_number, date_of_birth, gender, level, intended_department_name, intended_program, proposed_password, proposed_username)
@@ -157,7 +1614,7 @@ def register_lecturer():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Insert the lecturer application data into the AdmissionApplications table
@@ -187,9 +1644,11 @@ def get_all_applications():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
         cur.execute("SELECT * FROM AdmissionApplications;")
+        if wants_columnar_format():
+            return columnar_response(cur), 200
         applications = cur.fetchall()
 
         # Get column names for better formatting
@@ -214,6 +1673,9 @@ def get_all_applications():
         if conn:
             conn.close()
 
+# Application levels that can be approved into the students table
+STUDENT_APPLICATION_LEVELS = ('Undergraduate', 'Graduate', '100', '200', '300', '400', '500')
+
 @app.route('/admin/applications/<application_id>', methods=['PUT'])
 def update_applicationstatus(application_id):
     """Updates the status of a student application."""
@@ -244,7 +1706,7 @@ def update_applicationstatus(application_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         cur.execute("SELECT application_id, level, proposed_username, proposed_password, first_name, last_name, email, contact_number, date_of_birth, gender, intended_department_name, intended_program FROM AdmissionApplications WHERE application_id = %s;", (application_id,))
@@ -271,7 +1733,7 @@ def update_applicationstatus(application_id):
         if new_status == 'approved' and is_student_approval_data:
             # --- Student Approval Logic ---
 
-            if level not in ['Undergraduate', 'Graduate', '100', '200', '300', '400', '500']:
+            if level not in STUDENT_APPLICATION_LEVELS:
                  return jsonify({"error": f"Application with level '{level}' cannot be approved as a student."}), 400
 
             cur.execute("SELECT department_id FROM departments WHERE department_name = %s;", (department_name_app,))
@@ -293,7 +1755,7 @@ def update_applicationstatus(application_id):
             new_student_id = cur.fetchone()[0]
 
             # --- Hash the password before storing ---
-            hashed_password = generate_password_hash(proposed_password) # *** HASHING ***
+            hashed_password = hash_password(proposed_password) # *** HASHING ***
 
             # Create user account for student - Insert HASHED password
             insert_user_sql = """
@@ -318,7 +1780,7 @@ def update_applicationstatus(application_id):
                 update_qr_sql = "UPDATE students SET qr_code_data = %s WHERE student_id = %s;"
                 cur.execute(update_qr_sql, (qr_data_string, new_student_id))
             else:
-                 print(f"Warning: qr_data_string is None. Could not generate QR data string for new student_id {new_student_id}. qr_code_data column will be NULL.")
+                 log.warning("qr_data_string is None. Could not generate QR data string for new student_id %s. qr_code_data column will be NULL.", new_student_id)
 
 
             # Insert/Update admissionstatus for student
@@ -479,7 +1941,7 @@ def update_applicationstatus(application_id):
 
 
              # --- Hash the password before storing ---
-             hashed_password = generate_password_hash(proposed_password)
+             hashed_password = hash_password(proposed_password)
 
              # Create user account for lecturer - Insert HASHED password and ***lecturer_id*** as entity_id
              insert_user_sql = """
@@ -534,19 +1996,19 @@ def update_applicationstatus(application_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during application update: {e}")
+        log.error("Database integrity error during application update: %s", e)
         return jsonify({"error": f"Database integrity error: {e}"}), 409
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during application update: {e}")
+        log.error("Database error during application update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
 
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during application update: {e}")
+        log.exception("An unexpected error occurred during application update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -563,8 +2025,6 @@ def generate_student_qr_data_string(cur, student_id):
         cur: An active database cursor (must use RealDictCursor or adapt logic)
         student_id: The ID of the student (VARCHAR)
     """
-    # --- DEBUG PRINT STATEMENTS ADDED ---
-    print(f"--- generate_student_qr_data_string called for student_id: {student_id} ---")
     # Removed connection/cursor setup
 
     qr_data_string = None
@@ -575,7 +2035,7 @@ def generate_student_qr_data_string(cur, student_id):
              # Create a new RealDictCursor from the same connection if the passed one is not
              # This might be slightly less efficient but safer if different cursor types are used
              # Alternatively, require the caller to pass a RealDictCursor
-             print("Warning: generate_student_qr_data_string received non-RealDictCursor, creating a new one.")
+             log.warning("generate_student_qr_data_string received non-RealDictCursor, creating a new one.")
              dict_cur = cur.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         else:
              dict_cur = cur # Use the passed cursor
@@ -592,7 +2052,6 @@ def generate_student_qr_data_string(cur, student_id):
             JOIN departments d ON s.department_id = d.department_id
             WHERE s.student_id = %s;
         """
-        print(f"Executing SQL in QR function: {sql} with student_id: {student_id}")
         dict_cur.execute(sql, (str(student_id),))
 
         student_details = dict_cur.fetchone()
@@ -603,7 +2062,6 @@ def generate_student_qr_data_string(cur, student_id):
 
 
         if student_details:
-            print(f"Fetched student details: {student_details}")
             qr_data_string = (
                 f"ID:{student_details['student_id']},"
                 f"Name:{student_details['first_name']} {student_details['last_name']},"
@@ -611,21 +2069,76 @@ def generate_student_qr_data_string(cur, student_id):
                 f"Level:{student_details['level']},"
                 f"Dept:{student_details['department_name']}"
             )
-            print(f"Generated QR data string: {qr_data_string}")
+            log.debug("Generated QR data string for student_id %s", student_id)
         else:
-            print(f"No student details found for student_id: {student_id}")
+            log.warning("No student details found for student_id: %s", student_id)
 
     except psycopg2.Error as e:
-        print(f"Database error fetching student details for QR code: {e}")
+        log.error("Database error fetching student details for QR code: %s", e)
         qr_data_string = None
     except Exception as e:
-        print(f"An unexpected error occurred fetching student details for QR code: {e}")
+        log.exception("An unexpected error occurred fetching student details for QR code: %s", e)
         qr_data_string = None
 
     # Removed finally block for closing connection/cursor
 
-    print(f"--- generate_student_qr_data_string returning: {qr_data_string} ---")
     return qr_data_string
+
+
+# --- QR Data Regeneration ---
+# qr_code_data embeds the student's name, matriculation number, level and department name, so it goes stale when
+# any of those change. regenerate_student_qr_data() recomputes it for a whole scope with one UPDATE ... FROM
+# departments, skipping rows whose string is already current. update_department_details_for_admin and
+# update_student_details_for_admin call it inside their own transactions; `flask --app app regenerate-qr`
+# runs it by hand (e.g. after a direct SQL fix).
+# SQL twin of generate_student_qr_data_string(); expects students aliased as s and departments as d.
+QR_DATA_SQL = (
+    "'ID:' || s.student_id || ',Name:' || s.first_name || ' ' || s.last_name"
+    " || ',Matric:' || s.matriculation_number || ',Level:' || s.level || ',Dept:' || d.department_name"
+)
+QR_DATA_SOURCE_FIELDS = ('first_name', 'last_name', 'matriculation_number', 'level', 'department_id')
+
+
+def regenerate_student_qr_data(cur, scope=None):
+    """
+    Recomputes qr_code_data for every student in scope, a cohort selector as accepted by
+    build_student_cohort_filter() ({"department_id", "level", "academic_year_id", "student_ids"}),
+    or for all students when scope is None. Runs in the caller's transaction; returns the number of rows changed.
+    """
+    conditions, values = build_student_cohort_filter(scope) if scope is not None else ([], [])
+    conditions = ["d.department_id = s.department_id", f"s.qr_code_data IS DISTINCT FROM ({QR_DATA_SQL})"] + conditions
+    cur.execute(f"""
+        UPDATE students s
+        SET qr_code_data = {QR_DATA_SQL}
+        FROM departments d
+        WHERE {" AND ".join(conditions)};
+    """, values)
+    return cur.rowcount
+
+
+@app.cli.command('regenerate-qr')
+@click.option('--department-id', help='Only students in this department.')
+@click.option('--level', help='Only students at this level.')
+@click.option('--academic-year-id', help='Only students admitted in this academic year.')
+@click.option('--student-id', 'student_ids', multiple=True, help='Only these students (repeatable).')
+@click.option('--all', 'all_students', is_flag=True, help='Every student.')
+def regenerate_qr_command(department_id, level, academic_year_id, student_ids, all_students):
+    """Recomputes stale students.qr_code_data for a department, level, academic year or list of students."""
+    scope = {'department_id': department_id, 'level': level, 'academic_year_id': academic_year_id,
+             'student_ids': list(student_ids) or None}
+    if all_students:
+        scope = None
+    elif not any(scope.values()):
+        raise click.UsageError("Give --department-id, --level, --academic-year-id, --student-id or --all.")
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            changed = regenerate_student_qr_data(cur, scope)
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f"Regenerated qr_code_data for {changed} student(s).")
+# --- QR Data Regeneration Ends Here ---
 # --- Students and Lecturers Registration, Approval, and Rejection route ---
 
 ######################################################################################################################################################
@@ -658,7 +2171,7 @@ def create_course():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Insert the new course into the courses table
@@ -700,7 +2213,7 @@ def get_all_courses():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         course_title_filter = request.args.get('name') # Get the 'name' query parameter
@@ -734,13 +2247,13 @@ def get_course_by_id(course_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         cur.execute("SELECT * FROM courses WHERE course_id = %s;", (course_id,))
         course = cur.fetchone()
 
-        if course is None:
+        if course is None or is_soft_deleted('course', course_id):
             return jsonify({"error": f"Course with ID '{course_id}' not found."}), 404
 
         return jsonify(course), 200
@@ -774,7 +2287,7 @@ def update_course(course_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Check if the course exists
@@ -838,7 +2351,7 @@ def delete_course(course_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Delete the course
@@ -894,7 +2407,7 @@ def assign_lecturer_to_course():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Insert the new assignment into the coursesassignedtolecturers table
@@ -907,6 +2420,7 @@ def assign_lecturer_to_course():
         new_assignment_id = cur.fetchone()[0]
 
         conn.commit()
+        invalidate_lecturer_ownership(lecturer_id)
         return jsonify({"message": "Lecturer assigned to course successfully!", "assignment_id": new_assignment_id}), 201 # 201 Created
 
     except psycopg2.IntegrityError as e:
@@ -958,7 +2472,7 @@ def get_lecturer_assignments():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Get optional query parameters for filtering
@@ -1006,7 +2520,7 @@ def get_lecturer_assignment_by_id(assignment_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # assignment_id is VARCHAR, so cast the URL parameter to string if it's not already
@@ -1033,7 +2547,7 @@ def delete_lecturer_assignment(assignment_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Delete the assignment record
@@ -1041,6 +2555,7 @@ def delete_lecturer_assignment(assignment_id):
         cur.execute("DELETE FROM coursesassignedtolecturers WHERE assignment_id = %s;", (str(assignment_id),))
 
         conn.commit()
+        invalidate_lecturer_ownership()
 
         # Check if any row was deleted
         if cur.rowcount == 0:
@@ -1091,7 +2606,7 @@ def enroll_student_in_course():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Insert the new enrollment into the studentsenrolledcourses table
@@ -1155,7 +2670,7 @@ def get_student_enrollments():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Get optional query parameters for filtering
@@ -1204,7 +2719,7 @@ def get_student_enrollment_by_id(enrollment_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # enrollment_id is VARCHAR, so cast the URL parameter to string if it's not already
@@ -1231,7 +2746,7 @@ def delete_student_enrollment(enrollment_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Delete the enrollment record
@@ -1288,7 +2803,7 @@ def record_attendance():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # --- Validation: Check if session is valid and not expired ---
@@ -1337,6 +2852,10 @@ def record_attendance():
         conn.commit()
         return jsonify({"message": f"Attendance recorded for student '{student_id_from_qr}' in session '{session_id}'.", "record_id": new_record_id}), 201 # 201 Created
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
@@ -1355,7 +2874,7 @@ def record_attendance():
     except (psycopg2.Error, Exception) as e: # Catch other potential errors
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance recording: {e}") # Log the error
+        log.exception("An unexpected error occurred during attendance recording: %s", e) # Log the error
         return jsonify({"error": f"An error occurred: {e}"}), 500 # Generic error for client
     finally:
         if cur:
@@ -1364,35 +2883,30 @@ def record_attendance():
             conn.close()
 
 # --- Attendance Record Viewing Routes ---
+def attendance_record_filters(args):
+    """Turns the session_id / student_id / status query parameters into (conditions, values) on attendancerecords."""
+    # You could add filtering by date range here as well if needed
+    conditions = []
+    values = []
+    for column in ('session_id', 'student_id', 'status'):
+        if args.get(column):
+            conditions.append(f"{column} = %s")
+            values.append(str(args[column])) # Cast to string for VARCHAR column
+    return conditions, values
+
+
 @app.route('/attendance/records', methods=['GET'])
 def get_attendance_records():
     """Retrieves all attendance records, with optional filtering by session or student."""
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
-
-        # Get optional query parameters for filtering
-        session_id_filter = request.args.get('session_id')
-        student_id_filter = request.args.get('student_id')
-        status_filter = request.args.get('status')
-        # You could add filtering by date range here as well if needed
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
+        # Optional filtering by session, student or status (shared with the CSV export)
         sql = "SELECT * FROM attendancerecords"
-        conditions = []
-        values = []
-
-        if session_id_filter:
-            conditions.append("session_id = %s")
-            values.append(str(session_id_filter)) # Cast to string for VARCHAR column
-        if student_id_filter:
-            conditions.append("student_id = %s")
-            values.append(str(student_id_filter))   # Cast to string for VARCHAR column
-        if status_filter:
-             conditions.append("status = %s")
-             values.append(str(status_filter)) # Cast to string for VARCHAR column
-
+        conditions, values = attendance_record_filters(request.args)
 
         if conditions:
             sql += " WHERE " + " AND ".join(conditions)
@@ -1403,6 +2917,9 @@ def get_attendance_records():
 
         cur.execute(sql, tuple(values))
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         records = cur.fetchall()
 
         return jsonify(records), 200
@@ -1421,7 +2938,7 @@ def get_attendance_record_by_id(record_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # record_id is VARCHAR, so cast the URL parameter to string
@@ -1448,7 +2965,7 @@ def delete_attendance_record(record_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Delete the attendance record
@@ -1465,6 +2982,10 @@ def delete_attendance_record(record_id):
             # If rowcount is > 0, the record was deleted
             return jsonify({"message": f"Attendance record with ID '{record_id}' deleted successfully."}), 200
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
          if conn:
              conn.rollback()
@@ -1488,7 +3009,7 @@ def get_attendance_sessions():
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Get optional query parameters for filtering
@@ -1549,6 +3070,294 @@ def get_attendance_sessions():
 
 ######################################################################################################################################################
 
+# --- Password Hashing and Verification Pool ---
+# scrypt verification is deliberately expensive. At semester start thousands of logins arrive at once, so
+# checks run in a small per-worker process pool instead of on the request thread. The number of checks
+# waiting for the pool is capped; past that, /login answers 503 immediately instead of queueing forever.
+# PASSWORD_HASH_METHOD uses werkzeug's method syntax (e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000').
+# When it changes, users are transparently rehashed the next time they log in successfully.
+# Every gunicorn worker owns its own pool, so size PASSWORD_POOL_WORKERS so that
+# (gunicorn workers x PASSWORD_POOL_WORKERS) stays at or below the number of cores; the default of 2 suits
+# the usual one or two gunicorn workers per core. Each pool process also re-imports this module (spawn).
+# If a pool process dies (OOM kill, segfault) the executor is broken for good: it is dropped and recreated, and
+# the check is retried once on the new pool before the login is shed with 503.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_POOL_WORKERS = int(os.environ.get('PASSWORD_POOL_WORKERS', 2)) # Per gunicorn worker; 0 verifies inline
+PASSWORD_POOL_MAX_PENDING = int(os.environ.get('PASSWORD_POOL_MAX_PENDING', 4 * max(PASSWORD_POOL_WORKERS, 1)))
+PASSWORD_VERIFY_TIMEOUT_SECONDS = float(os.environ.get('PASSWORD_VERIFY_TIMEOUT_SECONDS', 10))
+PASSWORD_POOL_START_METHOD = os.environ.get('PASSWORD_POOL_START_METHOD', 'spawn') # Safe with gunicorn threads
+PASSWORD_BULK_HASHES_PER_WORKER = int(os.environ.get('PASSWORD_BULK_HASHES_PER_WORKER', 8))
+
+_password_pool = None
+_password_pool_lock = threading.Lock()
+_password_pool_slots = threading.BoundedSemaphore(PASSWORD_POOL_MAX_PENDING)
+
+
+class PasswordVerificationBusy(Exception):
+    """Raised when the verification pool is saturated or a check timed out; callers answer 503."""
+
+
+def hash_password(password):
+    """Hashes a password with the configured PASSWORD_HASH_METHOD."""
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+@lru_cache(maxsize=None)
+def _hash_method_prefix(method):
+    # werkzeug stores the fully expanded method (e.g. 'scrypt:32768:8:1') before the first '$'
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def password_hash_needs_update(stored_password_hash, method=None):
+    """True if a stored hash was produced with different parameters than the configured method."""
+    method = method or PASSWORD_HASH_METHOD
+    return stored_password_hash.split('$', 1)[0] != _hash_method_prefix(method)
+
+
+def _check_password_and_rehash(stored_password_hash, password, method):
+    """Runs in the pool: returns (matches, new_hash_or_None)."""
+    if not check_password_hash(stored_password_hash, password):
+        return False, None
+    if password_hash_needs_update(stored_password_hash, method):
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+def get_password_pool():
+    """Creates the verification pool lazily so each gunicorn worker gets its own after forking."""
+    global _password_pool
+    if _password_pool is None:
+        with _password_pool_lock:
+            if _password_pool is None:
+                _password_pool = ProcessPoolExecutor(
+                    max_workers=PASSWORD_POOL_WORKERS,
+                    mp_context=multiprocessing.get_context(PASSWORD_POOL_START_METHOD)
+                )
+    return _password_pool
+
+
+def discard_password_pool(pool):
+    """Drops a broken pool so the next get_password_pool() creates a fresh one (unless another thread already did)."""
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is pool:
+            _password_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit_password_check(pool, stored_password_hash, password):
+    if not _password_pool_slots.acquire(blocking=False):
+        raise PasswordVerificationBusy("Password verification queue is full.")
+    try:
+        future = pool.submit(_check_password_and_rehash, stored_password_hash, password, PASSWORD_HASH_METHOD)
+    except BaseException:
+        _password_pool_slots.release()
+        raise
+    # The slot is held until the check really finishes: a timed-out check that is already running cannot be
+    # cancelled, and it must keep counting against PASSWORD_POOL_MAX_PENDING until it does
+    future.add_done_callback(lambda _: _password_pool_slots.release())
+    return future
+
+
+def verify_password(stored_password_hash, password):
+    """
+    Checks a password against its stored hash off the request thread.
+    Returns (matches, new_hash_or_None); new_hash is set when the stored hash should be upgraded.
+    Raises PasswordVerificationBusy when too many checks are already pending or the pool keeps breaking.
+    """
+    if PASSWORD_POOL_WORKERS <= 0:
+        return _check_password_and_rehash(stored_password_hash, password, PASSWORD_HASH_METHOD)
+
+    started = time.perf_counter()
+    try:
+        for attempt in (1, 2):
+            pool = get_password_pool()
+            try:
+                future = _submit_password_check(pool, stored_password_hash, password)
+                return future.result(timeout=PASSWORD_VERIFY_TIMEOUT_SECONDS)
+            except FutureTimeoutError:
+                future.cancel()
+                raise PasswordVerificationBusy("Password verification timed out.")
+            except BrokenProcessPool:
+                log.warning("Password pool broke (a pool process died); recreating it (attempt %d).", attempt)
+                discard_password_pool(pool)
+        raise PasswordVerificationBusy("Password verification pool is unavailable.")
+    finally:
+        observe_metric('esas_password_verify_seconds', time.perf_counter() - started)
+
+
+def hash_passwords(passwords):
+    """
+    Hashes many passwords (bulk imports/approvals) in the pool; returns the hashes in input order.
+    Work is submitted a few hashes per worker at a time so queued logins never wait behind a whole batch.
+    """
+    passwords = list(passwords)
+    if PASSWORD_POOL_WORKERS <= 0:
+        return [hash_password(password) for password in passwords]
+
+    window = PASSWORD_POOL_WORKERS * PASSWORD_BULK_HASHES_PER_WORKER
+    hashes = []
+    for start in range(0, len(passwords), window):
+        chunk = passwords[start:start + window]
+        for attempt in (1, 2):
+            pool = get_password_pool()
+            try:
+                chunk_hashes = list(pool.map(generate_password_hash, chunk, [PASSWORD_HASH_METHOD] * len(chunk),
+                                             chunksize=PASSWORD_BULK_HASHES_PER_WORKER))
+                break
+            except BrokenProcessPool:
+                log.warning("Password pool broke during bulk hashing; recreating it (attempt %d).", attempt)
+                discard_password_pool(pool)
+                if attempt == 2:
+                    raise
+        hashes.extend(chunk_hashes)
+    return hashes
+# --- Password Hashing and Verification Pool Ends Here ---
+
+
+# --- Login Rate Limiting ---
+# Token buckets per client IP and per username, checked before any DB lookup or password hashing so that
+# brute-force or misbehaving clients cannot burn the CPU that legitimate logins need.
+# 'memory' keeps buckets in this process (single worker / single node). 'sqlite' keeps them in a small
+# SQLite file so all gunicorn workers on the same machine share one set of buckets.
+# The per-IP bucket is deliberately generous: a whole campus can sit behind one NAT address.
+LOGIN_RATE_LIMIT_BACKEND = os.environ.get('LOGIN_RATE_LIMIT_BACKEND', 'memory') # 'memory' or 'sqlite'
+LOGIN_RATE_LIMIT_SQLITE_PATH = os.environ.get('LOGIN_RATE_LIMIT_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'esas_login_buckets.sqlite3'))
+LOGIN_USERNAME_BUCKET_CAPACITY = float(os.environ.get('LOGIN_USERNAME_BUCKET_CAPACITY', 5))
+LOGIN_USERNAME_REFILL_PER_SECOND = float(os.environ.get('LOGIN_USERNAME_REFILL_PER_SECOND', 1 / 30)) # One attempt every 30s after the burst
+LOGIN_IP_BUCKET_CAPACITY = float(os.environ.get('LOGIN_IP_BUCKET_CAPACITY', 200))
+LOGIN_IP_REFILL_PER_SECOND = float(os.environ.get('LOGIN_IP_REFILL_PER_SECOND', 20))
+LOGIN_TRUST_X_FORWARDED_FOR = os.environ.get('LOGIN_TRUST_X_FORWARDED_FOR', 'false').lower() == 'true'
+
+
+def _refill_bucket(tokens, updated_at, now, capacity, refill_per_second):
+    return min(capacity, tokens + (now - updated_at) * refill_per_second)
+
+
+def _retry_after_seconds(tokens, refill_per_second):
+    return max(1, math.ceil((1 - tokens) / refill_per_second)) if refill_per_second > 0 else 3600
+
+
+def _bucket_full_at(tokens, now, capacity, refill_per_second):
+    """When a bucket will have refilled completely, i.e. stops carrying state worth keeping."""
+    return now + (capacity - tokens) / refill_per_second if refill_per_second > 0 else float('inf')
+
+
+class InProcessRateLimiter:
+    """Token buckets held in this worker's memory."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict() # key -> (tokens, updated_at, full_at), least recently used first
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_per_second):
+        """Takes one token from the bucket. Returns (allowed, retry_after_seconds)."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at, _ = self.buckets.pop(key, (capacity, now, now))
+            tokens = _refill_bucket(tokens, updated_at, now, capacity, refill_per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now, _bucket_full_at(tokens, now, capacity, refill_per_second))
+            self._evict(now)
+        return allowed, 0 if allowed else _retry_after_seconds(tokens, refill_per_second)
+
+    def _evict(self, now):
+        # Every bucket records when it will be full again under its own parameters, so IP and username
+        # buckets never refill with each other's rates. Drop refilled buckets from the cold end, and past
+        # max_keys drop the least recently used one regardless; both are O(1) per consume.
+        for _ in range(2):
+            oldest_key, (_, _, full_at) = next(iter(self.buckets.items()))
+            if full_at > now:
+                break
+            del self.buckets[oldest_key]
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+
+class SharedFileRateLimiter:
+    """Token buckets in a local SQLite file, shared by every worker process on this machine."""
+
+    def __init__(self, path, prune_interval_seconds=60):
+        self.path = path
+        self.prune_interval_seconds = prune_interval_seconds
+        self.local = threading.local()
+        self.last_pruned = 0.0
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, full_at REAL NOT NULL DEFAULT 0);")
+            if 'full_at' not in [column[1] for column in conn.execute("PRAGMA table_info(buckets);")]:
+                conn.execute("ALTER TABLE buckets ADD COLUMN full_at REAL NOT NULL DEFAULT 0;") # Files from older releases
+            conn.execute("CREATE INDEX IF NOT EXISTS buckets_full_at ON buckets (full_at);")
+            self.local.conn = conn
+        return conn
+
+    def consume(self, key, capacity, refill_per_second):
+        """Takes one token from the bucket. Returns (allowed, retry_after_seconds)."""
+        now = time.time() # Wall clock: monotonic clocks are not comparable across processes
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE;") # Serialises read-modify-write across workers
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?;", (key,)).fetchone()
+            tokens = _refill_bucket(row[0], row[1], now, capacity, refill_per_second) if row else capacity
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute(
+                "INSERT INTO buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at, full_at = excluded.full_at;",
+                (key, tokens, now, _bucket_full_at(tokens, now, capacity, refill_per_second))
+            )
+            if now - self.last_pruned >= self.prune_interval_seconds:
+                # Refilled buckets behave exactly like missing ones, so deleting them keeps the file bounded
+                self.last_pruned = now
+                conn.execute("DELETE FROM buckets WHERE full_at <= ?;", (now,))
+            conn.execute("COMMIT;")
+        except Exception:
+            conn.execute("ROLLBACK;")
+            raise
+        return allowed, 0 if allowed else _retry_after_seconds(tokens, refill_per_second)
+
+
+if LOGIN_RATE_LIMIT_BACKEND == 'sqlite':
+    login_rate_limiter = SharedFileRateLimiter(LOGIN_RATE_LIMIT_SQLITE_PATH)
+else:
+    login_rate_limiter = InProcessRateLimiter()
+
+
+def get_client_ip():
+    """Client address for rate limiting; honours X-Forwarded-For only when explicitly trusted."""
+    if LOGIN_TRUST_X_FORWARDED_FOR and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or 'unknown'
+
+
+def check_login_rate_limit(username):
+    """Returns None when the attempt may proceed, or a 429 response carrying Retry-After."""
+    checks = [
+        (f"ip:{get_client_ip()}", LOGIN_IP_BUCKET_CAPACITY, LOGIN_IP_REFILL_PER_SECOND),
+        (f"user:{str(username).strip().lower()}", LOGIN_USERNAME_BUCKET_CAPACITY, LOGIN_USERNAME_REFILL_PER_SECOND),
+    ]
+    for key, capacity, refill_per_second in checks:
+        try:
+            allowed, retry_after = login_rate_limiter.consume(key, capacity, refill_per_second)
+        except sqlite3.Error as e:
+            log.warning("Login rate limiter unavailable, allowing attempt: %s", e) # Fail open; the pool still sheds load
+            return None
+        if not allowed:
+            response = jsonify({"error": "Too many login attempts. Please wait before trying again."})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429 # 429 Too Many Requests
+    return None
+# --- Login Rate Limiting Ends Here ---
+
+
 #--- Authentication Route for Users Logins---
 @app.route('/login', methods=['POST'])
 def login_user():
@@ -1564,15 +3373,25 @@ def login_user():
     if not all([username, password]):
         return jsonify({"error": "Missing username or password."}), 400
 
+    # --- Rate limit before touching the database or the password hasher ---
+    rate_limited = check_login_rate_limit(username)
+    if rate_limited is not None:
+        return rate_limited
+
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        ensure_support_tables() # pendingdeletions hides soft-deleted students/lecturers
+        conn = connect_db()
         cur = conn.cursor()
 
         # Select the stored HASHED password, user_account_id, role, and entity_id
         cur.execute(
-            "SELECT user_account_id, password, role, entity_id FROM useraccounts WHERE username = %s;",
+            """
+                SELECT ua.user_account_id, ua.password, ua.role, ua.entity_id FROM useraccounts ua
+                WHERE ua.username = %s
+                  AND NOT EXISTS (SELECT 1 FROM pendingdeletions pd WHERE pd.entity_type = ua.role AND pd.entity_id = ua.entity_id::TEXT);
+            """,
             (username,)
         )
         user_account = cur.fetchone()
@@ -1582,19 +3401,40 @@ def login_user():
             return jsonify({"error": "Invalid username or password."}), 401 # 401 Unauthorized
 
         user_account_id, stored_password_hash, role, entity_id = user_account
+        conn.commit() # End the read transaction; verification can take a while under load
 
-        # --- Password Verification ---
-        if check_password_hash(stored_password_hash, password):
+        # --- Password Verification (off the request thread, see verify_password) ---
+        try:
+            password_matches, upgraded_password_hash = verify_password(stored_password_hash, password)
+        except PasswordVerificationBusy as e:
+            log.warning("Login shed for '%s': %s", username, e, extra={'sample': LOG_SAMPLE_RATE})
+            response = jsonify({"error": "Login service is busy. Please try again shortly."})
+            response.headers['Retry-After'] = '2'
+            return response, 503 # 503 Service Unavailable
+
+        if password_matches:
             # Authentication successful - *** GENERATE JWT ***
 
+            # Hash parameters changed since this password was stored: upgrade it now that we know the plaintext.
+            # Compare-and-set on the old hash so a concurrent password change is never overwritten.
+            if upgraded_password_hash:
+                cur.execute(
+                    "UPDATE useraccounts SET password = %s WHERE user_account_id = %s AND password = %s;",
+                    (upgraded_password_hash, user_account_id, stored_password_hash)
+                )
+                conn.commit()
+
             # Define the payload (claims) for the token.
             # Include data needed for authentication/authorization checks later.
-            # Standard claims like 'exp' (expiration) are important in production.
+            # exp bounds how long a verified token may be cached; jti lets it be revoked (see /logout).
+            issued_at = datetime.now(timezone.utc)
             payload = {
                 'user_account_id': user_account_id,
                 'role': role,
-                'entity_id': entity_id
-                # 'exp': datetime.utcnow() + timedelta(minutes=30) # Example expiration (requires import)
+                'entity_id': entity_id,
+                'iat': issued_at,
+                'exp': issued_at + timedelta(minutes=JWT_EXPIRY_MINUTES),
+                'jti': secrets.token_urlsafe(16)
             }
 
             # Encode the payload into a JWT using the secret key
@@ -1612,10 +3452,10 @@ def login_user():
             return jsonify({"error": "Invalid username or password."}), 401 # 401 Unauthorized
 
     except psycopg2.Error as e:
-        print(f"Database error during login: {e}")
+        log.error("Database error during login: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred during login: {e}")
+        log.exception("An unexpected error occurred during login: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -1624,54 +3464,141 @@ def login_user():
             conn.close()
 
 
-def get_authenticated_user():
-    """
-    Extracts JWT from Authorization header, verifies it, and returns user payload.
-    Returns None if token is missing, invalid, expired, or malformed.
-    """
+# --- Token Verification Cache and Revocation ---
+# Every protected request used to run a full jwt.decode. Tokens now carry exp/jti, so once a token has been
+# verified its claims are kept in a bounded LRU (keyed by a digest of the token, never the token itself) until
+# the token expires. Revoked jtis are held in memory and re-read from the database every few seconds so a
+# logout on one worker reaches the others.
+JWT_EXPIRY_MINUTES = int(os.environ.get('JWT_EXPIRY_MINUTES', 480)) # One working day
+VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get('VERIFIED_TOKEN_CACHE_SIZE', 10000))
+REVOCATION_REFRESH_SECONDS = int(os.environ.get('REVOCATION_REFRESH_SECONDS', 30))
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS revokedtokens (
+        jti VARCHAR(64) PRIMARY KEY,
+        user_account_id VARCHAR(64),
+        expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        revoked_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+    );
+""")
+
+_verified_tokens = OrderedDict() # sha256(token) -> (user tuple, exp timestamp, jti)
+_verified_tokens_lock = threading.Lock()
+_revoked_jtis = set()
+_revoked_jtis_refreshed_at = 0.0 # time.monotonic() of the last successful (or attempted) refresh
+_revoked_jtis_lock = threading.Lock()
+
+
+def get_bearer_token():
+    """Returns the token from an 'Authorization: Bearer <token>' header, or None."""
     auth_header = request.headers.get('Authorization')
     if not auth_header:
-        print("Authentication failed: No Authorization header provided.")
-        return None # No Authorization header provided
-
+        return None
     parts = auth_header.split()
+    if len(parts) != 2 or parts[0].lower() != 'bearer' or not parts[1]:
+        return None
+    return parts[1]
+
 
-    # Check if the header starts with "Bearer " and has a token part
-    if parts[0].lower() != 'bearer' or len(parts) != 2:
-        print("Authentication failed: Invalid Authorization header format.")
-        return None # Invalid Authorization header format (e.g., just "Bearer" or something else)
+def refresh_revoked_tokens(force=False):
+    """
+    Reloads the unexpired revoked jtis from the database if the in-memory copy is older than
+    REVOCATION_REFRESH_SECONDS. Only one thread refreshes at a time; others keep using the current set.
+    """
+    global _revoked_jtis, _revoked_jtis_refreshed_at
+    if not force and time.monotonic() - _revoked_jtis_refreshed_at < REVOCATION_REFRESH_SECONDS:
+        return
+    if not _revoked_jtis_lock.acquire(blocking=force):
+        return
+    conn = None
+    try:
+        _revoked_jtis_refreshed_at = time.monotonic() # Set first so a DB outage does not trigger a reload per request
+        ensure_support_tables()
+        conn = connect_db()
+        with conn.cursor() as cur:
+            cur.execute("SELECT jti FROM revokedtokens WHERE expires_at > NOW();")
+            _revoked_jtis = {row[0] for row in cur.fetchall()}
+    except psycopg2.Error as e:
+        log.warning("Could not refresh revoked tokens, keeping the previous set: %s", e)
+    finally:
+        if conn:
+            conn.close()
+        _revoked_jtis_lock.release()
 
-    token = parts[1] # This should be the token string
 
-    # Basic check for empty token string after split (should be caught by len(parts)!=2, but defensive)
-    if not token:
-         print("Authentication failed: Token part is empty.")
-         return None
+def revoke_token(cur, jti, user_account_id, expires_at):
+    """Records a revoked jti (caller commits) and drops it from this worker's caches immediately."""
+    cur.execute(
+        "INSERT INTO revokedtokens (jti, user_account_id, expires_at) VALUES (%s, %s, %s) ON CONFLICT (jti) DO NOTHING;",
+        (jti, str(user_account_id), expires_at)
+    )
+    _revoked_jtis.add(jti)
+    with _verified_tokens_lock:
+        for digest in [d for d, entry in _verified_tokens.items() if entry[2] == jti]:
+            del _verified_tokens[digest]
 
-    try:
-        # *** Use your SECRET_KEY for decoding ***
-        # Add DecodeError to the exceptions caught to handle malformed tokens gracefully
-        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
 
-        # Optional: Check if essential keys exist in payload (basic validation)
-        if 'user_account_id' not in payload or 'role' not in payload or 'entity_id' not in payload:
-             print("JWT payload missing essential keys.")
-             return None # Payload missing required keys
+def verify_token(token):
+    """
+    Returns (user tuple, exp timestamp, jti) for a valid, unexpired, unrevoked token, or None.
+    Cache hits skip jwt.decode entirely.
+    """
+    refresh_revoked_tokens()
+    digest = hashlib.sha256(token.encode('utf-8')).digest()
+    now = time.time()
 
-        # Return the decoded payload information as a tuple
-        return (payload['user_account_id'], payload['role'], payload['entity_id'])
+    with _verified_tokens_lock:
+        entry = _verified_tokens.get(digest)
+        if entry is not None:
+            if entry[1] > now and entry[2] not in _revoked_jtis:
+                _verified_tokens.move_to_end(digest)
+                return entry
+            del _verified_tokens[digest] # Expired or revoked since it was cached
 
-    # *** CORRECTED: Catch specific exception classes directly in a tuple ***
-    # Catch InvalidTokenError (signature invalid, audience, issuer etc.),
+    try:
+        # *** Use your SECRET_KEY for decoding ***
+        # exp/iat/jti are required so every accepted token is bounded and revocable
+        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'], options={'require': ['exp', 'iat', 'jti']})
+    # Catch InvalidTokenError (signature invalid, missing claims etc.),
     # ExpiredSignatureError (token expired), and
     # DecodeError (token format is fundamentally wrong, like "Not enough segments")
     except (InvalidTokenError, ExpiredSignatureError, DecodeError) as e:
-        print(f"Authentication failed: JWT validation failed (Invalid/Expired/Malformed) - {e}")
-        return None # Authentication failed due to invalid/expired/malformed token
+        log.info("Authentication failed: JWT validation failed (Invalid/Expired/Malformed) - %s", e, extra={'sample': LOG_SAMPLE_RATE})
+        return None
     except Exception as e:
         # Catch any other unexpected errors during decoding process
-        print(f"An unexpected error occurred during JWT decoding: {e}")
-        return None # Unexpected decoding error
+        log.exception("An unexpected error occurred during JWT decoding: %s", e)
+        return None
+
+    # Basic validation: essential keys must exist in the payload
+    if 'user_account_id' not in payload or 'role' not in payload or 'entity_id' not in payload:
+        log.warning("JWT payload missing essential keys.")
+        return None
+    if payload['jti'] in _revoked_jtis:
+        return None
+
+    entry = ((payload['user_account_id'], payload['role'], payload['entity_id']), payload['exp'], payload['jti'])
+    with _verified_tokens_lock:
+        _verified_tokens[digest] = entry
+        while len(_verified_tokens) > VERIFIED_TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+    return entry
+
+
+def get_authenticated_user():
+    """
+    Extracts JWT from Authorization header, verifies it, and returns user payload.
+    Returns None if token is missing, invalid, expired, revoked, or malformed.
+    """
+    token = get_bearer_token()
+    if token is None:
+        return None # Missing or malformed Authorization header
+
+    entry = verify_token(token)
+    if entry is None:
+        return None
+    # Return the decoded payload information as a tuple
+    return entry[0]
 
 # --- Authentication Decorator ---
 def login_required(f):
@@ -1686,6 +3613,8 @@ def login_required(f):
         if user is None:
             # If get_authenticated_user returned None, authentication failed
             return jsonify({"error": "Authentication required."}), 401 # 401 Unauthorized
+        if user[1] in ('student', 'lecturer') and is_soft_deleted(user[1], user[2]):
+            return jsonify({"error": "Authentication required."}), 401 # Account soft-deleted after the token was issued
 
         # Pass the authenticated user tuple to the wrapped function
         # The view function can now access user[0] (user_account_id), user[1] (role), user[2] (entity_id)
@@ -1693,6 +3622,36 @@ def login_required(f):
 
     return decorated_function
 
+@app.route('/logout', methods=['POST'])
+@login_required
+def logout_user(user):
+    """Revokes the caller's token so it is rejected by every worker until it would have expired anyway."""
+    entry = verify_token(get_bearer_token())
+    if entry is None:
+        return jsonify({"error": "Authentication required."}), 401
+    user_tuple, expires_at, jti = entry
+
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables()
+        conn = connect_db()
+        cur = conn.cursor()
+        revoke_token(cur, jti, user_tuple[0], datetime.fromtimestamp(expires_at, timezone.utc))
+        conn.commit()
+        return jsonify({"message": "Logged out successfully."}), 200
+
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        log.error("Database error during logout: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
 ######################################################################################################################################################
 
 # --- Protected Student Profile Route ---
@@ -1717,7 +3676,7 @@ def get_student_profile(user):
     cur = None
     student_profile = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         # Use RealDictCursor to easily access data by column name
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
@@ -1748,16 +3707,16 @@ def get_student_profile(user):
 
         if student_profile is None:
             # This should ideally not happen if the student_id in useraccounts is correct
-            print(f"Error: Student profile not found for user_account_id {user_account_id} with student_id {student_id}")
+            log.error("Student profile not found for user_account_id %s with student_id %s", user_account_id, student_id)
             return jsonify({"error": "Student profile not found."}), 404
 
         return jsonify(student_profile), 200 # Return the student profile data
 
     except psycopg2.Error as e:
-        print(f"Database error fetching student profile: {e}")
+        log.error("Database error fetching student profile: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching student profile: {e}")
+        log.exception("An unexpected error occurred fetching student profile: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -1765,30 +3724,311 @@ def get_student_profile(user):
         if conn:
             conn.close()
 
-# --- Protected Student Dashboard Routes ---
-@app.route('/student/schedule', methods=['GET'])
-@login_required
-def get_student_schedule(user):
+# --- QR Image Rendering ---
+# Students get their QR code as an image instead of rendering qr_code_data on the client. Images are cached in a
+# small in-process LRU and on disk, both keyed by a sha256 of (format, render settings, payload), so the same
+# payload is rendered once per host. The digest doubles as the ETag: it only changes when qr_code_data does, so
+# clients revalidate with If-None-Match and get a 304 without the image being looked up at all.
+# Printable ID-card sheets for a department are rendered in a separate process pool (the password pool is
+# reserved for logins) and streamed back as a ZIP of PNG sheets or a multi-page PDF.
+QR_IMAGE_CACHE_DIR = os.environ.get('QR_IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'esas-qr-cache'))
+QR_IMAGE_MEMORY_CACHE_ENTRIES = int(os.environ.get('QR_IMAGE_MEMORY_CACHE_ENTRIES', 1024))
+QR_IMAGE_BOX_SIZE = int(os.environ.get('QR_IMAGE_BOX_SIZE', 10)) # Pixels per QR module in PNGs
+QR_IMAGE_BORDER = int(os.environ.get('QR_IMAGE_BORDER', 4)) # Quiet zone, in modules
+RENDER_POOL_WORKERS = int(os.environ.get('RENDER_POOL_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+RENDER_POOL_START_METHOD = os.environ.get('RENDER_POOL_START_METHOD', 'spawn')
+
+QR_IMAGE_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+# ID-card sheet geometry: CR80 cards (85.6 x 54 mm), 2 x 5 per A4 page, at ID_CARD_DPI
+ID_CARD_DPI = int(os.environ.get('ID_CARD_DPI', 150))
+ID_CARD_COLUMNS, ID_CARD_ROWS = 2, 5
+ID_CARDS_PER_SHEET = ID_CARD_COLUMNS * ID_CARD_ROWS
+
+_qr_image_cache = OrderedDict() # digest -> image bytes, oldest first
+_qr_image_cache_lock = threading.Lock()
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def qr_image_digest(payload, image_format):
+    """Cache key and ETag for a payload rendered in a format with the current settings."""
+    key = f"{image_format}:{QR_IMAGE_BOX_SIZE}:{QR_IMAGE_BORDER}:{payload}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def render_qr_image(payload, image_format):
+    """Renders a payload as PNG or SVG bytes."""
+    buffer = io.BytesIO()
+    if image_format == 'svg':
+        qrcode.make(payload, image_factory=qrcode.image.svg.SvgPathImage, border=QR_IMAGE_BORDER).save(buffer)
+    else:
+        qrcode.make(payload, box_size=QR_IMAGE_BOX_SIZE, border=QR_IMAGE_BORDER).save(buffer)
+    return buffer.getvalue()
+
+
+def get_qr_image(payload, image_format, digest=None):
+    """Returns the image bytes for a payload from the memory LRU, the disk cache, or a fresh render."""
+    digest = digest or qr_image_digest(payload, image_format)
+    with _qr_image_cache_lock:
+        image = _qr_image_cache.get(digest)
+        if image is not None:
+            _qr_image_cache.move_to_end(digest)
+            return image
+
+    path = os.path.join(QR_IMAGE_CACHE_DIR, digest[:2], f"{digest}.{image_format}")
+    try:
+        with open(path, 'rb') as cached_file:
+            image = cached_file.read()
+    except OSError:
+        image = render_qr_image(payload, image_format)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(image)
+            os.replace(temp_path, path) # Atomic, so concurrent workers never read a half-written file
+        except OSError as e:
+            log.warning("Could not write QR image cache file %s: %s", path, e)
+
+    with _qr_image_cache_lock:
+        _qr_image_cache[digest] = image
+        while len(_qr_image_cache) > QR_IMAGE_MEMORY_CACHE_ENTRIES:
+            _qr_image_cache.popitem(last=False)
+    return image
+
+
+def get_render_pool():
+    """Creates the image rendering pool lazily so each gunicorn worker gets its own after forking."""
+    global _render_pool
+    if _render_pool is None:
+        with _render_pool_lock:
+            if _render_pool is None:
+                _render_pool = ProcessPoolExecutor(
+                    max_workers=RENDER_POOL_WORKERS,
+                    mp_context=multiprocessing.get_context(RENDER_POOL_START_METHOD)
+                )
+    return _render_pool
+
+
+def iter_pool_results(pool, fn, items, in_flight):
+    """Like pool.map, but keeps at most `in_flight` tasks queued so a slow consumer does not buffer every result."""
+    pending = []
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= in_flight:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def _fit_text(draw, text, font, max_width):
+    """Truncates text with an ellipsis so it fits in max_width pixels."""
+    text = str(text or '')
+    if draw.textlength(text, font=font) <= max_width:
+        return text
+    while text and draw.textlength(text + '...', font=font) > max_width:
+        text = text[:-1]
+    return text + '...'
+
+
+def render_id_card_sheet(job):
+    """
+    Runs in the render pool: draws up to ID_CARDS_PER_SHEET cards on one A4 page.
+    job is (students, image_format) where each student is
+    (student_id, first_name, last_name, matriculation_number, level, department_name, qr_code_data).
+    Returns the page as PNG or JPEG bytes.
+    """
+    students, image_format = job
+    px = lambda millimetres: round(millimetres * ID_CARD_DPI / 25.4)
+    page_width, page_height = px(210), px(297)
+    card_width, card_height = px(85.6), px(54)
+    gap = px(5)
+    left = (page_width - ID_CARD_COLUMNS * card_width - (ID_CARD_COLUMNS - 1) * gap) // 2
+    top = (page_height - ID_CARD_ROWS * card_height - (ID_CARD_ROWS - 1) * gap) // 2
+    header_height = px(10)
+    qr_size = card_height - header_height - px(6)
+
+    title_font = ImageFont.load_default(size=px(3.2))
+    name_font = ImageFont.load_default(size=px(3.6))
+    body_font = ImageFont.load_default(size=px(2.8))
+
+    page = Image.new('RGB', (page_width, page_height), 'white')
+    draw = ImageDraw.Draw(page)
+    for index, (student_id, first_name, last_name, matriculation_number, level, department_name, qr_code_data) in enumerate(students):
+        x = left + (index % ID_CARD_COLUMNS) * (card_width + gap)
+        y = top + (index // ID_CARD_COLUMNS) * (card_height + gap)
+        draw.rounded_rectangle((x, y, x + card_width, y + card_height), radius=px(3), outline='#1f3a68', width=2)
+        draw.rounded_rectangle((x, y, x + card_width, y + header_height), radius=px(3), fill='#1f3a68', corners=(True, True, False, False))
+        draw.text((x + px(3), y + px(1.2)), "STUDENT IDENTITY CARD", font=title_font, fill='white')
+        draw.text((x + px(3), y + px(5.4)), _fit_text(draw, department_name, body_font, card_width - px(6)), font=body_font, fill='white')
+
+        qr_image = qrcode.make(qr_code_data or '', border=1).get_image().convert('RGB').resize((qr_size, qr_size), Image.NEAREST)
+        page.paste(qr_image, (x + px(3), y + header_height + px(3)))
+
+        text_x = x + px(3) + qr_size + px(3)
+        text_width = x + card_width - px(3) - text_x
+        text_y = y + header_height + px(4)
+        draw.text((text_x, text_y), _fit_text(draw, f"{first_name} {last_name}", name_font, text_width), font=name_font, fill='black')
+        for offset, line in enumerate((f"Matric: {matriculation_number}", f"Level: {level}", f"ID: {student_id}"), start=1):
+            draw.text((text_x, text_y + px(2) + offset * px(5)), _fit_text(draw, line, body_font, text_width), font=body_font, fill='#333333')
+
+    buffer = io.BytesIO()
+    if image_format == 'jpeg':
+        page.save(buffer, 'JPEG', quality=90, dpi=(ID_CARD_DPI, ID_CARD_DPI))
+    else:
+        page.save(buffer, 'PNG', dpi=(ID_CARD_DPI, ID_CARD_DPI))
+    return buffer.getvalue()
+
+
+def iter_pdf_from_jpeg_pages(pages, page_width_px, page_height_px):
+    """
+    Streams a PDF with one full-page JPEG per page, writing each page as soon as it arrives.
+    The page tree (object 2) is written last, once the page count is known; PDF allows any object order.
+    """
+    width_pt = page_width_px * 72 / ID_CARD_DPI
+    height_pt = page_height_px * 72 / ID_CARD_DPI
+    offsets = {}
+    position = 0
+    page_ids = []
+
+    def emit(object_id, body):
+        nonlocal position
+        offsets[object_id] = position
+        data = f"{object_id} 0 obj\n".encode('ascii') + body + b"\nendobj\n"
+        position += len(data)
+        return data
+
+    header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    position = len(header)
+    yield header
+    yield emit(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+    next_id = 3
+    for jpeg in pages:
+        image_id, content_id, page_id = next_id, next_id + 1, next_id + 2
+        next_id += 3
+        yield emit(image_id, (
+            f"<< /Type /XObject /Subtype /Image /Width {page_width_px} /Height {page_height_px} "
+            f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>\nstream\n"
+        ).encode('ascii') + jpeg + b"\nendstream")
+        content = f"q {width_pt:.2f} 0 0 {height_pt:.2f} 0 0 cm /Im0 Do Q".encode('ascii')
+        yield emit(content_id, f"<< /Length {len(content)} >>\nstream\n".encode('ascii') + content + b"\nendstream")
+        yield emit(page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width_pt:.2f} {height_pt:.2f}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode('ascii'))
+        page_ids.append(page_id)
+
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    yield emit(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode('ascii'))
+
+    xref = [f"xref\n0 {next_id}\n", "0000000000 65535 f \n"]
+    xref.extend(f"{offsets[object_id]:010d} 00000 n \n" for object_id in range(1, next_id))
+    xref.append(f"trailer\n<< /Size {next_id} /Root 1 0 R >>\nstartxref\n{position}\n%%EOF\n")
+    yield "".join(xref).encode('ascii')
+
+
+class _ChunkSink:
+    """Write-only, unseekable file object that zipfile writes into while the response drains it."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_zip_from_pages(pages, name_prefix):
+    """Streams a ZIP (stored, PNGs are already compressed) containing one file per page."""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for page_number, png in enumerate(pages, start=1):
+            archive.writestr(f"{name_prefix}-{page_number:03d}.png", png)
+            yield sink.drain()
+    yield sink.drain() # Central directory, written on close
+
+
+@app.route('/student/qr.<any(png, svg):image_format>', methods=['GET'])
+@login_required # Protect this route
+def get_student_qr_image(user, image_format):
     """
-    Retrieves the course schedule (sessions) for the logged-in student
-    based on their enrollments in studentsenrolledcourses.
+    Returns the logged-in student's QR code as a PNG or SVG image.
     Requires 'student' role.
+    The ETag is derived from qr_code_data, so an unchanged code is answered with 304 Not Modified.
     """
-    user_account_id, role, student_id = user # student_id is the entity_id from useraccounts
+    user_account_id, role, student_id = user # Unpack the user tuple from the decorator
 
+    # --- Role Check: Ensure only students can access this route ---
     if role != 'student':
-        return jsonify({"error": "Access forbidden. Only students can view their schedule."}), 403
+        return jsonify({"error": "Access forbidden. Only students can access their QR code."}), 403
 
     conn = None
     cur = None
-    schedule_data = []
-
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
+        cur = conn.cursor()
+        cur.execute("SELECT qr_code_data FROM students WHERE student_id = %s;", (student_id,))
+        row = cur.fetchone()
+    except psycopg2.Error as e:
+        log.error("Database error fetching student QR data: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+    if row is None:
+        return jsonify({"error": "Student profile not found."}), 404
+    if not row[0]:
+        return jsonify({"error": "QR code data has not been generated for this student yet."}), 404
+
+    digest = qr_image_digest(row[0], image_format)
+    if request.if_none_match.contains_weak(digest):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(get_qr_image(row[0], image_format, digest), mimetype=QR_IMAGE_MIMETYPES[image_format])
+    response.set_etag(digest, weak=True) # Weak: the SVG may also be served gzip/br encoded
+    response.cache_control.private = True
+    response.cache_control.no_cache = True # Always revalidate; the URL is stable while the code can change
+    return response
+# --- QR Image Rendering Ends Here ---
+
+
+# --- Protected Student Dashboard Routes ---
+@app.route('/student/schedule', methods=['GET'])
+@login_required
+def get_student_schedule(user):
+    """
+    Retrieves the course schedule (sessions) for the logged-in student
+    based on their enrollments in studentsenrolledcourses.
+    Requires 'student' role.
+    """
+    user_account_id, role, student_id = user # student_id is the entity_id from useraccounts
+
+    if role != 'student':
+        return jsonify({"error": "Access forbidden. Only students can view their schedule."}), 403
+
+    conn = None
+    cur = None
+    schedule_data = []
+
+    try:
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
         # SQL query updated to use the correct column name: term_name
-        sql = """
+        sql = f"""
             SELECT
                 c.course_id,
                 c.course_code,
@@ -1807,9 +4047,11 @@ def get_student_schedule(user):
             JOIN academicyears ay ON sec.academic_year_id = ay.academic_year_id
             JOIN coursesassignedtolecturers cal ON c.course_id = cal.course_id AND sec.academic_year_id = cal.academic_year_id
             LEFT JOIN attendancesessions s ON cal.assignment_id = s.assignment_id
+                AND {soft_deleted_filter('attendance_session', 's.session_id')}
             LEFT JOIN lecturers l ON cal.lecturer_id = l.lecturer_id
             LEFT JOIN useraccounts u ON l.user_account_id = u.user_account_id
             WHERE sec.student_id = %s -- Filter using student_id (assuming this spelling is correct)
+              AND {soft_deleted_filter('course', 'c.course_id')}
             ORDER BY s.session_datetime NULLS LAST, c.course_code; -- Order by session time, courses without sessions last
         """
         # Use the student_id obtained from the authenticated user's entity_id
@@ -1820,7 +4062,7 @@ def get_student_schedule(user):
         return jsonify(schedule_data), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching student schedule: {e}")
+        log.error("Database error fetching student schedule: %s", e)
         error_message = str(e)
         # Check if the error is specifically about table/column names
         if "relation \"studentsenrolledcourses\" does not exist" in error_message or \
@@ -1835,7 +4077,7 @@ def get_student_schedule(user):
              return jsonify({"error": "Configuration error: One or more table/column names are incorrect. Check spelling against your database schema."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching student schedule: {e}")
+        log.exception("An unexpected error occurred fetching student schedule: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -1863,12 +4105,12 @@ def get_student_attendance(user):
     attendance_summary = {}
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
         # 1. Fetch detailed attendance records for this student
         # SQL query updated to use the correct column name: term_name
-        sql_records = """
+        sql_records = f"""
             SELECT
                 ar.record_id,
                 ar.attendance_time,
@@ -1886,6 +4128,8 @@ def get_student_attendance(user):
             JOIN academicyears ay ON cal.academic_year_id = ay.academic_year_id -- *** Correct table name ***
             JOIN studentsenrolledcourses sec ON ar.student_id = sec.student_id AND c.course_id = sec.course_id AND ay.academic_year_id = sec.academic_year_id
             WHERE ar.student_id = %s
+              AND {soft_deleted_filter('attendance_session', 's.session_id')}
+              AND {soft_deleted_filter('course', 'c.course_id')}
             ORDER BY ar.attendance_time DESC;
         """
         cur.execute(sql_records, (student_id,))
@@ -1893,7 +4137,7 @@ def get_student_attendance(user):
 
         # 2. Calculate attendance summary
         # SQL query updated to use the correct column name: term_name
-        sql_summary = """
+        sql_summary = f"""
             SELECT
                 ar.status,
                 COUNT(*) as count
@@ -1903,6 +4147,8 @@ def get_student_attendance(user):
             JOIN academicyears ay ON cal.academic_year_id = ay.academic_year_id -- *** Correct table name ***
             JOIN studentsenrolledcourses sec ON ar.student_id = sec.student_id AND cal.course_id = sec.course_id AND ay.academic_year_id = sec.academic_year_id
             WHERE ar.student_id = %s
+              AND {soft_deleted_filter('attendance_session', 's.session_id')}
+              AND {soft_deleted_filter('course', 'cal.course_id')}
             GROUP BY ar.status;
         """
         cur.execute(sql_summary, (student_id,))
@@ -1917,7 +4163,7 @@ def get_student_attendance(user):
         }), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching student attendance: {e}")
+        log.error("Database error fetching student attendance: %s", e)
         error_message = str(e)
         # Check if the error is specifically about table/column names for common typos
         if "relation \"studentsenrolledcourses\" does not exist" in error_message or \
@@ -1933,7 +4179,7 @@ def get_student_attendance(user):
              return jsonify({"error": "Configuration error: One or more table/column names are incorrect. Check spelling against your database schema."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching student attendance: {e}")
+        log.exception("An unexpected error occurred fetching student attendance: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -1966,14 +4212,14 @@ def get_student_enrolled_courses(user):
     enrolled_courses_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         # Use RealDictCursor to easily access data by column name
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
         # Fetch details of courses the student is enrolled in
         # Join courses and academicyears for details
         # *** VERIFY TABLE NAMES AND COLUMN NAMES ***
-        sql = """
+        sql = f"""
             SELECT
                 sec.enrollment_id, -- Assuming a unique ID for enrollment
                 sec.course_id,
@@ -1989,6 +4235,7 @@ def get_student_enrolled_courses(user):
             JOIN courses c ON sec.course_id = c.course_id -- *** Join courses table ***
             JOIN academicyears ay ON sec.academic_year_id = ay.academic_year_id -- *** Join academicyears table ***
             WHERE sec.student_id = %s -- Filter using the student_id from the authenticated user
+              AND {soft_deleted_filter('course', 'c.course_id')}
             ORDER BY ay.year DESC, ay.term_name, c.course_code; -- Order by year, term, course code
         """
         # Note: Adjust column names (enrollment_id, course_id, academic_year_id, enrollment_date,
@@ -2010,10 +4257,10 @@ def get_student_enrolled_courses(user):
         return jsonify(enrolled_courses_list), 200 # Return the list of enrolled courses
 
     except psycopg2.Error as e:
-        print(f"Database error fetching student enrolled courses: {e}")
+        log.error("Database error fetching student enrolled courses: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching student enrolled courses: {e}")
+        log.exception("An unexpected error occurred fetching student enrolled courses: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2065,7 +4312,7 @@ def change_student_password(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- Verify Old Password ---
@@ -2076,7 +4323,7 @@ def change_student_password(user):
 
         if user_account is None:
             # This case should ideally not be reached if token is valid, but good safeguard
-            print(f"Error: User account not found for user_account_id {user_account_id} during password change.")
+            log.error("User account not found for user_account_id %s during password change.", user_account_id)
             return jsonify({"error": "User account not found."}), 404 # Or 401/500
 
         stored_password = user_account[0]
@@ -2087,7 +4334,7 @@ def change_student_password(user):
 
 
         # --- Hash the New Password ---
-        hashed_new_password = generate_password_hash(new_password)
+        hashed_new_password = hash_password(new_password)
 
 
         # --- Update the Password in the Database ---
@@ -2112,12 +4359,12 @@ def change_student_password(user):
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during password change: {e}")
+        log.error("Database error during password change: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during password change: {e}")
+        log.exception("An unexpected error occurred during password change: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2180,7 +4427,7 @@ def update_student_profile(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for executions
 
         # --- Optional Validation for Specific Fields ---
@@ -2225,19 +4472,19 @@ def update_student_profile(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during student profile update: {e}")
+        log.error("Database integrity error during student profile update: %s", e)
         # Might happen if a unique constraint is violated (e.g., updating email if it's unique)
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during student profile update: {e}")
+        log.error("Database error during student profile update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during student profile update: {e}")
+        log.exception("An unexpected error occurred during student profile update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2263,7 +4510,7 @@ def list_relevant_notifications_for_student(user):
     notifications_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # --- Get Context for Filtering (Student's Department and Enrolled Courses) ---
@@ -2271,13 +4518,8 @@ def list_relevant_notifications_for_student(user):
         cur.execute("SELECT department_id FROM students WHERE student_id = %s;", (student_id,))
         student_dept_row = cur.fetchone()
 
-        # --- DEBUG PRINT ---
-        print(f"DEBUG: student_id: {student_id}")
-        print(f"DEBUG: student_dept_row: {student_dept_row} (Type: {type(student_dept_row)})")
-        # --- END DEBUG PRINT ---
-
         if student_dept_row is None:
-             print(f"Error: Student department not found for student_id {student_id} during notification fetch.")
+             log.error("Student department not found for student_id %s during notification fetch.", student_id)
              return jsonify({"error": "Student department not found."}), 404 # Changed to 404 Not Found
 
         # Access department_id from the fetched row (should be a dictionary)
@@ -2293,17 +4535,10 @@ def list_relevant_notifications_for_student(user):
         cur.execute(sql_get_student_courses, (student_id,))
         fetched_courses = cur.fetchall() # Fetch all results first
 
-        # --- DEBUG PRINT ---
-        print(f"DEBUG: fetched_courses from sql_get_student_courses: {fetched_courses} (Type: {type(fetched_courses)})")
-        # --- END DEBUG PRINT ---
-
         # Process the fetched list into just a list of course IDs
         student_enrolled_course_ids = [row['course_id'] for row in fetched_courses]
 
-        # --- DEBUG PRINT ---
-        print(f"DEBUG: student_department_id: {student_department_id} (Type: {type(student_department_id)})") # Print again after getting value
-        print(f"DEBUG: student_enrolled_course_ids: {student_enrolled_course_ids} (Type: {type(student_enrolled_course_ids)})")
-        # --- END DEBUG PRINT ---
+        log.debug("Notification filters for student %s: department %s, courses %s", student_id, student_department_id, student_enrolled_course_ids)
 
 
         # --- Fetch Relevant Notifications Data ---
@@ -2345,7 +4580,7 @@ def list_relevant_notifications_for_student(user):
 
     except psycopg2.Error as e:
         # ... (database error handling) ...
-        print(f"Database error fetching student notifications: {e}")
+        log.error("Database error fetching student notifications: %s", e)
         error_message = str(e)
         # Add checks for specific table/column names if needed
         # The "tuple index out of range" is likely happening before here, but keep this general catch
@@ -2354,7 +4589,7 @@ def list_relevant_notifications_for_student(user):
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         # ... (general error handling) ...
-        print(f"An unexpected error occurred fetching student notifications: {e}")
+        log.exception("An unexpected error occurred fetching student notifications: %s", e)
         # The "tuple index out of range" error will likely be printed here
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
@@ -2367,6 +4602,100 @@ def list_relevant_notifications_for_student(user):
 
 # --- Protected Lecturer Dashboard Routes (Attendance Management) ---
 
+# --- Lecturer Ownership Index ---
+# Lecturer routes must prove the lecturer owns the assignment/session they touch. Instead of joining
+# coursesassignedtolecturers on every request, each worker keeps lecturer -> assignments -> sessions in memory,
+# loaded lazily with one query per lecturer. Assignment and session CRUD routes invalidate it; entries also
+# expire after LECTURER_OWNERSHIP_TTL_SECONDS because other gunicorn workers cannot see those invalidations.
+# A miss reloads once before denying, so sessions created on another worker are found immediately.
+# A cached hit can be stale for up to the TTL, so routes that write repeat the check inside the write statement
+# itself (lecturer_owns_session_sql): a lecturer whose session was reassigned or deleted on any worker writes
+# nothing, and the route drops the stale entry and answers 404. That costs no extra round trip.
+LECTURER_OWNERSHIP_TTL_SECONDS = int(os.environ.get('LECTURER_OWNERSHIP_TTL_SECONDS', 30))
+
+_lecturer_ownership = {} # str(lecturer_id) -> (loaded_at, {assignment_id: {course_id, academic_year_id}}, {session_id: assignment_id})
+_lecturer_ownership_lock = threading.Lock()
+
+
+def load_lecturer_ownership(conn, lecturer_id):
+    """Reads every assignment and session owned by a lecturer in one query and caches the result."""
+    assignments = {}
+    sessions = {}
+    ensure_support_tables() # pendingdeletions hides soft-deleted sessions and courses
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT ca.assignment_id, ca.course_id, ca.academic_year_id, ats.session_id
+            FROM coursesassignedtolecturers ca
+            LEFT JOIN attendancesessions ats ON ats.assignment_id = ca.assignment_id
+                AND {soft_deleted_filter('attendance_session', 'ats.session_id')}
+            WHERE ca.lecturer_id = %s
+              AND {soft_deleted_filter('course', 'ca.course_id')};
+        """, (lecturer_id,))
+        for assignment_id, course_id, academic_year_id, session_id in cur.fetchall():
+            assignments[str(assignment_id)] = {'course_id': course_id, 'academic_year_id': academic_year_id}
+            if session_id is not None:
+                sessions[str(session_id)] = str(assignment_id)
+    entry = (time.monotonic(), assignments, sessions)
+    with _lecturer_ownership_lock:
+        _lecturer_ownership[str(lecturer_id)] = entry
+    return entry
+
+
+def get_lecturer_ownership(conn, lecturer_id):
+    """Returns the cached (loaded_at, assignments, sessions) entry for a lecturer, loading it if missing or stale."""
+    entry = _lecturer_ownership.get(str(lecturer_id))
+    if entry is None or time.monotonic() - entry[0] > LECTURER_OWNERSHIP_TTL_SECONDS:
+        entry = load_lecturer_ownership(conn, lecturer_id)
+    return entry
+
+
+def lecturer_assignment_info(conn, lecturer_id, assignment_id):
+    """{'course_id', 'academic_year_id'} if the lecturer owns the assignment, otherwise None."""
+    loaded_at, assignments, sessions = get_lecturer_ownership(conn, lecturer_id)
+    info = assignments.get(str(assignment_id))
+    if info is None and time.monotonic() - loaded_at > 1:
+        info = load_lecturer_ownership(conn, lecturer_id)[1].get(str(assignment_id))
+    if info is not None and is_soft_deleted('course', info['course_id']):
+        return None
+    return info
+
+
+def lecturer_session_assignment(conn, lecturer_id, session_id):
+    """The owning assignment_id if the session belongs to one of the lecturer's assignments, otherwise None."""
+    loaded_at, assignments, sessions = get_lecturer_ownership(conn, lecturer_id)
+    assignment_id = sessions.get(str(session_id))
+    if assignment_id is None and time.monotonic() - loaded_at > 1:
+        assignment_id = load_lecturer_ownership(conn, lecturer_id)[2].get(str(session_id))
+    if assignment_id is not None and (is_soft_deleted('attendance_session', session_id)
+                                      or is_soft_deleted('course', assignments.get(assignment_id, {}).get('course_id'))):
+        return None
+    return assignment_id
+
+
+def lecturer_owns_session_sql(session_column):
+    """
+    SQL condition, with one %s placeholder for the lecturer_id, that holds while `session_column` is a live session
+    of one of the lecturer's assignments. Write statements include it so a stale cache hit cannot write.
+    """
+    return f"""EXISTS (
+        SELECT 1 FROM attendancesessions owner_ats
+        JOIN coursesassignedtolecturers owner_ca ON owner_ca.assignment_id = owner_ats.assignment_id
+        WHERE owner_ats.session_id = {session_column} AND owner_ca.lecturer_id = %s
+          AND {soft_deleted_filter('attendance_session', 'owner_ats.session_id')}
+          AND {soft_deleted_filter('course', 'owner_ca.course_id')}
+    )"""
+
+
+def invalidate_lecturer_ownership(lecturer_id=None):
+    """Drops one lecturer's cached ownership, or every lecturer's when lecturer_id is None."""
+    with _lecturer_ownership_lock:
+        if lecturer_id is None:
+            _lecturer_ownership.clear()
+        else:
+            _lecturer_ownership.pop(str(lecturer_id), None)
+# --- Lecturer Ownership Index Ends Here ---
+
+
 @app.route('/lecturer/profile', methods=['GET'])
 @login_required # Apply the decorator to protect this route
 def get_lecturer_profile(user):
@@ -2387,7 +4716,7 @@ def get_lecturer_profile(user):
     cur = None
     lecturer_profile = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         # Use RealDictCursor to easily access data by column name
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
@@ -2417,17 +4746,17 @@ def get_lecturer_profile(user):
 
         if lecturer_profile is None:
             # This should ideally not happen if the entity_id in useraccounts is correct
-            print(f"Error: Lecturer profile not found for user_account_id {user_account_id} with lecturer_id {lecturer_id}")
+            log.error("Lecturer profile not found for user_account_id %s with lecturer_id %s", user_account_id, lecturer_id)
             return jsonify({"error": "Lecturer profile not found."}), 404
 
         return jsonify(lecturer_profile), 200 # Return the lecturer profile data
 
     except psycopg2.Error as e:
-        print(f"Database error fetching lecturer profile: {e}")
+        log.error("Database error fetching lecturer profile: %s", e)
         # Add checks for specific table/column names if needed, like we did for student routes
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching lecturer profile: {e}")
+        log.exception("An unexpected error occurred fetching lecturer profile: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2455,12 +4784,12 @@ def get_lecturer_assigned_courses(user):
     assigned_courses = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select courses assigned to this lecturer
         # Join coursesassignedtolecturers with courses and academicyears for details
-        sql = """
+        sql = f"""
             SELECT
                 cal.assignment_id, -- The assignment identifier
                 c.course_id,
@@ -2474,6 +4803,7 @@ def get_lecturer_assigned_courses(user):
             JOIN courses c ON cal.course_id = c.course_id -- Correct table name
             JOIN academicyears ay ON cal.academic_year_id = ay.academic_year_id -- *** Correct table name ***
             WHERE cal.lecturer_id = %s -- *** Filter by the lecturer_id from the authenticated user's entity_id ***
+              AND {soft_deleted_filter('course', 'c.course_id')}
             ORDER BY ay.term_name DESC, c.course_code; -- Order by academic year and course code (check column name for year name)
         """
         # Use the lecturer_id obtained from the authenticated user's entity_id
@@ -2484,7 +4814,7 @@ def get_lecturer_assigned_courses(user):
         return jsonify(assigned_courses), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching lecturer assigned courses: {e}")
+        log.error("Database error fetching lecturer assigned courses: %s", e)
         # Add checks for specific table/column names if needed
         error_message = str(e)
         if "relation \"coursesassignedtolecturers\" does not exist" in error_message or \
@@ -2497,7 +4827,7 @@ def get_lecturer_assigned_courses(user):
              return jsonify({"error": "Configuration error: One or more table/column names are incorrect. Check spelling against your database schema."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching lecturer assigned courses: {e}")
+        log.exception("An unexpected error occurred fetching lecturer assigned courses: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2524,7 +4854,7 @@ def get_lecturer_assignment_sessions(user, assignment_id):
     sessions_data = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
         # --- Security Check: Verify the assignment belongs to the logged-in lecturer ---
@@ -2543,7 +4873,7 @@ def get_lecturer_assignment_sessions(user, assignment_id):
 
 
         # --- Fetch Sessions for the Assignment ---
-        sql_sessions = """
+        sql_sessions = f"""
             SELECT
                 s.session_id,
                 s.session_datetime,
@@ -2553,6 +4883,7 @@ def get_lecturer_assignment_sessions(user, assignment_id):
                 s.assignment_id -- Include assignment_id for context
             FROM attendancesessions s -- *** Correct table name ***
             WHERE s.assignment_id = %s -- Filter by the assignment ID from the URL
+              AND {soft_deleted_filter('attendance_session', 's.session_id')}
             ORDER BY s.session_datetime; -- Order sessions chronologically
         """
         # Use the assignment_id from the URL path parameter
@@ -2563,7 +4894,7 @@ def get_lecturer_assignment_sessions(user, assignment_id):
         return jsonify(sessions_data), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching assignment sessions: {e}")
+        log.error("Database error fetching assignment sessions: %s", e)
         # Add checks for specific table/column names if needed
         error_message = str(e)
         if "relation \"coursesassignedtolecturers\" does not exist" in error_message or \
@@ -2572,7 +4903,7 @@ def get_lecturer_assignment_sessions(user, assignment_id):
              return jsonify({"error": "Configuration error: One or more table/column names are incorrect. Check spelling against your database schema."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching assignment sessions: {e}")
+        log.exception("An unexpected error occurred fetching assignment sessions: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2588,6 +4919,7 @@ def get_students_for_lecturer_assignment(user, assignment_id):
     of a specific course assignment.
     Requires 'lecturer' role.
     Requires the assignment to be assigned to the logged-in lecturer.
+    Query parameters: include=stats adds each student's attended, sessions_held, percentage, eligible and last_seen.
     """
     user_account_id, role, lecturer_id = user # Unpack the user tuple; entity_id is the lecturer_id
 
@@ -2595,24 +4927,19 @@ def get_students_for_lecturer_assignment(user, assignment_id):
     if role != 'lecturer':
         return jsonify({"error": "Access forbidden. Only lecturers can view student lists for assignments."}), 403
 
+    include_stats = 'stats' in request.args.get('include', '').split(',')
+
     conn = None
     cur = None
     students_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # --- Security Check: Verify the assignment belongs to the logged-in lecturer and get course/year IDs ---
-        # This query checks ownership and gets the necessary course_id and academic_year_id for filtering studentsenrolledcourses
-        # *** VERIFY 'coursesassignedtolecturers' TABLE NAME AND COLUMNS ***
-        sql_verify_assignment_owner = """
-            SELECT cal.course_id, cal.academic_year_id
-            FROM coursesassignedtolecturers cal -- Correct table name
-            WHERE cal.assignment_id = %s AND cal.lecturer_id = %s; -- Check both assignment ID and logged-in lecturer ID
-        """
-        cur.execute(sql_verify_assignment_owner, (assignment_id, lecturer_id))
-        assignment_info = cur.fetchone()
+        # The cached ownership index also carries the course_id and academic_year_id needed to filter studentsenrolledcourses
+        assignment_info = lecturer_assignment_info(conn, lecturer_id, assignment_id)
 
         if assignment_info is None:
             # Assignment not found OR it doesn't belong to this lecturer
@@ -2624,37 +4951,56 @@ def get_students_for_lecturer_assignment(user, assignment_id):
 
         # --- Fetch Students Enrolled in this Course and Academic Year ---
         # Query studentsenrolledcourses, filtering by the course_id and academic_year_id from the assignment
-        # Join students table for student details
+        # Join students table for student details; with include=stats, also the maintained eligibility row,
+        # so a roster with per-student attendance stays a single indexed join
         # *** VERIFY TABLE NAMES AND COLUMN NAMES ***
-        sql_students = """
+        stats_columns = ""
+        stats_join = ""
+        if include_stats:
+            refresh_attendance_stats(conn) # Folds in attendance written since the last refresh
+            stats_columns = """,
+                COALESCE(e.attended, 0) AS attended,
+                COALESCE(e.sessions_held, 0) AS sessions_held,
+                e.percentage::FLOAT AS percentage,
+                COALESCE(e.eligible, TRUE) AS eligible,
+                e.last_seen"""
+            stats_join = """
+            LEFT JOIN attendanceeligibility e
+                   ON e.student_id = sec.student_id AND e.course_id = sec.course_id AND e.academic_year_id = sec.academic_year_id"""
+        sql_students = f"""
             SELECT
                 sec.enrollment_id, -- Optional, but good to include enrollment context
                 sec.student_id,    -- FK to students
                 s.first_name,      -- From joined students
                 s.last_name,       -- From joined students
-                s.matriculation_number -- From joined students
+                s.matriculation_number{stats_columns} -- From joined students
                 -- Include other student profile columns relevant for a class list if needed
             FROM studentsenrolledcourses sec -- *** Use the correct table name ***
-            JOIN students s ON sec.student_id = s.student_id -- *** Join students table ***
+            JOIN students s ON sec.student_id = s.student_id -- *** Join students table ***{stats_join}
             WHERE sec.course_id = %s AND sec.academic_year_id = %s -- *** Filter by the course and year of the assignment ***
+              AND {soft_deleted_filter('student', 's.student_id')}
             ORDER BY s.last_name, s.first_name; -- Order by student name
         """
         # Use the course_id and academic_year_id obtained from the assignment
         cur.execute(sql_students, (course_id, academic_year_id))
 
         students_list = cur.fetchall()
+        if include_stats:
+            for student in students_list:
+                if student['last_seen']:
+                    student['last_seen'] = student['last_seen'].isoformat()
 
         return jsonify(students_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching students for assignment {assignment_id}: {e}")
+        log.error("Database error fetching students for assignment %s: %s", assignment_id, e)
         # Add checks for specific table/column names if needed
         error_message = str(e)
         if "relation \"" in error_message or "column \"" in error_message or "missing FROM-clause entry for table" in error_message:
             return jsonify({"error": "Configuration error: Database query error. Check table/column names and aliases."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching students for assignment {assignment_id}: {e}")
+        log.exception("An unexpected error occurred fetching students for assignment %s: %s", assignment_id, e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2662,6 +5008,261 @@ def get_students_for_lecturer_assignment(user, assignment_id):
         if conn:
             conn.close()
 
+# --- Attendance Register Export ---
+# The classic paper register: one row per enrolled student, one column per session holding P/A/L/E, then per-student
+# totals and a per-session "present" row at the bottom. Rows come from a server-side (named) cursor ordered by
+# assignment and student, so the pivot happens in a single pass holding one student's row at a time, and openpyxl's
+# write-only mode spools each finished row to disk. The workbook is saved to a temporary file and streamed back,
+# so a 1,000-student x 60-session register costs the same memory as a 10-student one. Finished workbooks also go
+# into the report cache, keyed on the assignment and course (or department) data versions.
+REGISTER_FETCH_SIZE = int(os.environ.get('REGISTER_FETCH_SIZE', 2000))
+REGISTER_STREAM_CHUNK_BYTES = 64 * 1024
+REGISTER_STATUS_MARKS = {'Present': 'P', 'Absent': 'A', 'Late': 'L', 'Excused': 'E'}
+REGISTER_ATTENDED_MARKS = ('P', 'L') # Counted as attended in the percentage and the per-session totals
+
+REGISTER_SESSIONS_SQL = f"""
+    SELECT ats.assignment_id, ats.session_id, ats.session_datetime, ats.session_datetime <= NOW() AS held
+    FROM attendancesessions ats
+    JOIN coursesassignedtolecturers ca ON ca.assignment_id = ats.assignment_id
+    JOIN courses c ON c.course_id = ca.course_id
+    WHERE ({{scope}})
+      AND {soft_deleted_filter('attendance_session', 'ats.session_id')}
+    ORDER BY ats.assignment_id, ats.session_datetime, ats.session_id;
+"""
+# One row per (student, attendance record); students without any record still get one row with NULL session
+REGISTER_ROWS_SQL = f"""
+    SELECT ca.assignment_id, c.course_code, c.course_title, ca.academic_year_id,
+           s.student_id, s.matriculation_number, s.last_name, s.first_name, ats.session_id, ar.status
+    FROM coursesassignedtolecturers ca
+    JOIN courses c ON c.course_id = ca.course_id
+    JOIN studentsenrolledcourses sec ON sec.course_id = ca.course_id AND sec.academic_year_id = ca.academic_year_id
+    JOIN students s ON s.student_id = sec.student_id
+    LEFT JOIN (attendancerecords ar JOIN attendancesessions ats ON ats.session_id = ar.session_id)
+           ON ats.assignment_id = ca.assignment_id AND ar.student_id = s.student_id
+          AND {soft_deleted_filter('attendance_session', 'ats.session_id')}
+    WHERE ({{scope}})
+      AND {soft_deleted_filter('student', 's.student_id')}
+      AND {soft_deleted_filter('course', 'c.course_id')}
+    ORDER BY ca.assignment_id, s.last_name, s.first_name, s.student_id;
+"""
+
+
+def register_sheet_title(course_code, assignment_id, used_titles):
+    """A unique worksheet title within Excel's 31-character limit and character rules."""
+    base = "".join(ch for ch in f"{course_code or 'Course'} ({assignment_id})" if ch not in '[]:*?/\\')[:31]
+    title, n = base, 2
+    while title.lower() in used_titles:
+        suffix = f" {n}"
+        title, n = base[:31 - len(suffix)] + suffix, n + 1
+    used_titles.add(title.lower())
+    return title
+
+
+def write_register_workbook(conn, scope_sql, scope_values, out_file):
+    """
+    Pivots the register rows for every assignment matched by `scope_sql` (a condition over ca/c) into one worksheet
+    per assignment of a write-only workbook saved to `out_file`. Returns the number of worksheets written.
+    """
+    with conn.cursor() as cur:
+        cur.execute(REGISTER_SESSIONS_SQL.format(scope=scope_sql), scope_values)
+        sessions_by_assignment = {}
+        for assignment_id, session_id, session_datetime, held in cur.fetchall():
+            sessions_by_assignment.setdefault(assignment_id, []).append((session_id, session_datetime, held))
+
+    workbook = openpyxl.Workbook(write_only=True)
+    bold = openpyxl.styles.Font(bold=True)
+    used_titles = set()
+    state = {'sheet': None}
+
+    def header_cell(value, sheet):
+        cell = openpyxl.cell.WriteOnlyCell(sheet, value=value)
+        cell.font = bold
+        return cell
+
+    def start_sheet(assignment_id, course_code, course_title, academic_year_id):
+        sessions = sessions_by_assignment.get(assignment_id, [])
+        sheet = workbook.create_sheet(register_sheet_title(course_code, assignment_id, used_titles))
+        sheet.freeze_panes = 'D3'
+        sheet.append([header_cell(f"{course_code} - {course_title}", sheet), f"Assignment {assignment_id}", f"Academic year {academic_year_id}"])
+        sheet.append([header_cell(label, sheet) for label in (
+            ["Matric No", "Last Name", "First Name"]
+            + [session_datetime.strftime('%d %b %Y %H:%M') if session_datetime else str(session_id) for session_id, session_datetime, _ in sessions]
+            + ["P", "A", "L", "E", "Held", "Attendance %"]
+        )])
+        state.update(sheet=sheet, assignment_id=assignment_id, sessions=sessions,
+                     column_of={session_id: index for index, (session_id, _, _) in enumerate(sessions)},
+                     held_count=sum(1 for _, _, held in sessions if held),
+                     session_attended=[0] * len(sessions), student=None, marks=None)
+
+    def flush_student():
+        if state['student'] is None:
+            return
+        marks = state['marks']
+        for index, (_, _, held) in enumerate(state['sessions']):
+            if marks[index] is None and held:
+                marks[index] = 'A' # No record for a session that has taken place
+            if marks[index] in REGISTER_ATTENDED_MARKS:
+                state['session_attended'][index] += 1
+        totals = {mark: marks.count(mark) for mark in ('P', 'A', 'L', 'E')}
+        attended = totals['P'] + totals['L']
+        held_count = state['held_count']
+        state['sheet'].append(
+            list(state['student']) + marks
+            + [totals['P'], totals['A'], totals['L'], totals['E'], held_count,
+               round(100.0 * attended / held_count, 1) if held_count else None]
+        )
+        state['student'] = None
+
+    def finish_sheet():
+        if state['sheet'] is None:
+            return
+        flush_student()
+        state['sheet'].append([])
+        state['sheet'].append([header_cell("Present (P+L)", state['sheet']), None, None] + state['session_attended'])
+
+    # Named cursor = server-side: rows arrive REGISTER_FETCH_SIZE at a time instead of all at once
+    with conn.cursor(name='attendance_register') as cur:
+        cur.itersize = REGISTER_FETCH_SIZE
+        cur.execute(REGISTER_ROWS_SQL.format(scope=scope_sql), scope_values)
+        for assignment_id, course_code, course_title, academic_year_id, student_id, matric, last_name, first_name, session_id, status in cur:
+            if assignment_id != state.get('assignment_id'):
+                finish_sheet()
+                start_sheet(assignment_id, course_code, course_title, academic_year_id)
+            if state['student'] is None or student_id != state['student_id']:
+                flush_student()
+                state.update(student=(matric, last_name, first_name), student_id=student_id, marks=[None] * len(state['sessions']))
+            column = state['column_of'].get(session_id)
+            if column is not None:
+                state['marks'][column] = REGISTER_STATUS_MARKS.get(status, (status or '?')[:1].upper())
+        finish_sheet()
+    conn.commit() # Closes the named cursor's transaction
+
+    sheet_count = len(workbook.worksheets)
+    if not sheet_count:
+        workbook.create_sheet("Register").append(["No enrolled students found."])
+    workbook.save(out_file)
+    return sheet_count
+
+
+def register_xlsx_response(out_file, filename):
+    """Streams a saved workbook from its temporary file, closing (and so deleting) the file afterwards."""
+    out_file.seek(0, os.SEEK_END)
+    size = out_file.tell()
+    out_file.seek(0)
+
+    def chunks():
+        try:
+            while True:
+                chunk = out_file.read(REGISTER_STREAM_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            out_file.close()
+    return app.response_class(chunks(), mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Content-Length": str(size)
+    })
+
+
+def cached_register_response(conn, scope_sql, scope_values, versions, filename):
+    """Serves a register from the report cache, or writes it (caching it when small enough) and streams it."""
+    cache_params = (scope_sql, tuple(scope_values))
+    body = get_cached_report('register', cache_params, versions)
+    if body is not None:
+        return register_xlsx_response(io.BytesIO(body), filename)
+
+    out_file = tempfile.TemporaryFile()
+    try:
+        write_register_workbook(conn, scope_sql, scope_values, out_file)
+        out_file.seek(0, os.SEEK_END)
+        if out_file.tell() <= REPORT_CACHE_MAX_BYTES // 4:
+            out_file.seek(0)
+            cache_report('register', cache_params, versions, out_file.read())
+        return register_xlsx_response(out_file, filename) # The response owns the file now
+    except BaseException:
+        out_file.close()
+        raise
+
+
+@app.route('/lecturer/assignments/<assignment_id>/register.xlsx', methods=['GET'])
+@login_required # Protect this route
+def get_lecturer_assignment_register(user, assignment_id):
+    """
+    Downloads the attendance register (students x sessions, P/A/L/E, totals) of one course assignment as XLSX.
+    Requires 'lecturer' role.
+    Requires the assignment to be assigned to the logged-in lecturer.
+    """
+    user_account_id, role, lecturer_id = user # Unpack the user tuple; entity_id is the lecturer_id
+
+    # --- Role Check ---
+    if role != 'lecturer':
+        return jsonify({"error": "Access forbidden. Only lecturers can download assignment registers."}), 403
+
+    conn = None
+    try:
+        conn = connect_db()
+        assignment_info = lecturer_assignment_info(conn, lecturer_id, assignment_id)
+        if assignment_info is None:
+            return jsonify({"error": "Assignment not found or you do not have permission to view its register."}), 404
+
+        # Course too: enrollment changes bump the course, not its assignments
+        versions = report_data_versions(conn, [('assignment', assignment_id), ('course', assignment_info['course_id'])])
+        return cached_register_response(conn, "ca.assignment_id = %s", (assignment_id,), versions, f"register-{assignment_id}.xlsx")
+
+    except psycopg2.Error as e:
+        log.error("Database error building register for assignment %s: %s", assignment_id, e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred building register for assignment %s: %s", assignment_id, e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if conn:
+            conn.close()
+
+
+@app.route('/admin/departments/<department_id>/register.xlsx', methods=['GET'])
+@login_required # Protect this route
+def get_department_register_for_admin(user, department_id):
+    """
+    Downloads the attendance registers of every course assignment in a department as one XLSX, one worksheet each.
+    Requires 'admin' role.
+    Query parameters: optional academic_year_id.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can download department registers."}), 403
+
+    academic_year_id = request.args.get('academic_year_id')
+    scope_sql = "c.department_id = %s"
+    scope_values = [department_id]
+    if academic_year_id:
+        scope_sql += " AND ca.academic_year_id = %s"
+        scope_values.append(academic_year_id)
+
+    conn = None
+    try:
+        conn = connect_db()
+        if department_id not in get_reference_data(conn)['department_ids']:
+            return jsonify({"error": "Department not found."}), 404
+
+        versions = report_data_versions(conn, [('department', department_id)])
+        filename = f"register-department-{department_id}" + (f"-{academic_year_id}" if academic_year_id else "") + ".xlsx"
+        return cached_register_response(conn, scope_sql, scope_values, versions, filename)
+
+    except psycopg2.Error as e:
+        log.error("Database error building register for department %s: %s", department_id, e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred building register for department %s: %s", department_id, e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if conn:
+            conn.close()
+# --- Attendance Register Export Ends Here ---
+
 @app.route('/lecturer/sessions', methods=['GET'])
 @login_required # Apply the decorator to protect this route
 def get_all_lecturer_sessions(user):
@@ -2681,14 +5282,14 @@ def get_all_lecturer_sessions(user):
     sessions_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all sessions linked to assignments assigned to this lecturer
         # Join through coursesassignedtolecturers to filter by lecturer_id
         # Join other tables for context (Course, Year)
         # *** VERIFY TABLE NAMES AND COLUMN NAMES ***
-        sql = """
+        sql = f"""
             SELECT
                 ats.session_id,      -- Primary key
                 ats.assignment_id,   -- FK to coursesassignedtolecturers
@@ -2707,6 +5308,8 @@ def get_all_lecturer_sessions(user):
             JOIN courses c ON ca.course_id = c.course_id -- *** Join courses table ***
             JOIN academicyears ay ON ca.academic_year_id = ay.academic_year_id -- *** Join academicyears table ***
             WHERE ca.lecturer_id = %s -- *** Filter by the logged-in lecturer's ID from the assignment table ***
+              AND {soft_deleted_filter('attendance_session', 'ats.session_id')}
+              AND {soft_deleted_filter('course', 'c.course_id')}
             ORDER BY ats.session_datetime DESC; -- Order sessions chronologically
         """
         # Note: Adjust column names and table names if your schema is different.
@@ -2728,14 +5331,14 @@ def get_all_lecturer_sessions(user):
         return jsonify(sessions_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching all lecturer sessions: {e}")
+        log.error("Database error fetching all lecturer sessions: %s", e)
         # Add checks for specific table/column names if needed
         error_message = str(e)
         if "relation \"" in error_message or "column \"" in error_message or "missing FROM-clause entry for table" in error_message:
             return jsonify({"error": "Configuration error: Database query error. Check table/column names and aliases."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching all lecturer sessions: {e}")
+        log.exception("An unexpected error occurred fetching all lecturer sessions: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2762,19 +5365,12 @@ def get_lecturer_session_attendance(user, session_id):
     attendance_records = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
         # --- Security Check: Verify the session belongs to an assignment owned by the logged-in lecturer ---
-        # Join sessions to assignments and check if the assignment belongs to this lecturer
-        sql_verify_session_ownership = """
-            SELECT s.session_id
-            FROM attendancesessions s -- Correct table name
-            JOIN coursesassignedtolecturers cal ON s.assignment_id = cal.assignment_id -- Correct table name
-            WHERE s.session_id = %s AND cal.lecturer_id = %s; -- Check both session ID and logged-in lecturer ID
-        """
-        cur.execute(sql_verify_session_ownership, (session_id, lecturer_id))
-        session_owner = cur.fetchone()
+        # Set membership against the cached ownership index (no join per request)
+        session_owner = lecturer_session_assignment(conn, lecturer_id, session_id)
 
         if session_owner is None:
             # Session not found OR its assignment doesn't belong to this lecturer
@@ -2784,7 +5380,7 @@ def get_lecturer_session_attendance(user, session_id):
         # --- Fetch Attendance Records for the Session ---
         # Join attendancerecords with students to get student names
         # *** MODIFIED: Corrected s.student_id to ar.student_id ***
-        sql_records = """
+        sql_records = f"""
             SELECT
                 ar.record_id,
                 ar.attendance_time,
@@ -2796,6 +5392,7 @@ def get_lecturer_session_attendance(user, session_id):
             FROM attendancerecords ar -- Use 'ar' alias
             JOIN students st ON ar.student_id = st.student_id -- Use 'st' alias
             WHERE ar.session_id = %s -- Filter by the session ID from the URL
+              AND {soft_deleted_filter('student', 'st.student_id')}
             ORDER BY st.matriculation_number; -- Order by student matric number
         """
         # Use the session_id from the URL path parameter
@@ -2806,14 +5403,14 @@ def get_lecturer_session_attendance(user, session_id):
         return jsonify(attendance_records), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching session attendance records: {e}")
+        log.error("Database error fetching session attendance records: %s", e)
         error_message = str(e)
         # Add checks for specific table/column names if needed
         if "relation \"" in error_message or "column \"" in error_message or "missing FROM-clause entry for table" in error_message:
              return jsonify({"error": "Configuration error: Database query error. Check table/column names and aliases."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching session attendance records: {e}")
+        log.exception("An unexpected error occurred fetching session attendance records: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -2857,19 +5454,12 @@ def submit_attendance_records_for_session(user, session_id):
 
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # --- Security Check: Verify the session belongs to an assignment owned by the logged-in lecturer ---
-        # Join sessions to assignments and check if the assignment belongs to this lecturer
-        sql_verify_session_ownership = """
-            SELECT s.session_id
-            FROM attendancesessions s -- Correct table name
-            JOIN coursesassignedtolecturers cal ON s.assignment_id = cal.assignment_id -- Correct table name
-            WHERE s.session_id = %s AND cal.lecturer_id = %s; -- Check both session ID and logged-in lecturer ID
-        """
-        cur.execute(sql_verify_session_ownership, (session_id, lecturer_id))
-        session_owner = cur.fetchone()
+        # Set membership against the cached ownership index rejects other lecturers without touching the database
+        session_owner = lecturer_session_assignment(conn, lecturer_id, session_id)
 
         if session_owner is None:
             # Session not found OR its assignment doesn't belong to this lecturer
@@ -2879,13 +5469,23 @@ def submit_attendance_records_for_session(user, session_id):
         # --- Validate and Prepare Records for Insertion ---
         # Fetch existing records for this session to quickly check for duplicates
         # This is more efficient than individual checks in the loop if there are many records
+        # The same statement re-checks ownership against the database (the cached hit may be stale): no row means
+        # the session is no longer this lecturer's
         # *** VERIFY 'attendancerecords' TABLE NAME AND 'session_id', 'student_id' COLUMNS ***
-        cur.execute("SELECT session_id, student_id FROM attendancerecords WHERE session_id = %s;", (session_id,))
-        existing_records = {(row[0], row[1]) for row in cur.fetchall()} # Store as a set of (session_id, student_id) tuples
+        cur.execute(f"""
+            SELECT owned.session_id, ar.student_id
+            FROM (SELECT %s AS session_id WHERE {lecturer_owns_session_sql('%s')}) owned
+            LEFT JOIN attendancerecords ar ON ar.session_id = %s;
+        """, (session_id, session_id, lecturer_id, session_id))
+        existing_rows = cur.fetchall()
+        if not existing_rows:
+            invalidate_lecturer_ownership(lecturer_id) # Reassigned or deleted on another worker
+            return jsonify({"error": "Session not found or you do not have permission to submit attendance for it."}), 404
+        existing_records = {(session_id, row[1]) for row in existing_rows if row[1] is not None} # Store as a set of (session_id, student_id) tuples
 
         # Fetch valid student IDs to validate incoming student_ids
         # *** VERIFY 'students' TABLE NAME AND 'student_id' COLUMN ***
-        cur.execute("SELECT student_id FROM students;") # Fetch all student IDs
+        cur.execute(f"SELECT s.student_id FROM students s WHERE {soft_deleted_filter('student', 's.student_id')};") # Fetch all student IDs
         valid_student_ids = {row[0] for row in cur.fetchall()} # Store as a set
 
         # Define allowed attendance statuses (adjust if needed)
@@ -2985,10 +5585,14 @@ def submit_attendance_records_for_session(user, session_id):
             # For more precise confirmation, individual inserts or a follow-up query is needed.
         }), 200 # 200 OK
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during batch attendance record submission for session {session_id}: {e}")
+        log.error("Database error during batch attendance record submission for session %s: %s", session_id, e)
         # This could happen if FK constraints fail despite manual check (very rare),
         # or other DB issues during batch insert.
         return jsonify({"error": f"Database error during submission: {e}"}), 500
@@ -2996,7 +5600,7 @@ def submit_attendance_records_for_session(user, session_id):
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during batch attendance record submission for session {session_id}: {e}")
+        log.exception("An unexpected error occurred during batch attendance record submission for session %s: %s", session_id, e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -3039,7 +5643,7 @@ def create_attendance_session(user):
     cur_dict = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Use standard cursor for simple fetches by index
         cur_dict = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use dict cursor for SELECTs and returning dict
 
@@ -3084,6 +5688,7 @@ def create_attendance_session(user):
 
 
         conn.commit()
+        invalidate_lecturer_ownership(entity_id_lecturer)
 
         # Format timestamps (like session_datetime, qr_code_expiry_time, and created_at if you return it) to ISO 8601 string for JSON response
         if new_session_details:
@@ -3101,9 +5706,13 @@ def create_attendance_session(user):
             "session": new_session_details # Return the details of the new session
         }), 201 # 201 Created
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
          if conn: conn.rollback()
-         print(f"Integrity error creating attendance session: {e}")
+         log.error("Integrity error creating attendance session: %s", e)
          # Handle potential foreign key violation if assignment ID is invalid in attendancesessions
          # or other integrity errors
          error_message = str(e)
@@ -3114,11 +5723,11 @@ def create_attendance_session(user):
 
     except psycopg2.Error as e:
         if conn: conn.rollback()
-        print(f"Database error creating attendance session: {e}")
+        log.error("Database error creating attendance session: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn: conn.rollback()
-        print(f"An unexpected error occurred creating attendance session: {e}")
+        log.exception("An unexpected error occurred creating attendance session: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -3165,21 +5774,17 @@ def update_lecturer_attendance_record(user, record_id):
     cur_fetch = None # Cursor for fetching updated details
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for executions
 
         # --- Security Check: Verify the record exists and belongs to a session owned by the logged-in lecturer ---
-        # Join attendancerecords to sessions and assignments to check ownership
-        # *** VERIFY TABLE NAMES AND COLUMN NAMES ***
-        sql_verify_record_ownership = """
-            SELECT atr.record_id
-            FROM attendancerecords atr -- Correct alias
-            JOIN attendancesessions ats ON atr.session_id = ats.session_id -- Correct table names
-            JOIN coursesassignedtolecturers cal ON ats.assignment_id = cal.assignment_id -- Correct table names
-            WHERE atr.record_id = %s AND cal.lecturer_id = %s; -- Check record ID and logged-in lecturer ID
-        """
-        cur.execute(sql_verify_record_ownership, (record_id, lecturer_id))
-        record_owner = cur.fetchone()
+        # Primary-key lookup of the record's session, then set membership against the cached ownership index
+        # (the UPDATE below repeats the ownership check in SQL, in case the cached hit is stale)
+        cur.execute("SELECT session_id FROM attendancerecords WHERE record_id = %s;", (record_id,))
+        record_session = cur.fetchone()
+        record_owner = None
+        if record_session is not None and lecturer_session_assignment(conn, lecturer_id, record_session[0]) is not None:
+            record_owner = record_session
 
         if record_owner is None:
             # Record not found OR it does not belong to a session taught by this lecturer
@@ -3238,15 +5843,18 @@ def update_lecturer_attendance_record(user, record_id):
         sql_update = f"""
             UPDATE attendancerecords -- *** Use the correct table name ***
             SET {', '.join(set_clauses)}
-            WHERE record_id = %s; -- Filter by the record_id from the URL path
+            WHERE record_id = %s -- Filter by the record_id from the URL path
+              AND {lecturer_owns_session_sql('attendancerecords.session_id')};
         """
-        execute_values = list(update_data.values()) + [record_id]
+        execute_values = list(update_data.values()) + [record_id, lecturer_id]
 
         cur.execute(sql_update, execute_values)
 
         if cur.rowcount == 0:
-             # This might happen if record_id from check didn't translate to update
-             return jsonify({"message": "Attendance record found, but no changes were applied (data might be the same or invalid fields provided)."}), 200
+             # The record was deleted meanwhile, or its session is no longer this lecturer's (stale cached ownership)
+             conn.rollback()
+             invalidate_lecturer_ownership(lecturer_id)
+             return jsonify({"error": "Attendance record not found or you do not have permission to update it."}), 404
 
 
         conn.commit()
@@ -3283,10 +5891,14 @@ def update_lecturer_attendance_record(user, record_id):
         return jsonify(updated_record_details), 200 # Return updated details
 
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during attendance record update: {e}")
+        log.error("Database integrity error during attendance record update: %s", e)
         # This shouldn't happen if allowed_updatable_fields prevents FK/unique constraint columns,
         # but included for safety.
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
@@ -3294,13 +5906,13 @@ def update_lecturer_attendance_record(user, record_id):
     except (psycopg2.Error, ValueError, TypeError) as e: # Catch DB errors and parsing errors
         if conn:
             conn.rollback()
-        print(f"Database or data processing error during attendance record update: {e}")
+        log.error("Database or data processing error during attendance record update: %s", e)
         # Specific checks for e type might be needed for more granular error responses
         return jsonify({"error": f"Database or data processing error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance record update: {e}")
+        log.exception("An unexpected error occurred during attendance record update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -3354,7 +5966,7 @@ def change_lecturer_password(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- Verify Old Password ---
@@ -3365,7 +5977,7 @@ def change_lecturer_password(user):
 
         if user_account is None:
             # This case should ideally not be reached if token is valid, but good safeguard
-            print(f"Error: User account not found for user_account_id {user_account_id} during lecturer password change.")
+            log.error("User account not found for user_account_id %s during lecturer password change.", user_account_id)
             return jsonify({"error": "User account not found."}), 404 # Or 401/500
 
         stored_hashed_password = user_account[0]
@@ -3376,7 +5988,7 @@ def change_lecturer_password(user):
 
 
         # --- Hash the New Password ---
-        hashed_new_password = generate_password_hash(new_password)
+        hashed_new_password = hash_password(new_password)
 
 
         # --- Update the Password in the Database ---
@@ -3401,12 +6013,12 @@ def change_lecturer_password(user):
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during lecturer password change: {e}")
+        log.error("Database error during lecturer password change: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during lecturer password change: {e}")
+        log.exception("An unexpected error occurred during lecturer password change: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -3432,21 +6044,16 @@ def delete_lecturer_attendance_record(user, record_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- Security Check: Verify the record exists and belongs to a session owned by the logged-in lecturer ---
-        # Join attendancerecords to sessions and assignments to check ownership
-        # *** VERIFY TABLE NAMES AND COLUMN NAMES ***
-        sql_verify_record_ownership = """
-            SELECT atr.record_id
-            FROM attendancerecords atr -- Correct alias
-            JOIN attendancesessions ats ON atr.session_id = ats.session_id -- Correct table names
-            JOIN coursesassignedtolecturers cal ON ats.assignment_id = cal.assignment_id -- Correct table names
-            WHERE atr.record_id = %s AND cal.lecturer_id = %s; -- Check record ID and logged-in lecturer ID
-        """
-        cur.execute(sql_verify_record_ownership, (record_id, lecturer_id))
-        record_owner = cur.fetchone()
+        # Primary-key lookup of the record's session, then set membership against the cached ownership index
+        cur.execute("SELECT session_id FROM attendancerecords WHERE record_id = %s;", (record_id,))
+        record_session = cur.fetchone()
+        record_owner = None
+        if record_session is not None and lecturer_session_assignment(conn, lecturer_id, record_session[0]) is not None:
+            record_owner = record_session
 
         if record_owner is None:
             # Record not found OR it does not belong to a session taught by this lecturer
@@ -3455,35 +6062,41 @@ def delete_lecturer_attendance_record(user, record_id):
 
         # --- Delete the Attendance Record ---
         # No other tables reference attendance records, so direct deletion is fine
-        sql_delete_record = "DELETE FROM attendancerecords WHERE record_id = %s;" # *** Use the correct table name ***
-        cur.execute(sql_delete_record, (record_id,))
+        # The ownership check is repeated in SQL, in case the cached hit is stale
+        sql_delete_record = f"DELETE FROM attendancerecords WHERE record_id = %s AND {lecturer_owns_session_sql('attendancerecords.session_id')};"
+        cur.execute(sql_delete_record, (record_id, lecturer_id))
 
         if cur.rowcount == 0:
              if conn:
                  conn.rollback()
-             # Should not happen if record_owner check passed
-             return jsonify({"error": "Attendance record found but could not be deleted."}), 500
+             # Deleted meanwhile, or the session is no longer this lecturer's (stale cached ownership)
+             invalidate_lecturer_ownership(lecturer_id)
+             return jsonify({"error": "Attendance record not found or you do not have permission to delete it."}), 404
 
 
         conn.commit()
         return jsonify({"message": f"Attendance record {record_id} deleted successfully."}), 200 # Or 204 No Content
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during lecturer attendance record deletion: {e}")
+        log.error("Database integrity error during lecturer attendance record deletion: %s", e)
         # This shouldn't happen if no tables reference attendancerecords, but included for safety
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during lecturer attendance record deletion: {e}")
+        log.error("Database error during lecturer attendance record deletion: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during lecturer attendance record deletion: {e}")
+        log.exception("An unexpected error occurred during lecturer attendance record deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -3520,25 +6133,24 @@ def mark_student_present_via_scan(user, session_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for executions
 
         # --- Step 1: Verify the Session Exists, Belongs to Lecturer, and Get Session Times ---
         # Need session_datetime and qr_code_expiry_time to check if scanning is allowed now
-        # *** VERIFIED TABLE NAMES AND COLUMN NAMES, CORRECTED ALIAS ***
-        sql_get_session_details = """
-            SELECT
-                ats.session_id,
-                ats.session_datetime,
-                ats.qr_code_expiry_time,
-                cal.course_id,        -- *** CORRECTED: Use alias 'cal' ***
-                cal.academic_year_id  -- *** CORRECTED: Use alias 'cal' ***
-            FROM attendancesessions ats -- Correct table name
-            JOIN coursesassignedtolecturers cal ON ats.assignment_id = cal.assignment_id -- Correct table name
-            WHERE ats.session_id = %s AND cal.lecturer_id = %s; -- Check session ID and logged-in lecturer ID
-        """
-        cur.execute(sql_get_session_details, (session_id, lecturer_id))
-        session_details = cur.fetchone()
+        # Ownership and the assignment's course/year come from the cached index; the session itself is a primary-key lookup
+        # (the writes in Step 4 repeat the ownership check in SQL, in case the cached hit is stale)
+        session_details = None
+        owning_assignment_id = lecturer_session_assignment(conn, lecturer_id, session_id)
+        if owning_assignment_id is not None:
+            cur.execute(
+                "SELECT session_id, session_datetime, qr_code_expiry_time FROM attendancesessions WHERE session_id = %s;",
+                (session_id,)
+            )
+            session_row = cur.fetchone()
+            assignment_info = lecturer_assignment_info(conn, lecturer_id, owning_assignment_id)
+            if session_row is not None and assignment_info is not None:
+                session_details = session_row + (assignment_info['course_id'], assignment_info['academic_year_id'])
 
         if session_details is None:
             # Session not found OR it doesn't belong to this lecturer
@@ -3565,8 +6177,10 @@ def mark_student_present_via_scan(user, session_id):
             JOIN studentsenrolledcourses sec ON s.student_id = sec.student_id -- Correct table name
             WHERE s.student_id = %s AND sec.course_id = %s AND sec.academic_year_id = %s; -- Check student ID and enrollment
         """
-        cur.execute(sql_check_student_enrolled, (student_id, course_id, academic_year_id))
-        student_enrolled = cur.fetchone()
+        student_enrolled = None
+        if not is_soft_deleted('student', student_id): # Soft-deleted students cannot be marked
+            cur.execute(sql_check_student_enrolled, (student_id, course_id, academic_year_id))
+            student_enrolled = cur.fetchone()
 
         if student_enrolled is None:
             # Student not found OR student is not enrolled in this course/year
@@ -3590,12 +6204,16 @@ def mark_student_present_via_scan(user, session_id):
             # Record exists, maybe update the status to 'Present' if it's not already, and update attendance_time
             existing_record_id, current_status = existing_record
             if current_status != 'Present':
-                 sql_update_record = """
+                 sql_update_record = f"""
                      UPDATE attendancerecords -- Correct table name
                      SET status = 'Present', attendance_time = %s -- Update status and time
-                     WHERE record_id = %s;
+                     WHERE record_id = %s AND {lecturer_owns_session_sql('attendancerecords.session_id')};
                  """
-                 cur.execute(sql_update_record, (now_db, existing_record_id))
+                 cur.execute(sql_update_record, (now_db, existing_record_id, lecturer_id))
+                 if cur.rowcount == 0:
+                     conn.rollback()
+                     invalidate_lecturer_ownership(lecturer_id) # Stale cached ownership
+                     return jsonify({"error": "Attendance session not found or you do not have permission to mark attendance for it."}), 404
                  action_taken = "updated (status changed to Present)"
             else:
                  # Record already exists and is 'Present', no update needed
@@ -3606,13 +6224,20 @@ def mark_student_present_via_scan(user, session_id):
 
         else:
             # No record exists, create a new one with status 'Present'
-            sql_create_record = """
+            # INSERT ... SELECT so the ownership check runs inside the insert (no row is written for a stale cache hit)
+            sql_create_record = f"""
                 INSERT INTO attendancerecords (session_id, student_id, status, attendance_time) -- Correct columns
-                VALUES (%s, %s, 'Present', %s) -- Set status to 'Present', use current time
+                SELECT %s, %s, 'Present', %s -- Set status to 'Present', use current time
+                WHERE {lecturer_owns_session_sql('%s')}
                 RETURNING record_id; -- Get the generated ID
             """
-            cur.execute(sql_create_record, (session_id, student_id, now_db))
-            new_record_id = cur.fetchone()[0]
+            cur.execute(sql_create_record, (session_id, student_id, now_db, session_id, lecturer_id))
+            created = cur.fetchone()
+            if created is None:
+                conn.rollback()
+                invalidate_lecturer_ownership(lecturer_id) # Stale cached ownership
+                return jsonify({"error": "Attendance session not found or you do not have permission to mark attendance for it."}), 404
+            new_record_id = created[0]
             action_taken = "marked Present"
             message = f"Student '{student_id}' {action_taken} for session '{session_id}'. Record ID: {new_record_id}"
             # Optional: Fetch and return the new record details here
@@ -3622,15 +6247,19 @@ def mark_student_present_via_scan(user, session_id):
 
         return jsonify({"message": message}), 200 # 200 OK
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during attendance marking for session {session_id}, student {student_id}: {e}")
+        log.error("Database error during attendance marking for session %s, student %s: %s", session_id, student_id, e)
         return jsonify({"error": f"Database error during attendance marking: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance marking for session {session_id}, student {student_id}: {e}")
+        log.exception("An unexpected error occurred during attendance marking for session %s, student %s: %s", session_id, student_id, e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -3693,7 +6322,7 @@ def update_lecturer_profile(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for executions
 
         # --- Optional Validation for Specific Fields ---
@@ -3745,19 +6374,19 @@ def update_lecturer_profile(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during lecturer profile update: {e}")
+        log.error("Database integrity error during lecturer profile update: %s", e)
         # Might happen if a unique constraint is violated (e.g., updating email if it's unique)
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during lecturer profile update: {e}")
+        log.error("Database error during lecturer profile update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during lecturer profile update: {e}")
+        log.exception("An unexpected error occurred during lecturer profile update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -3815,7 +6444,7 @@ def create_notification_for_lecturer(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # --- Handle Targeting Based on Lecturer's Role and Input ---
@@ -3903,20 +6532,20 @@ def create_notification_for_lecturer(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during lecturer notification creation: {e}")
+        log.error("Database integrity error during lecturer notification creation: %s", e)
         # This could happen due to FK violation if not caught by manual check or other constraints
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during lecturer notification creation: {e}")
+        log.error("Database error during lecturer notification creation: %s", e)
         # This could happen if data types are wrong or other DB issues
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during lecturer notification creation: {e}")
+        log.exception("An unexpected error occurred during lecturer notification creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -3942,7 +6571,7 @@ def list_relevant_notifications_for_lecturer(user):
     notifications_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # --- Get Context for Filtering (Lecturer's Department and Taught Courses) ---
@@ -3952,7 +6581,7 @@ def list_relevant_notifications_for_lecturer(user):
         lecturer_dept_row = cur.fetchone()
         if lecturer_dept_row is None:
              # Should not happen if lecturer_id in useraccounts is correct
-             print(f"Error: Lecturer department not found for lecturer_id {lecturer_id} during notification fetch.")
+             log.error("Lecturer department not found for lecturer_id %s during notification fetch.", lecturer_id)
              return jsonify({"error": "Lecturer department not found."}), 500 # Or appropriate error
 
         lecturer_department_id = lecturer_dept_row['department_id'] # Get the department ID
@@ -4025,19 +6654,180 @@ def list_relevant_notifications_for_lecturer(user):
         return jsonify(notifications_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching lecturer notifications: {e}")
+        log.error("Database error fetching lecturer notifications: %s", e)
         error_message = str(e)
         if "relation \"" in error_message or "column \"" in error_message or "missing FROM-clause entry for table" in error_message:
             return jsonify({"error": "Configuration error: Database query error. Check table/column names and aliases."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching lecturer notifications: {e}")
+        log.exception("An unexpected error occurred fetching lecturer notifications: %s", e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+######################################################################################################################################################
+
+# --- Bulk Enrollment ---
+# Enrolling a whole level into its courses used to take one POST /enrollments/student per student per course.
+# POST /enrollments/bulk selects a cohort of students and enrolls it into a list of courses with a single
+# INSERT ... SELECT ... ON CONFLICT DO NOTHING, so existing enrollments are skipped instead of failing the batch.
+BULK_ENROLLMENT_MAX_REPORTED_CONFLICTS = int(os.environ.get('BULK_ENROLLMENT_MAX_REPORTED_CONFLICTS', 1000))
+
+
+def build_student_cohort_filter(selector, alias='s'):
+    """
+    Turns a cohort selector {"department_id", "level", "academic_year_id", "student_ids"} into
+    (conditions, values) on the students table aliased as `alias`. Raises ValueError if nothing is selected.
+    """
+    if not isinstance(selector, dict):
+        raise ValueError("Cohort selector must be an object.")
+    conditions = []
+    values = []
+    for field in ('department_id', 'level', 'academic_year_id'):
+        if selector.get(field) not in (None, ''):
+            conditions.append(f"{alias}.{field} = %s")
+            values.append(str(selector[field]))
+    student_ids = selector.get('student_ids')
+    if student_ids is not None:
+        if not isinstance(student_ids, list) or not student_ids:
+            raise ValueError("student_ids must be a non-empty list.")
+        conditions.append(f"{alias}.student_id = ANY(%s::VARCHAR[])")
+        values.append([str(student_id) for student_id in student_ids])
+    if not conditions:
+        raise ValueError("Cohort selector needs at least one of department_id, level, academic_year_id or student_ids.")
+    return conditions, values
+
+
+@app.route('/enrollments/bulk', methods=['POST'])
+@login_required # Protect this route
+def bulk_enroll_students(user):
+    """
+    Enrolls a cohort of students into one or more courses for an academic year.
+    Requires 'admin' role.
+    Body: {"cohort": {"department_id", "level", "academic_year_id", "student_ids": [...]}, # any combination
+           "course_ids": [...],
+           "academic_year_id": "...", # enrollment year; defaults to cohort.academic_year_id
+           "status": "..."}           # optional, defaults to the column default ('Enrolled')
+    Returns the number of enrollments inserted and skipped, and the (student_id, course_id) pairs that already existed.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can bulk enroll students."}), 403
+
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
+    data = request.get_json()
+
+    cohort = data.get('cohort') or {}
+    course_ids = data.get('course_ids')
+    status = data.get('status')
+    if not isinstance(course_ids, list) or not course_ids:
+        return jsonify({"error": "Field 'course_ids' must be a non-empty list."}), 400
+    course_ids = list(dict.fromkeys(str(course_id) for course_id in course_ids)) # De-duplicate, keep order
+    academic_year_id = data.get('academic_year_id') or (cohort.get('academic_year_id') if isinstance(cohort, dict) else None)
+    if not academic_year_id:
+        return jsonify({"error": "Missing required field: academic_year_id (or cohort.academic_year_id)."}), 400
+    academic_year_id = str(academic_year_id)
+
+    try:
+        cohort_conditions, cohort_values = build_student_cohort_filter(cohort)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables() # pendingdeletions hides soft-deleted rows
+        conn = connect_db()
+        cur = conn.cursor()
+
+        if academic_year_id not in get_reference_data(conn)['academic_year_ids']:
+            return jsonify({"error": f"Academic Year ID '{academic_year_id}' does not exist."}), 400
+        cur.execute(f"SELECT course_id FROM courses WHERE course_id = ANY(%s::VARCHAR[]) AND {soft_deleted_filter('course', 'course_id')};",
+                    (course_ids,))
+        found_course_ids = {str(row[0]) for row in cur.fetchall()}
+        unknown_course_ids = [course_id for course_id in course_ids if course_id not in found_course_ids]
+        if unknown_course_ids:
+            return jsonify({"error": "Some courses do not exist.", "unknown_course_ids": unknown_course_ids}), 400
+
+        if status:
+            insert_columns = "student_id, course_id, academic_year_id, status"
+            insert_select = "c.student_id, c.course_id, %s, %s"
+            insert_values = [academic_year_id, str(status)]
+        else:
+            insert_columns = "student_id, course_id, academic_year_id"
+            insert_select = "c.student_id, c.course_id, %s"
+            insert_values = [academic_year_id]
+
+        explicit_ids = cohort_values[-1] if cohort.get('student_ids') is not None else []
+        sql = f"""
+            WITH cohort AS (
+                SELECT s.student_id FROM students s
+                WHERE {" AND ".join(cohort_conditions)} AND {soft_deleted_filter('student', 's.student_id')}
+            ),
+            candidates AS (
+                SELECT cohort.student_id, x.course_id
+                FROM cohort CROSS JOIN unnest(%s::VARCHAR[]) AS x (course_id)
+            ),
+            inserted AS (
+                INSERT INTO studentsenrolledcourses ({insert_columns})
+                SELECT {insert_select} FROM candidates c
+                ON CONFLICT DO NOTHING
+                RETURNING student_id, course_id
+            )
+            SELECT
+                (SELECT COUNT(*) FROM cohort),
+                (SELECT COUNT(*) FROM candidates),
+                (SELECT COUNT(*) FROM inserted),
+                ARRAY(
+                    SELECT ARRAY[c.student_id::TEXT, c.course_id::TEXT] FROM candidates c
+                    WHERE NOT EXISTS (SELECT 1 FROM inserted i WHERE i.student_id = c.student_id AND i.course_id = c.course_id)
+                    ORDER BY c.student_id, c.course_id
+                    LIMIT %s
+                ),
+                ARRAY(SELECT unnest(%s::VARCHAR[]) EXCEPT SELECT student_id FROM cohort);
+        """
+        cur.execute(sql, (*cohort_values, course_ids, *insert_values, BULK_ENROLLMENT_MAX_REPORTED_CONFLICTS, explicit_ids))
+        cohort_size, candidate_count, inserted_count, conflicts, unmatched_student_ids = cur.fetchone()
+
+        conn.commit()
+        return jsonify({
+            "message": f"Enrolled {inserted_count} of {candidate_count} student-course pairs.",
+            "cohort_size": cohort_size,
+            "course_count": len(course_ids),
+            "inserted": inserted_count,
+            "skipped": candidate_count - inserted_count,
+            "conflicts": [{"student_id": student_id, "course_id": course_id} for student_id, course_id in conflicts],
+            "conflicts_truncated": candidate_count - inserted_count > len(conflicts),
+            "unmatched_student_ids": sorted(unmatched_student_ids)
+        }), 200
+
+    except psycopg2.IntegrityError as e:
+        if conn:
+            conn.rollback()
+        log.error("Database integrity error during bulk enrollment: %s", e)
+        return jsonify({"error": f"Database integrity error: {e}"}), 409
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        log.error("Database error during bulk enrollment: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        log.exception("An unexpected error occurred during bulk enrollment: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
             cur.close()
         if conn:
             conn.close()
+# --- Bulk Enrollment Ends Here ---
 
 ######################################################################################################################################################
 
@@ -4062,11 +6852,11 @@ def list_all_students(user):
     students_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all relevant student details, maybe join departments and useraccounts
-        sql = """
+        sql = f"""
             SELECT
                 s.student_id,
                 s.first_name,
@@ -4085,21 +6875,26 @@ def list_all_students(user):
             FROM students s
             JOIN departments d ON s.department_id = d.department_id
             LEFT JOIN useraccounts ua ON s.user_account_id = ua.user_account_id -- LEFT JOIN in case a student record exists without a user account (less likely now)
+            WHERE {soft_deleted_filter('student', 's.student_id')}
             ORDER BY s.admission_date DESC, s.last_name, s.first_name; -- Order by admission date, then name
         """
         # No WHERE clause needed to filter by a specific user ID, as admin sees all
+        ensure_support_tables() # pendingdeletions hides soft-deleted rows
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         students_list = cur.fetchall()
 
         return jsonify(students_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching student list: {e}")
+        log.error("Database error fetching student list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching student list: {e}")
+        log.exception("An unexpected error occurred fetching student list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -4127,11 +6922,11 @@ def list_all_lecturers(user):
     lecturers_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all relevant lecturer details, maybe join departments and useraccounts
-        sql = """
+        sql = f"""
             SELECT
                 l.lecturer_id, -- Primary key for lecturer
                 l.first_name,
@@ -4145,21 +6940,26 @@ def list_all_lecturers(user):
             FROM lecturers l
             JOIN departments d ON l.department_id = d.department_id
             LEFT JOIN useraccounts ua ON l.user_account_id = ua.user_account_id -- LEFT JOIN in case a lecturer record exists without a user account
+            WHERE {soft_deleted_filter('lecturer', 'l.lecturer_id')}
             ORDER BY l.date_of_employment DESC, l.last_name, l.first_name; -- Order by employment date, then name
         """
         # No WHERE clause needed to filter by a specific user ID, as admin sees all
+        ensure_support_tables() # pendingdeletions hides soft-deleted rows
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         lecturers_list = cur.fetchall()
 
         return jsonify(lecturers_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching lecturer list: {e}")
+        log.error("Database error fetching lecturer list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching lecturer list: {e}")
+        log.exception("An unexpected error occurred fetching lecturer list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -4187,7 +6987,7 @@ def get_student_details_for_admin(user, student_id):
     student_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant student details for the given student_id
@@ -4217,18 +7017,18 @@ def get_student_details_for_admin(user, student_id):
 
         student_details = cur.fetchone()
 
-        if student_details is None:
+        if student_details is None or is_soft_deleted('student', student_id):
             # Student with the given ID not found
             return jsonify({"error": "Student not found."}), 404 # 404 Not Found
 
         return jsonify(student_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific student details: {e}")
+        log.error("Database error fetching specific student details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific student details: {e}")
+        log.exception("An unexpected error occurred fetching specific student details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -4256,7 +7056,7 @@ def get_lecturer_details_for_admin(user, lecturer_id):
     lecturer_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant lecturer details for the given lecturer_id
@@ -4282,18 +7082,18 @@ def get_lecturer_details_for_admin(user, lecturer_id):
 
         lecturer_details = cur.fetchone()
 
-        if lecturer_details is None:
+        if lecturer_details is None or is_soft_deleted('lecturer', lecturer_id):
             # Lecturer with the given ID not found
             return jsonify({"error": "Lecturer not found."}), 404 # 404 Not Found
 
         return jsonify(lecturer_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific lecturer details: {e}")
+        log.error("Database error fetching specific lecturer details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific lecturer details: {e}")
+        log.exception("An unexpected error occurred fetching specific lecturer details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -4342,7 +7142,7 @@ def update_student_details_for_admin(user, student_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # <--- Change it to this
 
         # --- First, verify if the student exists ---
@@ -4377,6 +7177,8 @@ def update_student_details_for_admin(user, student_id):
             # Depending on desired strictness, you might return a different status.
              return jsonify({"message": "Student found, but no changes were applied (data might be the same or invalid fields provided)."}), 200
 
+        if any(field in update_data for field in QR_DATA_SOURCE_FIELDS):
+            regenerate_student_qr_data(cur, {'student_ids': [student_id]})
 
         conn.commit()
         # Return the updated student details or a success message
@@ -4401,19 +7203,19 @@ def update_student_details_for_admin(user, student_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during student update: {e}")
+        log.error("Database integrity error during student update: %s", e)
         # This could happen if department_id is invalid or matriculation_number is not unique
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during student update: {e}")
+        log.error("Database error during student update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during student update: {e}")
+        log.exception("An unexpected error occurred during student update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -4458,7 +7260,7 @@ def update_lecturer_details_for_admin(user, lecturer_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use RealDictCursor
 
         # --- First, verify if the lecturer exists ---
@@ -4507,19 +7309,19 @@ def update_lecturer_details_for_admin(user, lecturer_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during lecturer update: {e}")
+        log.error("Database integrity error during lecturer update: %s", e)
         # This could happen if department_id is invalid or employee_id is not unique (if it has a unique constraint)
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during lecturer update: {e}")
+        log.error("Database error during lecturer update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during lecturer update: {e}")
+        log.exception("An unexpected error occurred during lecturer update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -4533,6 +7335,8 @@ def delete_student_for_admin(user, student_id):
     """
     Deletes a specific student by student_id for admin view,
     including associated records, handling FK constraints with NO ACTION.
+    Runs through the cascade delete engine in short chunked transactions;
+    ?mode=soft hides it immediately and purges it in the background.
     Requires 'admin' role.
     """
     user_account_id, role, entity_id = user # Unpack the user tuple
@@ -4541,11 +7345,15 @@ def delete_student_for_admin(user, student_id):
     if role != 'admin':
         return jsonify({"error": "Access forbidden. Only admins can delete students."}), 403
 
+    mode = request.args.get('mode', 'hard') # 'soft' hides the record now and purges it in the background
+    if mode not in ('hard', 'soft'):
+        return jsonify({"error": "Invalid mode. Use 'hard' or 'soft'."}), 400
+
 
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # --- First, verify if the student exists and get linked user_account_id ---
@@ -4555,61 +7363,18 @@ def delete_student_for_admin(user, student_id):
         if student_row is None:
             return jsonify({"error": "Student not found."}), 404
 
-        linked_user_account_id = student_row[1] # Get the linked user_account_id
-
-
-        # --- Delete Related Records (Order is crucial with NO ACTION!) ---
-
-        # 1. Delete Attendance Records (references students)
-        sql_delete_attendance = "DELETE FROM attendancerecords WHERE student_id = %s;"
-        cur.execute(sql_delete_attendance, (student_id,))
-        print(f"Deleted {cur.rowcount} attendance records for student {student_id}") # Debug print
-
-        # 2. Delete Student Course Enrollments (references students)
-        # Use the correct table name (studentsenrolledcourses) and column name (student_id or student_id)
-        # *** CRITICAL VERIFICATION: DOUBLE CHECK YOUR TABLE AND COLUMN NAME HERE ***
-        sql_delete_enrollments = "DELETE FROM studentsenrolledcourses WHERE student_id = %s;" # <--- VERIFY 'student_id' vs 'student_id'
-        cur.execute(sql_delete_enrollments, (student_id,))
-        print(f"Deleted {cur.rowcount} enrollment records for student {student_id}") # Debug print
-
-        # --- 3. IMPORTANT: Set the student's user_account_id to NULL (referenced by students table) ---
-        # This must happen before deleting the user account if FK has NO ACTION
-        sql_set_user_account_null = "UPDATE students SET user_account_id = NULL WHERE student_id = %s;"
-        cur.execute(sql_set_user_account_null, (student_id,))
-        print(f"Set students.user_account_id to NULL for student {student_id}") # Debug print
-
-        # 4. Delete the linked User Account (if one exists)
-        # This can now be done because the student record no longer references it
-        if linked_user_account_id:
-            sql_delete_user = "DELETE FROM useraccounts WHERE user_account_id = %s;"
-            cur.execute(sql_delete_user, (linked_user_account_id,))
-            print(f"Deleted user account {linked_user_account_id} linked to student {student_id}") # Debug print
-
-
-        # --- 5. Finally, Delete the Student Record (can now be done as referencing records are gone/nulled) ---
-        sql_delete_student = "DELETE FROM students WHERE student_id = %s;"
-        cur.execute(sql_delete_student, (student_id,))
-
-        # Check if the student record was actually deleted
-        if cur.rowcount == 0:
-             # Should ideally not happen if student_exists check passed, but good practice
-             if conn:
-                 conn.rollback() # Rollback if the final delete failed unexpectedly
-             return jsonify({"error": "Student found but could not be deleted."}), 500
-
-        conn.commit()
-        return jsonify({"message": f"Student {student_id} and related records deleted successfully."}), 200 # Or 204 No Content
+        return delete_entities_response(conn, 'student', [student_id], mode, entity_id)
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during student deletion: {e}")
+        log.error("Database error during student deletion: %s", e)
         # If you still get a foreign key violation here, it means a referencing table wasn't handled or order is wrong!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during student deletion: {e}")
+        log.exception("An unexpected error occurred during student deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -4623,6 +7388,8 @@ def delete_lecturer_for_admin(user, lecturer_id):
     """
     Deletes a specific lecturer by lecturer_id for admin view,
     including associated records, handling FK constraints with NO ACTION.
+    Runs through the cascade delete engine in short chunked transactions;
+    ?mode=soft hides it immediately and purges it in the background.
     Requires 'admin' role.
     """
     user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
@@ -4631,11 +7398,15 @@ def delete_lecturer_for_admin(user, lecturer_id):
     if role_admin != 'admin':
         return jsonify({"error": "Access forbidden. Only admins can delete lecturers."}), 403
 
+    mode = request.args.get('mode', 'hard') # 'soft' hides the record now and purges it in the background
+    if mode not in ('hard', 'soft'):
+        return jsonify({"error": "Invalid mode. Use 'hard' or 'soft'."}), 400
+
 
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the lecturer exists and get linked user_account_id ---
@@ -4644,89 +7415,18 @@ def delete_lecturer_for_admin(user, lecturer_id):
         if lecturer_row is None:
             return jsonify({"error": "Lecturer not found."}), 404
 
-        linked_user_account_id = lecturer_row[1] # Get the linked user_account_id
-
-
-        # --- Delete Related Records (Order is crucial with NO ACTION!) ---
-
-        # 1. Find all assignment_ids for this lecturer
-        sql_get_assignments = """
-            SELECT assignment_id FROM coursesassignedtolecturers WHERE lecturer_id = %s;
-        """
-        cur.execute(sql_get_assignments, (lecturer_id,))
-        assignment_ids_rows = cur.fetchall()
-        assignment_ids = [row[0] for row in assignment_ids_rows]
-        print(f"Found {len(assignment_ids)} assignments for lecturer {lecturer_id}: {assignment_ids}") # Debug print
-
-
-        # 2. If assignments exist, find all session_ids for these assignments
-        session_ids = []
-        if assignment_ids:
-            sql_get_sessions = """
-                SELECT session_id FROM attendancesessions WHERE assignment_id IN %s;
-            """
-            cur.execute(sql_get_sessions, (tuple(assignment_ids),))
-            session_ids_rows = cur.fetchall()
-            session_ids = [row[0] for row in session_ids_rows]
-            print(f"Found {len(session_ids)} sessions for assignments: {session_ids}") # Debug print
-
-            # 3. If sessions exist, delete attendance records for these sessions
-            if session_ids:
-                sql_delete_attendance = """
-                    DELETE FROM attendancerecords WHERE session_id IN %s;
-                """
-                cur.execute(sql_delete_attendance, (tuple(session_ids),))
-                print(f"Deleted {cur.rowcount} attendance records for sessions") # Debug print
-
-            # 4. Delete the sessions themselves (if sessions exist)
-            sql_delete_sessions = """
-                DELETE FROM attendancesessions WHERE assignment_id IN %s;
-            """
-            cur.execute(sql_delete_sessions, (tuple(assignment_ids),))
-            print(f"Deleted {cur.rowcount} sessions for assignments") # Debug print
-
-
-        # 5. Delete the course assignments for this lecturer
-        sql_delete_assignments = "DELETE FROM coursesassignedtolecturers WHERE lecturer_id = %s;"
-        cur.execute(sql_delete_assignments, (lecturer_id,))
-        print(f"Deleted {cur.rowcount} assignments for lecturer {lecturer_id}") # Debug print
-
-        # --- 6. IMPORTANT: Set the lecturer's user_account_id to NULL ---
-        # This must happen before deleting the user account because lecturers.user_account_id FK to useraccounts.user_account_id
-        sql_set_user_account_null = "UPDATE lecturers SET user_account_id = NULL WHERE lecturer_id = %s;"
-        cur.execute(sql_set_user_account_null, (lecturer_id,))
-        print(f"Set lecturers.user_account_id to NULL for lecturer {lecturer_id}") # Debug print
-
-        # 7. Delete the linked User Account (if one exists)
-        # This can now be done because the lecturer record no longer references it
-        if linked_user_account_id:
-            sql_delete_user = "DELETE FROM useraccounts WHERE user_account_id = %s;"
-            cur.execute(sql_delete_user, (linked_user_account_id,))
-            print(f"Deleted user account {linked_user_account_id} linked to lecturer {lecturer_id}") # Debug print
-
-
-        # --- 8. Finally, Delete the Lecturer Record ---
-        sql_delete_lecturer = "DELETE FROM lecturers WHERE lecturer_id = %s;"
-        cur.execute(sql_delete_lecturer, (lecturer_id,))
-
-        if cur.rowcount == 0:
-             if conn:
-                 conn.rollback()
-             return jsonify({"error": "Lecturer found but could not be deleted."}), 500
-
-        conn.commit()
-        return jsonify({"message": f"Lecturer {lecturer_id} and related records deleted successfully."}), 200 # Or 204 No Content
+        return delete_entities_response(conn, 'lecturer', [lecturer_id], mode, entity_id_admin)
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during lecturer deletion: {e}")
+        log.error("Database error during lecturer deletion: %s", e)
         # If you still get a foreign key violation here, it means a referencing table wasn't handled or order is wrong!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during lecturer deletion: {e}")
+        log.exception("An unexpected error occurred during lecturer deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -4783,7 +7483,7 @@ def create_student_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for inserts/updates
 
         # --- Basic Validation (More robust validation needed in a real app) ---
@@ -4802,7 +7502,7 @@ def create_student_for_admin(user):
 
 
         # --- Hash the password ---
-        hashed_password = generate_password_hash(proposed_password) # Use werkzeug security
+        hashed_password = hash_password(proposed_password) # Use werkzeug security
 
         # --- Create User Account ---
         # We insert into useraccounts first to get the user_account_id
@@ -4865,67 +7565,1261 @@ def create_student_for_admin(user):
                 sql_update_qr = "UPDATE students SET qr_code_data = %s WHERE student_id = %s;"
                 cur.execute(sql_update_qr, (qr_data_string, new_student_id))
              else:
-                 print(f"Warning: qr_data_string is None. Could not generate QR data string for new student_id {new_student_id}. qr_code_data column will be NULL.")
+                 log.warning("qr_data_string is None. Could not generate QR data string for new student_id %s. qr_code_data column will be NULL.", new_student_id)
         else:
-             print(f"Warning: Could not refetch student details for QR code generation for student_id {new_student_id}.")
+             log.warning("Could not refetch student details for QR code generation for student_id %s.", new_student_id)
 
 
         conn.commit()
 
-        # Optional: Fetch and return the full details of the newly created student
-        # Reuse the GET /admin/students/<student_id> logic or query again
-        # Using the GET logic is cleaner if it's already tested and working
-        # For simplicity now, let's return a success message and the new IDs
+        # Optional: Fetch and return the full details of the newly created student
+        # Reuse the GET /admin/students/<student_id> logic or query again
+        # Using the GET logic is cleaner if it's already tested and working
+        # For simplicity now, let's return a success message and the new IDs
+
+        return jsonify({
+            "message": f"Student {first_name} {last_name} created successfully!",
+            "student_id": new_student_id,
+            "user_account_id": new_user_account_id,
+            "username": proposed_username,
+            "qr_code_data": qr_data_string # Include generated QR data
+        }), 201 # 201 Created
+
+    except psycopg2.IntegrityError as e:
+        if conn:
+            conn.rollback()
+        log.error("Database integrity error during student creation: %s", e)
+        # This could happen due to duplicate matriculation_number, username, or invalid FKs
+        return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
+
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        log.error("Database error during student creation: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        log.exception("An unexpected error occurred during student creation: %s", e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        # Ensure temporary cursor is closed if used
+        # if 'cur_dict' in locals() and cur_dict:
+        #     cur_dict.close()
+        if conn:
+            conn.close()
+
+def generate_student_qr_data_string_from_dict(student_data_dict):
+    """Generates QR data string from a student details dictionary."""
+    if not student_data_dict:
+        return None
+    # Ensure all expected keys are present, use get with default None
+    student_id = student_data_dict.get('student_id', '')
+    first_name = student_data_dict.get('first_name', '')
+    last_name = student_data_dict.get('last_name', '')
+    matriculation_number = student_data_dict.get('matriculation_number', '')
+    level = student_data_dict.get('level', '')
+    department_name = student_data_dict.get('department_name', '')
+
+    # Basic format, adapt as needed
+    qr_data = f"ID:{student_id},Name:{first_name} {last_name},Matric:{matriculation_number},Level:{level},Dept:{department_name}"
+    return qr_data
+
+
+####################################################################################
+
+# --- Reference Data Cache ---
+# Department and academic-year IDs change rarely but bulk operations validate thousands of rows against them.
+# They are cached per worker and dropped by the department/academic-year create and delete routes;
+# REFERENCE_DATA_TTL_SECONDS bounds how long another worker can keep a stale copy.
+REFERENCE_DATA_TTL_SECONDS = int(os.environ.get('REFERENCE_DATA_TTL_SECONDS', 300))
+
+_reference_data = None # (loaded_at, {'department_ids': frozenset, 'academic_year_ids': frozenset})
+_reference_data_lock = threading.Lock()
+
+
+def get_reference_data(conn):
+    """Returns {'department_ids', 'academic_year_ids'} as frozensets of strings, loading them if missing or stale."""
+    global _reference_data
+    entry = _reference_data
+    if entry is None or time.monotonic() - entry[0] > REFERENCE_DATA_TTL_SECONDS:
+        with conn.cursor() as cur:
+            cur.execute("SELECT department_id FROM departments;")
+            department_ids = frozenset(str(row[0]) for row in cur.fetchall())
+            cur.execute("SELECT academic_year_id FROM academicyears;")
+            academic_year_ids = frozenset(str(row[0]) for row in cur.fetchall())
+        entry = (time.monotonic(), {'department_ids': department_ids, 'academic_year_ids': academic_year_ids})
+        with _reference_data_lock:
+            _reference_data = entry
+    return entry[1]
+
+
+def invalidate_reference_data():
+    """Forces the next get_reference_data() call to reload."""
+    global _reference_data
+    with _reference_data_lock:
+        _reference_data = None
+# --- Reference Data Cache Ends Here ---
+
+
+# --- Bulk Student Import ---
+# POST /admin/students/import takes a CSV or XLSX upload (multipart field 'file') whose header row names the same
+# fields create_student_for_admin expects. The file is stored with a 'student_import' job and processed by a worker:
+# rows are streamed (openpyxl read-only mode for XLSX), validated against the reference data cache, password
+# hashed in the process pool a batch at a time and COPYed into a temporary staging table. Duplicates are then
+# rejected and the survivors inserted into useraccounts and students with a few set-based statements in a single
+# transaction. Progress and the per-row error report are kept in studentimportjobs.
+STUDENT_IMPORT_BATCH_SIZE = int(os.environ.get('STUDENT_IMPORT_BATCH_SIZE', 500))
+STUDENT_IMPORT_MAX_REPORTED_ERRORS = int(os.environ.get('STUDENT_IMPORT_MAX_REPORTED_ERRORS', 1000))
+STUDENT_IMPORT_MAX_BYTES = int(os.environ.get('STUDENT_IMPORT_MAX_BYTES', 20 * 1024 * 1024)) # Stored in jobs.attachment
+
+STUDENT_IMPORT_FIELDS = [
+    'first_name', 'last_name', 'email', 'contact_number', 'date_of_birth',
+    'gender', 'level', 'intended_program', 'department_id', 'matriculation_number',
+    'academic_year_id', 'proposed_username', 'proposed_password'
+]
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS studentimportjobs (
+        job_id VARCHAR(32) PRIMARY KEY,
+        status VARCHAR(20) NOT NULL DEFAULT 'queued', -- queued, running, completed, failed
+        filename VARCHAR(255),
+        created_by VARCHAR(64),
+        total_rows INTEGER, -- NULL until known (CSV row counts are only known at the end)
+        processed_rows INTEGER NOT NULL DEFAULT 0,
+        inserted_rows INTEGER NOT NULL DEFAULT 0,
+        error_count INTEGER NOT NULL DEFAULT 0,
+        errors JSONB NOT NULL DEFAULT '[]'::jsonb,
+        message TEXT,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        started_at TIMESTAMP WITH TIME ZONE,
+        finished_at TIMESTAMP WITH TIME ZONE
+    );
+""")
+
+
+def normalize_import_header(value):
+    """'Proposed Username ' -> 'proposed_username'."""
+    return str(value or '').strip().lower().replace(' ', '_')
+
+
+def normalize_import_value(value):
+    """Cell value -> stripped string (or the date itself); XLSX numbers like 300.0 become '300'."""
+    if value is None:
+        return ''
+    if isinstance(value, (datetime, date)):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def open_student_import_rows(path, file_kind):
+    """
+    Opens an uploaded CSV/XLSX file and returns (header, rows, close) where rows yields raw value tuples
+    one at a time and close releases the file.
+    """
+    if file_kind == 'xlsx':
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        close = workbook.close
+    else:
+        handle = open(path, newline='', encoding='utf-8-sig')
+        rows = csv.reader(handle)
+        close = handle.close
+    header = [normalize_import_header(value) for value in next(rows, ())]
+    return header, rows, close
+
+
+def iter_student_import_rows(path, file_kind):
+    """Yields (row_number, {field: value}) for every non-blank data row; row_number matches the spreadsheet line."""
+    header, rows, close = open_student_import_rows(path, file_kind)
+    try:
+        positions = {field: header.index(field) for field in STUDENT_IMPORT_FIELDS if field in header}
+        for row_number, raw in enumerate(rows, start=2):
+            if not raw or all(value is None or str(value).strip() == '' for value in raw):
+                continue
+            yield row_number, {
+                field: normalize_import_value(raw[position]) if position < len(raw) else ''
+                for field, position in positions.items()
+            }
+    finally:
+        close()
+
+
+def validate_student_import_row(row, reference_data):
+    """Returns (field, error message) for the first problem in a row, or None if it can be staged."""
+    for field in STUDENT_IMPORT_FIELDS:
+        if row.get(field) in (None, ''):
+            return field, f"Missing or empty required field: {field}"
+    if row['department_id'] not in reference_data['department_ids']:
+        return 'department_id', f"Department ID {row['department_id']} does not exist."
+    if row['academic_year_id'] not in reference_data['academic_year_ids']:
+        return 'academic_year_id', f"Academic year ID {row['academic_year_id']} does not exist."
+    date_of_birth = row['date_of_birth']
+    if isinstance(date_of_birth, datetime):
+        row['date_of_birth'] = date_of_birth.date()
+    elif not isinstance(date_of_birth, date):
+        try:
+            row['date_of_birth'] = date.fromisoformat(date_of_birth)
+        except ValueError:
+            return 'date_of_birth', f"Invalid date_of_birth '{date_of_birth}'. Expected YYYY-MM-DD."
+    return None
+
+
+def update_student_import_job(job_conn, job_id, **fields):
+    """Writes progress columns for a job on the autocommit progress connection."""
+    assignments = ", ".join(f"{column} = %s" for column in fields)
+    with job_conn.cursor() as cur:
+        cur.execute(f"UPDATE studentimportjobs SET {assignments} WHERE job_id = %s;", (*fields.values(), job_id))
+
+
+def copy_student_import_rows(cur, rows):
+    """COPYs already-hashed staging rows (lists in staging column order) into the staging table."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cur.copy_expert("""
+        COPY student_import_staging (row_number, first_name, last_name, email, contact_number, date_of_birth,
+            gender, level, intended_program, department_id, matriculation_number, academic_year_id,
+            username, password_hash)
+        FROM STDIN WITH (FORMAT csv);
+    """, buffer)
+
+
+def stage_student_import_batch(cur, batch, record_error):
+    """
+    Hashes a batch's passwords in the pool and COPYs the rows into the staging table.
+    The staging columns have the students table's types, so a value the column cannot hold fails the COPY;
+    that batch is then re-staged row by row so each bad row is reported instead of failing the import.
+    """
+    password_hashes = hash_passwords(row['proposed_password'] for row_number, row in batch)
+    rows = [
+        [row_number] + [row[field] for field in STUDENT_IMPORT_FIELDS[:-1]] + [password_hash]
+        for (row_number, row), password_hash in zip(batch, password_hashes)
+    ]
+    cur.execute("SAVEPOINT staging_batch;")
+    try:
+        copy_student_import_rows(cur, rows)
+        return
+    except psycopg2.DataError:
+        cur.execute("ROLLBACK TO SAVEPOINT staging_batch;")
+    for staging_row in rows:
+        cur.execute("SAVEPOINT staging_batch;")
+        try:
+            copy_student_import_rows(cur, [staging_row])
+        except psycopg2.DataError as e:
+            cur.execute("ROLLBACK TO SAVEPOINT staging_batch;")
+            record_error(staging_row[0], None, (e.pgerror or str(e)).splitlines()[0])
+
+
+def run_student_import(job_id, path, file_kind, progress=None, check_lease=None):
+    """
+    Streams, validates, stages and inserts one import job's rows. `progress(current, total)` is called per batch
+    and `check_lease()` right before the final commit, so a run another worker has taken over never commits.
+    Returns the summary counters; failures are recorded on the import job and re-raised for the job queue.
+    """
+    conn = None
+    job_conn = None
+    errors = []
+    error_count = 0
+    processed_rows = 0
+
+    def record_error(row_number, field, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < STUDENT_IMPORT_MAX_REPORTED_ERRORS:
+            errors.append({"row": row_number, "field": field, "error": message})
+
+    try:
+        job_conn = connect_db()
+        job_conn.autocommit = True
+        update_student_import_job(job_conn, job_id, status='running', started_at=datetime.now(timezone.utc))
+
+        conn = connect_db()
+        cur = conn.cursor()
+        reference_data = get_reference_data(conn)
+        # Staging columns take their types from students, so COPY does the type checking
+        cur.execute("""
+            CREATE TEMP TABLE student_import_staging ON COMMIT DROP AS
+            SELECT 0 AS row_number, first_name, last_name, email, contact_number, date_of_birth, gender, level,
+                   intended_program, department_id, matriculation_number, academic_year_id,
+                   ''::text AS username, ''::text AS password_hash
+            FROM students
+            WITH NO DATA;
+        """)
+
+        if file_kind == 'xlsx':
+            # Read-only worksheets know their dimensions up front, which gives a progress denominator
+            workbook = openpyxl.load_workbook(path, read_only=True)
+            if workbook.active.max_row:
+                update_student_import_job(job_conn, job_id, total_rows=max(workbook.active.max_row - 1, 0))
+                if progress:
+                    progress(0, max(workbook.active.max_row - 1, 0))
+            workbook.close()
+
+        batch = []
+        for row_number, row in iter_student_import_rows(path, file_kind):
+            processed_rows += 1
+            problem = validate_student_import_row(row, reference_data)
+            if problem:
+                record_error(row_number, *problem)
+            else:
+                batch.append((row_number, row))
+            if len(batch) >= STUDENT_IMPORT_BATCH_SIZE:
+                stage_student_import_batch(cur, batch, record_error)
+                batch = []
+                update_student_import_job(job_conn, job_id, processed_rows=processed_rows, error_count=error_count)
+                if progress:
+                    progress(processed_rows)
+        if batch:
+            stage_student_import_batch(cur, batch, record_error)
+        update_student_import_job(job_conn, job_id, processed_rows=processed_rows, total_rows=processed_rows, error_count=error_count)
+
+        cur.execute("CREATE INDEX ON student_import_staging (matriculation_number);")
+        cur.execute("CREATE INDEX ON student_import_staging (username);")
+        cur.execute("ANALYZE student_import_staging;")
+
+        # Repeats inside the file: the first occurrence wins
+        cur.execute("""
+            DELETE FROM student_import_staging st
+            USING student_import_staging earlier
+            WHERE earlier.row_number < st.row_number
+              AND (earlier.matriculation_number = st.matriculation_number OR earlier.username = st.username)
+            RETURNING st.row_number, st.matriculation_number, st.username;
+        """)
+        for row_number, matriculation_number, username in sorted(cur.fetchall()):
+            record_error(row_number, 'matriculation_number', f"Duplicate of an earlier row in the file (matriculation number {matriculation_number} or username '{username}').")
+
+        # Clashes with existing students and accounts
+        cur.execute("""
+            DELETE FROM student_import_staging st
+            WHERE EXISTS (SELECT 1 FROM students s WHERE s.matriculation_number = st.matriculation_number)
+               OR EXISTS (SELECT 1 FROM useraccounts ua WHERE ua.username = st.username)
+            RETURNING st.row_number, st.matriculation_number, st.username,
+                EXISTS (SELECT 1 FROM students s WHERE s.matriculation_number = st.matriculation_number);
+        """)
+        for row_number, matriculation_number, username, matric_taken in sorted(cur.fetchall()):
+            if matric_taken:
+                record_error(row_number, 'matriculation_number', f"Matriculation number {matriculation_number} already exists.")
+            else:
+                record_error(row_number, 'proposed_username', f"Username '{username}' already exists.")
+
+        # Accounts and students in one statement, linked through the (unique) username
+        cur.execute("""
+            WITH new_accounts AS (
+                INSERT INTO useraccounts (username, password, role, entity_id)
+                SELECT username, password_hash, 'student', NULL
+                FROM student_import_staging
+                ORDER BY row_number
+                RETURNING user_account_id, username
+            )
+            INSERT INTO students (first_name, last_name, email, contact_number, date_of_birth, gender, level, intended_program, department_id, matriculation_number, academic_year_id, user_account_id, admission_date)
+            SELECT st.first_name, st.last_name, st.email, st.contact_number, st.date_of_birth, st.gender, st.level, st.intended_program,
+                   st.department_id, st.matriculation_number, st.academic_year_id, na.user_account_id, NOW()
+            FROM student_import_staging st
+            JOIN new_accounts na ON na.username = st.username
+            ORDER BY st.row_number;
+        """)
+        inserted_rows = cur.rowcount
+
+        cur.execute("""
+            UPDATE useraccounts ua
+            SET entity_id = s.student_id
+            FROM students s
+            JOIN student_import_staging st ON st.matriculation_number = s.matriculation_number
+            WHERE ua.user_account_id = s.user_account_id;
+        """)
+        cur.execute(f"""
+            UPDATE students s
+            SET qr_code_data = {QR_DATA_SQL}
+            FROM student_import_staging st, departments d
+            WHERE st.matriculation_number = s.matriculation_number AND d.department_id = s.department_id;
+        """)
+
+        if check_lease:
+            check_lease()
+        conn.commit()
+        update_student_import_job(
+            job_conn, job_id, status='completed', inserted_rows=inserted_rows, error_count=error_count,
+            errors=psycopg2.extras.Json(errors), finished_at=datetime.now(timezone.utc),
+            message=f"Imported {inserted_rows} of {processed_rows} rows."
+        )
+        return {"processed_rows": processed_rows, "inserted_rows": inserted_rows, "error_count": error_count}
+
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        log.error("Student import job %s failed: %s", job_id, e)
+        if job_conn and not isinstance(e, JobLeaseLost): # The worker that took over owns the status row now
+            try:
+                update_student_import_job(
+                    job_conn, job_id, status='failed', processed_rows=processed_rows, inserted_rows=0,
+                    error_count=error_count, errors=psycopg2.extras.Json(errors),
+                    finished_at=datetime.now(timezone.utc), message=f"Import failed, no rows were inserted: {type(e).__name__} - {e}"
+                )
+            except psycopg2.Error as status_error:
+                log.error("Could not record failure of student import job %s: %s", job_id, status_error)
+        raise
+    finally:
+        if conn:
+            conn.close()
+        if job_conn:
+            job_conn.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@job_handler('student_import', max_attempts=3)
+def student_import_job(job):
+    """Job queue entry point: parks the stored upload on the worker's disk and runs the import."""
+    file_kind = job.payload['file_kind']
+    fd, path = tempfile.mkstemp(prefix='student-import-', suffix=f'.{file_kind}')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(job.attachment)
+    return run_student_import(job.job_id, path, file_kind, progress=job.progress, check_lease=job.check_lease) # Removes the file when done
+
+
+@app.route('/admin/students/import', methods=['POST'])
+@login_required # Protect this route
+def import_students_for_admin(user):
+    """
+    Starts a bulk student import from an uploaded CSV or XLSX file (multipart field 'file').
+    Requires 'admin' role.
+    The header row must contain the fields of POST /admin/students. Returns 202 with a job ID;
+    poll GET /admin/students/import/<job_id> (or GET /admin/jobs/<job_id>) for progress and the per-row error report.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can import students."}), 403
+
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({"error": "No file uploaded. Send the CSV or XLSX file in the multipart field 'file'."}), 400
+    file_kind = upload.filename.rsplit('.', 1)[-1].lower() if '.' in upload.filename else ''
+    if file_kind not in ('csv', 'xlsx'):
+        return jsonify({"error": "Unsupported file type. Upload a .csv or .xlsx file."}), 400
+    too_large = jsonify({"error": f"File too large. Imports are limited to {STUDENT_IMPORT_MAX_BYTES} bytes; split the file."}), 413
+    if request.content_length and request.content_length > STUDENT_IMPORT_MAX_BYTES + 64 * 1024: # Allow for multipart overhead
+        return too_large
+
+    # Park the upload on disk to check its header; the worker gets its own copy from the jobs table
+    fd, path = tempfile.mkstemp(prefix='student-import-', suffix=f'.{file_kind}')
+    os.close(fd)
+    conn = None
+    cur = None
+    try:
+        upload.save(path)
+        if os.path.getsize(path) > STUDENT_IMPORT_MAX_BYTES:
+            os.remove(path)
+            return too_large
+
+        header, rows, close = open_student_import_rows(path, file_kind)
+        close()
+        missing_columns = [field for field in STUDENT_IMPORT_FIELDS if field not in header]
+        if missing_columns:
+            os.remove(path)
+            return jsonify({"error": "Missing required columns in header row.", "missing_columns": missing_columns}), 400
+
+        ensure_support_tables()
+        job_id = secrets.token_hex(16)
+        conn = connect_db()
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO studentimportjobs (job_id, status, filename, created_by) VALUES (%s, 'queued', %s, %s);",
+            (job_id, upload.filename[:255], str(user_account_id_admin))
+        )
+        with open(path, 'rb') as f:
+            enqueue_job(cur, 'student_import', {"file_kind": file_kind, "filename": upload.filename[:255]},
+                        created_by=user_account_id_admin, attachment=f.read(), job_id=job_id)
+        conn.commit()
+        os.remove(path)
+
+        return jsonify({
+            "message": "Student import started.",
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/admin/students/import/{job_id}"
+        }), 202 # 202 Accepted
+
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        if os.path.exists(path):
+            os.remove(path)
+        log.error("Database error starting student import: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        log.exception("An unexpected error occurred starting student import: %s", e)
+        return jsonify({"error": f"Could not read the uploaded file: {type(e).__name__} - {e}"}), 400
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+@app.route('/admin/students/import/<job_id>', methods=['GET'])
+@login_required # Protect this route
+def get_student_import_job(user, job_id):
+    """
+    Returns the status, progress counters and per-row error report of a bulk student import.
+    Requires 'admin' role.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can view student imports."}), 403
+
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables()
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("""
+            SELECT job_id, status, filename, created_by, total_rows, processed_rows, inserted_rows,
+                   error_count, errors, message, created_at, started_at, finished_at
+            FROM studentimportjobs
+            WHERE job_id = %s;
+        """, (job_id,))
+        job = cur.fetchone()
+        if not job:
+            return jsonify({"error": f"Import job {job_id} not found."}), 404
+
+        job['progress_percent'] = (
+            round(100.0 * job['processed_rows'] / job['total_rows'], 1) if job['total_rows'] else None
+        )
+        for key in ('created_at', 'started_at', 'finished_at'):
+            if job[key]:
+                job[key] = job[key].isoformat()
+        return jsonify(job), 200
+
+    except psycopg2.Error as e:
+        log.error("Database error fetching student import job %s: %s", job_id, e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred fetching student import job %s: %s", job_id, e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+# --- Bulk Student Import Ends Here ---
+
+# --- Cascade Delete Engine ---
+# The schema's foreign keys are ON DELETE NO ACTION, so deleting a student, lecturer, course, academic year or
+# session means clearing its dependents first. Instead of one long transaction per route (which held locks on
+# attendancerecords for the whole cascade), CASCADE_PLANS lists each entity's dependents in dependency order and
+# run_cascade_delete() clears them CASCADE_DELETE_CHUNK_SIZE rows at a time, walking each table in primary-key
+# order and committing after every chunk. A failure part-way leaves the root row in place, so the delete can
+# simply be retried. Soft deletes record a tombstone in pendingdeletions instead: the entity disappears from lists
+# and lookups, can no longer log in or use its tokens straight away, and a 'purge_deletions' job purges it with
+# the same engine.
+CASCADE_DELETE_CHUNK_SIZE = int(os.environ.get('CASCADE_DELETE_CHUNK_SIZE', 1000))
+CASCADE_DELETE_MAX_PASSES = int(os.environ.get('CASCADE_DELETE_MAX_PASSES', 3)) # Re-runs if rows were added mid-cascade
+BULK_DELETE_MAX_IDS = int(os.environ.get('BULK_DELETE_MAX_IDS', 10000))
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS pendingdeletions (
+        entity_type VARCHAR(32) NOT NULL,
+        entity_id VARCHAR(64) NOT NULL,
+        requested_by VARCHAR(64),
+        requested_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        PRIMARY KEY (entity_type, entity_id)
+    );
+""")
+
+# Scopes are SQL conditions over the step's table; %(ids)s is the list of root IDs being deleted.
+_SESSIONS_OF_ASSIGNMENTS = "session_id IN (SELECT session_id FROM attendancesessions WHERE assignment_id IN ({assignments}))"
+_LECTURER_ASSIGNMENTS = "SELECT assignment_id FROM coursesassignedtolecturers WHERE lecturer_id = ANY(%(ids)s)"
+_COURSE_ASSIGNMENTS = "SELECT assignment_id FROM coursesassignedtolecturers WHERE course_id = ANY(%(ids)s)"
+
+CASCADE_PLANS = {
+    'student': {
+        'label': 'Student',
+        'steps': [
+            {'table': 'attendancerecords', 'key': 'record_id', 'scope': "student_id = ANY(%(ids)s)"},
+            {'table': 'studentsenrolledcourses', 'key': 'enrollment_id', 'scope': "student_id = ANY(%(ids)s)"},
+            # The linked user account goes in the same statement as the student row (NO ACTION is checked at statement end)
+            {'table': 'students', 'key': 'student_id', 'scope': "student_id = ANY(%(ids)s)",
+             'linked': ('useraccounts', 'user_account_id')},
+        ],
+        'invalidates': (),
+    },
+    'lecturer': {
+        'label': 'Lecturer',
+        'steps': [
+            {'table': 'attendancerecords', 'key': 'record_id', 'scope': _SESSIONS_OF_ASSIGNMENTS.format(assignments=_LECTURER_ASSIGNMENTS)},
+            {'table': 'attendancesessions', 'key': 'session_id', 'scope': f"assignment_id IN ({_LECTURER_ASSIGNMENTS})"},
+            {'table': 'coursesassignedtolecturers', 'key': 'assignment_id', 'scope': "lecturer_id = ANY(%(ids)s)"},
+            {'table': 'lecturers', 'key': 'lecturer_id', 'scope': "lecturer_id = ANY(%(ids)s)",
+             'linked': ('useraccounts', 'user_account_id')},
+        ],
+        'invalidates': (invalidate_lecturer_ownership,),
+    },
+    'course': {
+        'label': 'Course',
+        'steps': [
+            {'table': 'attendancerecords', 'key': 'record_id', 'scope': _SESSIONS_OF_ASSIGNMENTS.format(assignments=_COURSE_ASSIGNMENTS)},
+            {'table': 'attendancesessions', 'key': 'session_id', 'scope': f"assignment_id IN ({_COURSE_ASSIGNMENTS})"},
+            {'table': 'studentsenrolledcourses', 'key': 'enrollment_id', 'scope': "course_id = ANY(%(ids)s)"},
+            {'table': 'coursesassignedtolecturers', 'key': 'assignment_id', 'scope': "course_id = ANY(%(ids)s)"},
+            {'table': 'courses', 'key': 'course_id', 'scope': "course_id = ANY(%(ids)s)"},
+        ],
+        'invalidates': (invalidate_lecturer_ownership,),
+    },
+    'academic_year': {
+        'label': 'Academic year',
+        'steps': [
+            # Records that belong to a year are kept and unlinked, as before
+            {'table': 'students', 'key': 'student_id', 'scope': "academic_year_id = ANY(%(ids)s)", 'nullify': 'academic_year_id'},
+            {'table': 'coursesassignedtolecturers', 'key': 'assignment_id', 'scope': "academic_year_id = ANY(%(ids)s)", 'nullify': 'academic_year_id'},
+            {'table': 'studentsenrolledcourses', 'key': 'enrollment_id', 'scope': "academic_year_id = ANY(%(ids)s)", 'nullify': 'academic_year_id'},
+            {'table': 'academicyears', 'key': 'academic_year_id', 'scope': "academic_year_id = ANY(%(ids)s)"},
+        ],
+        'invalidates': (invalidate_lecturer_ownership, invalidate_reference_data),
+    },
+    'attendance_session': {
+        'label': 'Attendance session',
+        'steps': [
+            {'table': 'attendancerecords', 'key': 'record_id', 'scope': "session_id = ANY(%(ids)s)"},
+            {'table': 'attendancesessions', 'key': 'session_id', 'scope': "session_id = ANY(%(ids)s)"},
+        ],
+        'invalidates': (invalidate_lecturer_ownership,),
+    },
+}
+
+def cascade_step_sql(step):
+    """Builds the chunk statement for one plan step; it returns one row per touched primary key."""
+    table, key, scope = step['table'], step['key'], step['scope']
+    batch = f"""
+        SELECT {key}{', ' + step['linked'][1] if 'linked' in step else ''} FROM {table}
+        WHERE ({scope}) AND (%(after)s IS NULL OR {key} > %(after)s)
+        ORDER BY {key}
+        LIMIT %(limit)s
+    """
+    if 'nullify' in step:
+        return f"""
+            WITH batch AS ({batch})
+            UPDATE {table} t SET {step['nullify']} = NULL FROM batch WHERE t.{key} = batch.{key}
+            RETURNING t.{key}, 0;
+        """
+    if 'linked' in step:
+        linked_table, linked_key = step['linked']
+        return f"""
+            WITH batch AS ({batch}),
+            deleted AS (
+                DELETE FROM {table} t USING batch WHERE t.{key} = batch.{key}
+                RETURNING t.{key}, t.{linked_key}
+            ),
+            linked AS (
+                DELETE FROM {linked_table} WHERE {linked_key} IN (SELECT {linked_key} FROM deleted)
+                RETURNING {linked_key}
+            )
+            SELECT {key}, (SELECT COUNT(*) FROM linked) FROM deleted;
+        """
+    return f"""
+        WITH batch AS ({batch})
+        DELETE FROM {table} t USING batch WHERE t.{key} = batch.{key}
+        RETURNING t.{key}, 0;
+    """
+
+
+def run_cascade_delete(conn, entity_type, ids, chunk_size=None):
+    """
+    Deletes (or unlinks, per the plan) every dependent of the given root entities and then the roots themselves,
+    in short chunked transactions on `conn`. Returns {'deleted': {table: rows}, 'chunks': n, 'roots_deleted': n}.
+    Commits as it goes; on error the current chunk is rolled back and the exception propagates.
+    """
+    plan = CASCADE_PLANS[entity_type]
+    chunk_size = chunk_size or CASCADE_DELETE_CHUNK_SIZE
+    ids = [str(entity_id) for entity_id in ids]
+    counts = {}
+    chunks = 0
+    conn.commit() # Never run chunks inside a caller's open transaction
+    with conn.cursor() as cur:
+        cur.execute(CLOSED_YEAR_OVERRIDE_SQL) # Admin deletes may clear rows of closed academic years
+    conn.commit()
+
+    try:
+        for attempt in range(1, CASCADE_DELETE_MAX_PASSES + 1):
+            try:
+                for step in plan['steps']:
+                    sql = cascade_step_sql(step)
+                    label = f"{step['table']} (unlinked)" if 'nullify' in step else step['table']
+                    after = None
+                    while True:
+                        with conn.cursor() as cur:
+                            cur.execute(sql, {'ids': ids, 'after': after, 'limit': chunk_size})
+                            rows = cur.fetchall()
+                        conn.commit()
+                        chunks += 1
+                        if not rows:
+                            break
+                        counts[label] = counts.get(label, 0) + len(rows)
+                        if 'linked' in step:
+                            counts[step['linked'][0]] = counts.get(step['linked'][0], 0) + sum(row[1] for row in rows)
+                        after = max(row[0] for row in rows)
+                        if len(rows) < chunk_size:
+                            break
+                break
+            except psycopg2.errors.ForeignKeyViolation:
+                # A dependent row was inserted after its step had finished (e.g. a scan during the delete); go again
+                conn.rollback()
+                if attempt == CASCADE_DELETE_MAX_PASSES:
+                    raise
+    finally:
+        for invalidate in plan['invalidates']:
+            invalidate()
+
+    return {'deleted': counts, 'chunks': chunks, 'roots_deleted': counts.get(plan['steps'][-1]['table'], 0)}
+
+
+# Every worker keeps the set of tombstones in memory (re-read every TOMBSTONE_REFRESH_SECONDS, and updated at once
+# on the worker that soft-deletes) so point lookups - the auth check, ownership checks, scans, detail routes -
+# can hide soft-deleted entities without a query. List queries use soft_deleted_filter() instead.
+TOMBSTONE_REFRESH_SECONDS = int(os.environ.get('TOMBSTONE_REFRESH_SECONDS', 10))
+
+_tombstones = frozenset() # {(entity_type, entity_id)}
+_tombstones_refreshed_at = 0.0
+_tombstones_lock = threading.Lock()
+
+
+def refresh_tombstones(force=False):
+    """Reloads pendingdeletions into memory if the copy is older than TOMBSTONE_REFRESH_SECONDS."""
+    global _tombstones, _tombstones_refreshed_at
+    if not force and time.monotonic() - _tombstones_refreshed_at < TOMBSTONE_REFRESH_SECONDS:
+        return
+    if not _tombstones_lock.acquire(blocking=force):
+        return
+    conn = None
+    try:
+        _tombstones_refreshed_at = time.monotonic() # Set first so a DB outage does not trigger a reload per request
+        ensure_support_tables()
+        conn = connect_db()
+        with conn.cursor() as cur:
+            cur.execute("SELECT entity_type, entity_id FROM pendingdeletions;")
+            _tombstones = frozenset(cur.fetchall())
+    except psycopg2.Error as e:
+        log.warning("Could not refresh soft-delete tombstones, keeping the previous set: %s", e)
+    finally:
+        if conn:
+            conn.close()
+        _tombstones_lock.release()
+
+
+def is_soft_deleted(entity_type, entity_id):
+    """True if the entity has been soft-deleted and is waiting to be purged."""
+    refresh_tombstones()
+    return (entity_type, str(entity_id)) in _tombstones
+
+
+def soft_delete_version():
+    """A short digest of the current tombstones; cached reports are keyed on it so soft deletes show up at once."""
+    refresh_tombstones()
+    return hashlib.sha256(repr(sorted(_tombstones)).encode('utf-8')).hexdigest()[:12]
+
+
+def soft_delete_entities(conn, entity_type, ids, requested_by):
+    """
+    Records tombstones (hiding the entities at once) and queues the purge job. Commits.
+    Soft-deleted students and lecturers are rejected by login_required from then on, so tokens they already
+    hold stop working without waiting for them to expire.
+    """
+    global _tombstones
+    ensure_support_tables()
+    with conn.cursor() as cur:
+        execute_values(cur, """
+            INSERT INTO pendingdeletions (entity_type, entity_id, requested_by) VALUES %s
+            ON CONFLICT (entity_type, entity_id) DO NOTHING;
+        """, [(entity_type, str(entity_id), str(requested_by)) for entity_id in ids])
+        enqueue_job(cur, 'purge_deletions', created_by=requested_by, dedupe_key='purge_deletions')
+    conn.commit()
+    with _tombstones_lock:
+        _tombstones = _tombstones | {(entity_type, str(entity_id)) for entity_id in ids}
+    for invalidate in CASCADE_PLANS[entity_type]['invalidates']:
+        invalidate()
+
+
+def purge_pending_deletions(check_lease=None):
+    """
+    Runs the cascade for every tombstone, oldest first, one entity type at a time. Returns the number purged.
+    `check_lease()` is called before each batch so a job that lost its lease stops between batches.
+    """
+    purged = 0
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT entity_type, array_agg(entity_id ORDER BY requested_at)
+                FROM pendingdeletions
+                WHERE attempts < %s
+                GROUP BY entity_type;
+            """, (CASCADE_DELETE_MAX_PASSES * 3,))
+            pending = cur.fetchall()
+        conn.commit()
+
+        for entity_type, entity_ids in pending:
+            if entity_type not in CASCADE_PLANS:
+                continue
+            for start in range(0, len(entity_ids), CASCADE_DELETE_CHUNK_SIZE):
+                batch_ids = entity_ids[start:start + CASCADE_DELETE_CHUNK_SIZE]
+                if check_lease:
+                    check_lease()
+                try:
+                    run_cascade_delete(conn, entity_type, batch_ids)
+                    with conn.cursor() as cur:
+                        cur.execute("DELETE FROM pendingdeletions WHERE entity_type = %s AND entity_id = ANY(%s);", (entity_type, batch_ids))
+                    conn.commit()
+                    purged += len(batch_ids)
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    log.error("Background purge of %s %s... failed: %s", entity_type, batch_ids[:5], e)
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            "UPDATE pendingdeletions SET attempts = attempts + 1, last_error = %s WHERE entity_type = %s AND entity_id = ANY(%s);",
+                            (str(e), entity_type, batch_ids)
+                        )
+                    conn.commit()
+    finally:
+        conn.close()
+    return purged
+
+
+@job_handler('purge_deletions', priority=JOB_DEFAULT_PRIORITY + 50)
+def purge_deletions_job(job):
+    """
+    Job queue entry point: sweeps pendingdeletions until a sweep finds nothing left to purge. Tombstones that
+    failed but still have attempts left make the job fail, so the queue retries it after a backoff.
+    """
+    purged = 0
+    while True:
+        swept = purge_pending_deletions(check_lease=job.check_lease)
+        if not swept:
+            break
+        purged += swept
+        job.progress(purged, message=f"Purged {purged} soft-deleted entities.", force=True)
+
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM pendingdeletions WHERE attempts < %s;", (CASCADE_DELETE_MAX_PASSES * 3,))
+            remaining = cur.fetchone()[0]
+    finally:
+        conn.close()
+    if remaining:
+        raise RuntimeError(f"{remaining} soft-deleted entities could not be purged yet (purged {purged}).")
+    return {"purged": purged}
+
+
+def delete_entities_response(conn, entity_type, ids, mode, requested_by):
+    """
+    Shared tail of the admin delete routes: runs a hard (chunked) or soft delete for already-validated IDs
+    and returns the (response, status) pair.
+    """
+    label = CASCADE_PLANS[entity_type]['label']
+    subject = f"{label} {ids[0]}" if len(ids) == 1 else f"{len(ids)} {label.lower()} records"
+    if mode == 'soft':
+        soft_delete_entities(conn, entity_type, ids, requested_by)
+        return jsonify({"message": f"{subject} hidden and scheduled for deletion.", "mode": "soft"}), 202 # 202 Accepted
+
+    result = run_cascade_delete(conn, entity_type, ids)
+    if result['roots_deleted'] < len(ids):
+        return jsonify({"error": f"{subject}: only {result['roots_deleted']} of {len(ids)} could be deleted.", **result}), 500
+    return jsonify({"message": f"{subject} and related records deleted successfully.", "mode": "hard", **result}), 200
+
+
+@app.cli.command('purge-deletions')
+def purge_deletions_command():
+    """Purges every soft-deleted entity still waiting in pendingdeletions."""
+    ensure_support_tables()
+    click.echo(f"Purged {purge_pending_deletions()} soft-deleted entities.")
+
+
+@app.route('/admin/bulk-delete', methods=['POST'])
+@login_required # Protect this route
+def bulk_delete_for_admin(user):
+    """
+    Deletes many entities of one type with the cascade engine.
+    Requires 'admin' role.
+    Body: {"entity_type": "student" | "lecturer" | "course" | "academic_year" | "attendance_session",
+           "ids": [...], "mode": "hard" (default) | "soft"}
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can bulk delete records."}), 403
+
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
+    data = request.get_json()
+
+    entity_type = data.get('entity_type')
+    ids = data.get('ids')
+    mode = data.get('mode', 'hard')
+    if entity_type not in CASCADE_PLANS:
+        return jsonify({"error": f"Invalid entity_type. Allowed: {', '.join(CASCADE_PLANS)}."}), 400
+    if not isinstance(ids, list) or not ids:
+        return jsonify({"error": "Field 'ids' must be a non-empty list."}), 400
+    if len(ids) > BULK_DELETE_MAX_IDS:
+        return jsonify({"error": f"At most {BULK_DELETE_MAX_IDS} IDs can be deleted per request."}), 400
+    if mode not in ('hard', 'soft'):
+        return jsonify({"error": "Field 'mode' must be 'hard' or 'soft'."}), 400
+    ids = list(dict.fromkeys(str(entity_id) for entity_id in ids))
+
+    root = CASCADE_PLANS[entity_type]['steps'][-1]
+    conn = None
+    try:
+        conn = connect_db()
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT {root['key']} FROM {root['table']} WHERE {root['key']} = ANY(%s);", (ids,))
+            found = {str(row[0]) for row in cur.fetchall()}
+        missing = [entity_id for entity_id in ids if entity_id not in found]
+        if missing:
+            return jsonify({"error": "Some IDs were not found. Nothing was deleted.", "missing_ids": missing}), 404
+        return delete_entities_response(conn, entity_type, ids, mode, entity_id_admin)
+
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        log.error("Database error during bulk delete of %s: %s", entity_type, e)
+        return jsonify({"error": f"Database error during deletion (completed chunks stay deleted; retry to finish): {e}"}), 500
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        log.exception("An unexpected error occurred during bulk delete of %s: %s", entity_type, e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if conn:
+            conn.close()
+# --- Cascade Delete Engine Ends Here ---
+
+# --- Background Job Status ---
+@app.route('/admin/jobs/<job_id>', methods=['GET'])
+@login_required # Protect this route
+def get_job_for_admin(user, job_id):
+    """
+    Returns the status, attempts, progress and result (or last error) of a background job.
+    Requires 'admin' role.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can view background jobs."}), 403
+
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables()
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("""
+            SELECT job_id, job_type, payload, status, priority, attempts, max_attempts, run_after, locked_by, locked_until,
+                   progress_current, progress_total, progress_message, result, last_error, created_by,
+                   created_at, started_at, finished_at
+            FROM jobs
+            WHERE job_id = %s;
+        """, (job_id,))
+        job = cur.fetchone()
+        if not job:
+            return jsonify({"error": f"Job {job_id} not found."}), 404
+        return jsonify(serialize_job(job)), 200
+
+    except psycopg2.Error as e:
+        log.error("Database error fetching job %s: %s", job_id, e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred fetching job %s: %s", job_id, e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+# --- Background Job Status Ends Here ---
+
+# --- Slow Query Log ---
+# Every statement already goes through the instrumented cursors (see Request Metrics). Any statement slower than
+# SLOW_QUERY_THRESHOLD_MS is captured with its text, the shape of its parameters (types and list lengths only, never
+# values), the route and request ID (or the thread outside requests), and its duration. Statements that fail count
+# too, since statement timeouts are the slowest queries. The text is normalised like pg_stat_statements does: string
+# and numeric literals become ?, and repeated VALUES rows collapse into one. That matters because execute_values()
+# inlines every row (names, password hashes...) into the SQL before executing it, and some older routes build
+# statements with literals in them. A SLOW_QUERY_EXPLAIN_SAMPLE_RATE fraction of the successful single-statement
+# SELECT/WITH/INSERT/UPDATE/DELETE ones that were sent with parameters also get a plan, with its string literals
+# redacted: plain EXPLAIN (never ANALYZE, so nothing runs twice) on the same connection, inside a savepoint so a
+# failing EXPLAIN cannot abort the caller's transaction. Captures are logged and queued for a background
+# writer thread with its own uninstrumented connection, so neither the request nor its transaction waits on the
+# slowqueries table. GET /admin/slow-queries lists them, or groups them per statement.
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', 250)) # 0 disables capturing
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.1))
+SLOW_QUERY_RETENTION_DAYS = int(os.environ.get('SLOW_QUERY_RETENTION_DAYS', 7))
+SLOW_QUERY_MAX_STATEMENT_CHARS = 4000
+SLOW_QUERY_QUEUE_SIZE = 1000
+EXPLAINABLE_STATEMENTS = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS slowqueries (
+        slow_query_id BIGSERIAL PRIMARY KEY,
+        captured_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        duration_ms NUMERIC(12, 1) NOT NULL,
+        statement TEXT NOT NULL,
+        params_shape JSONB,
+        route VARCHAR(255),
+        request_id VARCHAR(64),
+        failed BOOLEAN NOT NULL DEFAULT FALSE,
+        plan TEXT,
+        worker VARCHAR(128) -- host:pid
+    );
+""")
+register_support_table("CREATE INDEX IF NOT EXISTS slowqueries_captured_idx ON slowqueries (captured_at DESC);")
+
+_slow_query_queue = None
+_slow_query_writer_pid = None
+_slow_query_writer_lock = threading.Lock()
+
+
+_SQL_STRING_LITERAL = re.compile(r"\b[Ee]'(?:[^'\\]|\\.|'')*'|(?:\b[BbXxNn])?'(?:[^']|'')*'")
+_SQL_NUMERIC_LITERAL = re.compile(r"(?<![\w$.%])\d+(?:\.\d+)?(?![\w.])")
+_SQL_REPEATED_ROWS = re.compile(r"(\([^()]*\))(?:\s*,\s*\1)+")
+
+
+def redact_sql_literals(text, numbers=True):
+    """Replaces string (and numeric) literals with ? and collapses repeated VALUES rows: `(?, ?), ...`."""
+    text = _SQL_STRING_LITERAL.sub("'?'", text)
+    if numbers:
+        text = _SQL_NUMERIC_LITERAL.sub("?", text)
+        text = _SQL_REPEATED_ROWS.sub(r"\1, ...", text)
+    return text
+
+
+def describe_params_shape(params):
+    """Types (and list lengths) of statement parameters, without their values."""
+    def shape(value):
+        if isinstance(value, (list, tuple)):
+            return f"{type(value).__name__}[{len(value)}]"
+        return type(value).__name__
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: shape(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [shape(value) for value in params]
+    return shape(params)
+
+
+def explain_statement(cursor, statement, params):
+    """The plan of a statement that just ran on `cursor`'s connection, or None when it cannot be explained safely."""
+    body = statement.strip().rstrip(';')
+    if ';' in body or body.split(None, 1)[0].upper() not in EXPLAINABLE_STATEMENTS:
+        return None # Multiple statements: EXPLAIN would only cover the first and run the rest again
+    conn = cursor.connection
+    with conn.raw_cursor() as raw:
+        use_savepoint = not conn.autocommit
+        try:
+            if use_savepoint:
+                raw.execute("SAVEPOINT slow_query_explain;")
+            raw.execute("EXPLAIN " + body, params)
+            plan = "\n".join(row[0] for row in raw.fetchall())
+            if use_savepoint:
+                raw.execute("RELEASE SAVEPOINT slow_query_explain;")
+            return plan
+        except psycopg2.Error as e:
+            if use_savepoint:
+                try:
+                    raw.execute("ROLLBACK TO SAVEPOINT slow_query_explain;")
+                except psycopg2.Error:
+                    pass
+            return f"EXPLAIN failed: {e}"
+
+
+def capture_slow_query(cursor, query, params, duration, succeeded):
+    """Logs a slow statement and queues it for the slowqueries table."""
+    statement = query.as_string(cursor) if hasattr(query, 'as_string') else query
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    plan = None
+    # Without parameters the values may already be inlined (execute_values): such statements are not explained
+    if succeeded and params is not None and random.random() < SLOW_QUERY_EXPLAIN_SAMPLE_RATE:
+        plan = explain_statement(cursor, statement, params)
+        if plan is not None:
+            plan = redact_sql_literals(plan, numbers=False) # Plans show parameter values as literals
+    if has_request_context():
+        route = f"{request.method} {request.url_rule.rule if request.url_rule is not None else request.path}"
+        request_id = g.get('request_id')
+    else:
+        route, request_id = f"thread {threading.current_thread().name}", None
+    entry = {
+        "duration_ms": round(duration * 1000, 1),
+        "statement": redact_sql_literals(" ".join(statement.split()))[:SLOW_QUERY_MAX_STATEMENT_CHARS],
+        "params_shape": describe_params_shape(params),
+        "route": route,
+        "request_id": request_id,
+        "failed": not succeeded,
+        "plan": plan,
+        "worker": f"{socket.gethostname()}:{os.getpid()}",
+    }
+    log.warning("Slow query (%.1f ms) on %s: %.200s", entry["duration_ms"], route, entry["statement"],
+                extra={"slow_query": {key: entry[key] for key in ("duration_ms", "params_shape", "failed")}})
+    try:
+        start_slow_query_writer().put_nowait(entry)
+    except queue.Full:
+        pass # The log line above still has it
+
+
+def start_slow_query_writer():
+    """Starts the writer thread once per process (again in each gunicorn worker after forking); returns its queue."""
+    global _slow_query_queue, _slow_query_writer_pid
+    if _slow_query_writer_pid == os.getpid():
+        return _slow_query_queue
+    with _slow_query_writer_lock:
+        if _slow_query_writer_pid != os.getpid():
+            _slow_query_queue = queue.Queue(SLOW_QUERY_QUEUE_SIZE)
+            threading.Thread(target=write_slow_queries_forever, args=(_slow_query_queue,), name='slow-query-writer', daemon=True).start()
+            _slow_query_writer_pid = os.getpid()
+    return _slow_query_queue
+
+
+def write_slow_queries_forever(entries):
+    conn = None
+    while True:
+        batch = [entries.get()]
+        while len(batch) < 100:
+            try:
+                batch.append(entries.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            ensure_support_tables()
+            if conn is None or conn.closed:
+                # Plain connection: the writer's own statements must not be timed (or captured) again
+                conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+            with conn.cursor() as cur:
+                execute_values(cur, """
+                    INSERT INTO slowqueries (duration_ms, statement, params_shape, route, request_id, failed, plan, worker)
+                    VALUES %s;
+                """, [(entry["duration_ms"], entry["statement"], psycopg2.extras.Json(entry["params_shape"]), entry["route"],
+                       entry["request_id"], entry["failed"], entry["plan"], entry["worker"]) for entry in batch])
+            conn.commit()
+        except Exception as e:
+            log.warning("Could not store %s slow query record(s): %s", len(batch), e)
+            if conn is not None:
+                conn.close()
+            conn = None
+            time.sleep(5)
+
+
+@periodic_task(3600)
+def trim_slow_queries():
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM slowqueries WHERE captured_at < NOW() - %s * INTERVAL '1 day';", (SLOW_QUERY_RETENTION_DAYS,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@app.route('/admin/slow-queries', methods=['GET'])
+@login_required # Protect this route
+def list_slow_queries_for_admin(user):
+    """
+    Lists captured slow queries, newest first, or grouped per statement (group_by=statement, slowest total first).
+    Requires 'admin' role.
+    Query parameters: optional route (substring), min_ms, hours (default 24), with_plan=true, page, per_page.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can view slow queries."}), 403
 
-        return jsonify({
-            "message": f"Student {first_name} {last_name} created successfully!",
-            "student_id": new_student_id,
-            "user_account_id": new_user_account_id,
-            "username": proposed_username,
-            "qr_code_data": qr_data_string # Include generated QR data
-        }), 201 # 201 Created
+    group_by = request.args.get('group_by')
+    if group_by not in (None, 'statement'):
+        return jsonify({"error": "Invalid group_by. Allowed: statement."}), 400
+    try:
+        page, per_page = parse_pagination(request.args)
+        conditions = ["captured_at >= NOW() - %s * INTERVAL '1 hour'"]
+        values = [float(request.args.get('hours', 24))]
+        if request.args.get('min_ms'):
+            conditions.append("duration_ms >= %s")
+            values.append(float(request.args['min_ms']))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {e}"}), 400
+    if request.args.get('route'):
+        conditions.append("route ILIKE %s")
+        values.append(f"%{request.args['route']}%")
+    if request.args.get('with_plan') == 'true':
+        conditions.append("plan IS NOT NULL")
+    where = " AND ".join(conditions)
+
+    if group_by == 'statement':
+        sql = f"""
+            SELECT statement, COUNT(*) AS count, SUM(duration_ms)::FLOAT AS total_ms, MAX(duration_ms)::FLOAT AS max_ms,
+                   ROUND(AVG(duration_ms), 1)::FLOAT AS avg_ms, COUNT(*) FILTER (WHERE failed) AS failed,
+                   ARRAY_AGG(DISTINCT route) AS routes, MAX(captured_at) AS last_seen,
+                   (ARRAY_AGG(plan ORDER BY captured_at DESC) FILTER (WHERE plan IS NOT NULL))[1] AS latest_plan,
+                   COUNT(*) OVER () AS total_count
+            FROM slowqueries
+            WHERE {where}
+            GROUP BY statement
+            ORDER BY total_ms DESC
+            LIMIT %s OFFSET %s;
+        """
+    else:
+        sql = f"""
+            SELECT slow_query_id, captured_at, duration_ms::FLOAT AS duration_ms, statement, params_shape,
+                   route, request_id, failed, plan, worker, COUNT(*) OVER () AS total_count
+            FROM slowqueries
+            WHERE {where}
+            ORDER BY captured_at DESC
+            LIMIT %s OFFSET %s;
+        """
 
-    except psycopg2.IntegrityError as e:
-        if conn:
-            conn.rollback()
-        print(f"Database integrity error during student creation: {e}")
-        # This could happen due to duplicate matriculation_number, username, or invalid FKs
-        return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables()
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(sql, values + [per_page, (page - 1) * per_page])
+        items = cur.fetchall()
+        total = items[0]['total_count'] if items else 0
+        for item in items:
+            del item['total_count']
+            for key in ('captured_at', 'last_seen'):
+                if item.get(key):
+                    item[key] = item[key].isoformat()
+        return jsonify({"items": items, "page": page, "per_page": per_page, "total": total,
+                        "threshold_ms": SLOW_QUERY_THRESHOLD_MS}), 200
 
     except psycopg2.Error as e:
-        if conn:
-            conn.rollback()
-        print(f"Database error during student creation: {e}")
+        log.error("Database error listing slow queries: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        if conn:
-            conn.rollback()
-        print(f"An unexpected error occurred during student creation: {e}")
+        log.exception("An unexpected error occurred listing slow queries: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
             cur.close()
-        # Ensure temporary cursor is closed if used
-        # if 'cur_dict' in locals() and cur_dict:
-        #     cur_dict.close()
         if conn:
             conn.close()
-
-def generate_student_qr_data_string_from_dict(student_data_dict):
-    """Generates QR data string from a student details dictionary."""
-    if not student_data_dict:
-        return None
-    # Ensure all expected keys are present, use get with default None
-    student_id = student_data_dict.get('student_id', '')
-    first_name = student_data_dict.get('first_name', '')
-    last_name = student_data_dict.get('last_name', '')
-    matriculation_number = student_data_dict.get('matriculation_number', '')
-    level = student_data_dict.get('level', '')
-    department_name = student_data_dict.get('department_name', '')
-
-    # Basic format, adapt as needed
-    qr_data = f"ID:{student_id},Name:{first_name} {last_name},Matric:{matriculation_number},Level:{level},Dept:{department_name}"
-    return qr_data
+# --- Slow Query Log Ends Here ---
 
 ####################################################################################
 
@@ -4974,7 +8868,7 @@ def create_lecturer_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for inserts/updates
 
         # --- Basic Validation (More robust validation needed) ---
@@ -4994,7 +8888,7 @@ def create_lecturer_for_admin(user):
 
 
         # --- Hash the password ---
-        hashed_password = generate_password_hash(proposed_password)
+        hashed_password = hash_password(proposed_password)
 
         # --- Create User Account ---
         # Insert into useraccounts first to get the user_account_id
@@ -5052,19 +8946,19 @@ def create_lecturer_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during lecturer creation: {e}")
+        log.error("Database integrity error during lecturer creation: %s", e)
         # This could happen due to duplicate employee_id, username, or invalid FKs
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during lecturer creation: {e}")
+        log.error("Database error during lecturer creation: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during lecturer creation: {e}")
+        log.exception("An unexpected error occurred during lecturer creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5114,7 +9008,7 @@ def create_admin_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- Basic Validation ---
@@ -5133,7 +9027,7 @@ def create_admin_for_admin(user):
 
 
         # --- Hash the password ---
-        hashed_password = generate_password_hash(proposed_password)
+        hashed_password = hash_password(proposed_password)
 
         # --- Create User Account ---
         sql_insert_user = """
@@ -5181,7 +9075,7 @@ def create_admin_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during admin creation: {e}")
+        log.error("Database integrity error during admin creation: %s", e)
         # Check for specific error messages related to unique constraints or FKs
         if "unique constraint" in str(e).lower() or "duplicate key value" in str(e).lower():
              return jsonify({"error": "Integrity error: Duplicate employee ID or username."}), 409
@@ -5191,12 +9085,12 @@ def create_admin_for_admin(user):
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during admin creation: {e}")
+        log.error("Database error during admin creation: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during admin creation: {e}")
+        log.exception("An unexpected error occurred during admin creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5224,8 +9118,8 @@ def list_all_admins(user):
     admins_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all relevant admin details, join useraccounts
         # *** CORRECTED: Removed date_of_employment column ***
@@ -5246,16 +9140,19 @@ def list_all_admins(user):
 
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         admins_list = cur.fetchall()
 
         return jsonify(admins_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching admin list: {e}")
+        log.error("Database error fetching admin list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching admin list: {e}")
+        log.exception("An unexpected error occurred fetching admin list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5283,7 +9180,7 @@ def get_admin_details_for_admin(user, admin_id):
     admin_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant admin details for the given admin_id
@@ -5334,11 +9231,11 @@ def get_admin_details_for_admin(user, admin_id):
         return jsonify(admin_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific admin details: {e}")
+        log.error("Database error fetching specific admin details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific admin details: {e}")
+        log.exception("An unexpected error occurred fetching specific admin details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5387,7 +9284,7 @@ def update_admin_details_for_admin(user, admin_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use RealDictCursor
 
         # --- First, verify if the administrator exists ---
@@ -5437,19 +9334,19 @@ def update_admin_details_for_admin(user, admin_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during admin update: {e}")
+        log.error("Database integrity error during admin update: %s", e)
         # This could happen if employee_id is not unique (if allowed to update)
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during admin update: {e}")
+        log.error("Database error during admin update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during admin update: {e}")
+        log.exception("An unexpected error occurred during admin update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5480,7 +9377,7 @@ def delete_admin_for_admin(user, admin_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the administrator exists and get linked user_account_id ---
@@ -5502,14 +9399,14 @@ def delete_admin_for_admin(user, admin_id):
         # *** VERIFY TABLE AND COLUMN NAMES: admissionstatus.approved_by_admin_id ***
         sql_nullify_admission_status = "UPDATE admissionstatus SET approved_by_admin_id = NULL WHERE approved_by_admin_id = %s;"
         cur.execute(sql_nullify_admission_status, (admin_id,))
-        print(f"Set approved_by_admin_id to NULL for {cur.rowcount} admission status entries approved by admin {admin_id}") # Debug print
+        log.debug("Set approved_by_admin_id to NULL for %s admission status entries approved by admin %s", cur.rowcount, admin_id)
 
 
         # 2. Set the administrator's user_account_id to NULL
         # This must happen before deleting the user account (FK administrators.user_account_id -> useraccounts)
         sql_set_user_account_null = "UPDATE administrators SET user_account_id = NULL WHERE admin_id = %s;"
         cur.execute(sql_set_user_account_null, (admin_id,))
-        print(f"Set administrators.user_account_id to NULL for admin {admin_id}") # Debug print
+        log.debug("Set administrators.user_account_id to NULL for admin %s", admin_id)
 
 
         # 3. Delete the linked User Account (if one exists)
@@ -5517,7 +9414,7 @@ def delete_admin_for_admin(user, admin_id):
         if linked_user_account_id:
             sql_delete_user = "DELETE FROM useraccounts WHERE user_account_id = %s;"
             cur.execute(sql_delete_user, (linked_user_account_id,))
-            print(f"Deleted user account {linked_user_account_id} linked to admin {admin_id}") # Debug print
+            log.debug("Deleted user account %s linked to admin %s", linked_user_account_id, admin_id)
 
 
         # --- 4. Finally, Delete the Administrator Record ---
@@ -5535,13 +9432,13 @@ def delete_admin_for_admin(user, admin_id):
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during admin deletion: {e}")
+        log.error("Database error during admin deletion: %s", e)
         # If you get a foreign key violation here, it means a referencing table wasn't handled!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during admin deletion: {e}")
+        log.exception("An unexpected error occurred during admin deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5571,8 +9468,8 @@ def list_all_departments(user):
     departments_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all department details
         # *** CORRECTED: Removed department_code and creation_date columns ***
@@ -5587,16 +9484,19 @@ def list_all_departments(user):
 
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         departments_list = cur.fetchall()
 
         return jsonify(departments_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching department list: {e}")
+        log.error("Database error fetching department list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching department list: {e}")
+        log.exception("An unexpected error occurred fetching department list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5624,7 +9524,7 @@ def get_department_details_for_admin(user, department_id):
     department_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant department details for the given department_id
@@ -5651,11 +9551,11 @@ def get_department_details_for_admin(user, department_id):
         return jsonify(department_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific department details: {e}")
+        log.error("Database error fetching specific department details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific department details: {e}")
+        log.exception("An unexpected error occurred fetching specific department details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5663,6 +9563,81 @@ def get_department_details_for_admin(user, department_id):
         if conn:
             conn.close()
 
+@app.route('/admin/departments/<department_id>/id-cards', methods=['GET'])
+@login_required # Protect this route
+def get_department_id_cards_for_admin(user, department_id):
+    """
+    Streams printable ID-card sheets (10 cards per A4 page) for every student in a department.
+    Requires 'admin' role.
+    Query parameters: format=pdf (default, one multi-page PDF) or zip (one PNG per sheet); optional level.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can print ID cards."}), 403
+
+    output_format = request.args.get('format', 'pdf').lower()
+    if output_format not in ('pdf', 'zip'):
+        return jsonify({"error": "Invalid format. Use 'pdf' or 'zip'."}), 400
+    level_filter = request.args.get('level')
+
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables() # pendingdeletions hides soft-deleted rows
+        conn = connect_db()
+        cur = conn.cursor()
+        cur.execute("SELECT department_name FROM departments WHERE department_id = %s;", (department_id,))
+        department = cur.fetchone()
+        if department is None:
+            return jsonify({"error": "Department not found."}), 404
+
+        sql = f"""
+            SELECT s.student_id, s.first_name, s.last_name, s.matriculation_number, s.level, d.department_name,
+                   COALESCE(s.qr_code_data, {QR_DATA_SQL})
+            FROM students s
+            JOIN departments d ON d.department_id = s.department_id
+            WHERE s.department_id = %s AND {soft_deleted_filter('student', 's.student_id')}
+        """
+        values = [department_id]
+        if level_filter:
+            sql += " AND s.level = %s"
+            values.append(level_filter)
+        sql += " ORDER BY s.level, s.last_name, s.first_name, s.student_id;"
+        cur.execute(sql, values)
+        students = cur.fetchall()
+    except psycopg2.Error as e:
+        log.error("Database error fetching students for ID cards: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+    if not students:
+        return jsonify({"error": "No students found for this department."}), 404
+
+    # Rendering starts only once the client starts reading; the connection is already closed
+    page_format = 'jpeg' if output_format == 'pdf' else 'png'
+    sheets = ((students[start:start + ID_CARDS_PER_SHEET], page_format) for start in range(0, len(students), ID_CARDS_PER_SHEET))
+    pages = iter_pool_results(get_render_pool(), render_id_card_sheet, sheets, in_flight=2 * RENDER_POOL_WORKERS)
+
+    filename = f"id-cards-{department_id}" + (f"-level-{level_filter}" if level_filter else "")
+    if output_format == 'pdf':
+        page_width = round(210 * ID_CARD_DPI / 25.4)
+        page_height = round(297 * ID_CARD_DPI / 25.4)
+        body = iter_pdf_from_jpeg_pages(pages, page_width, page_height)
+        mimetype = 'application/pdf'
+    else:
+        body = iter_zip_from_pages(pages, filename)
+        mimetype = 'application/zip'
+    return app.response_class(body, mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="{filename}.{output_format}"'
+    })
+
+
 @app.route('/admin/departments', methods=['POST'])
 @login_required # Protect this route
 def create_department_for_admin(user):
@@ -5700,7 +9675,7 @@ def create_department_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for inserts/updates
 
         # --- Basic Validation (More robust validation needed) ---
@@ -5741,6 +9716,7 @@ def create_department_for_admin(user):
 
 
         conn.commit()
+        invalidate_reference_data()
 
         # Optional: Fetch and return the full details of the newly created department
         # Using the GET /admin/departments/<department_id> logic is cleaner
@@ -5757,19 +9733,19 @@ def create_department_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during department creation: {e}")
+        log.error("Database integrity error during department creation: %s", e)
         # This could happen due to duplicate department name/code (now including faculty), or invalid FKs
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during department creation: {e}")
+        log.error("Database error during department creation: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during department creation: {e}")
+        log.exception("An unexpected error occurred during department creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5816,7 +9792,7 @@ def update_department_details_for_admin(user, department_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use RealDictCursor for fetching updated details
 
         # --- First, verify if the department exists ---
@@ -5880,6 +9856,9 @@ def update_department_details_for_admin(user, department_id):
         if cur.rowcount == 0:
              return jsonify({"message": "Department found, but no changes were applied (data might be the same or invalid fields provided)."}), 200
 
+        # Students' QR strings embed the department name
+        if 'department_name' in update_data:
+            regenerate_student_qr_data(cur, {'department_id': department_id})
 
         conn.commit()
         # Return the updated department details
@@ -5903,19 +9882,19 @@ def update_department_details_for_admin(user, department_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during department update: {e}")
+        log.error("Database integrity error during department update: %s", e)
         # This could happen if department_name/code becomes a duplicate, or faculty_id is invalid
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during department update: {e}")
+        log.error("Database error during department update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during department update: {e}")
+        log.exception("An unexpected error occurred during department update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -5941,7 +9920,7 @@ def delete_department_for_admin(user, department_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the department exists ---
@@ -5958,19 +9937,19 @@ def delete_department_for_admin(user, department_id):
         # *** VERIFY 'students' TABLE NAME AND 'department_id' COLUMN ***
         sql_nullify_student_dept = "UPDATE students SET department_id = NULL WHERE department_id = %s;"
         cur.execute(sql_nullify_student_dept, (department_id,))
-        print(f"Set department_id to NULL for {cur.rowcount} students in department {department_id}") # Debug print
+        log.debug("Set department_id to NULL for %s students in department %s", cur.rowcount, department_id)
 
         # 2. Set department_id to NULL for lecturers in this department
         # *** VERIFY 'lecturers' TABLE NAME AND 'department_id' COLUMN ***
         sql_nullify_lecturer_dept = "UPDATE lecturers SET department_id = NULL WHERE department_id = %s;"
         cur.execute(sql_nullify_lecturer_dept, (department_id,))
-        print(f"Set department_id to NULL for {cur.rowcount} lecturers in department {department_id}") # Debug print
+        log.debug("Set department_id to NULL for %s lecturers in department %s", cur.rowcount, department_id)
 
         # 3. Set department_id to NULL for courses in this department
         # *** VERIFY 'courses' TABLE NAME AND 'department_id' COLUMN ***
         sql_nullify_course_dept = "UPDATE courses SET department_id = NULL WHERE department_id = %s;"
         cur.execute(sql_nullify_course_dept, (department_id,))
-        print(f"Set department_id to NULL for {cur.rowcount} courses in department {department_id}") # Debug print
+        log.debug("Set department_id to NULL for %s courses in department %s", cur.rowcount, department_id)
 
 
         # --- Finally, Delete the Department Record ---
@@ -5983,18 +9962,19 @@ def delete_department_for_admin(user, department_id):
              return jsonify({"error": "Department found but could not be deleted."}), 500
 
         conn.commit()
+        invalidate_reference_data()
         return jsonify({"message": f"Department {department_id} and linked records updated successfully."}), 200 # Or 204 No Content
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during department deletion: {e}")
+        log.error("Database error during department deletion: %s", e)
         # If you get a foreign key violation here, it means a referencing table wasn't handled or wasn't set to NULL!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during department deletion: {e}")
+        log.exception("An unexpected error occurred during department deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6024,18 +10004,19 @@ def list_all_academic_years(user):
     academic_years_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all academic year details
         # *** VERIFY 'academicyears' TABLE NAME AND COLUMN NAMES ***
-        sql = """
+        sql = f"""
             SELECT
                 ay.academic_year_id, -- Primary key
                 ay.term_name, -- e.g., '2023/2024' or 'Fall 2023/Spring 2024'
                 ay.start_date, -- Assuming start_date exists
                 ay.end_date -- Assuming end_date exists
             FROM academicyears ay -- *** Use the correct table name ***
+            WHERE {soft_deleted_filter('academic_year', 'ay.academic_year_id')}
             ORDER BY ay.term_name DESC; -- Order by year name, maybe start_date
         """
         # Note: Adjust column names (term_name, start_date, end_date) if your schema is different.
@@ -6043,8 +10024,12 @@ def list_all_academic_years(user):
 
 
         # No WHERE clause needed to filter, as admin sees all
+        ensure_support_tables() # pendingdeletions hides soft-deleted rows
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         academic_years_list = cur.fetchall()
 
         # Convert dates to string format for JSON if needed (optional, JSON standard handles datetime)
@@ -6058,11 +10043,11 @@ def list_all_academic_years(user):
         return jsonify(academic_years_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching academic year list: {e}")
+        log.error("Database error fetching academic year list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching academic year list: {e}")
+        log.exception("An unexpected error occurred fetching academic year list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6090,7 +10075,7 @@ def get_academic_year_details_for_admin(user, year_id):
     academic_year_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant academic year details for the given academic_year_id
@@ -6111,7 +10096,7 @@ def get_academic_year_details_for_admin(user, year_id):
 
         academic_year_details = cur.fetchone()
 
-        if academic_year_details is None:
+        if academic_year_details is None or is_soft_deleted('academic_year', year_id):
             # Academic year with the given ID not found
             return jsonify({"error": "Academic year not found."}), 404 # 404 Not Found
 
@@ -6126,11 +10111,11 @@ def get_academic_year_details_for_admin(user, year_id):
         return jsonify(academic_year_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific academic year details: {e}")
+        log.error("Database error fetching specific academic year details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific academic year details: {e}")
+        log.exception("An unexpected error occurred fetching specific academic year details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6180,7 +10165,7 @@ def create_academic_year_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- Basic Validation ---
@@ -6225,6 +10210,7 @@ def create_academic_year_for_admin(user):
 
 
         conn.commit()
+        invalidate_reference_data()
 
         return jsonify({
             "message": f"Academic year '{term_name}' ({year_int}) created successfully!",
@@ -6238,20 +10224,20 @@ def create_academic_year_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during academic year creation: {e}")
+        log.error("Database integrity error during academic year creation: %s", e)
         # This could happen due to duplicate term_name, year, or invalid/overlapping dates if constraints exist
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during academic year creation: {e}")
+        log.error("Database error during academic year creation: %s", e)
         # If date format is wrong and DB rejects it, this will be a Database error
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during academic year creation: {e}")
+        log.exception("An unexpected error occurred during academic year creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6297,7 +10283,7 @@ def update_academic_year_details_for_admin(user, year_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use RealDictCursor for fetching updated details
 
         # --- First, verify if the academic year exists ---
@@ -6385,20 +10371,20 @@ def update_academic_year_details_for_admin(user, year_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during academic year update: {e}")
+        log.error("Database integrity error during academic year update: %s", e)
         # This could happen if term_name/year becomes a duplicate, or date constraints are violated
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during academic year update: {e}")
+        log.error("Database error during academic year update: %s", e)
         # If date format is wrong and DB rejects it, this will be a Database error
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during academic year update: {e}")
+        log.exception("An unexpected error occurred during academic year update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6412,6 +10398,8 @@ def delete_academic_year_for_admin(user, year_id):
     """
     Deletes a specific academic year by academic_year_id for admin view,
     setting FKs in related tables to NULL based on schema findings.
+    Runs through the cascade delete engine in short chunked transactions;
+    ?mode=soft hides it immediately and purges it in the background.
     Requires 'admin' role.
     """
     user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
@@ -6420,11 +10408,15 @@ def delete_academic_year_for_admin(user, year_id):
     if role_admin != 'admin':
         return jsonify({"error": "Access forbidden. Only admins can delete academic years."}), 403
 
+    mode = request.args.get('mode', 'hard') # 'soft' hides the record now and purges it in the background
+    if mode not in ('hard', 'soft'):
+        return jsonify({"error": "Invalid mode. Use 'hard' or 'soft'."}), 400
+
 
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the academic year exists ---
@@ -6434,70 +10426,422 @@ def delete_academic_year_for_admin(user, year_id):
         if year_exists is None:
             return jsonify({"error": "Academic year not found."}), 404
 
+        return delete_entities_response(conn, 'academic_year', [year_id], mode, entity_id_admin)
 
-        # --- Update Related Records (Set FKs to NULL) ---
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        log.error("Database error during academic year deletion: %s", e)
+        # If you get a foreign key violation here, it means a referencing table wasn't handled or wasn't set to NULL!
+        return jsonify({"error": f"Database error during deletion: {e}"}), 500
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        log.exception("An unexpected error occurred during academic year deletion: %s", e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+# --- Academic Year Rollover ---
+# Year end used to mean editing every student's level by hand and recreating each course assignment. The
+# 'academic_year_rollover' job does it in a few set-based statements: students of the old year move up one level
+# (per a level map; the last level graduates and stays behind) and into the new year, the old year's course
+# assignments are cloned into the new year, and the old year is closed. Closed years are read-only: a statement-level
+# trigger on the attendance, assignment and enrollment tables rejects writes that touch them with a check_violation,
+# which the attendance write routes turn into 409 (closed_year_response). Finally the old year's attendance sessions and records are moved into
+# archive tables in chunked transactions. POST /admin/academic-years/<id>/rollover queues the job; dry_run only counts.
+ROLLOVER_ARCHIVE_CHUNK_SIZE = int(os.environ.get('ROLLOVER_ARCHIVE_CHUNK_SIZE', 5000))
+_NUMERIC_LEVELS = [level for level in STUDENT_APPLICATION_LEVELS if level.isdigit()]
+# Current level -> next level; None means the student graduates (keeps level and year)
+ROLLOVER_DEFAULT_LEVEL_MAP = {**dict(zip(_NUMERIC_LEVELS, _NUMERIC_LEVELS[1:])), _NUMERIC_LEVELS[-1]: None}
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS closedacademicyears (
+        academic_year_id VARCHAR(64) PRIMARY KEY,
+        rolled_over_to VARCHAR(64),
+        closed_by VARCHAR(64),
+        closed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        rollover_job_id VARCHAR(32),
+        archived_at TIMESTAMP WITH TIME ZONE
+    );
+""")
+# Archive tables mirror the live ones, plus the year they were archived from
+for _live_table in ('attendancesessions', 'attendancerecords'):
+    register_support_table(f"CREATE TABLE IF NOT EXISTS archived{_live_table} (LIKE {_live_table});")
+    register_support_table(f"""
+        ALTER TABLE archived{_live_table}
+            ADD COLUMN IF NOT EXISTS archived_academic_year_id VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW();
+    """)
+    register_support_table(f"CREATE INDEX IF NOT EXISTS archived{_live_table}_year_idx ON archived{_live_table} (archived_academic_year_id);")
+# One check per statement over its transition tables (a batch of records joins closedacademicyears once, not per row)
+register_support_table("""
+    CREATE OR REPLACE FUNCTION enforce_open_academic_year() RETURNS trigger AS $$
+    DECLARE
+        closed_year TEXT;
+    BEGIN
+        -- Maintenance (archiving, cascade deletes) opts out for its own connection
+        IF current_setting('esas.closed_year_override', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        IF TG_TABLE_NAME = 'attendancerecords' THEN
+            IF TG_OP <> 'DELETE' THEN
+                SELECT cy.academic_year_id INTO closed_year
+                FROM (SELECT DISTINCT session_id FROM new_rows) r
+                JOIN attendancesessions ats ON ats.session_id = r.session_id
+                JOIN coursesassignedtolecturers ca ON ca.assignment_id = ats.assignment_id
+                JOIN closedacademicyears cy ON cy.academic_year_id = ca.academic_year_id::TEXT
+                LIMIT 1;
+            END IF;
+            IF closed_year IS NULL AND TG_OP <> 'INSERT' THEN
+                SELECT cy.academic_year_id INTO closed_year
+                FROM (SELECT DISTINCT session_id FROM old_rows) r
+                JOIN attendancesessions ats ON ats.session_id = r.session_id
+                JOIN coursesassignedtolecturers ca ON ca.assignment_id = ats.assignment_id
+                JOIN closedacademicyears cy ON cy.academic_year_id = ca.academic_year_id::TEXT
+                LIMIT 1;
+            END IF;
+        ELSIF TG_TABLE_NAME = 'attendancesessions' THEN
+            IF TG_OP <> 'DELETE' THEN
+                SELECT cy.academic_year_id INTO closed_year
+                FROM (SELECT DISTINCT assignment_id FROM new_rows) r
+                JOIN coursesassignedtolecturers ca ON ca.assignment_id = r.assignment_id
+                JOIN closedacademicyears cy ON cy.academic_year_id = ca.academic_year_id::TEXT
+                LIMIT 1;
+            END IF;
+            IF closed_year IS NULL AND TG_OP <> 'INSERT' THEN
+                SELECT cy.academic_year_id INTO closed_year
+                FROM (SELECT DISTINCT assignment_id FROM old_rows) r
+                JOIN coursesassignedtolecturers ca ON ca.assignment_id = r.assignment_id
+                JOIN closedacademicyears cy ON cy.academic_year_id = ca.academic_year_id::TEXT
+                LIMIT 1;
+            END IF;
+        ELSE
+            IF TG_OP <> 'DELETE' THEN
+                SELECT cy.academic_year_id INTO closed_year
+                FROM closedacademicyears cy
+                WHERE cy.academic_year_id IN (SELECT DISTINCT academic_year_id::TEXT FROM new_rows)
+                LIMIT 1;
+            END IF;
+            IF closed_year IS NULL AND TG_OP <> 'INSERT' THEN
+                SELECT cy.academic_year_id INTO closed_year
+                FROM closedacademicyears cy
+                WHERE cy.academic_year_id IN (SELECT DISTINCT academic_year_id::TEXT FROM old_rows)
+                LIMIT 1;
+            END IF;
+        END IF;
+        IF closed_year IS NOT NULL THEN
+            RAISE EXCEPTION 'Academic year % is closed and read-only.', closed_year USING ERRCODE = 'check_violation';
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+register_support_table("""
+    DO $$
+    DECLARE
+        guarded TEXT;
+    BEGIN
+        FOREACH guarded IN ARRAY ARRAY['attendancerecords', 'attendancesessions', 'coursesassignedtolecturers', 'studentsenrolledcourses'] LOOP
+            -- Replaces the earlier FOR EACH ROW guard
+            IF EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = guarded || '_open_year_guard') THEN
+                EXECUTE format('DROP TRIGGER %I ON %I', guarded || '_open_year_guard', guarded);
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = guarded || '_open_year_insert') THEN
+                EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION enforce_open_academic_year()', guarded || '_open_year_insert', guarded);
+                EXECUTE format('CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION enforce_open_academic_year()', guarded || '_open_year_update', guarded);
+                EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION enforce_open_academic_year()', guarded || '_open_year_delete', guarded);
+            END IF;
+        END LOOP;
+    END $$;
+""")
+
+CLOSED_YEAR_OVERRIDE_SQL = "SELECT set_config('esas.closed_year_override', 'on', false);" # Session-wide on that connection
+
+
+def closed_year_response(e):
+    """409 for a write rejected by the closed-year guard (psycopg2.errors.CheckViolation)."""
+    return jsonify({"error": e.diag.message_primary or str(e)}), 409
+
+# (live table, key, rows of the year being archived); records go first, they reference sessions
+ROLLOVER_ARCHIVE_STEPS = [
+    ('attendancerecords', 'record_id',
+     "session_id IN (SELECT ats.session_id FROM attendancesessions ats JOIN coursesassignedtolecturers ca ON ca.assignment_id = ats.assignment_id WHERE ca.academic_year_id = %(year)s)"),
+    ('attendancesessions', 'session_id',
+     "assignment_id IN (SELECT assignment_id FROM coursesassignedtolecturers WHERE academic_year_id = %(year)s)"),
+]
+
+
+def validate_rollover_level_map(level_map):
+    """Returns the level map as {str: str | None}; raises ValueError when it is not an object of levels."""
+    if not isinstance(level_map, dict) or not level_map:
+        raise ValueError("level_map must be a non-empty object of current level -> next level (or null to graduate).")
+    return {str(level): (str(next_level) if next_level is not None else None) for level, next_level in level_map.items()}
+
+
+def plan_academic_year_rollover(cur, from_year_id, to_year_id, level_map):
+    """Counts what a rollover would change without changing anything (dry runs and progress totals)."""
+    cur.execute("SELECT level::TEXT, COUNT(*) FROM students WHERE academic_year_id = %s GROUP BY 1;", (from_year_id,))
+    students_by_level = {level: count for level, count in cur.fetchall()}
+    promotions = {}
+    graduating = carried_over = 0
+    for level, count in students_by_level.items():
+        if level not in level_map:
+            carried_over += count
+        elif level_map[level] is None:
+            graduating += count
+        else:
+            promotions[f"{level} -> {level_map[level]}"] = count
+
+    cur.execute("""
+        SELECT COUNT(*),
+               COUNT(*) FILTER (WHERE EXISTS (
+                   SELECT 1 FROM coursesassignedtolecturers x
+                   WHERE x.academic_year_id = %(to)s AND x.course_id = ca.course_id AND x.lecturer_id = ca.lecturer_id
+               ))
+        FROM coursesassignedtolecturers ca
+        WHERE ca.academic_year_id = %(from)s;
+    """, {'from': from_year_id, 'to': to_year_id})
+    assignments, already_cloned = cur.fetchone()
+
+    cur.execute("""
+        SELECT COUNT(DISTINCT ats.session_id), COUNT(ar.session_id)
+        FROM attendancesessions ats
+        JOIN coursesassignedtolecturers ca ON ca.assignment_id = ats.assignment_id
+        LEFT JOIN attendancerecords ar ON ar.session_id = ats.session_id
+        WHERE ca.academic_year_id = %s;
+    """, (from_year_id,))
+    sessions, records = cur.fetchone()
+
+    return {
+        "from_academic_year_id": from_year_id,
+        "to_academic_year_id": to_year_id,
+        "students_promoted": sum(promotions.values()),
+        "promotions": promotions,
+        "students_graduating": graduating,
+        "students_carried_over": carried_over, # Levels outside the map move year without changing level
+        "assignments_to_clone": assignments - already_cloned,
+        "assignments_already_in_target_year": already_cloned,
+        "attendance_sessions_to_archive": sessions,
+        "attendance_records_to_archive": records,
+    }
+
+
+def promote_and_clone_for_rollover(cur, from_year_id, to_year_id, level_map):
+    """The set-based half of a rollover, in the caller's transaction. Returns the counts changed."""
+    levels = list(level_map)
+    next_levels = [level_map[level] for level in levels]
+    cur.execute("""
+        UPDATE students s
+        SET level = m.next_level, academic_year_id = %(to)s
+        FROM unnest(%(levels)s::TEXT[], %(next_levels)s::TEXT[]) AS m (level, next_level)
+        WHERE s.academic_year_id = %(from)s AND s.level::TEXT = m.level AND m.next_level IS NOT NULL;
+    """, {'from': from_year_id, 'to': to_year_id, 'levels': levels, 'next_levels': next_levels})
+    promoted = cur.rowcount
+    cur.execute("""
+        UPDATE students s
+        SET academic_year_id = %(to)s
+        WHERE s.academic_year_id = %(from)s AND (s.level IS NULL OR NOT (s.level::TEXT = ANY(%(levels)s::TEXT[])));
+    """, {'from': from_year_id, 'to': to_year_id, 'levels': levels})
+    carried_over = cur.rowcount
+
+    # Clone every column except the (trigger-generated) key and the year, whatever optional columns the table has
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'coursesassignedtolecturers'
+        ORDER BY ordinal_position;
+    """)
+    copied_columns = [row[0] for row in cur.fetchall() if row[0] not in ('assignment_id', 'academic_year_id')]
+    cur.execute(f"""
+        INSERT INTO coursesassignedtolecturers (academic_year_id, {", ".join(copied_columns)})
+        SELECT %(to)s, {", ".join(f"ca.{column}" for column in copied_columns)}
+        FROM coursesassignedtolecturers ca
+        WHERE ca.academic_year_id = %(from)s
+          AND NOT EXISTS (
+              SELECT 1 FROM coursesassignedtolecturers x
+              WHERE x.academic_year_id = %(to)s AND x.course_id = ca.course_id AND x.lecturer_id = ca.lecturer_id
+          )
+        ORDER BY ca.assignment_id;
+    """, {'from': from_year_id, 'to': to_year_id})
+    cloned = cur.rowcount
+
+    qr_updated = regenerate_student_qr_data(cur, {'academic_year_id': to_year_id}) # QR payloads include the level
+    return {"students_promoted": promoted, "students_carried_over": carried_over,
+            "assignments_cloned": cloned, "qr_codes_updated": qr_updated}
+
+
+def archive_academic_year_attendance(conn, year_id, progress=None):
+    """
+    Moves a closed year's attendance records and sessions into the archive tables, ROLLOVER_ARCHIVE_CHUNK_SIZE rows
+    per committed transaction. Safe to re-run. Returns {table: rows moved}.
+    """
+    moved_counts = {}
+    moved_total = 0
+    with conn.cursor() as cur:
+        cur.execute(CLOSED_YEAR_OVERRIDE_SQL)
+        cur.execute(SKIP_ATTENDANCE_CHANGE_LOG_SQL) # The year's statistics stay as they were at rollover
+    conn.commit()
+    for table, key, scope in ROLLOVER_ARCHIVE_STEPS:
+        sql = f"""
+            WITH batch AS (
+                SELECT {key} FROM {table}
+                WHERE ({scope}) AND (%(after)s IS NULL OR {key} > %(after)s)
+                ORDER BY {key}
+                LIMIT %(limit)s
+            ),
+            moved AS (
+                DELETE FROM {table} t USING batch WHERE t.{key} = batch.{key}
+                RETURNING t.*
+            ),
+            archived AS (
+                INSERT INTO archived{table} SELECT moved.*, %(year)s, NOW() FROM moved
+            )
+            SELECT MAX({key}), COUNT(*) FROM moved;
+        """
+        after = None
+        moved_counts[table] = 0
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(sql, {'year': year_id, 'after': after, 'limit': ROLLOVER_ARCHIVE_CHUNK_SIZE})
+                last_key, moved = cur.fetchone()
+            conn.commit()
+            if not moved:
+                break
+            moved_counts[table] += moved
+            moved_total += moved
+            after = last_key
+            if progress:
+                progress(moved_total, message=f"Archived {moved_counts[table]} rows from {table}.")
+            if moved < ROLLOVER_ARCHIVE_CHUNK_SIZE:
+                break
+    return moved_counts
+
+
+@job_handler('academic_year_rollover', max_attempts=3, priority=JOB_DEFAULT_PRIORITY - 50)
+def academic_year_rollover_job(job):
+    """
+    Job queue entry point. Payload: from_academic_year_id, to_academic_year_id, level_map, dry_run, archive_attendance.
+    The closedacademicyears row is written in the same transaction as the promotions, so a retried job skips
+    straight to archiving instead of promoting twice.
+    """
+    from_year_id = job.payload['from_academic_year_id']
+    to_year_id = job.payload['to_academic_year_id']
+    level_map = validate_rollover_level_map(job.payload.get('level_map') or ROLLOVER_DEFAULT_LEVEL_MAP)
+    conn = connect_db()
+    try:
+        cur = conn.cursor()
+        plan = plan_academic_year_rollover(cur, from_year_id, to_year_id, level_map)
+        conn.commit()
+        if job.payload.get('dry_run'):
+            return {"dry_run": True, **plan}
+
+        to_archive = plan['attendance_sessions_to_archive'] + plan['attendance_records_to_archive']
+        job.progress(0, to_archive, message="Promoting students and cloning course assignments.", force=True)
+        cur.execute("""
+            INSERT INTO closedacademicyears (academic_year_id, rolled_over_to, closed_by, rollover_job_id)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (academic_year_id) DO NOTHING
+            RETURNING academic_year_id;
+        """, (from_year_id, to_year_id, job.payload.get('requested_by'), job.job_id))
+        if cur.fetchone():
+            result = promote_and_clone_for_rollover(cur, from_year_id, to_year_id, level_map)
+            conn.commit()
+            invalidate_lecturer_ownership()
+        else:
+            conn.rollback()
+            cur.execute("SELECT rollover_job_id FROM closedacademicyears WHERE academic_year_id = %s;", (from_year_id,))
+            row = cur.fetchone()
+            if not row or row[0] != job.job_id:
+                raise JobFailed(f"Academic year {from_year_id} is already closed.")
+            result = {"resumed": True} # An earlier attempt of this job already promoted and cloned
+
+        if job.payload.get('archive_attendance', True):
+            result['archived'] = archive_academic_year_attendance(conn, from_year_id, job.progress)
+            with conn.cursor() as cur:
+                cur.execute("UPDATE closedacademicyears SET archived_at = NOW() WHERE academic_year_id = %s;", (from_year_id,))
+            conn.commit()
+        return {"dry_run": False, "plan": plan, **result}
+    finally:
+        conn.close()
 
-        # 1. Set academic_year_id to NULL for students linked to this year
-        #    This query caused a NOT NULL error earlier, which you hopefully fixed by making the column nullable.
-        # *** VERIFY 'students' TABLE NAME AND 'academic_year_id' COLUMN ***
-        sql_nullify_student_year = "UPDATE students SET academic_year_id = NULL WHERE academic_year_id = %s;"
-        cur.execute(sql_nullify_student_year, (year_id,))
-        print(f"Set academic_year_id to NULL for {cur.rowcount} students linked to academic year {year_id}") # Debug print
-
-        # 2. Set academic_year_id to NULL for course assignments linked to this year
-        #    This query caused an error earlier, which you hopefully fixed by making the column nullable and adding the update.
-        # *** VERIFY 'coursesassignedtolecturers' TABLE NAME AND 'academic_year_id' COLUMN ***
-        sql_nullify_assignment_year = "UPDATE coursesassignedtolecturers SET academic_year_id = NULL WHERE academic_year_id = %s;"
-        cur.execute(sql_nullify_assignment_year, (year_id,))
-        print(f"Set academic_year_id to NULL for {cur.rowcount} course assignments linked to academic year {year_id}") # Debug print
-
-        # 3. Set academic_year_id to NULL for student enrollments linked to this year
-        #    *** ADDED: Nullify FK in studentsenrolledcourses ***
-        # *** VERIFY 'studentsenrolledcourses' TABLE NAME AND 'academic_year_id' COLUMN ***
-        sql_nullify_enrollment_year = "UPDATE studentsenrolledcourses SET academic_year_id = NULL WHERE academic_year_id = %s;"
-        cur.execute(sql_nullify_enrollment_year, (year_id,))
-        print(f"Set academic_year_id to NULL for {cur.rowcount} student enrollments linked to academic year {year_id}") # Debug print
-
-
-        # 4. Set academic_year_id to NULL for AdmissionApplications linked to this year
-        #    This query caused a "relation does not exist" error earlier, so it might need to be removed if the table doesn't exist or the column name is different.
-        # *** VERIFY 'AdmissionApplications' TABLE NAME AND 'academic_year_id' COLUMN (or similar) ***
-        # sql_nullify_application_year = "UPDATE \"AdmissionApplications\" SET academic_year_id = NULL WHERE academic_year_id = %s;" # Uncomment and verify if table/column exist
-        # cur.execute(sql_nullify_application_year, (year_id,))
-        # print(f"Set academic_year_id to NULL for {cur.rowcount} applications linked to academic year {year_id}") # Debug print
-
-
-        # 5. Set academic_year_id to NULL for admissionstatus linked to this year
-        #    This query was commented out previously. If admissionstatus HAS an academic_year_id column
-        #    and needs nulling, uncomment and verify table/column name.
-        # *** VERIFY 'admissionstatus' TABLE NAME AND 'academic_year_id' COLUMN (or similar) ***
-        # sql_nullify_admissionstatus_year = "UPDATE admissionstatus SET academic_year_id = NULL WHERE academic_year_id = %s;"
-        # cur.execute(sql_nullify_admissionstatus_year, (year_id,))
-        # print(f"Set academic_year_id to NULL for {cur.rowcount} admission status entries linked to academic year {year_id}") # Debug print
-
-
-        # --- Finally, Delete the Academic Year Record ---
-        sql_delete_year = "DELETE FROM academicyears WHERE academic_year_id = %s;" # *** Use the correct table name ***
-        cur.execute(sql_delete_year, (year_id,))
 
-        if cur.rowcount == 0:
-             if conn:
-                 conn.rollback()
-             return jsonify({"error": "Academic year found but could not be deleted."}), 500
+@app.route('/admin/academic-years/<year_id>/rollover', methods=['POST'])
+@login_required # Protect this route
+def rollover_academic_year_for_admin(user, year_id):
+    """
+    Queues the year-end rollover of academic year `year_id` into another academic year.
+    Requires 'admin' role.
+    Body: {"to_academic_year_id": "...", "dry_run": false, "archive_attendance": true,
+           "level_map": {"100": "200", ..., "500": null}} # optional; null graduates the level
+    Returns 202 with the job ID; GET /admin/jobs/<job_id> shows progress and, for dry runs, the counts.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can roll over academic years."}), 403
+
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
+    data = request.get_json()
+
+    to_year_id = data.get('to_academic_year_id')
+    dry_run = bool(data.get('dry_run', False))
+    if not to_year_id:
+        return jsonify({"error": "Missing required field: to_academic_year_id."}), 400
+    to_year_id = str(to_year_id)
+    if to_year_id == str(year_id):
+        return jsonify({"error": "The target academic year must differ from the year being rolled over."}), 400
+    try:
+        level_map = validate_rollover_level_map(data.get('level_map') or ROLLOVER_DEFAULT_LEVEL_MAP)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables()
+        conn = connect_db()
+        cur = conn.cursor()
 
+        academic_year_ids = get_reference_data(conn)['academic_year_ids']
+        for academic_year_id in (str(year_id), to_year_id):
+            if academic_year_id not in academic_year_ids:
+                return jsonify({"error": f"Academic Year ID '{academic_year_id}' does not exist."}), 404
+        cur.execute("SELECT academic_year_id FROM closedacademicyears WHERE academic_year_id = ANY(%s);", ([str(year_id), to_year_id],))
+        closed = {row[0] for row in cur.fetchall()}
+        if to_year_id in closed:
+            return jsonify({"error": f"Academic year {to_year_id} is closed; roll over into an open year."}), 409
+        if str(year_id) in closed and not dry_run:
+            return jsonify({"error": f"Academic year {year_id} has already been closed."}), 409
+
+        job_id = enqueue_job(cur, 'academic_year_rollover', {
+            "from_academic_year_id": str(year_id),
+            "to_academic_year_id": to_year_id,
+            "level_map": level_map,
+            "dry_run": dry_run,
+            "archive_attendance": bool(data.get('archive_attendance', True)),
+            "requested_by": str(entity_id_admin),
+        }, created_by=user_account_id_admin, dedupe_key=None if dry_run else f"rollover:{year_id}")
         conn.commit()
-        return jsonify({"message": f"Academic year {year_id} and linked records updated successfully."}), 200 # Or 204 No Content
+        return jsonify({
+            "message": f"Academic year rollover {'dry run ' if dry_run else ''}queued.",
+            "job_id": job_id,
+            "status_url": f"/admin/jobs/{job_id}"
+        }), 202 # 202 Accepted
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during academic year deletion: {e}")
-        # If you get a foreign key violation here, it means a referencing table wasn't handled or wasn't set to NULL!
-        return jsonify({"error": f"Database error during deletion: {e}"}), 500
+        log.error("Database error queuing rollover of academic year %s: %s", year_id, e)
+        return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during academic year deletion: {e}")
+        log.exception("An unexpected error occurred queuing rollover of academic year %s: %s", year_id, e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6505,6 +10849,44 @@ def delete_academic_year_for_admin(user, year_id):
         if conn:
             conn.close()
 
+
+@app.route('/admin/academic-years/<year_id>/reopen', methods=['POST'])
+@login_required # Protect this route
+def reopen_academic_year_for_admin(user, year_id):
+    """
+    Makes a closed academic year writable again. Archived attendance stays in the archive tables.
+    Requires 'admin' role.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can reopen academic years."}), 403
+
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables()
+        conn = connect_db()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM closedacademicyears WHERE academic_year_id = %s RETURNING academic_year_id;", (year_id,))
+        if cur.fetchone() is None:
+            return jsonify({"error": f"Academic year {year_id} is not closed."}), 404
+        conn.commit()
+        return jsonify({"message": f"Academic year {year_id} reopened."}), 200
+
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        log.error("Database error reopening academic year %s: %s", year_id, e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+# --- Academic Year Rollover Ends Here ---
+
 ####################################################################################
 
 @app.route('/admin/courses', methods=['GET'])
@@ -6527,14 +10909,14 @@ def list_all_courses(user):
     courses_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all course details, join departments for department name
         # Based on previous errors, courses might not be directly linked to academic years
         # by a column named academic_year_id.
         # *** VERIFY 'courses' and 'departments' TABLE NAMES AND COLUMN NAMES ***
-        sql = """
+        sql = f"""
             SELECT
                 c.course_id, -- Primary key
                 c.course_code, -- e.g., 'CSC 101'
@@ -6545,6 +10927,7 @@ def list_all_courses(user):
                 -- Include other columns if they exist in your courses table (e.g., academic_year_id if FK column name is different)
             FROM courses c -- *** Use the correct table name ***
             JOIN departments d ON c.department_id = d.department_id -- *** Join departments table ***
+            WHERE {soft_deleted_filter('course', 'c.course_id')}
             ORDER BY c.course_code; -- Order by course code
         """
         # Note: Adjust column names (course_code, course_title, credits, department_id) if your schema is different.
@@ -6552,18 +10935,22 @@ def list_all_courses(user):
 
 
         # No WHERE clause needed to filter, as admin sees all
+        ensure_support_tables() # pendingdeletions hides soft-deleted rows
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         courses_list = cur.fetchall()
 
         return jsonify(courses_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching course list: {e}")
+        log.error("Database error fetching course list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching course list: {e}")
+        log.exception("An unexpected error occurred fetching course list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6591,7 +10978,7 @@ def get_course_details_for_admin(user, course_id):
     course_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant course details for the given course_id
@@ -6616,18 +11003,18 @@ def get_course_details_for_admin(user, course_id):
 
         course_details = cur.fetchone()
 
-        if course_details is None:
+        if course_details is None or is_soft_deleted('course', course_id):
             # Course with the given ID not found
             return jsonify({"error": "Course not found."}), 404 # 404 Not Found
 
         return jsonify(course_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific course details: {e}")
+        log.error("Database error fetching specific course details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific course details: {e}")
+        log.exception("An unexpected error occurred fetching specific course details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6682,7 +11069,7 @@ def create_course_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for inserts/updates
 
         # Check for duplicate course code (assuming it should be unique)
@@ -6729,19 +11116,19 @@ def create_course_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during course creation: {e}")
+        log.error("Database integrity error during course creation: %s", e)
         # This could happen due to duplicate course_code, or invalid department_id if FK constraint fails
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during course creation: {e}")
+        log.error("Database error during course creation: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during course creation: {e}")
+        log.exception("An unexpected error occurred during course creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6797,7 +11184,7 @@ def update_course_details_for_admin(user, course_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use RealDictCursor for fetching updated details
 
         # --- First, verify if the course exists ---
@@ -6865,19 +11252,19 @@ def update_course_details_for_admin(user, course_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during course update: {e}")
+        log.error("Database integrity error during course update: %s", e)
         # This could happen if course_code becomes a duplicate, or department_id is invalid
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during course update: {e}")
+        log.error("Database error during course update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during course update: {e}")
+        log.exception("An unexpected error occurred during course update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -6891,6 +11278,8 @@ def delete_course_for_admin(user, course_id):
     """
     Deletes a specific course by course_id for admin view,
     including associated records based on ON DELETE NO ACTION schema.
+    Runs through the cascade delete engine in short chunked transactions;
+    ?mode=soft hides it immediately and purges it in the background.
     Requires 'admin' role.
     """
     user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
@@ -6899,11 +11288,15 @@ def delete_course_for_admin(user, course_id):
     if role_admin != 'admin':
         return jsonify({"error": "Access forbidden. Only admins can delete courses."}), 403
 
+    mode = request.args.get('mode', 'hard') # 'soft' hides the record now and purges it in the background
+    if mode not in ('hard', 'soft'):
+        return jsonify({"error": "Invalid mode. Use 'hard' or 'soft'."}), 400
+
 
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the course exists ---
@@ -6913,92 +11306,18 @@ def delete_course_for_admin(user, course_id):
         if course_exists is None:
             return jsonify({"error": "Course not found."}), 404
 
-
-        # --- Delete Related Records (Order is crucial with NO ACTION!) ---
-
-        # 1. Find all assignment_ids for this course
-        # *** VERIFY 'coursesassignedtolecturers' TABLE NAME AND 'course_id', 'assignment_id' COLUMNS ***
-        sql_get_assignments = """
-            SELECT assignment_id FROM coursesassignedtolecturers WHERE course_id = %s;
-        """
-        cur.execute(sql_get_assignments, (course_id,))
-        assignment_ids_rows = cur.fetchall()
-        # Extract assignment IDs into a list
-        assignment_ids = [row[0] for row in assignment_ids_rows]
-        print(f"Found {len(assignment_ids)} assignments for course {course_id}: {assignment_ids}") # Debug print
-
-
-        # 2. If assignments exist, find all session_ids for these assignments
-        session_ids = []
-        if assignment_ids:
-            # Use IN clause to select sessions for any of these assignments
-            # *** VERIFY 'attendancesessions' TABLE NAME AND 'assignment_id', 'session_id' COLUMNS ***
-            sql_get_sessions = """
-                SELECT session_id FROM attendancesessions WHERE assignment_id IN %s;
-            """
-            # Execute with tuple of assignment_ids for the IN clause
-            cur.execute(sql_get_sessions, (tuple(assignment_ids),))
-            session_ids_rows = cur.fetchall()
-            # Extract session IDs into a list
-            session_ids = [row[0] for row in session_ids_rows]
-            print(f"Found {len(session_ids)} sessions for assignments: {session_ids}") # Debug print
-
-            # 3. If sessions exist, delete attendance records for these sessions
-            # *** VERIFY 'attendancerecords' TABLE NAME AND 'session_id' COLUMN ***
-            if session_ids:
-                sql_delete_attendance = """
-                    DELETE FROM attendancerecords WHERE session_id IN %s;
-                """
-                 # Execute with tuple of session_ids for the IN clause
-                cur.execute(sql_delete_attendance, (tuple(session_ids),))
-                print(f"Deleted {cur.rowcount} attendance records for sessions") # Debug print
-
-            # 4. Delete the sessions themselves (if sessions exist)
-            # *** VERIFY 'attendancesessions' TABLE NAME ***
-            sql_delete_sessions = """
-                DELETE FROM attendancesessions WHERE assignment_id IN %s;
-            """
-            # Execute with tuple of assignment_ids for the IN clause (sessions linked to these assignments)
-            cur.execute(sql_delete_sessions, (tuple(assignment_ids),)) # Delete sessions linked to assignments
-            print(f"Deleted {cur.rowcount} sessions for assignments") # Debug print
-
-
-        # 5. Delete student enrollments for this course
-        # *** VERIFY 'studentsenrolledcourses' TABLE NAME AND 'course_id' COLUMN ***
-        sql_delete_enrollments = "DELETE FROM studentsenrolledcourses WHERE course_id = %s;"
-        cur.execute(sql_delete_enrollments, (course_id,))
-        print(f"Deleted {cur.rowcount} student enrollments for course {course_id}") # Debug print
-
-        # 6. Delete the course assignments for this course
-        # *** VERIFY 'coursesassignedtolecturers' TABLE NAME ***
-        sql_delete_assignments = "DELETE FROM coursesassignedtolecturers WHERE course_id = %s;"
-        cur.execute(sql_delete_assignments, (course_id,))
-        print(f"Deleted {cur.rowcount} course assignments for course {course_id}") # Debug print
-
-
-        # --- Finally, Delete the Course Record ---
-        # *** VERIFY 'courses' TABLE NAME ***
-        sql_delete_course = "DELETE FROM courses WHERE course_id = %s;"
-        cur.execute(sql_delete_course, (course_id,))
-
-        if cur.rowcount == 0:
-             if conn:
-                 conn.rollback()
-             return jsonify({"error": "Course found but could not be deleted."}), 500
-
-        conn.commit()
-        return jsonify({"message": f"Course {course_id} and related records deleted successfully."}), 200 # Or 204 No Content
+        return delete_entities_response(conn, 'course', [course_id], mode, entity_id_admin)
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during course deletion: {e}")
+        log.error("Database error during course deletion: %s", e)
         # If you get a foreign key violation here, it means a referencing table wasn't handled!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during course deletion: {e}")
+        log.exception("An unexpected error occurred during course deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7028,8 +11347,8 @@ def list_all_faculties(user):
     faculties_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all faculty details
         # *** VERIFY 'faculties' TABLE NAME AND COLUMN NAMES ***
@@ -7048,16 +11367,19 @@ def list_all_faculties(user):
         # No WHERE clause needed to filter, as admin sees all
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         faculties_list = cur.fetchall()
 
         return jsonify(faculties_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching faculty list: {e}")
+        log.error("Database error fetching faculty list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching faculty list: {e}")
+        log.exception("An unexpected error occurred fetching faculty list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7085,7 +11407,7 @@ def get_faculty_details_for_admin(user, faculty_id):
     faculty_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant faculty details for the given faculty_id
@@ -7113,11 +11435,11 @@ def get_faculty_details_for_admin(user, faculty_id):
         return jsonify(faculty_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific faculty details: {e}")
+        log.error("Database error fetching specific faculty details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific faculty details: {e}")
+        log.exception("An unexpected error occurred fetching specific faculty details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7159,7 +11481,7 @@ def create_faculty_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for inserts/updates
 
         # --- Basic Validation (More robust validation needed) ---
@@ -7199,19 +11521,19 @@ def create_faculty_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during faculty creation: {e}")
+        log.error("Database integrity error during faculty creation: %s", e)
         # This could happen due to duplicate faculty_name
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during faculty creation: {e}")
+        log.error("Database error during faculty creation: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during faculty creation: {e}")
+        log.exception("An unexpected error occurred during faculty creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7258,7 +11580,7 @@ def update_faculty_details_for_admin(user, faculty_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use RealDictCursor for fetching updated details
 
         # --- First, verify if the faculty exists ---
@@ -7317,19 +11639,19 @@ def update_faculty_details_for_admin(user, faculty_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during faculty update: {e}")
+        log.error("Database integrity error during faculty update: %s", e)
         # This could happen if faculty_name becomes a duplicate
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during faculty update: {e}")
+        log.error("Database error during faculty update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during faculty update: {e}")
+        log.exception("An unexpected error occurred during faculty update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7355,7 +11677,7 @@ def delete_faculty_for_admin(user, faculty_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the faculty exists ---
@@ -7373,7 +11695,7 @@ def delete_faculty_for_admin(user, faculty_id):
         # *** VERIFY 'departments' TABLE NAME AND 'faculty_id' COLUMN ***
         sql_nullify_department_faculty = "UPDATE departments SET faculty_id = NULL WHERE faculty_id = %s;"
         cur.execute(sql_nullify_department_faculty, (faculty_id,))
-        print(f"Set faculty_id to NULL for {cur.rowcount} departments in faculty {faculty_id}") # Debug print
+        log.debug("Set faculty_id to NULL for %s departments in faculty %s", cur.rowcount, faculty_id)
 
         # Add updates for any other tables that directly reference faculties if they exist
         # e.g., programs.faculty_id -> faculties.faculty_id
@@ -7394,13 +11716,13 @@ def delete_faculty_for_admin(user, faculty_id):
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during faculty deletion: {e}")
+        log.error("Database error during faculty deletion: %s", e)
         # If you get a foreign key violation here, it means a referencing table wasn't handled or wasn't set to NULL!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during faculty deletion: {e}")
+        log.exception("An unexpected error occurred during faculty deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7430,8 +11752,8 @@ def list_all_admission_statuses(user):
     statuses_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all admission status details
         # *** VERIFY 'admissionstatus' TABLE NAME AND COLUMN NAMES ***
@@ -7455,16 +11777,19 @@ def list_all_admission_statuses(user):
         # No WHERE clause needed to filter, as admin sees all
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         statuses_list = cur.fetchall()
 
         return jsonify(statuses_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching admission status list: {e}")
+        log.error("Database error fetching admission status list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching admission status list: {e}")
+        log.exception("An unexpected error occurred fetching admission status list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7492,7 +11817,7 @@ def get_admission_status_details_for_admin(user, status_id):
     status_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant admission status details for the given admission_status_id
@@ -7520,11 +11845,11 @@ def get_admission_status_details_for_admin(user, status_id):
         return jsonify(status_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific admission status details: {e}")
+        log.error("Database error fetching specific admission status details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific admission status details: {e}")
+        log.exception("An unexpected error occurred fetching specific admission status details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7568,7 +11893,7 @@ def create_admission_status_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for inserts/updates
 
         # --- Basic Validation (More robust validation needed) ---
@@ -7609,19 +11934,19 @@ def create_admission_status_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during admission status creation: {e}")
+        log.error("Database integrity error during admission status creation: %s", e)
         # This could happen due to duplicate status name
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during admission status creation: {e}")
+        log.error("Database error during admission status creation: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during admission status creation: {e}")
+        log.exception("An unexpected error occurred during admission status creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7647,7 +11972,7 @@ def delete_admission_status_for_admin(user, status_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the admission status exists ---
@@ -7690,14 +12015,14 @@ def delete_admission_status_for_admin(user, status_id):
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during admission status deletion: {e}")
+        log.error("Database error during admission status deletion: %s", e)
         # If you get a foreign key violation here, it means some *other* table references
         # admissionstatus.admission_status_id and wasn't handled!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during admission status deletion: {e}")
+        log.exception("An unexpected error occurred during admission status deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7727,8 +12052,8 @@ def list_all_applications(user):
     applications_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all application details based on your schema output
         # *** VERIFY 'admissionapplications' TABLE NAME AND COLUMN NAMES ***
@@ -7759,6 +12084,9 @@ def list_all_applications(user):
         # No WHERE clause needed to filter, as admin sees all
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         applications_list = cur.fetchall()
 
         # Optional: Convert dates/timestamps to string format for JSON if needed
@@ -7772,11 +12100,11 @@ def list_all_applications(user):
         return jsonify(applications_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching application list: {e}")
+        log.error("Database error fetching application list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching application list: {e}")
+        log.exception("An unexpected error occurred fetching application list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7804,7 +12132,7 @@ def get_application_details_for_admin(user, application_id):
     application_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant application details for the given application_id based on your schema
@@ -7854,11 +12182,11 @@ def get_application_details_for_admin(user, application_id):
         return jsonify(application_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific application details: {e}")
+        log.error("Database error fetching specific application details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific application details: {e}")
+        log.exception("An unexpected error occurred fetching specific application details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -7935,7 +12263,7 @@ def create_application_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for inserts/updates
 
         # Check for duplicate email (Unique constraint in schema)
@@ -7998,20 +12326,20 @@ def create_application_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during application creation: {e}")
+        log.error("Database integrity error during application creation: %s", e)
         # This could happen due to duplicate email or username, or other constraints
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during application creation: {e}")
+        log.error("Database error during application creation: %s", e)
         # This could happen if a date format is wrong (if not validated client/server side)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during application creation: {e}")
+        log.exception("An unexpected error occurred during application creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -8053,7 +12381,7 @@ def update_admission_application_details_for_admin(user, application_id):
     # --- Use psycopg2 context managers for connection and transaction ---
     try:
         # 'with' statement manages the connection and transaction automatically
-        with psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS) as conn:
+        with connect_db() as conn:
             # Cursors created within the 'with conn:' block are part of the transaction
             with conn.cursor() as cur: # Standard cursor (for INSERT, UPDATE, DELETE, simple fetches by index)
                  with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur_dict: # Dict cursor (for SELECT where column names are needed)
@@ -8154,7 +12482,7 @@ def update_admission_application_details_for_admin(user, application_id):
 
 
                             # Hash the applicant's proposed password (NEVER store plain text password)
-                            hashed_proposed_password = generate_password_hash(proposed_password_plain)
+                            hashed_proposed_password = hash_password(proposed_password_plain)
 
                             # Check if the proposed username is already used by another user account
                             # Use standard cursor for this simple fetch by index
@@ -8322,35 +12650,298 @@ def update_admission_application_details_for_admin(user, application_id):
                         return jsonify({"message": "No 'status' field provided for update. No action taken."}), 200 # Or 400 if status is expected
 
 
-    except psycopg2.IntegrityError as e:
-         # Catch specific integrity errors (like duplicate matriculation number/username)
-         # The 'with conn:' block will automatically ROLLBACK the transaction.
-         print(f"Integrity error during approval transaction for application {application_id}: {e}")
-         error_message = str(e)
-         if 'violates unique constraint "students_matriculation_number_key"' in error_message: # Adjust constraint name if different
-              return jsonify({"error": f"Database error: Matriculation number '{matriculation_number.strip()}' is already in use."}), 409
-         # IMPORTANT: Check for unique constraint violation on username now (using 'username' column)
-         elif 'violates unique constraint "useraccounts_username_key"' in error_message: # Adjust constraint name if different
-             # The error message might include the username value, which is helpful
-             # Check if proposed_username was used, otherwise use the original error message
-             username_in_error = proposed_username.strip() if 'proposed_username' in locals() and proposed_username else 'provided username'
-             return jsonify({"error": f"Database error: Username '{username_in_error}' is already in use."}), 409 # Return proposed username in message
-         # Catch FK violation on department_id if it wasn't caught by explicit check (less likely now)
-         # elif 'violates foreign key constraint' in error_message and '"students_department_id_fkey"' in error_message: # Adjust constraint name
-         #     return jsonify({"error": "Database error: Invalid department specified for student."}), 409
-         return jsonify({"error": f"Database integrity error during approval: {e}"}), 409 # 409 Conflict
+    except psycopg2.IntegrityError as e:
+         # Catch specific integrity errors (like duplicate matriculation number/username)
+         # The 'with conn:' block will automatically ROLLBACK the transaction.
+         log.error("Integrity error during approval transaction for application %s: %s", application_id, e)
+         error_message = str(e)
+         if 'violates unique constraint "students_matriculation_number_key"' in error_message: # Adjust constraint name if different
+              return jsonify({"error": f"Database error: Matriculation number '{matriculation_number.strip()}' is already in use."}), 409
+         # IMPORTANT: Check for unique constraint violation on username now (using 'username' column)
+         elif 'violates unique constraint "useraccounts_username_key"' in error_message: # Adjust constraint name if different
+             # The error message might include the username value, which is helpful
+             # Check if proposed_username was used, otherwise use the original error message
+             username_in_error = proposed_username.strip() if 'proposed_username' in locals() and proposed_username else 'provided username'
+             return jsonify({"error": f"Database error: Username '{username_in_error}' is already in use."}), 409 # Return proposed username in message
+         # Catch FK violation on department_id if it wasn't caught by explicit check (less likely now)
+         # elif 'violates foreign key constraint' in error_message and '"students_department_id_fkey"' in error_message: # Adjust constraint name
+         #     return jsonify({"error": "Database error: Invalid department specified for student."}), 409
+         return jsonify({"error": f"Database integrity error during approval: {e}"}), 409 # 409 Conflict
+
+
+    except Exception as e:
+        # Catch other exceptions during the process (e.g., department lookup failed, missing proposed credentials)
+        # The 'with conn:' block will automatically ROLLBACK the transaction.
+        log.exception("An error occurred during admission application update/approval for application %s: %s", application_id, e)
+        # Check if the error was one of the specific exceptions we raised
+        error_message_str = str(e)
+        if isinstance(e, Exception) and ("from application not found in departments table" in error_message_str or "Admission application is missing a valid proposed username" in error_message_str or "Admission application is missing a proposed password" in error_message_str or "Cannot approve: Proposed username" in error_message_str or "Failed to fetch details for newly created student" in error_message_str): # Check for new exceptions
+             return jsonify({"error": error_message_str}), 400 # Return the specific data/validation error with 400
+        # If it's another type of exception, return a generic 500 error
+        return jsonify({"error": f"An unexpected error occurred during approval process: {type(e).__name__} - {e}"}), 500
+
+
+# --- Batch Application Decisions ---
+# Admission season means thousands of approvals. Approving one by one costs about eight statements and an
+# in-transaction password hash each; the batch route validates everything up front, hashes in the process
+# pool with no transaction open, then applies all approvals (or rejections) with a few set-based statements.
+APPLICATION_BATCH_MAX_SIZE = int(os.environ.get('APPLICATION_BATCH_MAX_SIZE', 5000))
+
+
+@app.route('/admin/applications/batch', methods=['POST'])
+@login_required # Protect this route
+def batch_decide_applications_for_admin(user):
+    """
+    Approves or rejects many admission applications in one transaction.
+    Requires 'admin' role.
+    Body: {"action": "approve" | "reject",
+           "academic_year_id": "...",        # approve: default for every item
+           "rejection_reason": "...",        # reject: default for every item
+           "applications": [{"application_id": "...", "matriculation_number": "...", # matriculation_number for approve
+                             "academic_year_id": "...", "rejection_reason": "..."}]}  # optional per-item overrides
+    Items that fail validation are reported and skipped; the rest are applied with a handful of set-based
+    statements. Proposed passwords are hashed in the process pool before the transaction opens.
+    Returns per-application results in request order.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can approve or reject applications."}), 403
+
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
+    data = request.get_json()
+
+    action = data.get('action')
+    items = data.get('applications')
+    if action not in ('approve', 'reject'):
+        return jsonify({"error": "Field 'action' must be 'approve' or 'reject'."}), 400
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Field 'applications' must be a non-empty list."}), 400
+    if len(items) > APPLICATION_BATCH_MAX_SIZE:
+        return jsonify({"error": f"At most {APPLICATION_BATCH_MAX_SIZE} applications can be processed per request."}), 400
+
+    # One result per requested item, filled in as items are rejected or applied
+    results = []
+    pending = {} # application_id -> result dict still eligible for processing
+    for item in items:
+        application_id = str(item.get('application_id') or '').strip() if isinstance(item, dict) else ''
+        result = {"application_id": application_id or None, "status": "error"}
+        results.append(result)
+        if not application_id:
+            result["error"] = "Missing application_id."
+        elif application_id in pending:
+            result["error"] = "Duplicate application_id in this request."
+        elif action == 'approve' and not str(item.get('matriculation_number') or '').strip():
+            result["error"] = "Matriculation number is required for approval."
+        elif action == 'approve' and not (item.get('academic_year_id') or data.get('academic_year_id')):
+            result["error"] = "academic_year_id is required for approval."
+        elif action == 'reject' and (item.get('rejection_reason') or data.get('rejection_reason')) is None:
+            result["error"] = "rejection_reason is required for rejection."
+        else:
+            result["matriculation_number"] = str(item.get('matriculation_number') or '').strip() or None
+            result["academic_year_id"] = str(item.get('academic_year_id') or data.get('academic_year_id') or '') or None
+            result["rejection_reason"] = item.get('rejection_reason') or data.get('rejection_reason')
+            pending[application_id] = result
+
+    def fail(application_id, message):
+        result = pending.pop(application_id)
+        result["error"] = message
+
+    conn = None
+    cur = None
+    try:
+        conn = connect_db()
+        cur = conn.cursor()
+
+        # --- Validation pass (short read-only transaction) ---
+        cur.execute("""
+            SELECT a.application_id, a.application_status, a.level, a.proposed_username, a.proposed_password,
+                   a.intended_department_name, d.department_id
+            FROM AdmissionApplications a
+            LEFT JOIN departments d ON d.department_name = a.intended_department_name
+            WHERE a.application_id = ANY(%s);
+        """, (list(pending),))
+        applications = {str(row[0]): row for row in cur.fetchall()}
+
+        reference_data = get_reference_data(conn) if action == 'approve' else None
+        matriculation_numbers = {}
+        usernames = {}
+        for application_id in list(pending):
+            row = applications.get(application_id)
+            result = pending[application_id]
+            if row is None:
+                fail(application_id, f"Application with ID {application_id} not found.")
+                continue
+            app_id, current_status, level, proposed_username, proposed_password, department_name_app, department_id = row
+            if current_status and current_status.lower() in ('approved', 'rejected'):
+                fail(application_id, f"Application status is already '{current_status}' and cannot be changed.")
+            elif action == 'reject':
+                continue
+            elif level not in STUDENT_APPLICATION_LEVELS:
+                fail(application_id, f"Application with level '{level}' cannot be approved as a student.")
+            elif department_id is None:
+                fail(application_id, f"Department '{department_name_app}' from application not found in departments table. Cannot approve.")
+            elif result["academic_year_id"] not in reference_data['academic_year_ids']:
+                fail(application_id, f"Academic year ID {result['academic_year_id']} does not exist.")
+            elif not proposed_username or not str(proposed_username).strip():
+                fail(application_id, "Cannot approve: Admission application is missing a valid proposed username.")
+            elif not proposed_password:
+                fail(application_id, "Cannot approve: Admission application is missing a proposed password.")
+            elif result["matriculation_number"] in matriculation_numbers:
+                fail(application_id, f"Matriculation number '{result['matriculation_number']}' is used by another application in this request.")
+            elif str(proposed_username).strip() in usernames:
+                fail(application_id, f"Proposed username '{str(proposed_username).strip()}' is used by another application in this request.")
+            else:
+                matriculation_numbers[result["matriculation_number"]] = application_id
+                usernames[str(proposed_username).strip()] = application_id
+
+        if action == 'approve' and pending:
+            cur.execute("SELECT matriculation_number FROM students WHERE matriculation_number = ANY(%s);", (list(matriculation_numbers),))
+            for (matriculation_number,) in cur.fetchall():
+                fail(matriculation_numbers[matriculation_number], f"Matriculation number '{matriculation_number}' is already assigned to another student.")
+            cur.execute("SELECT username FROM useraccounts WHERE username = ANY(%s);", (list(usernames),))
+            for (username,) in cur.fetchall():
+                if usernames[username] in pending:
+                    fail(usernames[username], f"Cannot approve: Proposed username '{username}' is already in use.")
+        conn.commit() # End the read transaction before hashing
+
+        # --- Hash passwords outside any transaction ---
+        password_hashes = {}
+        if action == 'approve' and pending:
+            approved_ids = list(pending)
+            hashes = hash_passwords(applications[application_id][4] for application_id in approved_ids)
+            password_hashes = dict(zip(approved_ids, hashes))
+
+        # --- Apply (one transaction) ---
+        if pending:
+            # Lock the rows and drop any that another admin decided while we were hashing
+            cur.execute("""
+                SELECT application_id FROM AdmissionApplications
+                WHERE application_id = ANY(%s)
+                  AND (application_status IS NULL OR LOWER(application_status) NOT IN ('approved', 'rejected'))
+                FOR UPDATE;
+            """, ([applications[application_id][0] for application_id in pending],))
+            still_open = {str(row[0]) for row in cur.fetchall()}
+            for application_id in [application_id for application_id in pending if application_id not in still_open]:
+                fail(application_id, "Application was decided by another request while this batch was running.")
+
+        if pending and action == 'approve':
+            batch_rows = [
+                (applications[application_id][0], result["matriculation_number"], result["academic_year_id"],
+                 applications[application_id][6], password_hashes[application_id])
+                for application_id, result in pending.items()
+            ]
+            # Students and their accounts in one statement, linked through the matriculation number
+            created = execute_values(cur, """
+                WITH batch (application_id, matriculation_number, academic_year_id, department_id, password_hash) AS (
+                    VALUES %s
+                ),
+                new_students AS (
+                    INSERT INTO students (first_name, last_name, email, contact_number, date_of_birth, gender, level, intended_program, department_id, matriculation_number, academic_year_id)
+                    SELECT a.first_name, a.last_name, a.email, a.contact_number, a.date_of_birth, a.gender, a.level, a.intended_program,
+                           b.department_id, b.matriculation_number, b.academic_year_id
+                    FROM batch b
+                    JOIN AdmissionApplications a ON a.application_id = b.application_id
+                    RETURNING student_id, matriculation_number
+                ),
+                new_accounts AS (
+                    INSERT INTO useraccounts (username, password, role, entity_id)
+                    SELECT TRIM(a.proposed_username), b.password_hash, 'student', ns.student_id
+                    FROM new_students ns
+                    JOIN batch b ON b.matriculation_number = ns.matriculation_number
+                    JOIN AdmissionApplications a ON a.application_id = b.application_id
+                    RETURNING user_account_id, username, entity_id
+                )
+                SELECT b.application_id, ns.student_id, na.user_account_id, na.username
+                FROM new_students ns
+                JOIN batch b ON b.matriculation_number = ns.matriculation_number
+                JOIN new_accounts na ON na.entity_id = ns.student_id;
+            """, batch_rows, page_size=len(batch_rows), fetch=True)
+
+            if not created:
+                raise Exception("No students were created for the approved applications.")
+
+            # Link accounts and set qr_code_data in one pass
+            execute_values(cur, f"""
+                UPDATE students s
+                SET user_account_id = v.user_account_id, qr_code_data = {QR_DATA_SQL}
+                FROM (VALUES %s) AS v (student_id, user_account_id), departments d
+                WHERE s.student_id = v.student_id AND d.department_id = s.department_id;
+            """, [(student_id, user_account_id) for application_id, student_id, user_account_id, username in created],
+                page_size=len(created))
+
+            execute_values(cur, """
+                INSERT INTO admissionstatus (application_id, status, approved_entity_id, approved_entity_type, approval_date, approved_by_admin_id)
+                VALUES %s
+                ON CONFLICT (application_id) DO UPDATE SET status = EXCLUDED.status, approved_entity_id = EXCLUDED.approved_entity_id,
+                    approved_entity_type = EXCLUDED.approved_entity_type, approval_date = EXCLUDED.approval_date,
+                    approved_by_admin_id = EXCLUDED.approved_by_admin_id;
+            """, [(application_id, 'approved', student_id, 'student', entity_id_admin) for application_id, student_id, user_account_id, username in created],
+                template="(%s, %s, %s, %s, NOW(), %s)", page_size=len(created))
+
+            cur.execute("UPDATE AdmissionApplications SET application_status = 'Approved' WHERE application_id = ANY(%s);",
+                        ([row[0] for row in created],))
+
+            for application_id, student_id, user_account_id, username in created:
+                result = pending.pop(str(application_id))
+                result.update({"status": "approved", "student_id": student_id, "user_account_id": user_account_id, "username": username})
+
+        elif pending and action == 'reject':
+            execute_values(cur, """
+                INSERT INTO admissionstatus (application_id, status, rejection_reason, rejection_date, approved_by_admin_id, approved_entity_id, approved_entity_type)
+                VALUES %s
+                ON CONFLICT (application_id) DO UPDATE SET status = EXCLUDED.status, rejection_reason = EXCLUDED.rejection_reason,
+                    rejection_date = EXCLUDED.rejection_date, approved_by_admin_id = EXCLUDED.approved_by_admin_id,
+                    approved_entity_id = NULL, approved_entity_type = NULL;
+            """, [(applications[application_id][0], 'rejected', result["rejection_reason"], entity_id_admin) for application_id, result in pending.items()],
+                template="(%s, %s, %s, NOW(), %s, NULL, NULL)", page_size=len(pending))
+
+            cur.execute("UPDATE AdmissionApplications SET application_status = 'Rejected' WHERE application_id = ANY(%s);",
+                        ([applications[application_id][0] for application_id in pending],))
+
+            for application_id in list(pending):
+                pending.pop(application_id)["status"] = "rejected"
+
+        conn.commit()
 
+        for application_id in list(pending):
+            fail(application_id, "Application could not be processed.")
+        for result in results:
+            for key in ("matriculation_number", "academic_year_id", "rejection_reason"):
+                if result.get(key) is None or result["status"] == "error":
+                    result.pop(key, None)
+        decided = sum(1 for result in results if result["status"] != "error")
+        return jsonify({
+            "message": f"{decided} of {len(results)} applications {'approved' if action == 'approve' else 'rejected'}.",
+            "succeeded": decided,
+            "failed": len(results) - decided,
+            "results": results
+        }), 200
 
+    except psycopg2.IntegrityError as e:
+        if conn:
+            conn.rollback()
+        log.error("Database integrity error during batch application %s: %s", action, e)
+        # A concurrent insert took a matriculation number or username; nothing in this batch was applied
+        return jsonify({"error": f"Database integrity error, no applications were changed: {e}"}), 409
+    except psycopg2.Error as e:
+        if conn:
+            conn.rollback()
+        log.error("Database error during batch application %s: %s", action, e)
+        return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        # Catch other exceptions during the process (e.g., department lookup failed, missing proposed credentials)
-        # The 'with conn:' block will automatically ROLLBACK the transaction.
-        print(f"An error occurred during admission application update/approval for application {application_id}: {e}")
-        # Check if the error was one of the specific exceptions we raised
-        error_message_str = str(e)
-        if isinstance(e, Exception) and ("from application not found in departments table" in error_message_str or "Admission application is missing a valid proposed username" in error_message_str or "Admission application is missing a proposed password" in error_message_str or "Cannot approve: Proposed username" in error_message_str or "Failed to fetch details for newly created student" in error_message_str): # Check for new exceptions
-             return jsonify({"error": error_message_str}), 400 # Return the specific data/validation error with 400
-        # If it's another type of exception, return a generic 500 error
-        return jsonify({"error": f"An unexpected error occurred during approval process: {type(e).__name__} - {e}"}), 500
+        if conn:
+            conn.rollback()
+        log.exception("An unexpected error occurred during batch application %s: %s", action, e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+# --- Batch Application Decisions Ends Here ---
 
 
 @app.route('/admin/applications/<application_id>', methods=['DELETE'])
@@ -8371,7 +12962,7 @@ def delete_application_for_admin(user, application_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the application exists ---
@@ -8390,7 +12981,7 @@ def delete_application_for_admin(user, application_id):
         # *** VERIFY 'admissionstatus' TABLE NAME AND 'application_id' COLUMN ***
         sql_nullify_status_application = "UPDATE admissionstatus SET application_id = NULL WHERE application_id = %s;"
         cur.execute(sql_nullify_status_application, (application_id,))
-        print(f"Set application_id to NULL for {cur.rowcount} admission status records linked to application {application_id}") # Debug print
+        log.debug("Set application_id to NULL for %s admission status records linked to application %s", cur.rowcount, application_id)
 
         # Add updates for any other tables that directly reference admissionapplications if they exist
         # e.g., if a 'student_documents' table had a foreign key application_id -> admissionapplications.application_id
@@ -8414,13 +13005,13 @@ def delete_application_for_admin(user, application_id):
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during application deletion: {e}")
+        log.error("Database error during application deletion: %s", e)
         # If you get a foreign key violation here, it means a referencing table wasn't handled or wasn't set to NULL!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during application deletion: {e}")
+        log.exception("An unexpected error occurred during application deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -8450,8 +13041,8 @@ def list_all_course_assignments(user):
     assignments_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all assignment details, join related tables for context
         # *** VERIFY TABLE NAMES AND COLUMN NAMES ***
@@ -8482,16 +13073,19 @@ def list_all_course_assignments(user):
         # No WHERE clause needed to filter, as admin sees all
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         assignments_list = cur.fetchall()
 
         return jsonify(assignments_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching course assignment list: {e}")
+        log.error("Database error fetching course assignment list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching course assignment list: {e}")
+        log.exception("An unexpected error occurred fetching course assignment list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -8519,7 +13113,7 @@ def get_course_assignment_details_for_admin(user, assignment_id):
     assignment_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant assignment details for the given assignment_id, join related tables
@@ -8558,11 +13152,11 @@ def get_course_assignment_details_for_admin(user, assignment_id):
         return jsonify(assignment_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific course assignment details: {e}")
+        log.error("Database error fetching specific course assignment details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific course assignment details: {e}")
+        log.exception("An unexpected error occurred fetching specific course assignment details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -8618,7 +13212,7 @@ def create_course_assignment_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for inserts/updates
 
         # --- Basic Validation ---
@@ -8668,6 +13262,7 @@ def create_course_assignment_for_admin(user):
 
 
         conn.commit()
+        invalidate_lecturer_ownership()
 
         # Return success message and the created ID
         return jsonify({
@@ -8678,19 +13273,19 @@ def create_course_assignment_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during course assignment creation: {e}")
+        log.error("Database integrity error during course assignment creation: %s", e)
         # This could happen due to duplicate assignment_id, or FK violation if not validated manually
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during course assignment creation: {e}")
+        log.error("Database error during course assignment creation: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during course assignment creation: {e}")
+        log.exception("An unexpected error occurred during course assignment creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -8749,7 +13344,7 @@ def update_course_assignment_details_for_admin(user, assignment_id):
     cur_fetch = None # Initialize cur_fetch to None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # *** Initialize main cursor HERE, inside the try block ***
         # cur_fetch will be initialized later if needed within the try block
 
@@ -8811,6 +13406,7 @@ def update_course_assignment_details_for_admin(user, assignment_id):
 
 
         conn.commit()
+        invalidate_lecturer_ownership()
 
         # Fetch and return the updated assignment details including joined data
         cur_fetch = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use RealDictCursor
@@ -8837,19 +13433,19 @@ def update_course_assignment_details_for_admin(user, assignment_id):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during course assignment update: {e}")
+        log.error("Database integrity error during course assignment update: %s", e)
         # This could happen if FK constraints fail despite validation, or if a unique constraint is violated (e.g., duplicate assignment combination)
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during course assignment update: {e}")
+        log.error("Database error during course assignment update: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during course assignment update: {e}")
+        log.exception("An unexpected error occurred during course assignment update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -8877,7 +13473,7 @@ def delete_course_assignment_for_admin(user, assignment_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the assignment exists ---
@@ -8899,7 +13495,7 @@ def delete_course_assignment_for_admin(user, assignment_id):
         session_ids_rows = cur.fetchall()
         # Extract session IDs into a list
         session_ids = [row[0] for row in session_ids_rows]
-        print(f"Found {len(session_ids)} sessions for assignment {assignment_id}: {session_ids}") # Debug print
+        log.debug("Found %s sessions for assignment %s: %s", len(session_ids), assignment_id, session_ids)
 
         # 2. If sessions exist, delete attendance records for these sessions
         # *** VERIFY 'attendancerecords' TABLE NAME AND 'session_id' COLUMN ***
@@ -8909,13 +13505,13 @@ def delete_course_assignment_for_admin(user, assignment_id):
             """
              # Execute with tuple of session_ids for the IN clause
             cur.execute(sql_delete_attendance, (tuple(session_ids),))
-            print(f"Deleted {cur.rowcount} attendance records for sessions") # Debug print
+            log.debug("Deleted %s attendance records for sessions", cur.rowcount)
 
         # 3. Delete the sessions themselves (if sessions exist)
         # *** VERIFY 'attendancesessions' TABLE NAME ***
         sql_delete_sessions = "DELETE FROM attendancesessions WHERE assignment_id = %s;" # Delete sessions linked to this assignment
         cur.execute(sql_delete_sessions, (assignment_id,))
-        print(f"Deleted {cur.rowcount} sessions for assignment") # Debug print
+        log.debug("Deleted %s sessions for assignment", cur.rowcount)
 
         # Add deletions for any other tables that directly reference coursesassignedtolecturers if they exist
 
@@ -8931,18 +13527,23 @@ def delete_course_assignment_for_admin(user, assignment_id):
              return jsonify({"error": "Course assignment found but could not be deleted."}), 500
 
         conn.commit()
+        invalidate_lecturer_ownership()
         return jsonify({"message": f"Course assignment {assignment_id} and related records deleted successfully."}), 200 # Or 204 No Content
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during course assignment deletion: {e}")
+        log.error("Database error during course assignment deletion: %s", e)
         # If you get a foreign key violation here, it means a referencing table wasn't handled!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during course assignment deletion: {e}")
+        log.exception("An unexpected error occurred during course assignment deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -8972,13 +13573,13 @@ def list_all_attendance_sessions(user):
     sessions_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all session details, join related tables for context
         # Join through coursesassignedtolecturers to get Course, Lecturer, Year details
         # *** VERIFIED TABLE NAMES AND COLUMN NAMES based on schema ***
-        sql = """
+        sql = f"""
             SELECT
                 ats.session_id,      -- Primary key
                 ats.assignment_id,   -- FK to coursesassignedtolecturers
@@ -9000,6 +13601,7 @@ def list_all_attendance_sessions(user):
             JOIN courses c ON ca.course_id = c.course_id -- *** Join courses table ***
             JOIN lecturers l ON ca.lecturer_id = l.lecturer_id -- *** Join lecturers table ***
             JOIN academicyears ay ON ca.academic_year_id = ay.academic_year_id -- *** Join academicyears table ***
+            WHERE {soft_deleted_filter('attendance_session', 'ats.session_id')}
             ORDER BY ats.session_datetime DESC; -- *** CORRECTED ORDER BY column ***
         """
         # Removed: ats.session_date, ats.start_time, ats.end_time
@@ -9007,8 +13609,12 @@ def list_all_attendance_sessions(user):
 
 
         # No WHERE clause needed to filter, as admin sees all
+        ensure_support_tables() # pendingdeletions hides soft-deleted rows
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         sessions_list = cur.fetchall()
 
         # Optional: Convert timestamps to string format for JSON if needed
@@ -9021,11 +13627,11 @@ def list_all_attendance_sessions(user):
         return jsonify(sessions_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching attendance session list: {e}")
+        log.error("Database error fetching attendance session list: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching attendance session list: {e}")
+        log.exception("An unexpected error occurred fetching attendance session list: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -9053,7 +13659,7 @@ def get_attendance_session_details_for_admin(user, session_id):
     session_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant session details for the given session_id, join related tables
@@ -9093,7 +13699,7 @@ def get_attendance_session_details_for_admin(user, session_id):
 
         session_details = cur.fetchone()
 
-        if session_details is None:
+        if session_details is None or is_soft_deleted('attendance_session', session_id):
             # Session with the given ID not found
             return jsonify({"error": "Attendance session not found."}), 404 # 404 Not Found
 
@@ -9110,11 +13716,11 @@ def get_attendance_session_details_for_admin(user, session_id):
         return jsonify(session_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific attendance session details: {e}")
+        log.error("Database error fetching specific attendance session details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific attendance session details: {e}")
+        log.exception("An unexpected error occurred fetching specific attendance session details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -9176,7 +13782,7 @@ def create_attendance_session_for_admin(user):
     cur = None # Initialize cursor here
     conn = None # Initialize connection here
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         cur.execute("SELECT assignment_id FROM coursesassignedtolecturers WHERE assignment_id = %s;", (assignment_id,))
@@ -9229,6 +13835,7 @@ def create_attendance_session_for_admin(user):
 
 
         conn.commit()
+        invalidate_lecturer_ownership()
 
         # Return success message and the created ID
         return jsonify({
@@ -9236,23 +13843,27 @@ def create_attendance_session_for_admin(user):
             "session_id": new_session_id # Return the generated ID
         }), 201 # 201 Created
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during attendance session creation: {e}")
+        log.error("Database integrity error during attendance session creation: %s", e)
         # This could happen if FK violation (should be caught by manual check) or other constraints
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during attendance session creation: {e}")
+        log.error("Database error during attendance session creation: %s", e)
         # This could happen if data types are wrong or other DB issues
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance session creation: {e}")
+        log.exception("An unexpected error occurred during attendance session creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -9299,7 +13910,7 @@ def update_attendance_session_details_for_admin(user, session_id):
 
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for executions
 
 
@@ -9387,6 +13998,7 @@ def update_attendance_session_details_for_admin(user, session_id):
 
 
         conn.commit()
+        invalidate_lecturer_ownership()
 
         # Fetch and return the updated session details including joined data
         cur_fetch = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Use RealDictCursor
@@ -9422,23 +14034,27 @@ def update_attendance_session_details_for_admin(user, session_id):
         return jsonify(updated_session_details), 200 # Return updated details
 
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during attendance session update: {e}")
+        log.error("Database integrity error during attendance session update: %s", e)
         # This could happen if FK constraints fail despite validation, or if a unique constraint is violated (e.g., duplicate session combination)
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except (psycopg2.Error, ValueError, TypeError) as e: # Catch DB errors and parsing errors
         if conn:
             conn.rollback()
-        print(f"Database or data processing error during attendance session update: {e}")
+        log.error("Database or data processing error during attendance session update: %s", e)
         # Specific checks for e type might be needed for more granular error responses
         return jsonify({"error": f"Database or data processing error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance session update: {e}")
+        log.exception("An unexpected error occurred during attendance session update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -9454,6 +14070,8 @@ def delete_attendance_session_for_admin(user, session_id):
     """
     Deletes a specific attendance session by session_id for admin view,
     including associated attendance records based on ON DELETE NO ACTION schema.
+    Runs through the cascade delete engine in short chunked transactions;
+    ?mode=soft hides it immediately and purges it in the background.
     Requires 'admin' role.
     """
     user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
@@ -9462,11 +14080,15 @@ def delete_attendance_session_for_admin(user, session_id):
     if role_admin != 'admin':
         return jsonify({"error": "Access forbidden. Only admins can delete attendance sessions."}), 403
 
+    mode = request.args.get('mode', 'hard') # 'soft' hides the record now and purges it in the background
+    if mode not in ('hard', 'soft'):
+        return jsonify({"error": "Invalid mode. Use 'hard' or 'soft'."}), 400
+
 
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the session exists ---
@@ -9476,41 +14098,18 @@ def delete_attendance_session_for_admin(user, session_id):
         if session_exists is None:
             return jsonify({"error": "Attendance session not found."}), 404
 
-
-        # --- Delete Related Records (Order is crucial with NO ACTION!) ---
-
-        # 1. Delete attendance records for this session
-        # *** VERIFY 'attendancerecords' TABLE NAME AND 'session_id' COLUMN ***
-        sql_delete_attendance_records = "DELETE FROM attendancerecords WHERE session_id = %s;"
-        cur.execute(sql_delete_attendance_records, (session_id,))
-        print(f"Deleted {cur.rowcount} attendance records for session {session_id}") # Debug print
-
-        # Add deletions for any other tables that directly reference attendancesessions if they exist
-
-
-        # --- Finally, Delete the Attendance Session Record ---
-        sql_delete_session = "DELETE FROM attendancesessions WHERE session_id = %s;" # *** Use the correct table name ***
-        cur.execute(sql_delete_session, (session_id,))
-
-        if cur.rowcount == 0:
-             if conn:
-                 conn.rollback()
-             # Should not happen if session_exists check passed
-             return jsonify({"error": "Attendance session found but could not be deleted."}), 500
-
-        conn.commit()
-        return jsonify({"message": f"Attendance session {session_id} and related records deleted successfully."}), 200 # Or 204 No Content
+        return delete_entities_response(conn, 'attendance_session', [session_id], mode, entity_id_admin)
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during attendance session deletion: {e}")
+        log.error("Database error during attendance session deletion: %s", e)
         # If you get a foreign key violation here, it means a referencing table wasn't handled!
         return jsonify({"error": f"Database error during deletion: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance session deletion: {e}")
+        log.exception("An unexpected error occurred during attendance session deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -9538,8 +14137,8 @@ def list_attendance_records_for_session(user, session_id):
     records_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # --- First, verify if the session exists ---
         # Good practice to ensure the session_id in the URL is valid
@@ -9576,6 +14175,9 @@ def list_attendance_records_for_session(user, session_id):
         # Use the session_id from the URL path parameter to filter
         cur.execute(sql, (session_id,))
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         records_list = cur.fetchall()
 
         # Optional: Convert timestamps to string format for JSON if needed
@@ -9589,11 +14191,751 @@ def list_attendance_records_for_session(user, session_id):
         return jsonify(records_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching attendance records for session {session_id}: {e}")
+        log.error("Database error fetching attendance records for session %s: %s", session_id, e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching attendance records for session {session_id}: {e}")
+        log.exception("An unexpected error occurred fetching attendance records for session %s: %s", session_id, e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+# --- Attendance Records CSV Export ---
+# Warehouse feeds pull millions of attendancerecords rows. GET /admin/attendance-records/export.csv runs
+# COPY (SELECT ...) TO STDOUT on a helper thread that owns the connection; COPY's output is coalesced into ~64 KB
+# chunks and handed to the response generator through a bounded queue, so rows never become Python objects and a
+# slow client just makes the COPY wait. ?gzip=true produces a .csv.gz file; without it, the usual Accept-Encoding
+# compression still applies to the text/csv stream.
+CSV_EXPORT_CHUNK_BYTES = 64 * 1024
+CSV_EXPORT_QUEUE_CHUNKS = 16 # In-flight chunks between the COPY thread and the client (~1 MB)
+
+
+class _CopyPipe:
+    """File-like target for cursor.copy_expert() that feeds a bounded queue read by the response generator."""
+
+    def __init__(self):
+        self.chunks = queue.Queue(maxsize=CSV_EXPORT_QUEUE_CHUNKS)
+        self.buffer = bytearray()
+        self.abandoned = False # Set by the reader when the client goes away
+        self.error = None
+
+    def put(self, item):
+        while True:
+            if self.abandoned:
+                raise IOError("CSV export client disconnected.") # Aborts the COPY
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        self.buffer += data.encode('utf-8') if isinstance(data, str) else data
+        if len(self.buffer) >= CSV_EXPORT_CHUNK_BYTES:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+
+def iter_copy_to_stdout(conn, copy_sql):
+    """
+    Streams the output of a COPY ... TO STDOUT statement. Takes ownership of `conn` (closed when done) and runs the
+    COPY on a helper thread, since copy_expert() only returns once the whole result has been written.
+    """
+    pipe = _CopyPipe()
+
+    def run_copy():
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert(copy_sql, pipe)
+            pipe.flush()
+        except Exception as e:
+            pipe.error = e
+        finally:
+            conn.close()
+            try:
+                pipe.put(None)
+            except IOError:
+                pass
+
+    threading.Thread(target=run_copy, daemon=True).start()
+    try:
+        while True:
+            chunk = pipe.chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        if pipe.error is not None:
+            # Headers are long gone: re-raising makes the server drop the connection without the terminating chunk,
+            # so the client sees a failed transfer instead of a well-formed but truncated CSV
+            log.error("CSV export failed mid-stream: %s - %s", type(pipe.error).__name__, pipe.error)
+            raise pipe.error
+    finally:
+        pipe.abandoned = True
+
+
+@app.route('/admin/attendance-records/export.csv', methods=['GET'])
+@login_required # Protect this route
+def export_attendance_records_csv_for_admin(user):
+    """
+    Streams attendance records as CSV via COPY ... TO STDOUT.
+    Requires 'admin' role.
+    Query parameters: the filters of GET /attendance/records (session_id, student_id, status),
+    header=true|false (default true) and gzip=true|false (default false). Rows are unordered.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can export attendance records."}), 403
+
+    include_header = request.args.get('header', 'true').lower() != 'false'
+    use_gzip = request.args.get('gzip', 'false').lower() == 'true'
+    conditions, values = attendance_record_filters(request.args)
+    select_sql = "SELECT * FROM attendancerecords"
+    if conditions:
+        select_sql += " WHERE " + " AND ".join(conditions)
+
+    conn = None
+    try:
+        conn = connect_db()
+        with conn.cursor() as cur:
+            # COPY takes no bind parameters, so the filter values are quoted client-side
+            copy_sql = f"COPY ({cur.mogrify(select_sql, values).decode()}) TO STDOUT WITH (FORMAT csv, HEADER {'true' if include_header else 'false'});"
+    except psycopg2.Error as e:
+        if conn:
+            conn.close()
+        log.error("Database error starting attendance records export: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+
+    body = iter_copy_to_stdout(conn, copy_sql) # Owns the connection from here on
+    filename = "attendance-records.csv"
+    mimetype = 'text/csv'
+    if use_gzip:
+        body = compress_chunks(body, 'gzip')
+        filename += ".gz"
+        mimetype = 'application/gzip' # Not in COMPRESSIBLE_MIMETYPES, so it is not compressed twice
+    return app.response_class(body, mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "no-store"
+    })
+# --- Attendance Records CSV Export Ends Here ---
+
+# --- Attendance Analytics ---
+# GET /admin/analytics/attendance reports attendance rates per course, department or faculty, broken down by ISO week
+# or weekday (or just totals). It groups the maintained attendancesessionstats rows, one per session, so a year's data
+# is a few thousand rows however many records it holds, and uses GROUPING SETS for the per-group totals and LAG()
+# for the week-on-week change. Results go through the report cache, keyed on the narrowest course, department or
+# faculty filter given (or the global stats version without one).
+# Rate = (present + late) / (expected - excused); only sessions that have started count.
+ANALYTICS_GROUPS = {
+    'course': ('course_id', "SELECT course_id, course_code || ' - ' || course_title FROM courses WHERE course_id = ANY(%s);"),
+    'department': ('department_id', "SELECT department_id, department_name FROM departments WHERE department_id = ANY(%s);"),
+    'faculty': ('faculty_id', "SELECT faculty_id, faculty_name FROM faculties WHERE faculty_id = ANY(%s);"),
+}
+ANALYTICS_PERIODS = {
+    'week': "date_trunc('week', session_datetime)::DATE",
+    'weekday': "EXTRACT(ISODOW FROM session_datetime)::INTEGER",
+    'total': None,
+}
+ANALYTICS_FILTERS = ('academic_year_id', 'faculty_id', 'department_id', 'course_id')
+WEEKDAY_NAMES = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+
+def compute_attendance_analytics(cur, group_by, period, filters, date_from=None, date_to=None):
+    """Runs the grouped analytics query over attendancesessionstats and shapes it into per-group results."""
+    group_column, names_sql = ANALYTICS_GROUPS[group_by]
+    period_expr = ANALYTICS_PERIODS[period]
+    conditions = ["session_datetime <= NOW()", f"{group_column} IS NOT NULL"]
+    values = []
+    for column, value in filters:
+        conditions.append(f"{column} = %s")
+        values.append(value)
+    if date_from:
+        conditions.append("session_datetime >= %s")
+        values.append(date_from)
+    if date_to:
+        conditions.append("session_datetime < %s::DATE + 1")
+        values.append(date_to)
+
+    if period_expr:
+        period_select = f"{period_expr} AS period, GROUPING({period_expr}) = 1 AS is_total"
+        grouping = f"GROUPING SETS (({group_column}, {period_expr}), ({group_column}))"
+    else:
+        period_select = "NULL AS period, TRUE AS is_total"
+        grouping = group_column
+    cur.execute(f"""
+        WITH grouped AS (
+            SELECT {group_column} AS group_id, {period_select},
+                   COUNT(*) AS sessions, SUM(expected) AS expected, SUM(present + late) AS attended, SUM(excused) AS excused
+            FROM attendancesessionstats
+            WHERE {" AND ".join(conditions)}
+            GROUP BY {grouping}
+        ),
+        rated AS (
+            SELECT grouped.*, ROUND(100.0 * attended / NULLIF(expected - excused, 0), 1)::FLOAT AS rate FROM grouped
+        )
+        SELECT group_id, period, is_total, sessions, expected, attended, excused, rate,
+               rate - LAG(rate) OVER (PARTITION BY group_id, is_total ORDER BY period) AS change
+        FROM rated
+        ORDER BY group_id, is_total DESC, period;
+    """, values)
+    rows = cur.fetchall()
+
+    cur.execute(names_sql, (list({row[0] for row in rows}),))
+    names = dict(cur.fetchall())
+
+    groups = {}
+    for group_id, period_value, is_total, sessions, expected, attended, excused, rate, change in rows:
+        figures = {"sessions": sessions, "expected": expected, "attended": attended, "excused": excused, "rate": rate}
+        if is_total:
+            groups[group_id] = {"id": group_id, "name": names.get(group_id), **figures, "periods": []}
+            continue
+        entry = {"period": WEEKDAY_NAMES[period_value - 1] if period == 'weekday' else period_value.isoformat(), **figures}
+        if period == 'week':
+            entry["change"] = round(change, 1) if change is not None else None
+        groups[group_id]["periods"].append(entry)
+    return sorted(groups.values(), key=lambda group: (group["name"] or "", str(group["id"])))
+
+
+@app.route('/admin/analytics/attendance', methods=['GET'])
+@login_required # Protect this route
+def get_attendance_analytics_for_admin(user):
+    """
+    Attendance rates grouped by course, department or faculty, per week, per weekday or in total.
+    Requires 'admin' role.
+    Query parameters: group_by=course|department (default)|faculty, period=week (default)|weekday|total,
+    optional academic_year_id, faculty_id, department_id, course_id, from and to (YYYY-MM-DD).
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can view attendance analytics."}), 403
+
+    group_by = request.args.get('group_by', 'department')
+    period = request.args.get('period', 'week')
+    if group_by not in ANALYTICS_GROUPS:
+        return jsonify({"error": f"Invalid group_by. Allowed: {', '.join(ANALYTICS_GROUPS)}."}), 400
+    if period not in ANALYTICS_PERIODS:
+        return jsonify({"error": f"Invalid period. Allowed: {', '.join(ANALYTICS_PERIODS)}."}), 400
+    filters = tuple((column, request.args[column]) for column in ANALYTICS_FILTERS if request.args.get(column))
+    try:
+        date_from = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        date_to = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return jsonify({"error": "Invalid from/to date. Use YYYY-MM-DD."}), 400
+    # Any one filter bounds the data read; the narrowest gives the fewest invalidations
+    filter_values = dict(filters)
+    scope = next(((scope_type, filter_values[f"{scope_type}_id"]) for scope_type in ('course', 'department', 'faculty')
+                  if f"{scope_type}_id" in filter_values), None)
+
+    conn = None
+    cur = None
+    try:
+        conn = connect_db()
+        versions = report_data_versions(conn, [scope] if scope else None)
+        cur = conn.cursor()
+        return cached_json_report('attendance_analytics', (group_by, period, filters, date_from, date_to), versions, lambda: {
+            "group_by": group_by,
+            "period": period,
+            "filters": filter_values,
+            "from": date_from.isoformat() if date_from else None,
+            "to": date_to.isoformat() if date_to else None,
+            "data_versions": [list(version) for version in versions],
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "groups": compute_attendance_analytics(cur, group_by, period, filters, date_from, date_to),
+        })
+
+    except psycopg2.Error as e:
+        log.error("Database error computing attendance analytics: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred computing attendance analytics: %s", e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+# --- Attendance Analytics Ends Here ---
+
+# --- Exam Eligibility ---
+# Students below ELIGIBILITY_MIN_PERCENT attendance in a course are flagged for exam eligibility. attendanceeligibility
+# keeps one row per enrollment (sessions held, attended, excused, percentage, eligible, last seen) and is maintained
+# as a step of the attendance stats refresh: only the (course, year) pairs touched by new records, session changes,
+# enrollment changes or sessions that have just started are recomputed, and unchanged rows are not rewritten.
+# Paginated admin and lecturer endpoints read it directly. After changing the threshold, run
+# `flask --app app rebuild-eligibility`.
+ELIGIBILITY_MIN_PERCENT = float(os.environ.get('ELIGIBILITY_MIN_PERCENT', 75))
+PAGINATION_DEFAULT_PER_PAGE = 50
+PAGINATION_MAX_PER_PAGE = 500
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS attendanceeligibility (
+        student_id VARCHAR(64) NOT NULL,
+        course_id VARCHAR(64) NOT NULL,
+        academic_year_id VARCHAR(64) NOT NULL,
+        sessions_held INTEGER NOT NULL DEFAULT 0,
+        attended INTEGER NOT NULL DEFAULT 0,
+        excused INTEGER NOT NULL DEFAULT 0,
+        percentage NUMERIC(5, 1), -- NULL until a session has been held
+        eligible BOOLEAN NOT NULL DEFAULT TRUE,
+        last_seen TIMESTAMP WITH TIME ZONE,
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (student_id, course_id, academic_year_id)
+    );
+""")
+register_support_table("CREATE INDEX IF NOT EXISTS attendanceeligibility_course_idx ON attendanceeligibility (course_id, academic_year_id, eligible);")
+
+
+def recompute_attendance_eligibility(cur):
+    """Recomputes eligibility for every (course_id, academic_year_id) pair in the temp table eligibility_pairs."""
+    cur.execute("""
+        DELETE FROM attendanceeligibility e
+        USING eligibility_pairs p
+        WHERE e.course_id = p.course_id AND e.academic_year_id = p.academic_year_id
+          AND NOT EXISTS (
+              SELECT 1 FROM studentsenrolledcourses sec
+              WHERE sec.student_id = e.student_id AND sec.course_id = e.course_id AND sec.academic_year_id = e.academic_year_id
+          );
+    """)
+    cur.execute("""
+        WITH held AS (
+            SELECT ats.session_id, ca.course_id, ca.academic_year_id
+            FROM eligibility_pairs p
+            JOIN coursesassignedtolecturers ca ON ca.course_id = p.course_id AND ca.academic_year_id = p.academic_year_id
+            JOIN attendancesessions ats ON ats.assignment_id = ca.assignment_id
+            WHERE ats.session_datetime <= NOW()
+        ),
+        computed AS (
+            SELECT sec.student_id, p.course_id, p.academic_year_id,
+                   COUNT(DISTINCT h.session_id) AS sessions_held,
+                   COUNT(DISTINCT ar.session_id) FILTER (WHERE ar.status = ANY(%(attended)s)) AS attended,
+                   COUNT(DISTINCT ar.session_id) FILTER (WHERE ar.status = ANY(%(excused)s)) AS excused,
+                   MAX(ar.attendance_time) FILTER (WHERE ar.status = ANY(%(attended)s)) AS last_seen
+            FROM eligibility_pairs p
+            JOIN studentsenrolledcourses sec ON sec.course_id = p.course_id AND sec.academic_year_id = p.academic_year_id
+            LEFT JOIN held h ON h.course_id = p.course_id AND h.academic_year_id = p.academic_year_id
+            LEFT JOIN attendancerecords ar ON ar.session_id = h.session_id AND ar.student_id = sec.student_id
+            GROUP BY sec.student_id, p.course_id, p.academic_year_id
+        ),
+        rated AS (
+            SELECT computed.*, ROUND(100.0 * attended / NULLIF(sessions_held - excused, 0), 1) AS percentage FROM computed
+        )
+        INSERT INTO attendanceeligibility (student_id, course_id, academic_year_id, sessions_held, attended, excused, percentage, eligible, last_seen, updated_at)
+        SELECT student_id, course_id, academic_year_id, sessions_held, attended, excused, percentage,
+               percentage IS NULL OR percentage >= %(threshold)s, last_seen, NOW()
+        FROM rated
+        ON CONFLICT (student_id, course_id, academic_year_id) DO UPDATE
+        SET sessions_held = EXCLUDED.sessions_held, attended = EXCLUDED.attended, excused = EXCLUDED.excused,
+            percentage = EXCLUDED.percentage, eligible = EXCLUDED.eligible, last_seen = EXCLUDED.last_seen, updated_at = NOW()
+        WHERE (attendanceeligibility.sessions_held, attendanceeligibility.attended, attendanceeligibility.excused,
+               attendanceeligibility.eligible, attendanceeligibility.last_seen)
+              IS DISTINCT FROM (EXCLUDED.sessions_held, EXCLUDED.attended, EXCLUDED.excused, EXCLUDED.eligible, EXCLUDED.last_seen);
+    """, {'attended': list(ATTENDED_STATUSES), 'excused': list(EXCUSED_STATUSES), 'threshold': ELIGIBILITY_MIN_PERCENT})
+    return cur.rowcount
+
+
+@attendance_stats_refresh_step
+def refresh_attendance_eligibility(cur):
+    cur.execute("""
+        CREATE TEMP TABLE eligibility_pairs ON COMMIT DROP AS
+        SELECT DISTINCT course_id, academic_year_id FROM affected_scopes
+        WHERE course_id IS NOT NULL AND academic_year_id IS NOT NULL;
+    """)
+    recompute_attendance_eligibility(cur)
+
+
+@app.cli.command('rebuild-eligibility')
+def rebuild_eligibility_command():
+    """Recomputes the eligibility table for every enrollment (e.g. after changing ELIGIBILITY_MIN_PERCENT)."""
+    ensure_support_tables()
+    refresh_attendance_stats()
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE eligibility_pairs ON COMMIT DROP AS
+                SELECT DISTINCT course_id, academic_year_id FROM studentsenrolledcourses WHERE academic_year_id IS NOT NULL;
+            """)
+            changed = recompute_attendance_eligibility(cur)
+        conn.commit()
+        click.echo(f"Eligibility rebuilt; {changed} rows changed.")
+    finally:
+        conn.close()
+
+
+def parse_pagination(args):
+    """(page, per_page) from ?page=&per_page=; raises ValueError on bad values."""
+    page = int(args.get('page', 1))
+    per_page = int(args.get('per_page', PAGINATION_DEFAULT_PER_PAGE))
+    if page < 1 or not 1 <= per_page <= PAGINATION_MAX_PER_PAGE:
+        raise ValueError(f"page must be >= 1 and per_page between 1 and {PAGINATION_MAX_PER_PAGE}.")
+    return page, per_page
+
+
+def query_eligibility_page(cur, conditions, values, page, per_page):
+    """Runs one page of the eligibility listing (RealDictCursor) and returns the paginated payload."""
+    cur.execute(f"""
+        SELECT e.student_id, s.matriculation_number, s.first_name, s.last_name,
+               e.course_id, c.course_code, c.course_title, e.academic_year_id,
+               e.sessions_held, e.attended, e.excused, e.percentage::FLOAT AS percentage, e.eligible, e.last_seen,
+               COUNT(*) OVER () AS total_count
+        FROM attendanceeligibility e
+        JOIN students s ON s.student_id = e.student_id
+        JOIN courses c ON c.course_id = e.course_id
+        WHERE {" AND ".join(conditions) if conditions else "TRUE"}
+          AND {soft_deleted_filter('student', 's.student_id')}
+          AND {soft_deleted_filter('course', 'c.course_id')}
+        ORDER BY e.percentage NULLS LAST, s.last_name, s.first_name, e.student_id, c.course_code
+        LIMIT %s OFFSET %s;
+    """, (*values, per_page, (page - 1) * per_page))
+    items = cur.fetchall()
+    total = items[0]['total_count'] if items else 0
+    for item in items:
+        del item['total_count']
+        if item['last_seen']:
+            item['last_seen'] = item['last_seen'].isoformat()
+    return {"items": items, "page": page, "per_page": per_page, "total": total, "min_percent": ELIGIBILITY_MIN_PERCENT}
+
+
+def eligibility_filter_conditions(args):
+    """Optional ?eligible=true|false and ?below=<percent> filters on attendanceeligibility e."""
+    conditions = []
+    values = []
+    if args.get('eligible') in ('true', 'false'):
+        conditions.append("e.eligible = %s")
+        values.append(args['eligible'] == 'true')
+    if args.get('below'):
+        conditions.append("e.percentage < %s")
+        values.append(float(args['below']))
+    return conditions, values
+
+
+@app.route('/admin/eligibility', methods=['GET'])
+@login_required # Protect this route
+def list_eligibility_for_admin(user):
+    """
+    Lists per-student, per-course attendance eligibility, lowest percentage first.
+    Requires 'admin' role.
+    Query parameters: optional academic_year_id, department_id, course_id, student_id, eligible=true|false,
+    below=<percent>, page, per_page.
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can view exam eligibility."}), 403
+
+    try:
+        page, per_page = parse_pagination(request.args)
+        conditions, values = eligibility_filter_conditions(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    for column, qualified in (('academic_year_id', 'e.academic_year_id'), ('course_id', 'e.course_id'),
+                              ('student_id', 'e.student_id'), ('department_id', 'c.department_id')):
+        if request.args.get(column):
+            conditions.append(f"{qualified} = %s")
+            values.append(request.args[column])
+
+    conn = None
+    cur = None
+    try:
+        conn = connect_db()
+        scope = next(((scope_type, request.args[f"{scope_type}_id"]) for scope_type in ('course', 'department')
+                      if request.args.get(f"{scope_type}_id")), None)
+        versions = report_data_versions(conn, [scope] if scope else None)
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        return cached_json_report('eligibility', (tuple(conditions), tuple(values), page, per_page), versions,
+                                  lambda: query_eligibility_page(cur, conditions, values, page, per_page))
+
+    except psycopg2.Error as e:
+        log.error("Database error listing eligibility: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred listing eligibility: %s", e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+@app.route('/lecturer/assignments/<assignment_id>/eligibility', methods=['GET'])
+@login_required # Protect this route
+def list_eligibility_for_lecturer_assignment(user, assignment_id):
+    """
+    Lists attendance eligibility of the students enrolled in one of the lecturer's course assignments.
+    Requires 'lecturer' role.
+    Query parameters: optional eligible=true|false, below=<percent>, page, per_page.
+    """
+    user_account_id, role, lecturer_id = user # Unpack the user tuple; entity_id is the lecturer_id
+
+    # --- Role Check ---
+    if role != 'lecturer':
+        return jsonify({"error": "Access forbidden. Only lecturers can view assignment eligibility."}), 403
+
+    try:
+        page, per_page = parse_pagination(request.args)
+        conditions, values = eligibility_filter_conditions(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = None
+    cur = None
+    try:
+        conn = connect_db()
+        assignment_info = lecturer_assignment_info(conn, lecturer_id, assignment_id)
+        if assignment_info is None:
+            return jsonify({"error": "Assignment not found or you do not have permission to view its eligibility."}), 404
+
+        versions = report_data_versions(conn, [('course', assignment_info['course_id'])])
+        conditions = ["e.course_id = %s", "e.academic_year_id = %s"] + conditions
+        values = [assignment_info['course_id'], assignment_info['academic_year_id']] + values
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        # Keyed on course and year rather than assignment, so co-teaching lecturers share cached pages
+        return cached_json_report('eligibility', (tuple(conditions), tuple(values), page, per_page), versions,
+                                  lambda: query_eligibility_page(cur, conditions, values, page, per_page))
+
+    except psycopg2.Error as e:
+        log.error("Database error listing eligibility for assignment %s: %s", assignment_id, e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred listing eligibility for assignment %s: %s", assignment_id, e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+# --- Exam Eligibility Ends Here ---
+
+# --- Attendance Rollups ---
+# Deans drill down faculty -> department -> course -> assignment. attendancerollups holds one row per node and
+# academic year (plus an all-years row, academic_year_id '*') with sessions held, expected, attended and excused.
+# It is maintained as an attendance stats refresh step: only the (node, year) pairs on the paths of the sessions that
+# changed are re-aggregated from attendancesessionstats, and a node's all-years row is re-summed from its per-year
+# rows. The drill-down endpoints only read rollup rows; nothing is aggregated at request time. Existing databases
+# are backfilled with `flask --app app rebuild-rollups`.
+ROLLUP_ALL_YEARS = '*'
+# (level, column in attendancesessionstats, parent column)
+ROLLUP_LEVELS = (
+    ('faculty', 'faculty_id', None),
+    ('department', 'department_id', 'faculty_id'),
+    ('course', 'course_id', 'department_id'),
+    ('assignment', 'assignment_id', 'course_id'),
+)
+ROLLUP_CHILD_LEVEL = {parent[0]: child[0] for parent, child in zip(ROLLUP_LEVELS, ROLLUP_LEVELS[1:])}
+ROLLUP_NAMES_SQL = {
+    'faculty': "SELECT faculty_id, faculty_name FROM faculties WHERE faculty_id = ANY(%s);",
+    'department': "SELECT department_id, department_name FROM departments WHERE department_id = ANY(%s);",
+    'course': "SELECT course_id, course_code || ' - ' || course_title FROM courses WHERE course_id = ANY(%s);",
+    'assignment': """
+        SELECT ca.assignment_id, c.course_code || ' (' || l.first_name || ' ' || l.last_name || ')'
+        FROM coursesassignedtolecturers ca
+        JOIN courses c ON c.course_id = ca.course_id
+        JOIN lecturers l ON l.lecturer_id = ca.lecturer_id
+        WHERE ca.assignment_id = ANY(%s);
+    """,
+}
+
+register_support_table("""
+    CREATE TABLE IF NOT EXISTS attendancerollups (
+        level VARCHAR(16) NOT NULL, -- faculty, department, course, assignment
+        node_id VARCHAR(64) NOT NULL,
+        academic_year_id VARCHAR(64) NOT NULL, -- '*' = all years
+        parent_id VARCHAR(64),
+        sessions INTEGER NOT NULL DEFAULT 0,
+        expected BIGINT NOT NULL DEFAULT 0,
+        attended BIGINT NOT NULL DEFAULT 0,
+        excused BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (level, node_id, academic_year_id)
+    );
+""")
+register_support_table("CREATE INDEX IF NOT EXISTS attendancerollups_parent_idx ON attendancerollups (level, parent_id, academic_year_id);")
+
+
+@attendance_stats_refresh_step
+def refresh_attendance_rollups(cur):
+    for level, column, parent_column in ROLLUP_LEVELS:
+        parent_expr = f"MAX(st.{parent_column})" if parent_column else "NULL"
+        cur.execute(f"""
+            CREATE TEMP TABLE rollup_pairs ON COMMIT DROP AS
+            SELECT DISTINCT {column} AS node_id, academic_year_id FROM affected_scopes
+            WHERE {column} IS NOT NULL AND academic_year_id IS NOT NULL;
+
+            DELETE FROM attendancerollups r
+            USING rollup_pairs p
+            WHERE r.level = %(level)s AND r.node_id = p.node_id AND r.academic_year_id IN (p.academic_year_id, %(all_years)s);
+
+            INSERT INTO attendancerollups (level, node_id, academic_year_id, parent_id, sessions, expected, attended, excused, updated_at)
+            SELECT %(level)s, st.{column}, st.academic_year_id, {parent_expr},
+                   COUNT(*), SUM(st.expected), SUM(st.present + st.late), SUM(st.excused), NOW()
+            FROM attendancesessionstats st
+            JOIN rollup_pairs p ON p.node_id = st.{column} AND p.academic_year_id = st.academic_year_id
+            WHERE st.session_datetime <= NOW()
+            GROUP BY st.{column}, st.academic_year_id;
+
+            INSERT INTO attendancerollups (level, node_id, academic_year_id, parent_id, sessions, expected, attended, excused, updated_at)
+            SELECT %(level)s, r.node_id, %(all_years)s, MAX(r.parent_id), SUM(r.sessions), SUM(r.expected), SUM(r.attended), SUM(r.excused), NOW()
+            FROM attendancerollups r
+            WHERE r.level = %(level)s AND r.academic_year_id <> %(all_years)s
+              AND r.node_id IN (SELECT node_id FROM rollup_pairs)
+            GROUP BY r.node_id;
+
+            DROP TABLE rollup_pairs;
+        """, {'level': level, 'all_years': ROLLUP_ALL_YEARS})
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Re-aggregates every rollup row from the session statistics (e.g. after the table was added to a live database)."""
+    ensure_support_tables()
+    refresh_attendance_stats()
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE affected_scopes ON COMMIT DROP AS
+                SELECT DISTINCT assignment_id, course_id, department_id, faculty_id, academic_year_id FROM attendancesessionstats;
+                TRUNCATE attendancerollups;
+            """)
+            refresh_attendance_rollups(cur)
+            cur.execute("SELECT COUNT(*) FROM attendancerollups;")
+            count = cur.fetchone()[0]
+        conn.commit()
+        click.echo(f"Attendance rollups rebuilt; {count} rows.")
+    finally:
+        conn.close()
+
+
+def rollup_rows(cur, level, academic_year_id, node_id=None, parent_id=None):
+    """Reads rollup rows of one level (optionally one node or one parent's children), named and with their rate."""
+    conditions = ["level = %s", "academic_year_id = %s"]
+    values = [level, academic_year_id]
+    if node_id is not None:
+        conditions.append("node_id = %s")
+        values.append(node_id)
+    if parent_id is not None:
+        conditions.append("parent_id = %s")
+        values.append(parent_id)
+    cur.execute(f"""
+        SELECT node_id, parent_id, sessions, expected, attended, excused,
+               ROUND(100.0 * attended / NULLIF(expected - excused, 0), 1)::FLOAT AS rate, updated_at
+        FROM attendancerollups
+        WHERE {" AND ".join(conditions)};
+    """, values)
+    rows = cur.fetchall()
+    with cur.connection.cursor() as names_cur:
+        names_cur.execute(ROLLUP_NAMES_SQL[level], ([row['node_id'] for row in rows],))
+        names = dict(names_cur.fetchall())
+    nodes = []
+    for row in rows:
+        row['level'] = level
+        row['name'] = names.get(row['node_id'])
+        row['updated_at'] = row['updated_at'].isoformat()
+        row['children_level'] = ROLLUP_CHILD_LEVEL.get(level)
+        nodes.append(row)
+    return sorted(nodes, key=lambda node: (node['name'] or '', node['node_id']))
+
+
+@app.route('/admin/analytics/rollups', methods=['GET'])
+@app.route('/admin/analytics/rollups/<level>/<node_id>', methods=['GET'])
+@login_required # Protect this route
+def get_attendance_rollups_for_admin(user, level=None, node_id=None):
+    """
+    Drill-down attendance rollups. Without a node: every faculty. With /<level>/<node_id>: that node and its
+    children one level down (faculty -> departments -> courses -> assignments).
+    Requires 'admin' role.
+    Query parameters: optional academic_year_id (default '*' = all years).
+    """
+    user_account_id_admin, role_admin, entity_id_admin = user # Unpack the admin user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_admin != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can view attendance rollups."}), 403
+
+    if level is not None and level not in ROLLUP_NAMES_SQL:
+        return jsonify({"error": f"Invalid level. Allowed: {', '.join(ROLLUP_NAMES_SQL)}."}), 400
+    academic_year_id = request.args.get('academic_year_id', ROLLUP_ALL_YEARS)
+
+    conn = None
+    cur = None
+    try:
+        conn = connect_db()
+        version = refresh_attendance_stats(conn)
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        if level is None:
+            return jsonify({"academic_year_id": academic_year_id, "stats_version": version,
+                            "node": None, "children": rollup_rows(cur, 'faculty', academic_year_id)}), 200
+
+        node = rollup_rows(cur, level, academic_year_id, node_id=node_id)
+        if not node:
+            return jsonify({"error": f"No attendance rollup for {level} {node_id} in academic year {academic_year_id}."}), 404
+        child_level = ROLLUP_CHILD_LEVEL.get(level)
+        children = rollup_rows(cur, child_level, academic_year_id, parent_id=node_id) if child_level else []
+        return jsonify({"academic_year_id": academic_year_id, "stats_version": version,
+                        "node": node[0], "children": children}), 200
+
+    except psycopg2.Error as e:
+        log.error("Database error reading attendance rollups: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred reading attendance rollups: %s", e)
+        return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+# --- Attendance Rollups Ends Here ---
+
+@app.route('/admin/attendance-records', methods=['GET'])
+@login_required # Protect this route
+def get_attendance_records_for_admin(user):
+    """
+    Retrieves all attendance records for the admin attendance grid, most recent first.
+    Requires 'admin' role.
+    Query parameters: optional session_id, student_id, status; format=columnar for the column-per-array shape.
+    """
+    user_account_id_requester, role_requester, entity_id_requester = user # Unpack the requesting user tuple
+
+    # --- Role Check: Ensure only admins can access this route ---
+    if role_requester != 'admin':
+        return jsonify({"error": "Access forbidden. Only admins can view attendance records."}), 403
+
+    conn = None
+    cur = None
+    try:
+        ensure_support_tables() # pendingdeletions hides soft-deleted rows
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
+
+        # Optional filtering by session, student or status (shared with the CSV export)
+        conditions, values = attendance_record_filters(request.args)
+        conditions += [soft_deleted_filter('attendance_session', 'atr.session_id'), soft_deleted_filter('student', 'atr.student_id')]
+        sql = f"SELECT atr.* FROM attendancerecords atr WHERE {' AND '.join(conditions)} ORDER BY atr.attendance_time DESC;"
+        cur.execute(sql, tuple(values))
+
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+        return jsonify(cur.fetchall()), 200
+
+    except psycopg2.Error as e:
+        log.error("Database error fetching attendance records for admin: %s", e)
+        return jsonify({"error": f"Database error: {e}"}), 500
+    except Exception as e:
+        log.exception("An unexpected error occurred fetching attendance records for admin: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -9619,7 +14961,7 @@ def get_attendance_record_details_for_admin(user, record_id):
     record_details = None
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
 
         # Select all relevant record details for the given record_id, join related tables
@@ -9669,11 +15011,11 @@ def get_attendance_record_details_for_admin(user, record_id):
         return jsonify(record_details), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching specific attendance record details: {e}")
+        log.error("Database error fetching specific attendance record details: %s", e)
         # Add checks for specific table/column names if needed
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching specific attendance record details: {e}")
+        log.exception("An unexpected error occurred fetching specific attendance record details: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -9738,7 +15080,7 @@ def create_attendance_record_for_admin(user):
     cur = None # Initialize cursor here
     conn = None # Initialize connection here
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Validate session_id exists (recommended before inserting)
@@ -9804,23 +15146,27 @@ def create_attendance_record_for_admin(user):
             "record_id": new_record_id # Return the generated ID
         }), 201 # 201 Created
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during attendance record creation: {e}")
+        log.error("Database integrity error during attendance record creation: %s", e)
         # This could happen due to duplicate (session_id, student_id) if not caught by manual check, or other constraints
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except (psycopg2.Error, ValueError, TypeError) as e: # Catch DB errors and parsing errors
         if conn:
             conn.rollback()
-        print(f"Database or data processing error during attendance record creation: {e}")
+        log.error("Database or data processing error during attendance record creation: %s", e)
         # Specific checks for e type might be needed for more granular error responses
         return jsonify({"error": f"Database or data processing error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance record creation: {e}")
+        log.exception("An unexpected error occurred during attendance record creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -9866,7 +15212,7 @@ def update_attendance_record_details_for_admin(user, record_id):
     cur_fetch = None # Cursor for fetching updated details
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor for executions
 
 
@@ -10009,23 +15355,27 @@ def update_attendance_record_details_for_admin(user, record_id):
         return jsonify(updated_record_details), 200 # Return updated details
 
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during attendance record update: {e}")
+        log.error("Database integrity error during attendance record update: %s", e)
         # This could happen if FK constraints fail despite validation, or if the unique constraint is violated
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except (psycopg2.Error, ValueError, TypeError) as e: # Catch DB errors and parsing errors
         if conn:
             conn.rollback()
-        print(f"Database or data processing error during attendance record update: {e}")
+        log.error("Database or data processing error during attendance record update: %s", e)
         # Specific checks for e type might be needed for more granular error responses
         return jsonify({"error": f"Database or data processing error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance record update: {e}")
+        log.exception("An unexpected error occurred during attendance record update: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -10052,7 +15402,7 @@ def delete_attendance_record_for_admin(user, record_id):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor() # Standard cursor
 
         # --- First, verify if the record exists ---
@@ -10077,22 +15427,26 @@ def delete_attendance_record_for_admin(user, record_id):
         conn.commit()
         return jsonify({"message": f"Attendance record {record_id} deleted successfully."}), 200 # Or 204 No Content
 
+    except psycopg2.errors.CheckViolation as e: # The academic year is closed
+        if conn:
+            conn.rollback()
+        return closed_year_response(e)
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during attendance record deletion: {e}")
+        log.error("Database integrity error during attendance record deletion: %s", e)
         # This shouldn't happen if no tables reference attendancerecords, but included for safety
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during attendance record deletion: {e}")
+        log.error("Database error during attendance record deletion: %s", e)
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during attendance record deletion: {e}")
+        log.exception("An unexpected error occurred during attendance record deletion: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -10146,7 +15500,7 @@ def create_notification_for_admin(user):
     conn = None
     cur = None
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+        conn = connect_db()
         cur = conn.cursor()
 
         # Validate FKs based on target_role
@@ -10210,20 +15564,20 @@ def create_notification_for_admin(user):
     except psycopg2.IntegrityError as e:
         if conn:
             conn.rollback()
-        print(f"Database integrity error during notification creation: {e}")
+        log.error("Database integrity error during notification creation: %s", e)
         # This could happen due to FK violation if not caught by manual check or other constraints
         return jsonify({"error": f"Database integrity error: {e}"}), 409 # 409 Conflict
 
     except psycopg2.Error as e:
         if conn:
             conn.rollback()
-        print(f"Database error during notification creation: {e}")
+        log.error("Database error during notification creation: %s", e)
         # This could happen if data types are wrong or other DB issues
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
         if conn:
             conn.rollback()
-        print(f"An unexpected error occurred during notification creation: {e}")
+        log.exception("An unexpected error occurred during notification creation: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
@@ -10251,8 +15605,8 @@ def list_all_notifications_for_admin(user):
     notifications_list = []
 
     try:
-        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) # Return rows as dictionaries
+        conn = connect_db()
+        cur = conn.cursor(cursor_factory=tabular_cursor_factory()) # Dict rows, or tuples for ?format=columnar
 
         # Select all notification details
         # Join useraccounts to show who created it (username and role)
@@ -10286,6 +15640,9 @@ def list_all_notifications_for_admin(user):
         # No WHERE clause needed to filter by target, as admin sees all
         cur.execute(sql)
 
+        if wants_columnar_format():
+            return columnar_response(cur), 200
+
         notifications_list = cur.fetchall()
 
         # Optional: Convert timestamps to string format for JSON if needed
@@ -10297,14 +15654,14 @@ def list_all_notifications_for_admin(user):
         return jsonify(notifications_list), 200
 
     except psycopg2.Error as e:
-        print(f"Database error fetching all notifications: {e}")
+        log.error("Database error fetching all notifications: %s", e)
         # Add checks for specific table/column names if needed
         error_message = str(e)
         if "relation \"" in error_message or "column \"" in error_message or "missing FROM-clause entry for table" in error_message:
             return jsonify({"error": "Configuration error: Database query error. Check table/column names and aliases."}), 500
         return jsonify({"error": f"Database error: {e}"}), 500
     except Exception as e:
-        print(f"An unexpected error occurred fetching all notifications: {e}")
+        log.exception("An unexpected error occurred fetching all notifications: %s", e)
         return jsonify({"error": f"An unexpected internal error occurred: {type(e).__name__} - {e}"}), 500
     finally:
         if cur:
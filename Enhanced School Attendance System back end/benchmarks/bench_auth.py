@@ -0,0 +1,60 @@
+"""
+Measures the overhead of @login_required per protected request.
+
+Run from the back end folder:
+    python benchmarks/bench_auth.py [iterations]
+
+"full decode" clears the verified-token cache before every call, which is what each request paid
+before tokens were cached; "cached" is the steady state for a token that has already been seen.
+The revocation refresh is pinned so no database is needed.
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jwt # noqa: E402
+import app as esas # noqa: E402
+
+
+def make_token():
+    issued_at = datetime.now(timezone.utc)
+    payload = {
+        'user_account_id': 'UA000001', 'role': 'admin', 'entity_id': 'ADM000001',
+        'iat': issued_at, 'exp': issued_at + timedelta(minutes=30), 'jti': 'bench-jti',
+    }
+    return jwt.encode(payload, esas.SECRET_KEY, algorithm='HS256')
+
+
+def time_calls(view, headers, iterations, clear_cache):
+    with esas.app.test_request_context('/bench', headers=headers):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            if clear_cache:
+                with esas._verified_tokens_lock:
+                    esas._verified_tokens.clear()
+            view()
+        return (time.perf_counter() - start) * 1e6 / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    esas.REVOCATION_REFRESH_SECONDS = 10 ** 9
+    esas._revoked_jtis_refreshed_at = time.monotonic()
+
+    @esas.login_required
+    def protected_view(user):
+        return user
+
+    headers = {'Authorization': f'Bearer {make_token()}'}
+    full = time_calls(protected_view, headers, iterations, clear_cache=True)
+    cached = time_calls(protected_view, headers, iterations, clear_cache=False)
+    print(f"iterations={iterations}")
+    print(f"full decode: {full:8.2f} us/request")
+    print(f"cached     : {cached:8.2f} us/request ({full / cached:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
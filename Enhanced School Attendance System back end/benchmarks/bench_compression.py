@@ -0,0 +1,82 @@
+"""
+Measures the response compression middleware on a payload shaped like GET /admin/students.
+
+Run from the back end folder:
+    python benchmarks/bench_compression.py [rows] [iterations]
+
+Reports body size and mean latency through the Flask test client for identity, gzip and
+(when the optional brotli package is installed) br, both cold (compressed bytes not cached
+yet) and warm (served from the ETag-keyed compressed body cache).
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as esas # noqa: E402
+from flask import jsonify # noqa: E402
+
+
+def build_student_rows(count):
+    return [
+        {
+            "student_id": f"STU{i:06d}",
+            "first_name": f"First{i % 97}",
+            "last_name": f"Last{i % 89}",
+            "matriculation_number": f"MAT/2024/{i:05d}",
+            "level": str(100 * (1 + i % 5)),
+            "intended_program": "B.Sc. Computer Science",
+            "email": f"student{i}@example.edu",
+            "contact_number": f"080{i:08d}",
+            "date_of_birth": "2003-01-01",
+            "gender": "Female" if i % 2 else "Male",
+            "admission_date": "2024-09-01T09:00:00+00:00",
+            "qr_code_data": f"ID:STU{i:06d},Name:First{i % 97} Last{i % 89},Matric:MAT/2024/{i:05d},Level:{100 * (1 + i % 5)},Dept:Computer Science",
+            "department_name": "Computer Science",
+            "user_account_username": f"student{i}",
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    payload = build_student_rows(rows)
+
+    @esas.app.route('/__bench/students')
+    def bench_students():
+        return jsonify(payload), 200
+
+    client = esas.app.test_client()
+    encodings = ['identity', 'gzip'] + (['br'] if esas.brotli is not None else [])
+    print(f"rows={rows} iterations={iterations}")
+    for encoding in encodings:
+        with esas._compressed_body_cache_lock:
+            esas._compressed_body_cache.clear()
+            esas._compressed_body_cache_bytes = 0
+        headers = {'Accept-Encoding': encoding}
+
+        start = time.perf_counter()
+        cold = client.get('/__bench/students', headers=headers)
+        cold_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            warm = client.get('/__bench/students', headers=headers)
+        warm_ms = (time.perf_counter() - start) * 1000 / iterations
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            revalidated = client.get('/__bench/students', headers={**headers, 'If-None-Match': warm.headers['ETag']})
+        revalidate_ms = (time.perf_counter() - start) * 1000 / iterations
+
+        print(
+            f"{encoding:>8}: bytes={len(cold.get_data()):>9} cold={cold_ms:8.2f}ms "
+            f"warm={warm_ms:8.2f}ms 304={revalidate_ms:8.2f}ms (status {revalidated.status_code})"
+        )
+
+
+if __name__ == '__main__':
+    main()
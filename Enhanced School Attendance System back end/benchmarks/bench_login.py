@@ -0,0 +1,59 @@
+"""
+Login-storm throughput for password verification.
+
+Run from the back end folder:
+    python benchmarks/bench_login.py [logins] [concurrency]
+
+Compares checking passwords on the request threads (what /login did before) with the
+per-worker verification pool, and reports how many attempts the pool shed with 503.
+Hash parameters follow PASSWORD_HASH_METHOD, so the cost of a parameter change can be
+measured by exporting a different method before running.
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as esas # noqa: E402
+
+
+def run_storm(check, logins, concurrency):
+    shed = 0
+
+    def attempt(_):
+        try:
+            return check()
+        except esas.PasswordVerificationBusy:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        results = list(threads.map(attempt, range(logins)))
+    elapsed = time.perf_counter() - start
+    shed = sum(1 for result in results if result is None)
+    return elapsed, shed
+
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    stored_hash = esas.hash_password('correct horse battery staple')
+    print(f"method={esas.PASSWORD_HASH_METHOD} logins={logins} concurrency={concurrency} "
+          f"pool_workers={esas.PASSWORD_POOL_WORKERS} max_pending={esas.PASSWORD_POOL_MAX_PENDING}")
+
+    inline_elapsed, _ = run_storm(
+        lambda: esas.check_password_hash(stored_hash, 'correct horse battery staple'), logins, concurrency)
+    print(f"request thread : {logins / inline_elapsed:8.1f} logins/s")
+
+    esas.verify_password(stored_hash, 'warm-up') # Start the pool processes outside the timing
+    pool_elapsed, shed = run_storm(
+        lambda: esas.verify_password(stored_hash, 'correct horse battery staple'), logins, concurrency)
+    served = logins - shed
+    print(f"process pool   : {served / pool_elapsed:8.1f} logins/s, {shed} shed with 503 "
+          f"({100.0 * shed / logins:.1f}%)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,568 @@
+"""
+End-to-end load test of a running back end with campus-shaped traffic.
+
+Start the app against a local Postgres first (e.g. gunicorn app:app --workers 4 --threads 8 --bind 127.0.0.1:8000),
+then run from the back end folder with an admin account in the environment:
+    export ESAS_ADMIN_USERNAME=admin ESAS_ADMIN_PASSWORD=secret
+    python benchmarks/load_campus.py seed [--students 500]
+    python benchmarks/load_campus.py run [--scenario scan_storm ...] [--duration 30] [--output results.json]
+    python benchmarks/load_campus.py compare before.json after.json
+    python benchmarks/load_campus.py cleanup
+
+"seed" creates a throwaway faculty, department, academic year, course, lecturer and N students (enrolled in the
+course) through the admin API, and writes their ids and the generated lecturer/student credentials to
+benchmarks/load_fixtures.json (gitignored). The admin password is never written there: admin_paging and cleanup read
+it from ESAS_ADMIN_PASSWORD again. "cleanup" deletes everything seed created (students, lecturer, course and academic
+year through /admin/bulk-delete, which also removes their sessions, records and enrollments) and then the fixtures.
+Only loopback base URLs are accepted unless --allow-remote is given, so a test run cannot hit production by accident.
+
+Scenarios (each runs for --duration seconds with its own number of virtual users):
+    scan_storm      lecturers' scanners posting /lecturer/sessions/<id>/mark-present back to back at class start;
+                    each student is scanned once per session, and a fresh session is opened when all have been
+    login_storm     students logging in at semester start (expect 429/503 once the rate limiter and password pool
+                    shed load; raise LOGIN_IP_BUCKET_CAPACITY / LOGIN_IP_REFILL_PER_SECOND on the server to
+                    measure raw login throughput instead)
+    dashboard_poll  logged-in students polling the dashboard endpoints with think time
+    admin_paging    admins paging through the eligibility list and loading the big admin lists
+
+Results are one JSON document (stdout, or --output) with p50/p95/p99/mean/max latency, throughput, status counts and
+error rate per scenario and per endpoint, plus the git commit, so runs can be diffed or compared with "compare".
+Only the standard library is used: the HTTP/1.1 keep-alive client below is deliberately minimal.
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import ssl
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urlsplit
+
+SCAN_SESSION_MINUTES = 30
+CLEANUP_CHUNK_SIZE = 1000
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_fixtures.json')
+STUDENT_DASHBOARD_PATHS = ('/student/profile', '/student/courses', '/student/schedule', '/student/attendance',
+                           '/student/notifications')
+ADMIN_LIST_PATHS = ('/admin/students', '/admin/courses', '/admin/attendance-sessions', '/admin/course-assignments')
+
+
+class TransportError(Exception):
+    pass
+
+
+class HttpConnection:
+    """One keep-alive HTTP/1.1 connection; reconnects when the server closed it."""
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, method, path, json_body=None, token=None):
+        """Returns (status, body bytes); raises TransportError on connection failures and timeouts."""
+        body = json.dumps(json_body).encode() if json_body is not None else b''
+        head = [f"{method} {self.prefix}{path} HTTP/1.1", f"Host: {self.host}:{self.port}", "Accept: application/json",
+                f"Content-Length: {len(body)}"]
+        if json_body is not None:
+            head.append("Content-Type: application/json")
+        if token:
+            head.append(f"Authorization: Bearer {token}")
+        payload = ("\r\n".join(head) + "\r\n\r\n").encode() + body
+
+        for attempt in (1, 2):
+            reused = self.writer is not None
+            try:
+                if not reused:
+                    self.reader, self.writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout)
+                self.writer.write(payload)
+                return await asyncio.wait_for(self._read_response(method), self.timeout)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+                await self.close()
+                if reused and attempt == 1:
+                    continue # The server dropped an idle keep-alive connection; retry once on a fresh one
+                raise TransportError(type(e).__name__) from e
+            except asyncio.TimeoutError as e:
+                await self.close()
+                raise TransportError('timeout') from e
+
+    async def _read_response(self, method):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed before the response")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass # Trailers
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, body
+
+
+class ScenarioStats:
+    def __init__(self):
+        self.endpoints = {} # label -> {"latencies": [...], "statuses": {status: count}}
+
+    def record(self, label, status, latency):
+        endpoint = self.endpoints.setdefault(label, {"latencies": [], "statuses": {}})
+        if latency is not None:
+            endpoint["latencies"].append(latency)
+        endpoint["statuses"][status] = endpoint["statuses"].get(status, 0) + 1
+
+    def summary(self, elapsed):
+        merged = ScenarioStats()
+        for endpoint in self.endpoints.values():
+            merged.endpoints.setdefault('*', {"latencies": [], "statuses": {}})
+            merged.endpoints['*']["latencies"].extend(endpoint["latencies"])
+            for status, count in endpoint["statuses"].items():
+                merged.endpoints['*']["statuses"][status] = merged.endpoints['*']["statuses"].get(status, 0) + count
+        result = summarize(merged.endpoints.get('*', {"latencies": [], "statuses": {}}), elapsed)
+        result["duration_s"] = round(elapsed, 2)
+        result["endpoints"] = {label: summarize(endpoint, elapsed) for label, endpoint in sorted(self.endpoints.items())}
+        return result
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-int(fraction * 1000) * len(sorted_values) // 1000)) # ceil(fraction * n) without float drift
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(endpoint, elapsed):
+    latencies = sorted(endpoint["latencies"])
+    statuses = endpoint["statuses"]
+    total = sum(statuses.values())
+    errors = sum(count for status, count in statuses.items() if status == 'transport_error' or int(status) >= 500)
+    shed = sum(count for status, count in statuses.items() if status in (429, 503))
+    non_2xx = sum(count for status, count in statuses.items() if status == 'transport_error' or not 200 <= int(status) < 300)
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+    return {
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+        "error_rate": round(errors / total, 4) if total else None, # 5xx and transport errors
+        "shed_rate": round(shed / total, 4) if total else None, # 429 from the rate limiter, 503 from a full pool
+        "non_2xx_rate": round(non_2xx / total, 4) if total else None,
+        "status_counts": {str(status): count for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))},
+    }
+
+
+async def timed(stats, connection, label, method, path, json_body=None, token=None):
+    """Sends one request, records it under `label`, and returns (status, parsed JSON or None)."""
+    started = time.perf_counter()
+    try:
+        status, body = await connection.request(method, path, json_body, token)
+    except TransportError:
+        stats.record(label, 'transport_error', None)
+        return None, None
+    stats.record(label, status, time.perf_counter() - started)
+    try:
+        return status, json.loads(body) if body else None
+    except ValueError:
+        return status, None
+
+
+async def login(connection, username, password):
+    status, body = await connection.request('POST', '/login', {"username": username, "password": password})
+    data = json.loads(body) if body else {}
+    if status != 200 or 'token' not in data:
+        raise SystemExit(f"Login as {username} failed with {status}: {data.get('error', body[:200])}")
+    return data['token']
+
+
+def admin_credentials(args):
+    """(username, password) of the admin account; the password only ever comes from the environment."""
+    password = os.environ.get('ESAS_ADMIN_PASSWORD')
+    if not args.admin_username or not password:
+        raise SystemExit("Set ESAS_ADMIN_USERNAME (or --admin-username) and ESAS_ADMIN_PASSWORD for the admin account.")
+    return args.admin_username, password
+
+
+def is_loopback_url(base_url):
+    host = urlsplit(base_url).hostname or ''
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+async def open_session(connection, token, assignment_id, minutes):
+    """Opens an attendance session on the assignment as its lecturer and returns the session JSON."""
+    status, body = await connection.request('POST', '/lecturer/sessions', {"assignment_id": assignment_id,
+                                                                         "duration_minutes": minutes}, token)
+    data = json.loads(body) if body else {}
+    if status not in (200, 201):
+        raise SystemExit(f"Opening a session for {assignment_id} failed with {status}: {data.get('error', body[:200])}")
+    return data['session']
+
+
+# --- Scenarios: setup(args, fixtures) -> shared state; user(state, connection, stats, deadline) loops until deadline ---
+
+async def setup_scan_storm(args, fixtures):
+    connection = HttpConnection(args.base_url, args.timeout)
+    token = await login(connection, fixtures['lecturer']['username'], fixtures['lecturer']['password'])
+    state = {"token": token, "connection": connection, "lock": asyncio.Lock(), "pool": [], "session_id": None}
+    await next_scan_session(fixtures, state)
+    return state
+
+
+async def next_scan_session(fixtures, state):
+    """Opens a fresh session and refills the pool of students not yet scanned into it, in random order."""
+    session = await open_session(state['connection'], state['token'], fixtures['assignment_id'], SCAN_SESSION_MINUTES)
+    state['session_id'] = session['session_id']
+    state['pool'] = random.sample(fixtures['students'], len(fixtures['students']))
+
+
+async def scan_storm_user(args, fixtures, state, connection, stats, deadline):
+    # Students are drawn without replacement: a second scan of a student is a "already Present" no-op, not a write
+    while time.perf_counter() < deadline:
+        if not state['pool']:
+            async with state['lock']:
+                if not state['pool']:
+                    await next_scan_session(fixtures, state)
+        student = state['pool'].pop()
+        await timed(stats, connection, 'POST /lecturer/sessions/<id>/mark-present', 'POST',
+                    f"/lecturer/sessions/{state['session_id']}/mark-present", {"student_id": student['student_id']},
+                    state['token'])
+
+
+async def login_storm_user(args, fixtures, state, connection, stats, deadline):
+    while time.perf_counter() < deadline:
+        student = random.choice(fixtures['students'])
+        await timed(stats, connection, 'POST /login', 'POST', '/login',
+                    {"username": student['username'], "password": student['password']})
+
+
+async def setup_dashboard_poll(args, fixtures):
+    connection = HttpConnection(args.base_url, args.timeout)
+    students = random.sample(fixtures['students'], min(args.users or 50, len(fixtures['students'])))
+    tokens = [await login(connection, student['username'], student['password']) for student in students]
+    await connection.close()
+    return {"tokens": tokens}
+
+
+async def dashboard_poll_user(args, fixtures, state, connection, stats, deadline):
+    token = random.choice(state['tokens'])
+    await asyncio.sleep(random.uniform(0, args.think)) # Spread the first polls out
+    while time.perf_counter() < deadline:
+        for path in STUDENT_DASHBOARD_PATHS:
+            await timed(stats, connection, f"GET {path}", 'GET', path, token=token)
+        await asyncio.sleep(random.uniform(0.5, 1.5) * args.think)
+
+
+async def setup_admin_paging(args, fixtures):
+    connection = HttpConnection(args.base_url, args.timeout)
+    token = await login(connection, *admin_credentials(args))
+    await connection.close()
+    return {"token": token}
+
+
+async def admin_paging_user(args, fixtures, state, connection, stats, deadline):
+    token = state['token']
+    while time.perf_counter() < deadline:
+        page = 1
+        while time.perf_counter() < deadline:
+            status, data = await timed(stats, connection, 'GET /admin/eligibility', 'GET',
+                                       f"/admin/eligibility?page={page}&per_page=50", token=token)
+            if status != 200 or not data or page * data['per_page'] >= data['total']:
+                break
+            page += 1
+            await asyncio.sleep(random.uniform(0.5, 1.5) * args.think)
+        for path in ADMIN_LIST_PATHS:
+            if time.perf_counter() >= deadline:
+                break
+            await timed(stats, connection, f"GET {path}", 'GET', path, token=token)
+            await asyncio.sleep(random.uniform(0.5, 1.5) * args.think)
+
+
+SCENARIOS = {
+    # name: (setup, user loop, default virtual users, default think time in seconds)
+    'scan_storm': (setup_scan_storm, scan_storm_user, 20, 0.0),
+    'login_storm': (None, login_storm_user, 50, 0.0),
+    'dashboard_poll': (setup_dashboard_poll, dashboard_poll_user, 200, 2.0),
+    'admin_paging': (setup_admin_paging, admin_paging_user, 5, 0.5),
+}
+
+
+async def run_scenario(name, args, fixtures):
+    setup, user, default_users, default_think = SCENARIOS[name]
+    scenario_args = argparse.Namespace(**vars(args))
+    scenario_args.users = args.users or default_users
+    scenario_args.think = default_think if args.think is None else args.think
+    state = await setup(scenario_args, fixtures) if setup else {}
+
+    stats = ScenarioStats()
+    connections = [HttpConnection(args.base_url, args.timeout) for _ in range(scenario_args.users)]
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(user(scenario_args, fixtures, state, connection, stats, deadline) for connection in connections))
+    elapsed = time.perf_counter() - started
+    for connection in connections + ([state['connection']] if 'connection' in state else []):
+        await connection.close()
+
+    result = stats.summary(elapsed)
+    result["virtual_users"] = scenario_args.users
+    result["think_s"] = scenario_args.think
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    with open(args.fixtures) as fixtures_file:
+        fixtures = json.load(fixtures_file)
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "base_url": args.base_url,
+        "duration_s": args.duration,
+        "scenarios": {},
+    }
+    for name in args.scenario or list(SCENARIOS):
+        print(f"running {name} for {args.duration}s ...", file=sys.stderr)
+        result = results["scenarios"][name] = await run_scenario(name, args, fixtures)
+        latency = result["latency_ms"]
+        print(f"  {result['requests']} requests, {result['throughput_rps']} req/s, p50 {latency['p50']} ms, "
+              f"p95 {latency['p95']} ms, p99 {latency['p99']} ms, error rate {result['error_rate']}, shed rate {result['shed_rate']}, "
+              f"statuses {result['status_counts']}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+# --- Seeding: throwaway campus data through the admin API ---
+
+async def seed(args):
+    tag = datetime.now().strftime('%m%d%H%M%S')
+    password = f"LoadTest-{tag}!"
+    connection = HttpConnection(args.base_url, args.timeout)
+    admin_token = await login(connection, *admin_credentials(args))
+
+    async def create(path, body, key, conn=connection, token=admin_token):
+        status, response = await conn.request('POST', path, body, token)
+        data = json.loads(response) if response else {}
+        if status not in (200, 201):
+            raise SystemExit(f"POST {path} failed with {status}: {data.get('error', response[:200])}")
+        return data.get(key) if key else data
+
+    today = date.today()
+    faculty_id = await create('/admin/faculties', {"faculty_name": f"Load Test Faculty {tag}"}, 'faculty_id')
+    department_id = await create('/admin/departments', {"department_name": f"Load Test Department {tag}",
+                                                        "faculty_id": faculty_id}, 'department_id')
+    academic_year_id = await create('/admin/academic-years', {
+        "term_name": f"Load Test {tag}", "year": today.year,
+        "start_date": (today - timedelta(days=30)).isoformat(), "end_date": (today + timedelta(days=120)).isoformat(),
+    }, 'academic_year_id')
+    course_id = await create('/admin/courses', {"course_code": f"LT{tag}", "course_title": "Load Test Course",
+                                                "credits": 3, "department_id": department_id}, 'course_id')
+    lecturer = {"username": f"lt_lecturer_{tag}", "password": password}
+    lecturer_id = await create('/admin/lecturers', {
+        "first_name": "Load", "last_name": "Lecturer", "email": f"lt_lecturer_{tag}@example.com",
+        "contact_number": "0000000000", "employee_id": f"LT{tag}", "department_id": department_id,
+        "proposed_username": lecturer['username'], "proposed_password": password,
+    }, 'lecturer_id')
+
+    students = []
+    pending = list(range(args.students))
+
+    async def create_students():
+        worker_connection = HttpConnection(args.base_url, args.timeout)
+        while pending:
+            n = pending.pop()
+            username = f"lt_student_{tag}_{n:05d}"
+            student_id = await create('/admin/students', {
+                "first_name": "Load", "last_name": f"Student{n:05d}", "email": f"{username}@example.com",
+                "contact_number": "0000000000", "date_of_birth": "2004-01-01", "gender": "Other", "level": "100",
+                "intended_program": "Load Testing", "department_id": department_id,
+                "matriculation_number": f"LT{tag}{n:05d}", "academic_year_id": academic_year_id,
+                "proposed_username": username, "proposed_password": password,
+            }, 'student_id', conn=worker_connection)
+            students.append({"student_id": student_id, "username": username, "password": password})
+        await worker_connection.close()
+    await asyncio.gather(*(create_students() for _ in range(8)))
+    print(f"created {len(students)} students", file=sys.stderr)
+
+    assignment_id = f"LT{tag}"
+    await create('/admin/course-assignments', {"assignment_id": assignment_id, "course_id": course_id,
+                                               "lecturer_id": lecturer_id, "academic_year_id": academic_year_id,
+                                               "semester": "First"}, None)
+    await create('/enrollments/bulk', {"cohort": {"student_ids": [student['student_id'] for student in students]},
+                                       "course_ids": [course_id], "academic_year_id": academic_year_id}, None)
+    await connection.close()
+
+    fixtures = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "base_url": args.base_url,
+        "lecturer": {"lecturer_id": lecturer_id, **lecturer},
+        "faculty_id": faculty_id, "department_id": department_id, "academic_year_id": academic_year_id,
+        "course_id": course_id, "assignment_id": assignment_id,
+        "students": students,
+    }
+    with open(args.fixtures, 'w') as fixtures_file:
+        json.dump(fixtures, fixtures_file, indent=2)
+    print(f"fixtures written to {args.fixtures}", file=sys.stderr)
+
+
+async def cleanup(args):
+    """Deletes everything seed created, then the fixtures file. Already deleted entities are skipped."""
+    with open(args.fixtures) as fixtures_file:
+        fixtures = json.load(fixtures_file)
+    connection = HttpConnection(args.base_url, args.timeout)
+    token = await login(connection, *admin_credentials(args))
+
+    async def delete(method, path, body=None):
+        status, response = await connection.request(method, path, body, token)
+        if status not in (200, 202, 204, 404):
+            data = json.loads(response) if response else {}
+            raise SystemExit(f"{method} {path} failed with {status}: {data.get('error', response[:200])}")
+        return status
+
+    async def bulk_delete(entity_type, ids):
+        for start in range(0, len(ids), CLEANUP_CHUNK_SIZE):
+            chunk = ids[start:start + CLEANUP_CHUNK_SIZE]
+            if await delete('POST', '/admin/bulk-delete', {"entity_type": entity_type, "ids": chunk, "mode": "hard"}) == 404:
+                # The whole chunk is refused when some ids are gone (an earlier, interrupted cleanup): go one by one
+                for entity_id in chunk:
+                    await delete('POST', '/admin/bulk-delete', {"entity_type": entity_type, "ids": [entity_id], "mode": "hard"})
+
+    # Courses and lecturers take their assignments, sessions and records with them
+    await bulk_delete('student', [student['student_id'] for student in fixtures['students']])
+    await bulk_delete('course', [fixtures['course_id']])
+    if fixtures['lecturer'].get('lecturer_id') is not None:
+        await bulk_delete('lecturer', [fixtures['lecturer']['lecturer_id']])
+    await bulk_delete('academic_year', [fixtures['academic_year_id']])
+    await delete('DELETE', f"/admin/departments/{fixtures['department_id']}")
+    await delete('DELETE', f"/admin/faculties/{fixtures['faculty_id']}")
+    await connection.close()
+
+    os.remove(args.fixtures)
+    print(f"deleted {len(fixtures['students'])} students and the rest of the load test data; removed {args.fixtures}",
+          file=sys.stderr)
+
+
+def compare(before_path, after_path):
+    """Prints per-scenario throughput and latency changes between two result files."""
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f"{before.get('git_commit')} -> {after.get('git_commit')}")
+    for name, new in after["scenarios"].items():
+        old = before["scenarios"].get(name)
+        if old is None:
+            continue
+        cells = []
+        for label, old_value, new_value in (
+            ("rps", old["throughput_rps"], new["throughput_rps"]),
+            ("p50", old["latency_ms"]["p50"], new["latency_ms"]["p50"]),
+            ("p95", old["latency_ms"]["p95"], new["latency_ms"]["p95"]),
+            ("p99", old["latency_ms"]["p99"], new["latency_ms"]["p99"]),
+            ("err", old["error_rate"], new["error_rate"]),
+            ("shed", old.get("shed_rate"), new.get("shed_rate")),
+        ):
+            change = f" ({100.0 * (new_value - old_value) / old_value:+.1f}%)" if old_value and new_value is not None else ""
+            cells.append(f"{label} {old_value} -> {new_value}{change}")
+        print(f"{name:15} " + ", ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--base-url', default=os.environ.get('ESAS_BASE_URL', 'http://127.0.0.1:8000'))
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES)
+    parser.add_argument('--timeout', type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument('--admin-username', default=os.environ.get('ESAS_ADMIN_USERNAME'),
+                        help="admin account for seed, cleanup and admin_paging (password: ESAS_ADMIN_PASSWORD)")
+    parser.add_argument('--allow-remote', action='store_true', help="allow a base URL that is not a loopback address")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help="create throwaway campus data through the admin API")
+    seed_parser.add_argument('--students', type=int, default=500)
+
+    run_parser = commands.add_parser('run', help="run the scenarios and report results as JSON")
+    run_parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help="repeatable; default: all")
+    run_parser.add_argument('--duration', type=float, default=30.0, help="seconds per scenario")
+    run_parser.add_argument('--users', type=int, help="virtual users per scenario (default: per-scenario)")
+    run_parser.add_argument('--think', type=float, help="mean think time in seconds (default: per-scenario)")
+    run_parser.add_argument('--output', help="write the JSON results here instead of stdout")
+
+    compare_parser = commands.add_parser('compare', help="compare two result files")
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+
+    commands.add_parser('cleanup', help="delete the data seed created and the fixtures file")
+
+    args = parser.parse_args()
+    if args.command != 'compare' and not args.allow_remote and not is_loopback_url(args.base_url):
+        parser.error(f"{args.base_url} is not a loopback address; pass --allow-remote to load test it anyway")
+    if args.command == 'seed':
+        asyncio.run(seed(args))
+    elif args.command == 'run':
+        asyncio.run(run(args))
+    elif args.command == 'cleanup':
+        asyncio.run(cleanup(args))
+    else:
+        compare(args.before, args.after)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,20 @@
 // Configurable API base URL for local and Render environments
 const API_BASE_URL = window.location.hostname === 'localhost' ? 'http://localhost:5000' : 'https://esas.onrender.com';
 
+// Opt-in: log wire vs decoded size for every API call so compression gains show up on real page loads.
+// Enable with localStorage.setItem('debugApiTiming', '1') and reload. The backend sends Timing-Allow-Origin for this.
+if ('PerformanceObserver' in window && localStorage.getItem('debugApiTiming') === '1') {
+    new PerformanceObserver(list => {
+        list.getEntries()
+            .filter(entry => entry.name.startsWith(API_BASE_URL))
+            .forEach(entry => {
+                const saved = entry.decodedBodySize ? (100 * (1 - entry.encodedBodySize / entry.decodedBodySize)).toFixed(1) : '0.0';
+                console.debug(`[api timing] ${entry.name.replace(API_BASE_URL, '')}: ${entry.duration.toFixed(0)} ms, ` +
+                    `${entry.transferSize} B transferred, ${entry.decodedBodySize} B decoded (${saved}% saved)`);
+            });
+    }).observe({ type: 'resource', buffered: true });
+}
+
 document.addEventListener('DOMContentLoaded', () => {
     // Retrieve JWT token from localStorage
     const token = localStorage.getItem('token');
@@ -835,7 +849,8 @@ document.addEventListener('DOMContentLoaded', () => {
         error.classList.add('hidden');
 
         try {
-            const response = await fetch(`${API_BASE_URL}/admin/attendance-records`, {
+            // Columnar format: keys are sent once, values arrive as one array per column
+            const response = await fetch(`${API_BASE_URL}/admin/attendance-records?format=columnar`, {
                 headers: {
                     'Content-Type': 'application/json',
                     'Authorization': `Bearer ${token}`
@@ -846,26 +861,34 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (response.status === 403) throw new Error('Forbidden: Insufficient permissions');
                 throw new Error(`HTTP error! Status: ${response.status}`);
             }
-            const records = await response.json();
-            tableBody.innerHTML = '';
-            records.forEach(record => {
-                const row = document.createElement('tr');
-                row.innerHTML = `
-                    <td>${record.id}</td>
-                    <td>${record.student_id || '-'}</td>
-                    <td>${record.course_id || '-'}</td>
-                    <td>${record.session_id || '-'}</td>
-                    <td>${record.date}</td>
-                    <td>${record.status}</td>
-                    <td>${record.remarks || '-'}</td>
+            const { row_count: rowCount, data } = await response.json();
+            const column = name => data[name] || [];
+            const ids = column('record_id');
+            const studentIds = column('student_id');
+            const courseIds = column('course_id');
+            const sessionIds = column('session_id');
+            const times = column('attendance_time');
+            const statuses = column('status');
+            const remarks = column('remarks');
+            const rows = new Array(rowCount);
+            for (let i = 0; i < rowCount; i++) {
+                rows[i] = `<tr>
+                    <td>${ids[i]}</td>
+                    <td>${studentIds[i] || '-'}</td>
+                    <td>${courseIds[i] || '-'}</td>
+                    <td>${sessionIds[i] || '-'}</td>
+                    <td>${times[i]}</td>
+                    <td>${statuses[i]}</td>
+                    <td>${remarks[i] || '-'}</td>
                     <td>
-                        <button class="action-button view" data-action="view-attendance" data-id="${record.id}">View</button>
-                        <button class="action-button edit" data-action="edit-attendance" data-id="${record.id}">Edit</button>
-                        <button class="action-button delete" data-action="delete-attendance" data-id="${record.id}">Delete</button>
+                        <button class="action-button view" data-action="view-attendance" data-id="${ids[i]}">View</button>
+                        <button class="action-button edit" data-action="edit-attendance" data-id="${ids[i]}">Edit</button>
+                        <button class="action-button delete" data-action="delete-attendance" data-id="${ids[i]}">Delete</button>
                     </td>
-                `;
-                tableBody.appendChild(row);
-            });
+                </tr>`;
+            }
+            // One DOM write for the whole grid instead of one appendChild per record
+            tableBody.innerHTML = rows.join('');
         } catch (err) {
             error.classList.remove('hidden');
             error.textContent = 'Failed to load attendance records: ' + err.message;